@@ -8,4 +8,8 @@ __version__ = "0.9-dev"
 __maintainer__ = "Jai Ram Rideout"
 __email__ = "jai.rideout@gmail.com"
 
-__all__ = ['format', 'parse', 'run', 'util']
+__all__ = ['artifacts', 'autoscale', 'backend', 'filters', 'format',
+           'history', 'lock', 'logarchive', 'matrix', 'metrics', 'outbox',
+           'parse', 'pool', 'preflight', 'profiling', 'progress', 'report',
+           'results', 'run', 'serve', 'snapshot', 'stage', 'state', 'steps',
+           'trace', 'util']
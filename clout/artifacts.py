@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to collect the files that test suites leave behind on the cluster.
+
+A test suite's 'artifacts' option lists globs (relative to the directory that
+the test suite's commands start in) matching files such as coverage reports,
+JUnit XML reports, or generated plots. Once the test suites have finished
+(before the cluster is terminated), the matching files of every test suite
+are gathered under remote_artifacts_dir on the cluster and streamed back as a
+single gzipped tar archive:
+
+    <remote_artifacts_dir>/<test suite>/<path>    link to a matching file
+
+The archive is then extracted locally, one directory per test suite.
+"""
+
+from os.path import isabs, join, normpath
+from re import compile
+from tarfile import open as open_tarfile, TarError
+
+from clout.state import get_safe_filename
+from clout.util import create_dir
+
+# Where artifacts are gathered on the cluster, relative to the directory that
+# commands are run from (the user's home directory on a StarCluster cluster).
+remote_artifacts_dir = '.clout_artifacts'
+
+# Globs are placed in shell commands unquoted (so that the shell expands
+# them), so only characters that are safe there are allowed.
+_glob_re = compile(r'^[A-Za-z0-9_.*?\[\]/+-]+$')
+
+def get_artifacts_dir_name(label):
+    """Returns the name of the directory that a test suite's artifacts are
+    in.
+    """
+    return get_safe_filename(label)
+
+def parse_artifact_globs(globs):
+    """Parses the value of a test suite's 'artifacts' option.
+
+    Returns the list of globs. Raises a ValueError if a glob is absolute,
+    refers to a parent directory, or contains characters other than letters,
+    digits, and '_.*?[]/+-'.
+
+    Arguments:
+        globs - a comma-separated list of globs
+    """
+    parsed_globs = []
+    for glob in globs.split(','):
+        glob = glob.strip().rstrip('/')
+        if not glob:
+            continue
+        if _glob_re.match(glob) is None or isabs(glob) or \
+           '..' in glob.split('/'):
+            raise ValueError("Invalid artifact glob '%s'. Globs must be "
+                             "relative paths below the directory that the "
+                             "test suite's commands start in, and may only "
+                             "contain letters, digits, and '_.*?[]/+-'." %
+                             glob)
+        parsed_globs.append(glob)
+    if not parsed_globs:
+        raise ValueError("At least one artifact glob must be provided.")
+    return parsed_globs
+
+def build_collect_artifacts_cmd(test_suites_artifacts):
+    """Returns the command that gathers the test suites' artifacts on the
+    cluster and writes them to stdout as a gzipped tar archive.
+
+    The command is run from the same directory as remote_artifacts_dir. Files
+    that no longer exist (or were never created) are skipped, so the command
+    only fails if the archive can't be written.
+
+    Arguments:
+        test_suites_artifacts - a list of 3-element tuples containing a test
+            suite's label, the directory (relative to the directory that the
+            command is run from) that the test suite's commands start in, and
+            the test suite's globs (the output of parse_artifact_globs())
+    """
+    link_cmds = []
+    for label, start_dir, globs in test_suites_artifacts:
+        link_dir = '$top/%s/%s' % (remote_artifacts_dir,
+                                   get_artifacts_dir_name(label))
+        link_cmds.append('(cd %s && for f in %s; do d="%s/$f"; '
+                         'if [ -e "$f" ] && [ ! -e "$d" ]; then '
+                         'mkdir -p "$(dirname "$d")" && ln -s "$PWD/$f" '
+                         '"$d"; fi; done)' % (start_dir, ' '.join(globs),
+                                              link_dir))
+    link_cmds.append('tar czhf - -C %s .' % remote_artifacts_dir)
+    return 'top="$PWD" && rm -rf %s && mkdir %s && { %s; }' % (
+            remote_artifacts_dir, remote_artifacts_dir, '; '.join(link_cmds))
+
+def extract_artifacts(archive_fp, out_dir):
+    """Extracts the artifacts streamed back from the cluster.
+
+    Returns a dictionary mapping each test suite's artifacts directory name
+    (see get_artifacts_dir_name()) to a list of the [path, size in bytes] of
+    each of its artifacts, sorted by path. Only regular files are extracted,
+    and members that would be written outside of out_dir are skipped. An
+    archive that can't be read (e.g. because it was only partially
+    transferred) is treated as empty.
+
+    Arguments:
+        archive_fp - the gzipped tar archive written by the command from
+            build_collect_artifacts_cmd()
+        out_dir - the directory to extract each test suite's artifacts
+            under (created if it doesn't exist)
+    """
+    artifacts = {}
+    try:
+        archive = open_tarfile(archive_fp, 'r:gz')
+    except (EOFError, IOError, TarError):
+        return artifacts
+
+    try:
+        for member in archive:
+            name = normpath(member.name)
+            if not member.isfile() or isabs(name) or \
+               name.split('/')[0] == '..' or '/' not in name:
+                continue
+            dir_name, path = name.split('/', 1)
+
+            out_fp = join(out_dir, name)
+            create_dir(join(out_dir, name.rsplit('/', 1)[0]))
+            in_f = archive.extractfile(member)
+            out_f = open(out_fp, 'wb')
+            try:
+                while True:
+                    data = in_f.read(65536)
+                    if not data:
+                        break
+                    out_f.write(data)
+            finally:
+                out_f.close()
+            artifacts.setdefault(dir_name, []).append([path, member.size])
+    except (EOFError, IOError, TarError):
+        # Keep whatever was extracted before the archive was cut off.
+        pass
+    finally:
+        archive.close()
+
+    for dir_artifacts in artifacts.values():
+        dir_artifacts.sort()
+    return artifacts
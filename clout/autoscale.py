@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to pick the size of a run's cluster from its test suites' history.
+
+Instead of always starting the number of nodes in the cluster template, a run
+can be given a deadline: the number of minutes that its test suites should
+take to run. Each test suite's duration is predicted from how long it usually
+takes (see clout.history), and the cluster is started with the fewest nodes
+that are predicted to finish the test suites by the deadline. Test suites are
+run on the nodes in order, each starting on the next node that is free, and a
+node is removed from the cluster once there are no test suites left for it to
+run (the master node is kept until the end).
+
+A run's cost is measured in node-hours: the number of hours that each node
+was running test suites (or waiting to be removed), summed over the nodes.
+"""
+
+from clout.history import get_usual_duration
+
+def predict_durations(test_suites, run_history, cluster_tag=None,
+                      run_id=None):
+    """Returns the number of seconds that each test suite is predicted to
+    take, or None for test suites that have no history.
+
+    Arguments:
+        test_suites - the output of clout.parse.parse_config_file()
+        run_history - the clout.history.RunHistory of past runs, or None if
+            there is no history
+        cluster_tag - same as for clout.history.RunHistory.get_runs()
+        run_id - the ID of the run to exclude from the history (see
+            clout.history.RunHistory.get_runs())
+    """
+    if run_history is None:
+        return [None] * len(test_suites)
+    return [get_usual_duration(run_history.get_test_suite_history(
+            label, cluster_tag, run_id)) for label, cmd in test_suites]
+
+def plan_cluster_size(test_suites, durations, deadline, max_nodes):
+    """Picks the number of nodes to start a run's cluster with.
+
+    Returns a dictionary describing the plan: the number of nodes
+    ('num_nodes'), the 'deadline' and 'max_nodes' it was made for, the
+    predicted number of seconds the test suites will take
+    ('predicted_duration') and the predicted cost in node-hours
+    ('predicted_cost'), whether the test suites are predicted to finish by
+    the deadline ('meets_deadline'), and the labels of the test suites that
+    had no history ('unknown_suites'). Test suites without history are
+    assumed to take the whole deadline, so each gets a node to itself. If no
+    number of nodes up to max_nodes meets the deadline, max_nodes are used.
+
+    Arguments:
+        test_suites - the output of clout.parse.parse_config_file()
+        durations - the output of predict_durations()
+        deadline - the number of minutes that the test suites should take to
+            run
+        max_nodes - the largest number of nodes to start the cluster with
+    """
+    if deadline <= 0:
+        raise ValueError("The deadline (in minutes) must be greater than "
+                         "zero.")
+    if max_nodes < 1:
+        raise ValueError("The maximum cluster size must be at least one "
+                         "node.")
+
+    deadline_secs = deadline * 60
+    known_durations = [deadline_secs if duration is None else duration
+                       for duration in durations]
+    for num_nodes in range(1, max(1, min(max_nodes, len(test_suites))) + 1):
+        finish_times = simulate_schedule(known_durations, num_nodes)
+        if max(finish_times) <= deadline_secs:
+            break
+    predicted_duration = max(finish_times)
+    return {'num_nodes': num_nodes, 'deadline': deadline,
+            'max_nodes': max_nodes, 'predicted_duration': predicted_duration,
+            'predicted_cost': get_cluster_cost(finish_times),
+            'meets_deadline': predicted_duration <= deadline_secs,
+            'unknown_suites': [label for (label, cmd), duration in
+                               zip(test_suites, durations)
+                               if duration is None]}
+
+def simulate_schedule(durations, num_nodes):
+    """Returns the number of seconds after the test suites start that each
+    node runs out of test suites to run.
+
+    Test suites are run in order, each on the node that is free first (the
+    node listed first, if several are). The first node is the master.
+
+    Arguments:
+        durations - the number of seconds that each test suite takes
+        num_nodes - the number of nodes that run test suites
+    """
+    finish_times = [0.0] * num_nodes
+    for duration in durations:
+        node_index = finish_times.index(min(finish_times))
+        finish_times[node_index] += duration
+    return finish_times
+
+def get_cluster_cost(finish_times):
+    """Returns the number of node-hours that a cluster ran test suites for.
+
+    The master node runs until the last test suite finishes, and every other
+    node until it is removed.
+
+    Arguments:
+        finish_times - the number of seconds after the test suites started
+            that each node ran out of test suites to run (or was removed),
+            master first
+    """
+    if not finish_times:
+        return 0.0
+    return (max(finish_times) + sum(finish_times[1:])) / 3600
+
+def get_node_name(node_index):
+    """Returns the name of a node in a cluster (the first node is the master).
+    """
+    if node_index == 0:
+        return 'master'
+    return 'node%03d' % node_index
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to build the commands that manage clusters and run test suites.
+
+A backend knows how to start a cluster (with a given number of nodes, which
+may be spot instances), run a command on one of its nodes, copy files to and
+from it (including syncing local directories to it with rsync), check whether
+a node is still reachable, add and remove nodes, and terminate it. Backends
+only build command strings; the commands
+themselves are always run by clout.util.CommandExecutor so that logging and
+timeouts behave the same way regardless of where the test suites are executed.
+"""
+
+from os.path import abspath, join
+from pipes import quote
+
+class StarClusterBackend(object):
+    """Backend that runs test suites on an Amazon EC2 cluster via StarCluster.
+    """
+
+    def __init__(self, sc_config_fp, cluster_template=None, user='root',
+                 sc_exe_fp='starcluster'):
+        """Initializes a new StarCluster backend.
+
+        Arguments:
+            sc_config_fp - the starcluster config filepath that will be used to
+                start/terminate the remote cluster
+            cluster_template - the starcluster cluster template to use. If not
+                provided, the default cluster template in the starcluster
+                config file will be used
+            user - the user who the commands should be run as on the remote
+                cluster
+            sc_exe_fp - path to the starcluster executable
+        """
+        self.sc_config_fp = sc_config_fp
+        self.cluster_template = cluster_template
+        self.user = user
+        self.sc_exe_fp = sc_exe_fp
+
+    def cluster_key(self):
+        """Returns a tuple identifying the kind of cluster this backend boots.
+
+        Two backends with equal cluster keys boot interchangeable clusters, so
+        a cluster started by one can be reused by the other.
+        """
+        return ('starcluster', self.sc_config_fp, self.cluster_template,
+                self.sc_exe_fp)
+
+    def build_start_cmd(self, cluster_tag, cluster_size=None, spot_bid=None):
+        """Returns the command that starts a cluster with the given tag.
+
+        If cluster_size is provided, the cluster is started with that many
+        nodes instead of the number in the cluster template. If spot_bid is
+        provided, the nodes other than the master are spot instances, bid for
+        at that maximum price (in dollars per hour).
+        """
+        sc_start_cmd = "%s -c %s start " % (self.sc_exe_fp, self.sc_config_fp)
+        if self.cluster_template is not None:
+            sc_start_cmd += "-c %s " % self.cluster_template
+        if cluster_size is not None:
+            sc_start_cmd += "-s %d " % cluster_size
+        if spot_bid is not None:
+            sc_start_cmd += "-b %s " % str(spot_bid)
+        sc_start_cmd += "%s" % cluster_tag
+        return sc_start_cmd
+
+    def build_run_cmd(self, cluster_tag, cmd, node=None):
+        """Returns the command that runs cmd on one of the cluster's nodes.
+
+        cmd is run on the master node unless the name of another node (e.g.
+        'node001') is provided.
+        """
+        # To have this command work without getting prompted to accept the
+        # new host, the user must have 'StrictHostKeyChecking no' in their SSH
+        # config (on the local machine). TODO: try to get starcluster devs to
+        # add this feature to sshmaster.
+        if node is None or node == 'master':
+            return "%s -c %s sshmaster -u %s %s '%s'" % (self.sc_exe_fp,
+                    self.sc_config_fp, self.user, cluster_tag, cmd)
+        return "%s -c %s sshnode -u %s %s %s '%s'" % (self.sc_exe_fp,
+                self.sc_config_fp, self.user, cluster_tag, node, cmd)
+
+    def build_put_cmd(self, cluster_tag, local_fp, remote_fp):
+        """Returns the command that copies a local file or directory to the
+        cluster's master node.
+
+        Relative remote paths are relative to the user's home directory (the
+        directory that commands run by build_run_cmd() start in). If
+        remote_fp is an existing directory, local_fp is copied into it.
+        """
+        return "%s -c %s put -u %s %s %s %s" % (self.sc_exe_fp,
+                self.sc_config_fp, self.user, cluster_tag, quote(local_fp),
+                quote(remote_fp))
+
+    def build_get_cmd(self, cluster_tag, remote_fp, local_fp):
+        """Returns the command that copies a file or directory on the
+        cluster's master node to this machine.
+
+        Relative remote paths are treated the same way as by build_put_cmd().
+        If local_fp is an existing directory, remote_fp is copied into it.
+        """
+        return "%s -c %s get -u %s %s %s %s" % (self.sc_exe_fp,
+                self.sc_config_fp, self.user, cluster_tag, quote(remote_fp),
+                quote(local_fp))
+
+    def build_sync_cmd(self, cluster_tag, local_fps, remote_dir):
+        """Returns the command that syncs local files or directories into a
+        directory on the cluster's master node in a single transfer.
+
+        Only the differences between each local directory and its copy
+        already on the cluster (if any) are transferred, and files that no
+        longer exist locally are removed from the copy. Symlinks to
+        directories are copied as the directories they point to. rsync must
+        be installed on this machine and on the master node. Relative remote
+        paths are treated the same way as by build_put_cmd().
+        """
+        remote_shell = "%s -c %s sshmaster -u %s" % (self.sc_exe_fp,
+                self.sc_config_fp, self.user)
+        return "rsync -az --delete --copy-dirlinks -e %s %s %s" % (
+                quote(remote_shell), ' '.join(map(quote, local_fps)),
+                quote('%s:%s/' % (cluster_tag, remote_dir)))
+
+    def build_check_node_cmd(self, cluster_tag, node):
+        """Returns the command that succeeds if a node (other than the
+        master) is still running and reachable.
+        """
+        return self.build_run_cmd(cluster_tag, 'true', node)
+
+    def build_add_node_cmd(self, cluster_tag, node, spot_bid=None):
+        """Returns the command that adds a node named node to the cluster.
+
+        If spot_bid is provided, the node is a spot instance (see
+        build_start_cmd()).
+        """
+        sc_add_node_cmd = "%s -c %s addnode -a %s " % (self.sc_exe_fp,
+                                                       self.sc_config_fp, node)
+        if spot_bid is not None:
+            sc_add_node_cmd += "-b %s " % str(spot_bid)
+        return sc_add_node_cmd + cluster_tag
+
+    def build_remove_node_cmd(self, cluster_tag, node):
+        """Returns the command that removes a node (other than the master)
+        from the cluster and terminates it.
+        """
+        # The second -c tells starcluster not to prompt us for confirmation.
+        return "%s -c %s removenode -c %s %s" % (self.sc_exe_fp,
+                self.sc_config_fp, cluster_tag, node)
+
+    def build_terminate_cmd(self, cluster_tag):
+        """Returns the command that terminates the cluster with the given tag.
+        """
+        # The second -c tells starcluster not to prompt us for termination
+        # confirmation.
+        return "%s -c %s terminate -c %s" % (self.sc_exe_fp, self.sc_config_fp,
+                                             cluster_tag)
+
+
+class LocalBackend(object):
+    """Stand-in backend that 'boots' clusters as directories on this machine.
+
+    Each cluster is a directory named after its cluster tag under root_dir, and
+    commands are run with that directory as the working directory (every
+    node of a cluster shares it, and nodes are never really added or
+    removed). This backend costs nothing to run, which makes it useful for
+    testing Clout itself (and for trying out a test suite config file before
+    paying for EC2 time).
+
+    A node other than the master can be preempted (as if it were a spot
+    instance that was reclaimed) with the command built by
+    build_preempt_node_cmd(), or by a command running on it creating the file
+    .clout_preempted_$CLOUT_NODE in the cluster's directory. Commands that
+    are running on a preempted node, or that are run on it later, exit with
+    255 (as ssh does when it loses its connection), and the node is
+    unreachable until it is added back to the cluster.
+    """
+
+    def __init__(self, root_dir, shell='/bin/sh'):
+        """Initializes a new local backend.
+
+        Arguments:
+            root_dir - the directory that cluster directories will be created
+                under
+            shell - the shell that test suite commands will be run with
+        """
+        self.root_dir = abspath(root_dir)
+        self.shell = shell
+
+    def cluster_key(self):
+        """Returns a tuple identifying the kind of cluster this backend boots.
+        """
+        return ('local', self.root_dir, self.shell)
+
+    def get_cluster_dir(self, cluster_tag):
+        """Returns the directory that represents the given cluster."""
+        return join(self.root_dir, cluster_tag)
+
+    def get_preempted_fp(self, cluster_tag, node):
+        """Returns the file whose existence marks a node as preempted."""
+        return join(self.get_cluster_dir(cluster_tag),
+                    '.clout_preempted_%s' % node)
+
+    def build_start_cmd(self, cluster_tag, cluster_size=None, spot_bid=None):
+        """Returns the command that starts a cluster with the given tag.
+
+        The cluster's size and spot bid are ignored.
+        """
+        return "mkdir -p %s" % quote(self.get_cluster_dir(cluster_tag))
+
+    def build_run_cmd(self, cluster_tag, cmd, node=None):
+        """Returns the command that runs cmd on the cluster.
+
+        Every node runs commands in the cluster's directory. Commands run on
+        a node other than the master have the node's name in $CLOUT_NODE,
+        and exit with 255 if the node is (or becomes) preempted.
+        """
+        run_cmd = "cd %s && %s -c %s" % (
+                quote(self.get_cluster_dir(cluster_tag)), self.shell,
+                quote(cmd))
+        if node is None or node == 'master':
+            return run_cmd
+        preempted_fp = quote(self.get_preempted_fp(cluster_tag, node))
+        return ("test ! -e %s && CLOUT_NODE=%s && export CLOUT_NODE && %s; "
+                "ret=$?; test ! -e %s || exit 255; exit $ret" % (preempted_fp,
+                quote(node), run_cmd, preempted_fp))
+
+    def build_put_cmd(self, cluster_tag, local_fp, remote_fp):
+        """Returns the command that copies a local file or directory to the
+        cluster.
+
+        Relative remote paths are relative to the cluster's directory.
+        """
+        return "cp -R %s %s" % (quote(local_fp), quote(
+                join(self.get_cluster_dir(cluster_tag), remote_fp)))
+
+    def build_get_cmd(self, cluster_tag, remote_fp, local_fp):
+        """Returns the command that copies a file or directory on the
+        cluster to this machine.
+
+        Relative remote paths are relative to the cluster's directory.
+        """
+        return "cp -R %s %s" % (quote(join(self.get_cluster_dir(cluster_tag),
+                                           remote_fp)), quote(local_fp))
+
+    def build_sync_cmd(self, cluster_tag, local_fps, remote_dir):
+        """Returns the command that syncs local files or directories into a
+        directory on the cluster.
+
+        Behaves the same way as StarClusterBackend.build_sync_cmd(). Relative
+        remote paths are relative to the cluster's directory.
+        """
+        return "rsync -a --delete --copy-dirlinks %s %s" % (
+                ' '.join(map(quote, local_fps)),
+                quote(join(self.get_cluster_dir(cluster_tag), remote_dir) +
+                      '/'))
+
+    def build_check_node_cmd(self, cluster_tag, node):
+        """Returns the command that succeeds if a node hasn't been
+        preempted.
+        """
+        return "test ! -e %s" % quote(self.get_preempted_fp(cluster_tag,
+                                                            node))
+
+    def build_add_node_cmd(self, cluster_tag, node, spot_bid=None):
+        """Returns the command that adds a node named node to the cluster.
+
+        A preempted node is added back (i.e. it is no longer preempted).
+        """
+        return "rm -f %s" % quote(self.get_preempted_fp(cluster_tag, node))
+
+    def build_preempt_node_cmd(self, cluster_tag, node):
+        """Returns the command that preempts a node of the cluster."""
+        return "touch %s" % quote(self.get_preempted_fp(cluster_tag, node))
+
+    def build_remove_node_cmd(self, cluster_tag, node):
+        """Returns the command that removes a node from the cluster.
+
+        Nodes share the cluster's directory, so there is nothing to remove.
+        """
+        return "true"
+
+    def build_terminate_cmd(self, cluster_tag):
+        """Returns the command that terminates the cluster with the given tag.
+        """
+        return "rm -rf %s" % quote(self.get_cluster_dir(cluster_tag))
+
+
+# Maps the names that backends are stored under (e.g. in a run's persisted
+# state) to their classes.
+backend_classes = {'starcluster': StarClusterBackend, 'local': LocalBackend}
+
+def get_backend_params(backend):
+    """Returns a JSON-serializable description of a backend.
+
+    The backend can be rebuilt from the description with load_backend().
+    """
+    for name, backend_class in backend_classes.items():
+        if backend.__class__ is backend_class:
+            return {'backend': name, 'options': dict(vars(backend))}
+    raise ValueError("Unrecognized backend class '%s'." %
+                     backend.__class__.__name__)
+
+def load_backend(backend_params):
+    """Rebuilds a backend from the output of get_backend_params()."""
+    try:
+        backend_class = backend_classes[backend_params['backend']]
+    except KeyError:
+        raise ValueError("Unrecognized backend '%s'." %
+                         backend_params['backend'])
+    return backend_class(**dict((str(key), val) for key, val in
+                                backend_params['options'].items()))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to collapse the noise in a command's output as it is captured.
+
+Much of what a test suite prints is noise: the file listings of 'tar zxvf',
+the progress bars of 'wget', and other lines that are redrawn or repeated
+many times. An OutputFilter is applied to each of a command's output streams
+as the output arrives (see clout.util.CommandExecutor), so only the filtered
+output is kept and logged. The filters are given as a comma-separated list,
+e.g. 'progress,repeats,cap:200':
+
+    progress    a line that is redrawn with carriage returns (e.g. a
+                progress bar) only keeps its final state
+    repeats     a run of similar lines keeps its first and last lines, with
+                the number of lines in between. Lines are similar if they
+                are identical apart from their numbers and spacing, or if
+                they only differ in the paths that they end with and the
+                paths are under the same top-level directory (e.g. the
+                lines of a 'tar zxvf' file listing). Lines that start
+                failure blocks (see 'cap') are never collapsed
+    cap:<n>     each step of the output (see clout.steps) keeps its first
+                and last n/2 lines, with the number of lines in between. If
+                n is omitted, default_cap is used. Failure blocks (a
+                Python traceback, or a test's 'FAIL:' or 'ERROR:' report)
+                are kept wherever they are in the step, up to their first
+                blank line (and at most n lines each), so that the
+                failures that the email reports are in its log. A
+                'FAILED' summary line (e.g. pytest's) is kept on its own
+
+'none' doesn't filter the output at all.
+"""
+
+from collections import deque
+from re import compile
+
+from clout.steps import parse_step_marker
+
+# The names of the filters.
+output_filter_names = ['progress', 'repeats', 'cap']
+
+# The number of lines that each step keeps if 'cap' isn't given a number.
+default_cap = 200
+
+# Lines that only differ in their numbers (and spacing) are similar.
+_number_re = compile(r'\d+')
+
+# The lines that start failure blocks, which the cap keeps.
+_failure_re = compile(r'^(Traceback \(most recent call last\):|'
+                      r'(FAIL|ERROR|FAILED)[: ])')
+
+# A path, and the top-level directory that it is under.
+_path_re = compile(r'^(?:\.?/)*([^/]+)/')
+
+def parse_output_filters(filters):
+    """Parses a comma-separated list of output filters.
+
+    Returns a dictionary with whether the 'progress' and 'repeats' filters
+    are used and the number of lines that the 'cap' filter keeps of each step
+    (None if it isn't used), or None if filters is 'none'. Raises a
+    ValueError if a filter isn't recognized.
+
+    Arguments:
+        filters - the list of filters (e.g. 'progress,repeats,cap:200')
+    """
+    if filters.strip() == 'none':
+        return None
+
+    parsed_filters = {'progress': False, 'repeats': False, 'cap': None}
+    for output_filter in filters.split(','):
+        name, sep, arg = output_filter.strip().partition(':')
+        if name == 'cap':
+            try:
+                cap = int(arg) if sep else default_cap
+            except ValueError:
+                cap = 0
+            if cap <= 0:
+                raise ValueError("Invalid output filter '%s'. The cap must "
+                                 "be a number of lines greater than zero." %
+                                 output_filter.strip())
+            parsed_filters['cap'] = cap
+        elif name in output_filter_names and not sep:
+            parsed_filters[name] = True
+        else:
+            raise ValueError("Unrecognized output filter '%s'. Valid filters "
+                             "are %s, or 'none'." % (output_filter.strip(),
+                             ', '.join(output_filter_names)))
+    return parsed_filters
+
+
+class OutputFilter(object):
+    """Filters one of a command's output streams as it arrives."""
+
+    def __init__(self, filters):
+        """Initializes a new filter for an output stream.
+
+        Arguments:
+            filters - the output of parse_output_filters()
+        """
+        self.filters = filters
+        self._partial_line = ''
+
+        # The run of similar lines that is being collapsed: the key that
+        # its lines share, its last line, and its number of lines.
+        self._run = None
+
+        # The current step's lines: how many of its first lines were kept,
+        # its last lines (kept until the step ends), and how many of its
+        # lines were left out.
+        self._head_lines = 0
+        self._tail_lines = deque()
+        self._omitted_lines = 0
+
+        # The number of lines of the current failure block that may still be
+        # kept (0 if the current line isn't in one).
+        self._failure_lines = 0
+
+    def feed(self, data):
+        """Returns the filtered output for output that just arrived.
+
+        Output is filtered a line at a time, so the returned output may be
+        empty (e.g. if no line was completed), and lines may be held back
+        until a run of similar lines or a step ends.
+
+        Arguments:
+            data - the output that arrived, with its original line endings
+        """
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        if self.filters['progress']:
+            # Only the last redraw of the current line is needed, so a
+            # progress bar that is redrawn many times doesn't pile up.
+            redraws = self._partial_line.split('\r')
+            if len(redraws) > 2:
+                last_redraw = ([redraw for redraw in redraws[:-1]
+                                if redraw] or [''])[-1]
+                self._partial_line = last_redraw + '\r' + redraws[-1]
+
+        filtered = []
+        for line in lines:
+            for redrawn_line in self._resolve_redraws(line, '\n'):
+                filtered.extend(self._filter_line(redrawn_line))
+        return ''.join(filtered)
+
+    def close(self):
+        """Returns the rest of the filtered output once the stream closed.
+
+        The last line is passed on even if it doesn't end in a newline.
+        """
+        filtered = []
+        if self._partial_line:
+            for line in self._resolve_redraws(self._partial_line, ''):
+                filtered.extend(self._filter_line(line))
+            self._partial_line = ''
+        filtered.extend(self._cap_lines(self._end_run()))
+        filtered.extend(self._end_step())
+        return ''.join(filtered)
+
+    def _resolve_redraws(self, line, line_ending):
+        """Returns the lines that a line containing carriage returns shows.
+
+        With the 'progress' filter, only the line's final state is shown.
+        Otherwise, each carriage return starts a new line (as if it were a
+        newline).
+        """
+        if line.endswith('\r') and line_ending:
+            line = line[:-1]
+        redraws = line.split('\r')
+        if self.filters['progress']:
+            redraws = [redraw for redraw in redraws if redraw][-1:] or ['']
+        return [redraw + '\n' for redraw in redraws[:-1]] + \
+               [redraws[-1] + line_ending]
+
+    def _filter_line(self, line):
+        """Returns the filtered lines that are ready once a line arrives."""
+        if not self.filters['repeats']:
+            return self._cap_lines([line])
+
+        # Failure lines are never collapsed, even if they are similar (e.g.
+        # pytest's 'FAILED' summary lines), so that every failure is logged.
+        if _failure_re.match(line):
+            return self._cap_lines(self._end_run() + [line])
+
+        key = _get_similarity_key(line)
+        if self._run is not None and self._run[0] == key:
+            self._run[1] = line
+            self._run[2] += 1
+            return []
+        lines = self._end_run()
+        self._run = [key, line, 1]
+        return self._cap_lines(lines + [line])
+
+    def _end_run(self):
+        """Returns the lines that end the current run of similar lines."""
+        if self._run is None:
+            return []
+        key, last_line, num_lines = self._run
+        self._run = None
+        if num_lines == 1:
+            return []
+        lines = []
+        if num_lines > 2:
+            lines.append('[%d similar line(s) omitted]\n' % (num_lines - 2))
+        return lines + [last_line]
+
+    def _cap_lines(self, lines):
+        """Returns the lines that the current step keeps."""
+        cap = self.filters['cap']
+        if cap is None:
+            return lines
+
+        kept_lines = []
+        for line in lines:
+            failure_match = _failure_re.match(line)
+            if failure_match is not None:
+                # The lines held back so far come before the failure block.
+                # A summary line (e.g. pytest's 'FAILED test_a.py::test_b')
+                # is a block of its own.
+                kept_lines.extend(self._end_omission())
+                self._failure_lines = cap
+                if failure_match.group(2) == 'FAILED':
+                    self._failure_lines = 1
+            elif not line.strip():
+                self._failure_lines = 0
+
+            if parse_step_marker(line) is not None:
+                kept_lines.extend(self._end_step())
+                kept_lines.append(line)
+            elif self._failure_lines:
+                self._failure_lines -= 1
+                kept_lines.append(line)
+            elif self._head_lines < cap - cap // 2:
+                self._head_lines += 1
+                kept_lines.append(line)
+            else:
+                self._tail_lines.append(line)
+                if len(self._tail_lines) > cap // 2:
+                    self._tail_lines.popleft()
+                    self._omitted_lines += 1
+        return kept_lines
+
+    def _end_step(self):
+        """Returns the last lines of the current step once it ends."""
+        lines = self._end_omission()
+        self._head_lines = 0
+        self._failure_lines = 0
+        return lines
+
+    def _end_omission(self):
+        """Returns the lines that were held back (and the number of lines
+        that were left out before them).
+        """
+        lines = []
+        if self._omitted_lines:
+            lines.append('[%d line(s) omitted]\n' % self._omitted_lines)
+        lines.extend(self._tail_lines)
+        self._tail_lines = deque()
+        self._omitted_lines = 0
+        return lines
+
+def _get_similarity_key(line):
+    """Returns a key that similar lines share (see 'repeats')."""
+    words = line.split()
+    if words:
+        path_match = _path_re.match(words[-1])
+        if path_match is not None:
+            words[-1] = path_match.group(1) + '/'
+    return _number_re.sub('0', ' '.join(words))
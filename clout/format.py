@@ -11,6 +11,26 @@ __email__ = "jai.rideout@gmail.com"
 
 """Module to format data structures for human consumption."""
 
+from time import localtime, strftime
+
+from clout.matrix import get_axis_combinations, get_variant_label
+
+# Describes each phase of a run (see clout.progress.run_phases).
+_phase_descriptions = {'waiting_for_cluster': 'Waiting for a pooled cluster',
+                       'setup': 'Starting the cluster',
+                       'staging': 'Staging local directories',
+                       'matrix_setup': 'Running the shared matrix setup',
+                       'test_suites': 'Running the test suites',
+                       'collecting': 'Collecting profiles and artifacts',
+                       'teardown': 'Terminating the cluster',
+                       'reporting': 'Sending the results'}
+
+# Describes what replaced each lost spot node (see
+# clout.run._execute_test_suites()).
+_replacement_descriptions = {'spot': 'replaced by a spot instance',
+                             'on_demand': 'replaced by an on-demand instance',
+                             None: 'not replaced'}
+
 def format_email_summary(test_suites_status):
     """Formats a string suitable for the body of an email message.
 
@@ -33,3 +53,503 @@ def format_email_summary(test_suites_status):
     if summary != '':
         summary += '\n'
     return summary
+
+def format_duration(seconds):
+    """Formats a number of seconds as a short human-readable duration.
+
+    Returns a string such as '0.25s', '45s', '3m 05s', or '2h 01m 09s'.
+    Durations under 10 seconds keep two decimal places. Returns '-' if seconds
+    is None (e.g. the duration is unknown).
+    """
+    if seconds is None:
+        return '-'
+    if seconds < 10 and seconds != int(seconds):
+        return '%.2fs' % seconds
+
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return '%dh %02dm %02ds' % (hours, minutes, seconds)
+    elif minutes:
+        return '%dm %02ds' % (minutes, seconds)
+    else:
+        return '%ds' % seconds
+
+def format_size(num_bytes):
+    """Formats a number of bytes as a short human-readable size.
+
+    Returns a string such as '512 B', '1.5 KB', or '2.3 GB'. Returns '-' if
+    num_bytes is None (e.g. the size is unknown).
+    """
+    if num_bytes is None:
+        return '-'
+    size = float(num_bytes)
+    for unit in 'B', 'KB', 'MB', 'GB':
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    if unit == 'B':
+        return '%d B' % size
+    return '%.1f %s' % (size, unit)
+
+def format_test_results_summary(test_suites_tests, max_failures=20):
+    """Formats the failing and slowest individual tests of each test suite.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if there are no individual test results to report.
+
+    Arguments:
+        test_suites_tests - a list of 2-element tuples, where the first
+            element is the test suite label and the second element is the
+            summary of its individual test results (see
+            clout.results.summarize_test_results()), or None if the test
+            suite's results weren't parsed
+        max_failures - the maximum number of failing tests to list per test
+            suite
+    """
+    failures = ''
+    slowest = ''
+    for label, tests in test_suites_tests:
+        if tests is None:
+            continue
+
+        if tests['failures']:
+            num_tests = sum(tests['counts'].values())
+            failures += '%s (%d of %d tests):\n' % (label,
+                                                    len(tests['failures']),
+                                                    num_tests)
+            for name, status in tests['failures'][:max_failures]:
+                failures += '    %s: %s\n' % (status.upper(), name)
+            if len(tests['failures']) > max_failures:
+                failures += '    ... and %d more\n' % (len(tests['failures']) -
+                                                     max_failures)
+
+        if tests['slowest']:
+            slowest += '%s:\n' % label
+            for name, duration in tests['slowest']:
+                slowest += '    %-11s %s\n' % (format_duration(duration), name)
+
+    summary = ''
+    if failures:
+        summary += 'Failing tests:\n\n%s\n' % failures
+    if slowest:
+        summary += 'Slowest tests:\n\n%s\n' % slowest
+    return summary
+
+def format_test_suite_regressions(test_suite_regressions):
+    """Formats the test suites that took much longer than they usually do.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if no test suites regressed.
+
+    Arguments:
+        test_suite_regressions - a list of 3-element lists containing a test
+            suite's label, its duration, and its usual duration (in seconds)
+    """
+    regressions = ''
+    for label, duration, usual_duration in test_suite_regressions:
+        regressions += '%s: %s (usually %s)\n' % (label,
+                format_duration(duration), format_duration(usual_duration))
+
+    if regressions:
+        regressions = ('Test suites that took much longer than usual:\n\n'
+                       '%s\n' % regressions)
+    return regressions
+
+def format_test_regressions(test_suites_regressions):
+    """Formats the tests that took much longer than they usually do.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if no tests regressed.
+
+    Arguments:
+        test_suites_regressions - a list of 2-element tuples, where the first
+            element is the test suite label and the second element is the
+            output of clout.history.find_test_regressions()
+    """
+    regressions = ''
+    for label, test_regressions in test_suites_regressions:
+        if test_regressions:
+            regressions += '%s:\n' % label
+            for name, duration, usual_duration in test_regressions:
+                regressions += '    %s: %s (usually %s)\n' % (name,
+                        format_duration(duration),
+                        format_duration(usual_duration))
+
+    if regressions:
+        regressions = ('Tests that took much longer than usual:\n\n%s\n' %
+                       regressions)
+    return regressions
+
+def format_profiles_summary(test_suites_profiles, max_hotspots=5):
+    """Formats the resource usage and hotspots of each profiled test suite.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if no test suites were profiled.
+
+    Arguments:
+        test_suites_profiles - a list of 2-element tuples, where the first
+            element is the test suite label and the second element is the
+            summary of its profile (see clout.profiling.summarize_profile()),
+            or None if the test suite wasn't profiled
+        max_hotspots - the maximum number of hotspots to list per test suite
+    """
+    profiles = ''
+    for label, profile in test_suites_profiles:
+        if profile is None:
+            continue
+
+        profiles += '%s:\n' % label
+        resources = profile['resources']
+        if resources is None:
+            profiles += '    Resource usage was not recorded.\n'
+        else:
+            max_rss_kb = resources['max_rss_kb']
+            profiles += ('    Peak memory: %s, CPU time: %s user, %s system, '
+                         'file system inputs/outputs: %s/%s\n' % (
+                         format_size(max_rss_kb and max_rss_kb * 1024),
+                         format_duration(resources['user_time']),
+                         format_duration(resources['system_time']),
+                         _format_count(resources['fs_inputs']),
+                         _format_count(resources['fs_outputs'])))
+
+        if profile['hotspots']:
+            profiles += ('    Python hotspots (time in function, total time, '
+                         'calls):\n')
+            for function, num_calls, tot_time, cum_time in \
+                    profile['hotspots'][:max_hotspots]:
+                profiles += '        %-9s %-9s %-9d %s\n' % (
+                        format_duration(tot_time), format_duration(cum_time),
+                        num_calls, function)
+
+    if profiles:
+        profiles = 'Profiles:\n\n%s\n' % profiles
+    return profiles
+
+def format_steps_summary(test_suites_steps, max_steps=20):
+    """Formats how long each step of each test suite took.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if no test suites' output marked any steps.
+
+    Arguments:
+        test_suites_steps - a list of 2-element tuples, where the first
+            element is the test suite label and the second element is the
+            list of its steps (see clout.steps.StepTimeline.get_steps())
+        max_steps - the maximum number of steps to list per test suite
+    """
+    steps_summary = ''
+    for label, steps in test_suites_steps:
+        if not steps:
+            continue
+
+        steps_summary += '%s:\n' % label
+        for step in steps[:max_steps]:
+            steps_summary += '    %-9s %s\n' % (
+                    format_duration(step['duration']), step['name'])
+        if len(steps) > max_steps:
+            steps_summary += '    ... and %d more step(s)\n' % (
+                    len(steps) - max_steps)
+
+    if steps_summary:
+        steps_summary = 'Steps:\n\n%s\n' % steps_summary
+    return steps_summary
+
+def format_artifacts_summary(test_suites_artifacts, collection,
+                             max_artifacts=10):
+    """Formats the artifacts that were collected from each test suite.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if no test suites have artifacts.
+
+    Arguments:
+        test_suites_artifacts - a list of 2-element tuples, where the first
+            element is the test suite label and the second element is a list
+            of the [path, size in bytes] of each of its artifacts, or None if
+            the test suite doesn't have an 'artifacts' option
+        collection - a dictionary containing the 'size' (in bytes, or None if
+            unknown) of the compressed archive that the artifacts were
+            transferred in and the 'duration' of the transfer (in seconds, or
+            None)
+        max_artifacts - the maximum number of artifacts to list per test
+            suite
+    """
+    artifacts = ''
+    for label, test_suite_artifacts in test_suites_artifacts:
+        if test_suite_artifacts is None:
+            continue
+
+        listed = ['%s (%s)' % (path, format_size(size))
+                  for path, size in test_suite_artifacts[:max_artifacts]]
+        if len(test_suite_artifacts) > max_artifacts:
+            listed.append('and %d more' %
+                          (len(test_suite_artifacts) - max_artifacts))
+        artifacts += '%s: %s\n' % (label, ', '.join(listed) or 'none found')
+
+    if artifacts:
+        artifacts = 'Artifacts (%s transferred in %s):\n\n%s\n' % (
+                format_size(collection['size']),
+                format_duration(collection['duration']), artifacts)
+    return artifacts
+
+def format_progress_event(event):
+    """Formats a single progress event (see clout.progress) as one line."""
+    name = event['event']
+    if name == 'run_started':
+        msg = 'Run %s started (test suites: %s)' % (event.get('run_id'),
+                ', '.join(event.get('test_suites', [])) or 'none')
+    elif name == 'phase_changed':
+        msg = _phase_descriptions.get(event['phase'], event['phase'])
+    elif name == 'suite_started':
+        msg = '%s started' % event['label']
+    elif name == 'output':
+        msg = '%s: %s of output (%d lines): %s' % (event['label'],
+                format_size(event['bytes']), event['lines'],
+                event['last_line'])
+    elif name == 'suite_interrupted':
+        msg = '%s interrupted: %s was lost after %s' % (event['label'],
+                event['node'], format_duration(event['duration']))
+    elif name == 'suite_finished':
+        msg = '%s finished: %s (%s)' % (event['label'],
+                format_test_suite_status(event['status']),
+                format_duration(event['duration']))
+    elif name == 'run_finished':
+        msg = 'Run finished' if event['succeeded'] else 'Run stopped early'
+    else:
+        msg = name
+    return '[%s] %s' % (strftime('%H:%M:%S', localtime(event['time'])), msg)
+
+def format_progress_summary(summary):
+    """Formats where a run is, as summarized by
+    clout.progress.summarize_progress().
+    """
+    lines = ['Run %s: %s' % (summary['run_id'], 'finished'
+             if summary['run_finished'] else _phase_descriptions.get(
+             summary['phase'], 'not started').lower())]
+    if summary['running'] is not None:
+        lines.append('Running: %s (for %s, last activity %s ago)' % (
+                summary['running'], format_duration(summary['running_for']),
+                format_duration(summary['idle_for'])))
+    if summary['finished_suites']:
+        lines.append('Finished: %s' % ', '.join(
+                ['%s (%s)' % (label, format_test_suite_status(status))
+                 for label, status in summary['finished_suites']]))
+    if summary['remaining_suites'] and not summary['run_finished']:
+        lines.append('Remaining: %s' % ', '.join(summary['remaining_suites']))
+    return '\n'.join(lines) + '\n'
+
+def format_pool_status(status):
+    """Formats the clusters in the cluster pool and the runs waiting for
+    one, as returned by clout.pool.ClusterPool.status().
+    """
+    lines = ['Clusters: %d (%d instance(s))' % (len(status['clusters']),
+                                                status['instances'])]
+    for cluster in status['clusters']:
+        line = '    %s: %s, %d node(s), up for %s' % (cluster['cluster_tag'],
+                cluster['state'], cluster['num_nodes'],
+                format_duration(cluster['running_for']))
+        if cluster['run_id'] is not None:
+            line += ' (run %s)' % cluster['run_id']
+        lines.append(line)
+    lines.append('Waiting runs: %d' % len(status['waiting']))
+    for waiter in status['waiting']:
+        lines.append('    %s: %d node(s), waiting for %s' % (
+                waiter['run_id'], waiter['num_nodes'],
+                format_duration(waiter['waiting_for'])))
+    return '\n'.join(lines) + '\n'
+
+def format_preflight_results(results):
+    """Formats the results of a run's preflight checks, as returned by
+    clout.preflight.run_preflight_checks().
+
+    Each check is listed with whether it passed and how long it took, and the
+    error of each check that failed is listed below it.
+    """
+    lines = []
+    for result in results:
+        if result['duration'] is None:
+            duration = 'unfinished'
+        else:
+            duration = '%.2f seconds' % result['duration']
+        lines.append('%s: %s (%s)' % (result['name'],
+                     'failed' if result['error'] is not None else 'passed',
+                     duration))
+        if result['error'] is not None:
+            lines.extend(['    %s' % line
+                          for line in result['error'].split('\n')])
+    return '\n'.join(lines) + '\n'
+
+def format_matrix_summary(matrix, statuses):
+    """Formats the statuses of a matrix test suite's variants as a grid.
+
+    Each row is a combination of the values of every axis but the last, and
+    each column is a value of the last axis (a matrix with a single axis is
+    shown as a single column). Returns a string suitable for the body of an
+    email message.
+
+    Arguments:
+        matrix - one of the matrices returned by
+            clout.matrix.expand_matrices()
+        statuses - a dictionary mapping each variant's label to its status
+            (see format_test_suite_status()). Variants that are missing are
+            shown as not run
+    """
+    label = matrix['label']
+    axes = matrix['axes']
+    if len(axes) == 1:
+        name, vals = axes[0]
+        rows = [['%s=%s' % (name, val),
+                 _format_variant_status(label, [[name, val]], statuses)]
+                for val in vals]
+    else:
+        col_name, col_vals = axes[-1]
+        rows = [[''] + ['%s=%s' % (col_name, val) for val in col_vals]]
+        for row_values in get_axis_combinations(axes[:-1]):
+            rows.append([', '.join(['%s=%s' % (name, val)
+                                    for name, val in row_values])] +
+                        [_format_variant_status(label,
+                                row_values + [[col_name, val]], statuses)
+                         for val in col_vals])
+
+    widths = [max([len(row[col]) for row in rows])
+              for col in range(len(rows[0]))]
+    grid = '\n'.join(['  '.join([cell.ljust(width) for cell, width in
+                                 zip(row, widths)]).rstrip() for row in rows])
+    return '%s:\n\n%s\n\n' % (label, grid)
+
+def format_cluster_plan_summary(cluster_plan):
+    """Formats how an autoscaled cluster was sized and what it cost.
+
+    Returns a string suitable for the body of an email message.
+
+    Arguments:
+        cluster_plan - the cluster plan in a run summary (see
+            clout.run._execute_commands_and_build_email())
+    """
+    summary = ('Cluster size: %d node(s), to run the test suites within %s '
+               'minute(s)' % (cluster_plan['num_nodes'],
+                              str(cluster_plan['deadline'])))
+    if not cluster_plan['meets_deadline']:
+        summary += (' (not predicted to be possible with up to %d node(s))' %
+                    cluster_plan['max_nodes'])
+    summary += '\n    Predicted: %s, %s\n' % (
+            format_duration(cluster_plan['predicted_duration']),
+            format_node_hours(cluster_plan['predicted_cost']))
+    if cluster_plan['actual_duration'] is not None:
+        summary += '    Actual: %s, %s\n' % (
+                format_duration(cluster_plan['actual_duration']),
+                format_node_hours(cluster_plan['actual_cost']))
+    if cluster_plan['removed_nodes']:
+        summary += '    Idle nodes removed early: %s\n' % ', '.join(
+                cluster_plan['removed_nodes'])
+    # Plans made before spot instances were supported have no spot bid.
+    if cluster_plan.get('spot_bid') is not None:
+        summary += '    Spot instances: bid $%s per hour' % str(
+                cluster_plan['spot_bid'])
+        if cluster_plan.get('lost_nodes'):
+            summary += ', lost %s' % ', '.join(['%s (%s)' % (lost['node'],
+                    _replacement_descriptions[lost['replacement']])
+                    for lost in cluster_plan['lost_nodes']])
+        summary += '\n'
+    if cluster_plan['unknown_suites']:
+        summary += ('    Test suites without any history (assumed to take '
+                    'the whole time): %s\n' %
+                    ', '.join(cluster_plan['unknown_suites']))
+    return summary + '\n'
+
+def format_interrupted_attempts_summary(test_suites_interrupted_attempts):
+    """Formats the attempts at running test suites that were interrupted
+    because the node running them was lost.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if no attempts were interrupted.
+
+    Arguments:
+        test_suites_interrupted_attempts - a list of 2-element tuples, where
+            the first element is the test suite label and the second element
+            is the list of its interrupted attempts (see
+            clout.run._execute_test_suites())
+    """
+    lines = []
+    for label, interrupted_attempts in test_suites_interrupted_attempts:
+        if interrupted_attempts:
+            lines.append('    %s: %s' % (label, ', '.join(
+                    ['%s after %s' % (attempt['node'],
+                                      format_duration(attempt['duration']))
+                     for attempt in interrupted_attempts])))
+    if not lines:
+        return ''
+    return ('The following test suites were interrupted because the node '
+            'running them was lost, and were run again (their results above '
+            'are from their last attempt):\n%s\n\n' % '\n'.join(lines))
+
+def format_snapshots_summary(snapshots):
+    """Formats whether each snapshotted setup was restored from its
+    snapshot.
+
+    Returns a string suitable for the body of an email message, or an empty
+    string if no setups were snapshotted.
+
+    Arguments:
+        snapshots - a list of dictionaries describing each snapshotted setup
+            (see clout.run._execute_matrix_setup_commands())
+    """
+    if not snapshots:
+        return ''
+    return 'Setup snapshots:\n%s\n\n' % '\n'.join(
+            ['    %s: %s' % (snapshot['label'],
+                             format_snapshot_status(snapshot))
+             for snapshot in snapshots])
+
+def format_snapshot_status(snapshot):
+    """Returns the human-readable form of a snapshotted setup's status
+    (e.g. 'restored from snapshot 3f2a9c0d1e4b').
+
+    Arguments:
+        snapshot - one of the snapshotted setups passed to
+            format_snapshots_summary()
+    """
+    if snapshot['status'] == 'hit':
+        return 'restored from snapshot %s' % snapshot['key'][:12]
+    if snapshot['captured']:
+        return 'rebuilt (no snapshot), captured snapshot %s' % (
+                snapshot['key'][:12])
+    return 'rebuilt (no snapshot), snapshot not captured'
+
+def format_cluster_lease_summary(cluster_lease):
+    """Formats which pooled cluster a run used and how long it waited.
+
+    Returns a string suitable for the body of an email message.
+
+    Arguments:
+        cluster_lease - the lease returned by
+            clout.pool.ClusterPool.acquire()
+    """
+    if cluster_lease['reused']:
+        how = 'an idle cluster that was reused'
+    else:
+        how = 'started for this run'
+    return ("Cluster: %s from the cluster pool (%s), after waiting %s for the "
+            "pool.\n\n" % (cluster_lease['cluster_tag'], how,
+                            format_duration(cluster_lease['queue_wait'])))
+
+def format_node_hours(node_hours):
+    """Formats a cluster's cost in node-hours (e.g. '1.25 node-hours')."""
+    if node_hours is None:
+        return '-'
+    return '%.2f node-hours' % node_hours
+
+def format_test_suite_status(status):
+    """Returns the human-readable form of a test suite status."""
+    return {'pass': 'Pass', 'fail': 'Fail', 'timeout': 'Timeout',
+            'not_run': 'Not run'}[status]
+
+def _format_variant_status(label, values, statuses):
+    """Formats the status of a matrix test suite's variant."""
+    return format_test_suite_status(statuses.get(
+            get_variant_label(label, values), 'not_run'))
+
+def _format_count(count):
+    """Formats a count that may be unknown (None)."""
+    return '-' if count is None else str(count)
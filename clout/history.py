@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to keep the results of past runs for spotting trends.
+
+The history is a file containing one JSON object per line, each describing a
+finished run: the status and duration of each test suite and, where they are
+known, the durations of the suite's individual tests. Only the most recent
+runs are kept.
+
+The history is used to spot tests and test suites that took much longer than
+they usually do, and to give each test suite a timeout based on how long it
+usually takes (so that a hung test suite is stopped long before the timeout
+for all of the test suites expires) and to size the cluster (see
+clout.autoscale).
+"""
+
+from json import dumps, loads
+from os import fsync
+from os.path import exists
+
+from clout.util import write_file_atomically
+
+class RunHistory(object):
+    """The results of recent runs."""
+
+    def __init__(self, history_fp, max_runs=100):
+        """Initializes a run history stored in history_fp.
+
+        Arguments:
+            history_fp - the file that the history is stored in (created if
+                it doesn't exist)
+            max_runs - the number of most recent runs to keep
+        """
+        self.history_fp = history_fp
+        self.max_runs = max_runs
+
+    def add_run(self, run_id, run_summary):
+        """Adds a finished run to the history.
+
+        If the history already contains a run with the same ID (e.g. the run
+        was resumed after it was added), it is replaced.
+
+        Arguments:
+            run_id - the ID of the run
+            run_summary - the summary of the run built by
+                clout.run._execute_commands_and_build_email(). Only the
+                parts needed to spot trends are kept
+        """
+        entry = {'run_id': run_id,
+                 'cluster_tag': run_summary.get('cluster_tag'),
+                 'finished_at': run_summary.get('finished_at'),
+                 'test_suites': [_get_test_suite_entry(test_suite) for
+                                 test_suite in run_summary['test_suites']]}
+
+        runs = self._read_runs()
+        replaced = [run for run in runs if run['run_id'] == run_id]
+        if replaced or len(runs) >= 2 * self.max_runs:
+            # Rewriting the file on every run would be wasteful, so it is
+            # allowed to grow to twice its maximum size before it is trimmed.
+            runs = [run for run in runs if run['run_id'] != run_id]
+            runs = runs[max(0, len(runs) - self.max_runs + 1):]
+            write_file_atomically(self.history_fp, ''.join(
+                    [dumps(run) + '\n' for run in runs + [entry]]))
+        else:
+            history_f = open(self.history_fp, 'a')
+            try:
+                history_f.write(dumps(entry) + '\n')
+                history_f.flush()
+                fsync(history_f.fileno())
+            finally:
+                history_f.close()
+
+    def get_runs(self, cluster_tag=None, exclude_run_id=None):
+        """Returns the most recent runs, oldest first.
+
+        Arguments:
+            cluster_tag - if provided, only runs with this cluster tag are
+                returned
+            exclude_run_id - if provided, the run with this ID is not returned
+                (e.g. the current run, if it was resumed after it was added)
+        """
+        runs = [run for run in self._read_runs()
+                if run['run_id'] != exclude_run_id]
+        if cluster_tag is not None:
+            runs = [run for run in runs if run['cluster_tag'] == cluster_tag]
+        return runs[-self.max_runs:] if self.max_runs > 0 else []
+
+    def get_test_suite_history(self, label, cluster_tag=None,
+                               exclude_run_id=None):
+        """Returns a test suite's entries in the most recent runs.
+
+        Returns a list of dictionaries (oldest first) with 'status',
+        'duration', 'test_durations', and 'timeout_exceeded' keys.
+
+        Arguments:
+            label - the test suite's label
+            cluster_tag - same as for get_runs()
+            exclude_run_id - same as for get_runs()
+        """
+        entries = []
+        for run in self.get_runs(cluster_tag, exclude_run_id):
+            for test_suite in run['test_suites']:
+                if test_suite['label'] == label:
+                    entries.append(test_suite)
+                    break
+        return entries
+
+    def get_last_success(self, label, cluster_tag=None, exclude_run_id=None):
+        """Returns when a test suite last passed, or None if it hasn't.
+
+        Only the most recent runs are considered, and runs that were added
+        without a finish time are skipped.
+
+        Arguments:
+            label - the test suite's label
+            cluster_tag - same as for get_runs()
+            exclude_run_id - same as for get_runs()
+        """
+        for run in reversed(self.get_runs(cluster_tag, exclude_run_id)):
+            if run.get('finished_at') is None:
+                continue
+            for test_suite in run['test_suites']:
+                if test_suite['label'] == label and \
+                   test_suite['status'] == 'pass':
+                    return run['finished_at']
+        return None
+
+    def _read_runs(self):
+        """Returns every run in the history file, in the order added.
+
+        A line that was only partially written is ignored.
+        """
+        if not exists(self.history_fp):
+            return []
+
+        runs = []
+        history_f = open(self.history_fp, 'U')
+        try:
+            for line in history_f:
+                try:
+                    runs.append(loads(line))
+                except ValueError:
+                    continue
+        finally:
+            history_f.close()
+        return runs
+
+
+def find_test_regressions(test_durations, test_suite_history, factor=2.0,
+                          min_increase=1.0, min_samples=3):
+    """Finds the tests that took much longer than they usually do.
+
+    A test's usual duration is the median of its durations in the previous
+    runs in which it passed. A test has regressed if it took more than factor
+    times its usual duration and at least min_increase seconds longer.
+
+    Returns a list of 3-element lists containing the test's name, its
+    duration, and its usual duration, with the largest increases first.
+
+    Arguments:
+        test_durations - a dictionary mapping test names to their durations
+            in the current run
+        test_suite_history - the output of
+            RunHistory.get_test_suite_history()
+        factor - how many times longer than usual a test must take
+        min_increase - how many seconds longer than usual a test must take
+            (so that fast tests with noisy timings aren't reported)
+        min_samples - the number of previous durations a test must have
+            before it can be considered to have regressed
+    """
+    past_durations = {}
+    for entry in test_suite_history:
+        for name, duration in entry['test_durations'].items():
+            past_durations.setdefault(name, []).append(duration)
+
+    regressions = []
+    for name, duration in test_durations.items():
+        durations = past_durations.get(name, [])
+        if len(durations) < min_samples:
+            continue
+        usual_duration = get_median(durations)
+        if duration > factor * usual_duration and \
+           duration - usual_duration >= min_increase:
+            regressions.append([name, duration, usual_duration])
+    return sorted(regressions, key=lambda r: (r[2] - r[1], r[0]))
+
+def find_test_suite_regression(duration, test_suite_history, factor=1.5,
+                               min_increase=60.0, min_samples=3):
+    """Returns a test suite's usual duration if it took much longer.
+
+    A test suite's usual duration is the median of its durations in the
+    previous runs in which it passed. Returns None if the test suite didn't
+    take more than factor times its usual duration and at least min_increase
+    seconds longer, or if there isn't enough history to tell.
+
+    Arguments:
+        duration - the number of seconds the test suite took in the current
+            run
+        test_suite_history - the output of
+            RunHistory.get_test_suite_history()
+        factor - how many times longer than usual the test suite must take
+        min_increase - how many seconds longer than usual the test suite must
+            take
+        min_samples - the number of previous durations the test suite must
+            have before it can be considered to have regressed
+    """
+    durations = _get_passing_durations(test_suite_history)
+    if duration is None or len(durations) < min_samples:
+        return None
+    usual_duration = get_median(durations)
+    if duration > factor * usual_duration and \
+       duration - usual_duration >= min_increase:
+        return usual_duration
+    return None
+
+def get_adaptive_timeout(test_suite_history, ceiling=None, factor=2.0,
+                         percentile=95, floor=5.0, min_samples=5):
+    """Returns a timeout for a test suite based on how long it usually takes.
+
+    The timeout is factor times the given percentile of the test suite's
+    durations in the previous runs in which it passed (rounded to a tenth of
+    a minute), but no less than floor and no more than ceiling.
+
+    Returns the timeout in minutes, or None if the test suite shouldn't have
+    its own timeout: there aren't at least min_samples previous durations, or
+    the test suite exceeded its timeout in its most recent run. The latter
+    means that a test suite that legitimately became slower is allowed to run
+    to completion once (bounded only by the overall timeout), after which its
+    new durations are taken into account.
+
+    Arguments:
+        test_suite_history - the output of
+            RunHistory.get_test_suite_history()
+        ceiling - the maximum timeout in minutes (e.g. the timeout for all of
+            the test suites). If None, there is no maximum
+        factor - how many times the percentile duration to allow
+        percentile - the percentile (0-100) of previous durations to use
+        floor - the minimum timeout in minutes, so that fast test suites
+            aren't stopped because of normal variation
+        min_samples - the number of previous durations the test suite must
+            have before it is given its own timeout
+    """
+    if test_suite_history and \
+       test_suite_history[-1].get('timeout_exceeded'):
+        return None
+
+    durations = _get_passing_durations(test_suite_history)
+    if len(durations) < min_samples:
+        return None
+
+    timeout = max(floor, round(factor * get_percentile(durations,
+                                                       percentile) / 60, 1))
+    if ceiling is not None:
+        timeout = min(timeout, ceiling)
+    return timeout
+
+def get_usual_duration(test_suite_history, min_samples=1):
+    """Returns how long a test suite usually takes, in seconds.
+
+    A test suite's usual duration is the median of its durations in the
+    previous runs in which it passed. Returns None if there are fewer than
+    min_samples of them.
+
+    Arguments:
+        test_suite_history - the output of
+            RunHistory.get_test_suite_history()
+        min_samples - the number of previous durations the test suite must
+            have
+    """
+    durations = _get_passing_durations(test_suite_history)
+    if not durations or len(durations) < min_samples:
+        return None
+    return get_median(durations)
+
+def get_percentile(vals, percentile):
+    """Returns a percentile (0-100) of a non-empty list of numbers.
+
+    Values between two numbers are linearly interpolated.
+    """
+    vals = sorted(vals)
+    position = (len(vals) - 1) * percentile / 100
+    lower = int(position)
+    upper = min(lower + 1, len(vals) - 1)
+    return vals[lower] + (vals[upper] - vals[lower]) * (position - lower)
+
+def get_median(vals):
+    """Returns the median of a non-empty list of numbers."""
+    vals = sorted(vals)
+    mid = len(vals) // 2
+    if len(vals) % 2:
+        return vals[mid]
+    return (vals[mid - 1] + vals[mid]) / 2
+
+def _get_test_suite_entry(test_suite):
+    """Returns the part of a test suite's summary that the history keeps.
+
+    Only the durations of tests that passed are kept, since a test that
+    failed (or errored) part-way through isn't representative.
+    """
+    test_durations = {}
+    tests = test_suite.get('tests')
+    if tests is not None:
+        failed_tests = set([name for name, status in tests['failures']])
+        test_durations = dict([(name, duration) for name, duration in
+                               tests['durations'].items()
+                               if name not in failed_tests])
+    return {'label': test_suite['label'], 'status': test_suite['status'],
+            'duration': test_suite['duration'],
+            'test_durations': test_durations,
+            'timeout_exceeded': test_suite.get('timeout_exceeded', False),
+            'steps': [{'name': step['name'], 'duration': step['duration']}
+                      for step in test_suite.get('steps') or []]}
+
+def _get_passing_durations(test_suite_history):
+    """Returns a test suite's known durations in runs in which it passed."""
+    return [entry['duration'] for entry in test_suite_history
+            if entry['status'] == 'pass' and entry['duration'] is not None]
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to keep overlapping runs from fighting over the same cluster."""
+
+from errno import EEXIST, ENOENT, EPERM, ESRCH
+from json import dumps, loads
+from os import close, getpid, kill, O_CREAT, O_EXCL, O_WRONLY, open as os_open
+from os import rename, unlink, write
+from os.path import getmtime, join
+from socket import gethostname
+from time import sleep, time
+from uuid import uuid4
+
+from clout.util import create_dir, write_file_atomically
+
+class RunLock(object):
+    """File-based lock on a cluster tag, shared by every Clout process.
+
+    Only one run can hold the lock for a given cluster tag at a time. The lock
+    records a hash of the run's configuration, so when a second run with the
+    same cluster tag and the same configuration tries to acquire the lock
+    (e.g. a cron job that fired while the previous night's run overran), it
+    attaches to the run that holds the lock and waits for its result instead
+    of launching a second cluster. A run with the same cluster tag but a
+    different configuration waits for the lock to be released and then runs.
+
+    If the run holding the lock fails (or stops in a state that can still be
+    resumed), no result is recorded and the runs attached to it go back to
+    acquiring the lock, so one of them runs instead. Locks left behind by
+    crashed processes are detected (the owning process no longer exists) and
+    reclaimed.
+    """
+
+    def __init__(self, lock_dir, cluster_tag, config_hash, poll_interval=5.0,
+                 stale_lock_timeout=60.0):
+        """Initializes a new (unacquired) lock.
+
+        Arguments:
+            lock_dir - the directory that lock files are stored in
+            cluster_tag - the cluster tag to lock
+            config_hash - a string identifying the run's configuration. Runs
+                with identical config hashes are coalesced
+            poll_interval - the number of seconds to wait between checks of
+                the lock's state
+            stale_lock_timeout - the number of seconds after which an
+                unreadable lock file (i.e. one whose owner crashed while
+                writing it) is considered stale
+        """
+        self.lock_dir = create_dir(lock_dir)
+        self.cluster_tag = cluster_tag
+        self.config_hash = config_hash
+        self.poll_interval = poll_interval
+        self.stale_lock_timeout = stale_lock_timeout
+
+        self.lock_fp = join(lock_dir, '%s.lock' % cluster_tag)
+        self.result_fp = join(lock_dir, '%s.result' % cluster_tag)
+        self.token = None
+        self.coalesced_result = None
+
+    def acquire(self):
+        """Acquires the lock, or attaches to the identical run holding it.
+
+        Returns True if the lock was acquired. Returns False if an identical
+        run held the lock; in that case, this method blocks until that run
+        releases the lock and its result is stored in self.coalesced_result.
+        If the identical run crashes or fails instead, this method tries to
+        acquire the lock again.
+        """
+        while True:
+            if self._try_create():
+                return True
+
+            owner = self._read_owner()
+            if owner is None:
+                # The lock was released (or reclaimed) after our attempt.
+                continue
+            if self._is_stale(owner):
+                self._reclaim(owner)
+                continue
+            if owner['token'] is None:
+                # The owner is still writing the lock file.
+                sleep(self.poll_interval)
+                continue
+
+            if owner['config_hash'] == self.config_hash:
+                self._wait_for_release(owner)
+                finished, result = self._read_result(owner)
+                if finished:
+                    self.coalesced_result = result
+                    return False
+            else:
+                self._wait_for_release(owner)
+
+    def release(self, result=None, finished=True):
+        """Releases the lock, recording the run's result for attached runs.
+
+        Arguments:
+            result - a JSON-serializable object describing the run's result
+            finished - False if the run failed (or can still be resumed). No
+                result is recorded, so attached runs try to acquire the lock
+                again instead of returning a result
+        """
+        if self.token is None:
+            raise ValueError("Cannot release a lock that isn't held.")
+
+        if finished:
+            write_file_atomically(self.result_fp, dumps(
+                    {'token': self.token, 'config_hash': self.config_hash,
+                     'finished_at': time(), 'result': result}))
+        owner = self._read_owner()
+        if owner is not None and owner['token'] == self.token:
+            _remove_file(self.lock_fp)
+        self.token = None
+
+    def _try_create(self):
+        """Attempts to create the lock file. Returns True if successful."""
+        token = uuid4().hex
+        try:
+            fd = os_open(self.lock_fp, O_CREAT | O_EXCL | O_WRONLY, 0o644)
+        except OSError as e:
+            if e.errno == EEXIST:
+                return False
+            raise
+        try:
+            write(fd, dumps({'token': token, 'config_hash': self.config_hash,
+                             'pid': getpid(), 'hostname': gethostname(),
+                             'acquired_at': time()}))
+        finally:
+            close(fd)
+        self.token = token
+        return True
+
+    def _read_owner(self):
+        """Returns the lock file's contents, or None if there is no lock.
+
+        A lock file that exists but can't be parsed (its owner is still
+        writing it, or crashed while doing so) is returned as a dictionary
+        containing only the file's modification time.
+        """
+        try:
+            lock_f = open(self.lock_fp, 'U')
+        except IOError as e:
+            if e.errno == ENOENT:
+                return None
+            raise
+        try:
+            contents = lock_f.read()
+        finally:
+            lock_f.close()
+
+        try:
+            return loads(contents)
+        except ValueError:
+            try:
+                return {'token': None, 'mtime': getmtime(self.lock_fp)}
+            except OSError:
+                return None
+
+    def _is_stale(self, owner):
+        """Returns True if the lock's owner has crashed."""
+        if owner['token'] is None:
+            return time() - owner['mtime'] > self.stale_lock_timeout
+
+        # We can only check whether processes on this machine are alive. Locks
+        # held by other machines (e.g. with a shared lock_dir) are trusted.
+        if owner['hostname'] != gethostname():
+            return False
+        return not _process_exists(owner['pid'])
+
+    def _reclaim(self, owner):
+        """Removes a stale lock, unless another process beat us to it."""
+        # Renaming is atomic, so only one process can claim the stale lock
+        # file. We then make sure that it was the stale lock that we moved
+        # (and not a fresh lock created in the meantime).
+        claimed_fp = '%s.stale.%s' % (self.lock_fp, uuid4().hex)
+        try:
+            rename(self.lock_fp, claimed_fp)
+        except OSError as e:
+            if e.errno == ENOENT:
+                return
+            raise
+
+        claimed_f = open(claimed_fp, 'U')
+        try:
+            contents = claimed_f.read()
+        finally:
+            claimed_f.close()
+        try:
+            claimed_token = loads(contents)['token']
+        except ValueError:
+            claimed_token = None
+
+        if claimed_token != owner['token']:
+            # Put back the fresh lock (if nobody has taken the lock since).
+            try:
+                fd = os_open(self.lock_fp, O_CREAT | O_EXCL | O_WRONLY, 0o644)
+            except OSError as e:
+                if e.errno != EEXIST:
+                    raise
+            else:
+                try:
+                    write(fd, contents)
+                finally:
+                    close(fd)
+        _remove_file(claimed_fp)
+
+    def _wait_for_release(self, owner):
+        """Blocks until the given owner no longer holds the lock."""
+        while True:
+            current_owner = self._read_owner()
+            if current_owner is None or \
+               current_owner['token'] != owner['token'] or \
+               self._is_stale(current_owner):
+                return
+            sleep(self.poll_interval)
+
+    def _read_result(self, owner):
+        """Reads the result recorded by the given (former) owner of the lock.
+
+        Returns a 2-element tuple containing True and the result if the owner
+        recorded one, or False and None if it didn't (i.e. it crashed).
+        """
+        try:
+            result_f = open(self.result_fp, 'U')
+        except IOError as e:
+            if e.errno == ENOENT:
+                return False, None
+            raise
+        try:
+            result = loads(result_f.read())
+        finally:
+            result_f.close()
+
+        if result['token'] != owner['token']:
+            return False, None
+        return True, result['result']
+
+
+def _process_exists(pid):
+    """Returns True if a process with the given pid exists on this machine."""
+    try:
+        kill(pid, 0)
+    except OSError as e:
+        if e.errno == ESRCH:
+            return False
+        if e.errno == EPERM:
+            # The process exists but is owned by another user.
+            return True
+        raise
+    return True
+
+def _remove_file(fp):
+    """Removes a file, ignoring it if it doesn't exist."""
+    try:
+        unlink(fp)
+    except OSError as e:
+        if e.errno != ENOENT:
+            raise
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to keep the logs of past runs in a searchable archive.
+
+Each run's logs are compressed into the archive once the run has finished, and
+an inverted index of the words in them is kept alongside, so that questions
+like "when did this traceback first appear?" can be answered without
+decompressing every log:
+
+    <archive_dir>/logs.jsonl                  one JSON object per archived log
+    <archive_dir>/logs/<run_id>/<name>.gz     compressed log
+    <archive_dir>/index/<bucket>.jsonl        inverted index
+
+Like the logs in a report (see clout.report), each log is compressed as a
+series of independent gzip members, but every member ends at a line boundary.
+The index maps each word (see get_tokens()) to the members of each log that
+contain it, and is split into buckets by word so that a search only reads the
+buckets of the words it is looking for. A search then decompresses only the
+members that contain all of its words.
+
+Every file is appended to as runs are archived. Old runs are removed once the
+archive holds more than max_runs runs or max_size bytes of compressed logs,
+and the index is compacted (rewritten without the removed logs) once it
+refers to more removed logs than archived ones.
+"""
+
+from fcntl import flock, LOCK_EX, LOCK_UN
+from gzip import GzipFile
+from json import dumps, loads
+from os import fsync
+from os.path import exists, getsize, join
+from re import compile, escape, IGNORECASE
+from shutil import rmtree
+from StringIO import StringIO
+from zlib import crc32
+
+from clout.state import get_safe_filename
+from clout.util import create_dir, write_file_atomically
+
+_word_re = compile(r'[A-Za-z0-9_]+')
+
+# Matches the line that a Python traceback ends with (e.g.
+# 'ValueError: invalid literal').
+_exception_re = compile(r'^\s*([A-Za-z_][A-Za-z0-9_.]*'
+                        r'(?:Error|Exception|Exit|Interrupt))(?::|\s*$)')
+
+class LogArchive(object):
+    """The compressed, indexed logs of recent runs."""
+
+    def __init__(self, archive_dir, max_runs=500, max_size=1073741824,
+                 chunk_size=65536, num_buckets=64):
+        """Initializes a log archive stored in archive_dir.
+
+        Arguments:
+            archive_dir - the directory that the archive is stored in
+                (created if it doesn't exist)
+            max_runs - the number of most recent runs to keep
+            max_size - the number of bytes of compressed logs to keep. The
+                oldest runs are removed until the archive is no larger than
+                this (though the most recent run is always kept)
+            chunk_size - the (approximate) number of uncompressed bytes in
+                each gzip member. Smaller members mean less is decompressed
+                by a search, but compress less well
+            num_buckets - the number of files the index is split into. This
+                must not change once the archive has been created
+        """
+        self.archive_dir = create_dir(archive_dir)
+        self.max_runs = max_runs
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.num_buckets = num_buckets
+
+        self._logs_fp = join(self.archive_dir, 'logs.jsonl')
+        self._index_dir = join(self.archive_dir, 'index')
+
+    def add_run(self, run_id, run_summary, logs):
+        """Adds a finished run's logs to the archive.
+
+        If the archive already contains the run (e.g. the run was resumed
+        after it was added), its logs are replaced. Old runs are then removed
+        as needed to keep the archive within its limits.
+
+        Arguments:
+            run_id - the ID of the run
+            run_summary - the summary of the run built by
+                clout.run._execute_commands_and_build_email(). It is used to
+                find the test suite that each log belongs to, and the names
+                of its failing tests
+            logs - a list of 2-element tuples containing a log's name and the
+                open log file, positioned at the beginning. Each file is left
+                positioned at the beginning again
+        """
+        test_suites = dict([(test_suite['log_name'], test_suite)
+                            for test_suite in run_summary['test_suites']
+                            if test_suite['log_name'] is not None])
+
+        lock_f = open(join(self.archive_dir, '.lock'), 'a')
+        flock(lock_f.fileno(), LOCK_EX)
+        try:
+            entries, removed_ids = self._read_entries()
+            replaced_ids = [entry['id'] for entry in entries
+                            if entry['run_id'] == run_id]
+            if replaced_ids:
+                self._append(self._logs_fp, {'removed': replaced_ids})
+                removed_ids.update(replaced_ids)
+                entries = [entry for entry in entries
+                           if entry['run_id'] != run_id]
+            next_id = max([entry['id'] for entry in entries] +
+                          list(removed_ids) + [0]) + 1
+
+            run_dir = join(self.archive_dir, 'logs', get_safe_filename(run_id))
+            rmtree(run_dir, ignore_errors=True)
+            create_dir(run_dir)
+            new_entries = []
+            for log_name, log_f in logs:
+                test_suite = test_suites.get(log_name)
+                entry = {'id': next_id, 'run_id': run_id, 'name': log_name,
+                         'label': None, 'status': None}
+                if test_suite is not None:
+                    entry['label'] = test_suite['label']
+                    entry['status'] = test_suite['status']
+                next_id += 1
+
+                log_fp = join(run_dir, get_safe_filename(log_name) + '.gz')
+                postings, signatures, size, chunks = _write_log(
+                        log_f, log_fp, self.chunk_size)
+                if test_suite is not None and test_suite['tests'] is not None:
+                    signatures.extend([name for name, status in
+                                       test_suite['tests']['failures']])
+                entry.update(fp=join('logs', get_safe_filename(run_id),
+                                     get_safe_filename(log_name) + '.gz'),
+                             size=size, compressed_size=getsize(log_fp),
+                             chunks=chunks, signatures=signatures)
+                self._add_postings(entry['id'], postings)
+                new_entries.append(entry)
+
+            # A log is only archived once its entry is written, after its
+            # postings.
+            for entry in new_entries:
+                self._append(self._logs_fp, entry)
+            entries.extend(new_entries)
+
+            self._apply_retention(entries, removed_ids)
+        finally:
+            flock(lock_f.fileno(), LOCK_UN)
+            lock_f.close()
+
+    def get_logs(self):
+        """Returns the archived logs, oldest run first.
+
+        Each log is a dictionary containing its 'run_id', 'name', the 'label'
+        and 'status' of its test suite (None if it doesn't belong to one),
+        its uncompressed 'size' and 'compressed_size', and its error
+        'signatures': the types of the exceptions that it ends tracebacks
+        with, followed by the names of its test suite's failing tests.
+        """
+        entries = self._read_entries()[0]
+        entries.sort(key=lambda entry: (entry['run_id'], entry['id']))
+        return entries
+
+    def search(self, pattern, label=None, max_lines=3,
+               signatures_only=False):
+        """Searches the archived logs for a string.
+
+        The search is case-insensitive, and if the string begins or ends with
+        a letter, digit, or underscore, it only matches whole words there
+        (e.g. 'ValueError' matches 'ValueError: foo' but not 'MyValueError').
+
+        Returns a list of the logs that matched (see get_logs()), oldest run
+        first, each with the first max_lines matching 'lines' and the total
+        number of matching lines ('num_lines') added.
+
+        Arguments:
+            pattern - the string to search for
+            label - if provided, only the logs of the test suite with this
+                label are searched
+            max_lines - the number of matching lines to return for each log
+            signatures_only - if True, pattern is only searched for in the
+                logs' error signatures, and the matching signatures are
+                returned as the 'lines'. Nothing is decompressed
+        """
+        pattern_re = _build_pattern_re(pattern)
+        logs = self.get_logs()
+        if label is not None:
+            logs = [log for log in logs if log['label'] == label]
+
+        candidates = None
+        tokens = get_tokens(pattern)
+        if tokens and not signatures_only:
+            candidates = self._find_candidates(tokens)
+
+        matches = []
+        for log in logs:
+            if signatures_only:
+                lines = [signature for signature in log['signatures']
+                         if pattern_re.search(signature)]
+            elif candidates is None:
+                lines = self._search_log(log, range(len(log['chunks'])),
+                                         pattern_re)
+            elif log['id'] in candidates:
+                lines = self._search_log(log, candidates[log['id']],
+                                         pattern_re)
+            else:
+                lines = []
+
+            if lines:
+                matches.append(dict(log, lines=lines[:max_lines],
+                                    num_lines=len(lines)))
+        return matches
+
+    def _search_log(self, log, chunk_indices, pattern_re):
+        """Returns the lines in a log's chunks that match pattern_re."""
+        lines = []
+        log_f = open(join(self.archive_dir, log['fp']), 'rb')
+        try:
+            for chunk_index in sorted(chunk_indices):
+                offset, length = log['chunks'][chunk_index]
+                log_f.seek(offset)
+                data = GzipFile(fileobj=StringIO(log_f.read(length))).read()
+                lines.extend([line for line in data.splitlines()
+                              if pattern_re.search(line)])
+        finally:
+            log_f.close()
+        return lines
+
+    def _find_candidates(self, tokens):
+        """Returns the chunks that contain every token.
+
+        Returns a dictionary mapping the ID of each log that contains every
+        token to the set of the indices of its chunks that do.
+        """
+        token_postings = dict([(token, {}) for token in tokens])
+        buckets = {}
+        for token in tokens:
+            buckets.setdefault(self._get_bucket(token), []).append(token)
+
+        for bucket, bucket_tokens in buckets.items():
+            for line in self._read_lines(self._get_bucket_fp(bucket)):
+                for token in bucket_tokens:
+                    if token in line['postings']:
+                        token_postings[token].setdefault(line['log'],
+                                set()).update(line['postings'][token])
+
+        candidates = None
+        for postings in token_postings.values():
+            if candidates is None:
+                candidates = postings
+                continue
+            candidates = dict([(log_id, chunks & postings[log_id])
+                               for log_id, chunks in candidates.items()
+                               if log_id in postings])
+        return dict([(log_id, chunks) for log_id, chunks in candidates.items()
+                     if chunks])
+
+    def _add_postings(self, log_id, postings):
+        """Appends a log's postings to the index buckets."""
+        buckets = {}
+        for token, chunk_indices in postings.items():
+            buckets.setdefault(self._get_bucket(token), {})[token] = \
+                    chunk_indices
+        create_dir(self._index_dir)
+        for bucket, bucket_postings in buckets.items():
+            self._append(self._get_bucket_fp(bucket),
+                         {'log': log_id, 'postings': bucket_postings})
+
+    def _apply_retention(self, entries, removed_ids):
+        """Removes the oldest runs that don't fit in the archive, and then
+        compacts the index if it refers to more removed logs than archived
+        ones.
+        """
+        run_ids = sorted(set([entry['run_id'] for entry in entries]))
+        sizes = dict([(run_id, 0) for run_id in run_ids])
+        for entry in entries:
+            sizes[entry['run_id']] += entry['compressed_size']
+
+        total_size = sum(sizes.values())
+        expired_run_ids = []
+        while len(run_ids) > 1 and (len(run_ids) > self.max_runs or
+                                    total_size > self.max_size):
+            run_id = run_ids.pop(0)
+            total_size -= sizes[run_id]
+            expired_run_ids.append(run_id)
+
+        if expired_run_ids:
+            expired_ids = [entry['id'] for entry in entries
+                           if entry['run_id'] in expired_run_ids]
+            self._append(self._logs_fp, {'removed': expired_ids})
+            removed_ids.update(expired_ids)
+            entries = [entry for entry in entries
+                       if entry['run_id'] not in expired_run_ids]
+            for run_id in expired_run_ids:
+                rmtree(join(self.archive_dir, 'logs',
+                            get_safe_filename(run_id)), ignore_errors=True)
+
+        if len(removed_ids) > len(entries):
+            self._compact(entries)
+
+    def _compact(self, entries):
+        """Rewrites the index and the list of logs without removed logs."""
+        # The buckets are rewritten first: until the list of logs is
+        # rewritten, it still records which logs were removed.
+        log_ids = set([entry['id'] for entry in entries])
+        for bucket in range(self.num_buckets):
+            bucket_fp = self._get_bucket_fp(bucket)
+            if not exists(bucket_fp):
+                continue
+            write_file_atomically(bucket_fp, ''.join(
+                    [dumps(line) + '\n' for line in self._read_lines(bucket_fp)
+                     if line['log'] in log_ids]))
+        write_file_atomically(self._logs_fp, ''.join(
+                [dumps(entry) + '\n' for entry in entries]))
+
+    def _read_entries(self):
+        """Returns the archived logs (in the order added) and the set of IDs
+        of removed logs.
+        """
+        entries = {}
+        removed_ids = set()
+        for line in self._read_lines(self._logs_fp):
+            if 'removed' in line:
+                removed_ids.update(line['removed'])
+            else:
+                entries[line['id']] = line
+        return ([entry for log_id, entry in sorted(entries.items())
+                 if log_id not in removed_ids], removed_ids)
+
+    def _read_lines(self, fp):
+        """Returns the JSON objects in a file, one per line.
+
+        A line that was only partially written is ignored.
+        """
+        if not exists(fp):
+            return []
+
+        lines = []
+        in_f = open(fp, 'U')
+        try:
+            for line in in_f:
+                try:
+                    lines.append(loads(line))
+                except ValueError:
+                    continue
+        finally:
+            in_f.close()
+        return lines
+
+    def _append(self, fp, obj):
+        """Appends a JSON object to a file as a line, and syncs it to disk."""
+        out_f = open(fp, 'a')
+        try:
+            out_f.write(dumps(obj) + '\n')
+            out_f.flush()
+            fsync(out_f.fileno())
+        finally:
+            out_f.close()
+
+    def _get_bucket(self, token):
+        """Returns the index bucket that a token is stored in."""
+        return (crc32(token) & 0xffffffff) % self.num_buckets
+
+    def _get_bucket_fp(self, bucket):
+        """Returns the file that an index bucket is stored in."""
+        return join(self._index_dir, '%03d.jsonl' % bucket)
+
+
+def get_tokens(text):
+    """Returns the set of words in text that are indexed.
+
+    Words are runs of letters, digits, and underscores. They are lowercased,
+    and words shorter than three characters, longer than 64 characters, or
+    starting with a digit (e.g. line numbers, timestamps, and memory
+    addresses) aren't indexed.
+    """
+    return set([word.lower() for word in _word_re.findall(text)
+                if 3 <= len(word) <= 64 and not word[0].isdigit()])
+
+def get_error_signatures(lines):
+    """Returns the types of the exceptions that the tracebacks in lines end
+    with, in the order they first appear.
+    """
+    signatures = []
+    for line in lines:
+        match = _exception_re.match(line)
+        if match is not None and match.group(1) not in signatures:
+            signatures.append(match.group(1))
+    return signatures
+
+def _write_log(log_f, out_fp, chunk_size):
+    """Compresses a log into independent gzip members that end at line
+    boundaries.
+
+    Returns a 4-element tuple containing the log's postings (a dictionary
+    mapping each token to the sorted indices of the members containing it),
+    its error signatures, its uncompressed size, and a list of the
+    [compressed offset, compressed length] of each member.
+    """
+    postings = {}
+    signatures = []
+    size = 0
+    chunks = []
+    offset = 0
+
+    out_f = open(out_fp, 'wb')
+    try:
+        while True:
+            lines = log_f.readlines(chunk_size)
+            if not lines:
+                break
+            data = ''.join(lines)
+
+            member = StringIO()
+            gzip_f = GzipFile(fileobj=member, mode='wb', mtime=0)
+            gzip_f.write(data)
+            gzip_f.close()
+            member = member.getvalue()
+            out_f.write(member)
+
+            for token in get_tokens(data):
+                postings.setdefault(token, []).append(len(chunks))
+            for signature in get_error_signatures(lines):
+                if signature not in signatures:
+                    signatures.append(signature)
+            chunks.append([offset, len(member)])
+            size += len(data)
+            offset += len(member)
+    finally:
+        out_f.close()
+    log_f.seek(0, 0)
+    return postings, signatures, size, chunks
+
+def _build_pattern_re(pattern):
+    """Returns the regular expression that a search pattern matches lines
+    with (see LogArchive.search()).
+    """
+    pattern_re = escape(pattern)
+    if _word_re.match(pattern[:1]):
+        pattern_re = r'(?<![A-Za-z0-9_])' + pattern_re
+    if _word_re.match(pattern[-1:]):
+        pattern_re += r'(?![A-Za-z0-9_])'
+    return compile(pattern_re, IGNORECASE)
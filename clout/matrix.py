@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to expand a test suite into variants over a matrix of parameters.
+
+A test suite's 'matrix' option declares one or more axes, each with a list of
+values (e.g. 'python:2.6,2.7;deps:stable,dev'). The test suite is expanded
+into one variant for every combination of values, labelled with the values it
+was built from (e.g. 'QIIME (python=2.6, deps=stable)'). Each '{axis}' in the
+test suite's command and other options is replaced by the variant's value for
+that axis.
+
+A matrix test suite may also have a 'setup' option: a command that the
+variants share, along with the axes it depends on (e.g. 'python:virtualenv
+env{python}'). It is run once for each distinct combination of those axes'
+values, before any of the test suites run. The directories that the setup
+command builds can be snapshotted with the 'snapshot' option, so that later
+runs restore them instead of running the setup command again (see
+clout.snapshot). The 'workers' option sets how many of the test suite's
+variants may run at the same time.
+"""
+
+from re import compile
+
+# The options that describe a matrix. They are removed from the options of
+# the expanded variants.
+matrix_options = ['matrix', 'setup', 'snapshot', 'snapshot_inputs',
+                  'workers']
+
+_axis_re = compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def parse_matrix(matrix):
+    """Parses the value of a test suite's 'matrix' option.
+
+    Returns a list of 2-element lists containing each axis's name and its
+    list of values, in the order they were declared.
+
+    Arguments:
+        matrix - semicolon-separated axes, each an axis name followed by a
+            colon and a comma-separated list of values (e.g.
+            'python:2.6,2.7;deps:stable,dev')
+    """
+    axes = []
+    for axis in matrix.split(';'):
+        if not axis.strip():
+            continue
+        if ':' not in axis:
+            raise ValueError("The matrix axis '%s' must be an axis name "
+                             "followed by a colon and a comma-separated list "
+                             "of values." % axis.strip())
+        name, vals = axis.split(':', 1)
+        name = name.strip()
+        vals = [val.strip() for val in vals.split(',') if val.strip()]
+        if _axis_re.match(name) is None:
+            raise ValueError("Invalid matrix axis name '%s'. Axis names may "
+                             "only contain letters, digits, and underscores, "
+                             "and may not start with a digit." % name)
+        if name in [axis_name for axis_name, axis_vals in axes]:
+            raise ValueError("The matrix axis '%s' is declared more than "
+                             "once." % name)
+        if not vals or len(set(vals)) != len(vals):
+            raise ValueError("The matrix axis '%s' must have at least one "
+                             "value, and each value must be unique." % name)
+        axes.append([name, vals])
+    if not axes:
+        raise ValueError("A matrix must declare at least one axis.")
+    return axes
+
+def parse_matrix_setup(setup, axes):
+    """Parses the value of a matrix test suite's 'setup' option.
+
+    Returns a 2-element tuple containing the list of the names of the axes
+    that the setup command depends on and the command.
+
+    Arguments:
+        setup - a comma-separated list of axis names, followed by a colon and
+            the command (e.g. 'python:virtualenv -p python{python} env')
+        axes - the output of parse_matrix()
+    """
+    if ':' not in setup:
+        raise ValueError("The matrix setup '%s' must be a comma-separated "
+                         "list of axis names followed by a colon and a "
+                         "command." % setup)
+    names, cmd = setup.split(':', 1)
+    names = [name.strip() for name in names.split(',') if name.strip()]
+    axis_names = [name for name, vals in axes]
+    for name in names:
+        if name not in axis_names:
+            raise ValueError("The matrix setup depends on the axis '%s', "
+                             "which is not declared in the matrix." % name)
+    if not names or not cmd.strip():
+        raise ValueError("The matrix setup '%s' must name at least one axis "
+                         "and a command." % setup)
+    return names, cmd.strip()
+
+def get_variant_label(label, values):
+    """Returns the label of a test suite's variant.
+
+    Arguments:
+        label - the test suite's label
+        values - a list of 2-element lists containing an axis name and the
+            variant's value for it
+    """
+    return '%s (%s)' % (label, ', '.join(['%s=%s' % (name, val)
+                                          for name, val in values]))
+
+def substitute_values(text, values):
+    """Replaces each '{axis}' in text with the given value for that axis.
+
+    Braces that don't surround the name of one of the axes (e.g. in
+    '${HOME}') are left as-is.
+
+    Arguments:
+        text - the text to substitute values into
+        values - same as for get_variant_label()
+    """
+    for name, val in values:
+        text = text.replace('{%s}' % name, val)
+    return text
+
+def expand_matrices(test_suites, suite_options):
+    """Expands each matrix test suite into its variants.
+
+    Returns a 3-element tuple containing the expanded test suites (in the
+    same format as clout.parse.parse_config_file(), with each matrix test
+    suite replaced in place by its variants), the expanded suite options
+    (each variant has its test suite's options, with values substituted and
+    the options in matrix_options removed), and a list of dictionaries
+    describing each matrix test suite: its 'label', 'axes' (the output of
+    parse_matrix()), 'variants' (a list of 2-element lists containing each
+    variant's label and its values, in the same format as for
+    get_variant_label()), 'workers' (the number of variants that may run at
+    the same time), 'setup' (a list of 2-element lists containing each
+    distinct setup command and the values it was built from, or an empty list
+    if the test suite has no setup), and 'snapshot' (a dictionary containing
+    the test suite's 'snapshot' and 'snapshot_inputs' options as 'dirs' and
+    'inputs', before values are substituted, or None if the setup isn't
+    snapshotted).
+
+    Arguments:
+        test_suites - the output of clout.parse.parse_config_file()
+        suite_options - the output of clout.parse.parse_suite_options()
+    """
+    expanded_test_suites = []
+    expanded_suite_options = {}
+    matrices = []
+    for label, cmd in test_suites:
+        options = suite_options.get(label, {})
+        if 'matrix' not in options:
+            for key in matrix_options:
+                if key in options:
+                    raise ValueError("The '%s' option of the test suite '%s' "
+                                     "can only be used along with the "
+                                     "'matrix' option." % (key, label))
+            expanded_test_suites.append([label, cmd])
+            expanded_suite_options[label] = options
+            continue
+
+        axes = parse_matrix(options['matrix'])
+        workers = options.get('workers', '1')
+        try:
+            workers = int(workers)
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            raise ValueError("The number of workers for the test suite '%s' "
+                             "must be a positive integer." % label)
+
+        setup = []
+        if 'setup' in options:
+            setup_axes, setup_cmd = parse_matrix_setup(options['setup'], axes)
+            setup_axes = [[name, vals] for name, vals in axes
+                          if name in setup_axes]
+            for values in get_axis_combinations(setup_axes):
+                setup.append([substitute_values(setup_cmd, values), values])
+
+        snapshot = None
+        if 'snapshot' in options:
+            if not setup:
+                raise ValueError("The 'snapshot' option of the test suite "
+                                 "'%s' can only be used along with the "
+                                 "'setup' option." % label)
+            snapshot = {'dirs': options['snapshot'],
+                        'inputs': options.get('snapshot_inputs')}
+        elif 'snapshot_inputs' in options:
+            raise ValueError("The 'snapshot_inputs' option of the test suite "
+                             "'%s' can only be used along with the "
+                             "'snapshot' option." % label)
+
+        variants = []
+        for values in get_axis_combinations(axes):
+            variant_label = get_variant_label(label, values)
+            expanded_test_suites.append([variant_label,
+                                         substitute_values(cmd, values)])
+            expanded_suite_options[variant_label] = dict(
+                    [(key, substitute_values(val, values))
+                     for key, val in options.items()
+                     if key not in matrix_options])
+            variants.append([variant_label, values])
+        matrices.append({'label': label, 'axes': axes, 'variants': variants,
+                         'workers': workers, 'setup': setup,
+                         'snapshot': snapshot})
+
+    labels = [label for label, cmd in expanded_test_suites]
+    for label in labels:
+        if labels.count(label) > 1:
+            raise ValueError("The test suite label '%s' is used by more than "
+                             "one test suite (or test suite variant). Each "
+                             "test suite label must be unique." % label)
+    return expanded_test_suites, expanded_suite_options, matrices
+
+def get_axis_combinations(axes):
+    """Returns every combination of the axes' values, in the order that the
+    axes and their values were declared (the last axis varies fastest).
+
+    Each combination is a list of 2-element lists containing an axis name
+    and a value. Returns an empty list if there are no axes.
+    """
+    if not axes:
+        return []
+    combinations = [[]]
+    for name, vals in axes:
+        combinations = [combination + [[name, val]]
+                        for combination in combinations for val in vals]
+    return combinations
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to export the metrics of runs for Prometheus.
+
+A run's metrics are written in Prometheus' text format to a '.prom' file that
+node_exporter's textfile collector reads. Each cluster tag gets its own file
+(see get_metrics_fp()), which always describes the latest run with that
+cluster tag and is replaced atomically, so node_exporter never reads a
+partially written file. The metrics are written once the run has finished
+and, if requested, while it executes (see RunMetrics).
+
+Every metric has a 'cluster_tag' label, and the test suite metrics also have a
+'suite' label:
+
+    clout_run_in_progress                     1 while the run executes
+    clout_run_succeeded                       1 if every phase and test suite
+                                              passed
+    clout_run_start_timestamp_seconds         when the run started
+    clout_run_duration_seconds                how long the run took (so far)
+    clout_run_resumes                         how many times the run was
+                                              resumed
+    clout_run_log_bytes                       the size of the complete log
+    clout_run_cost_node_hours                 the estimated cost of the run
+    clout_phase_duration_seconds              how long starting ('setup') and
+                                              terminating ('teardown') the
+                                              cluster took ('phase' label)
+    clout_test_suite_status                   1 for the test suite's status
+                                              and 0 for the others ('status'
+                                              label)
+    clout_test_suite_duration_seconds         how long the test suite took
+    clout_test_suite_timeout_exceeded         1 if the test suite was stopped
+                                              by its own timeout
+    clout_test_suite_interrupted_attempts     how many of the test suite's
+                                              attempts were interrupted by a
+                                              lost (spot) node
+    clout_test_suite_log_bytes                the size of the test suite's log
+    clout_test_suite_last_success_timestamp_seconds
+                                              when the test suite last passed
+"""
+
+from re import sub
+from os.path import join
+from threading import Lock
+from time import time
+
+from clout.report import is_successful_run
+from clout.util import write_file_atomically
+
+# The statuses that a test suite can have (see
+# clout.run._build_test_suite_summary()).
+test_suite_statuses = ['pass', 'fail', 'timeout', 'not_run']
+
+# The phases whose durations are exported.
+exported_phases = ['setup', 'teardown']
+
+# The help text and type of each metric, in the order they are written.
+metric_descriptions = [
+    ('clout_run_in_progress', 'gauge',
+     'Whether the run is still executing.'),
+    ('clout_run_succeeded', 'gauge',
+     'Whether every phase and test suite of the run passed.'),
+    ('clout_run_start_timestamp_seconds', 'gauge',
+     'When the run started, in seconds since the epoch.'),
+    ('clout_run_duration_seconds', 'gauge',
+     'How long the run took (so far, if it is still executing).'),
+    ('clout_run_resumes', 'gauge',
+     'How many times the run was resumed after being interrupted.'),
+    ('clout_run_log_bytes', 'gauge',
+     'The size of the run\'s complete log.'),
+    ('clout_run_cost_node_hours', 'gauge',
+     'The estimated cost of the run\'s cluster, in node-hours.'),
+    ('clout_phase_duration_seconds', 'gauge',
+     'How long starting and terminating the cluster took.'),
+    ('clout_test_suite_status', 'gauge',
+     'The status of each test suite (1 for its status, 0 for the others).'),
+    ('clout_test_suite_duration_seconds', 'gauge',
+     'How long each test suite took to run.'),
+    ('clout_test_suite_timeout_exceeded', 'gauge',
+     'Whether each test suite was stopped by its own timeout.'),
+    ('clout_test_suite_interrupted_attempts', 'gauge',
+     'How many attempts at running each test suite were interrupted by a '
+     'lost node.'),
+    ('clout_test_suite_log_bytes', 'gauge',
+     'The size of each test suite\'s log.'),
+    ('clout_test_suite_last_success_timestamp_seconds', 'gauge',
+     'When each test suite last passed, in seconds since the epoch.')
+]
+
+def get_metrics_fp(metrics_dir, cluster_tag):
+    """Returns the file that the metrics of runs with a cluster tag are
+    written to.
+
+    Arguments:
+        metrics_dir - node_exporter's textfile collector directory
+        cluster_tag - the cluster tag of the runs
+    """
+    return join(metrics_dir, 'clout_%s.prom' % sub(r'[^A-Za-z0-9_.-]', '_',
+                                                   cluster_tag))
+
+def build_run_metrics(run_summary, log_sizes=None, last_successes=None,
+                      cost=None, resumes=0, in_progress=False, now=None):
+    """Returns the metrics describing a run.
+
+    Returns a dictionary mapping each metric's name to a list of 2-element
+    tuples containing a sample's labels (a list of 2-element tuples
+    containing a label's name and value) and value. Values that aren't known
+    are left out.
+
+    Arguments:
+        run_summary - the summary of the run built by
+            clout.run._execute_commands_and_build_email(), along with its
+            'cluster_tag', 'started_at', and 'finished_at' (None if the run is
+            still executing). It may be partial while the run executes
+        log_sizes - a dictionary mapping the name of each log (e.g.
+            'complete_log.txt') to its size in bytes
+        last_successes - a dictionary mapping the label of each test suite to
+            when it last passed in an earlier run. If a test suite passed in
+            this run, the run's finish time (or now, if the run is still
+            executing) is used instead
+        cost - the estimated cost of the run in node-hours (see
+            estimate_run_cost())
+        resumes - the number of times the run was resumed
+        in_progress - whether the run is still executing
+        now - the current time (defaults to time())
+    """
+    if now is None:
+        now = time()
+    if log_sizes is None:
+        log_sizes = {}
+    if last_successes is None:
+        last_successes = {}
+
+    run_labels = [('cluster_tag', run_summary['cluster_tag'])]
+    metrics = dict([(name, []) for name, metric_type, help_text in
+                    metric_descriptions])
+    def add(name, labels, value):
+        if value is not None:
+            metrics[name].append((run_labels + labels, value))
+
+    started_at = run_summary.get('started_at')
+    finished_at = run_summary.get('finished_at')
+    add('clout_run_in_progress', [], int(in_progress))
+    if not in_progress:
+        add('clout_run_succeeded', [],
+            int(is_successful_run(run_summary)))
+    add('clout_run_start_timestamp_seconds', [], started_at)
+    if started_at is not None:
+        add('clout_run_duration_seconds', [],
+            (now if finished_at is None else finished_at) - started_at)
+    add('clout_run_resumes', [], resumes)
+    add('clout_run_log_bytes', [], log_sizes.get('complete_log.txt'))
+    add('clout_run_cost_node_hours', [], cost)
+    for phase in exported_phases:
+        if phase in run_summary:
+            add('clout_phase_duration_seconds', [('phase', phase)],
+                run_summary[phase]['duration'])
+
+    for test_suite in run_summary['test_suites']:
+        suite_labels = [('suite', test_suite['label'])]
+        for status in test_suite_statuses:
+            add('clout_test_suite_status',
+                suite_labels + [('status', status)],
+                int(test_suite['status'] == status))
+        add('clout_test_suite_duration_seconds', suite_labels,
+            test_suite['duration'])
+        add('clout_test_suite_timeout_exceeded', suite_labels,
+            int(bool(test_suite.get('timeout_exceeded'))))
+        add('clout_test_suite_interrupted_attempts', suite_labels,
+            len(test_suite.get('interrupted_attempts') or []))
+        add('clout_test_suite_log_bytes', suite_labels,
+            log_sizes.get(test_suite.get('log_name')))
+        last_success = last_successes.get(test_suite['label'])
+        if test_suite['status'] == 'pass':
+            last_success = now if finished_at is None else finished_at
+        add('clout_test_suite_last_success_timestamp_seconds', suite_labels,
+            last_success)
+    return metrics
+
+def estimate_run_cost(run_summary, num_nodes=1):
+    """Returns the estimated cost of a run's cluster in node-hours.
+
+    The cost of an autoscaled cluster is measured while its test suites run
+    (see clout.autoscale). Otherwise, the cluster is assumed to have
+    num_nodes nodes for the whole run. Returns None if the cost isn't known.
+
+    Arguments:
+        run_summary - same as for build_run_metrics()
+        num_nodes - the number of nodes in the cluster
+    """
+    cluster_plan = run_summary.get('cluster_plan')
+    if cluster_plan is not None and \
+       cluster_plan.get('actual_cost') is not None:
+        return cluster_plan['actual_cost']
+    if run_summary.get('started_at') is None or \
+       run_summary.get('finished_at') is None:
+        return None
+    return (run_summary['finished_at'] -
+            run_summary['started_at']) * num_nodes / 3600
+
+def get_log_sizes(logs):
+    """Returns a dictionary mapping the name of each log to its size.
+
+    Each log's file position is left at the beginning of the file.
+
+    Arguments:
+        logs - a list of 2-element tuples containing a log's name and an
+            open file containing the log (e.g. the attachments built by
+            clout.run._execute_commands_and_build_email())
+    """
+    log_sizes = {}
+    for log_name, log_f in logs:
+        log_f.seek(0, 2)
+        log_sizes[log_name] = log_f.tell()
+        log_f.seek(0)
+    return log_sizes
+
+def format_metrics(metrics):
+    """Formats metrics in Prometheus' text format.
+
+    Arguments:
+        metrics - the output of build_run_metrics()
+    """
+    lines = []
+    for name, metric_type, help_text in metric_descriptions:
+        samples = metrics.get(name)
+        if not samples:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in samples:
+            lines.append('%s{%s} %s' % (name, ','.join(
+                    ['%s="%s"' % (label, _escape_label_value(label_value))
+                     for label, label_value in labels]),
+                    _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(metrics_fp, metrics):
+    """Atomically writes metrics to a node_exporter textfile.
+
+    Arguments:
+        metrics_fp - the output of get_metrics_fp()
+        metrics - the output of build_run_metrics()
+    """
+    write_file_atomically(metrics_fp, format_metrics(metrics))
+
+
+class RunMetrics(object):
+    """Keeps a run's metrics file up to date while the run executes.
+
+    This is meant to be passed as a listener of a
+    clout.progress.ProgressReporter: the metrics file is rewritten whenever a
+    phase of the run starts or a test suite finishes.
+    """
+
+    def __init__(self, metrics_fp, cluster_tag, last_successes=None,
+                 resumes=0):
+        """Initializes a new object to write a run's metrics.
+
+        Arguments:
+            metrics_fp - the output of get_metrics_fp()
+            cluster_tag - the run's cluster tag
+            last_successes - same as for build_run_metrics()
+            resumes - same as for build_run_metrics()
+        """
+        self.metrics_fp = metrics_fp
+        self.last_successes = last_successes
+        self.resumes = resumes
+
+        self._lock = Lock()
+        self._summary = {'cluster_tag': cluster_tag, 'started_at': None,
+                         'finished_at': None, 'test_suites': []}
+        self._phase = None
+        self._phase_started_at = None
+
+    def update(self, event):
+        """Updates the metrics file with a progress event.
+
+        Arguments:
+            event - the event, as returned by
+                clout.progress.ProgressReporter.report()
+        """
+        with self._lock:
+            name = event['event']
+            if name == 'run_started':
+                self._summary['started_at'] = event['time']
+            elif name == 'phase_changed':
+                if self._phase in exported_phases:
+                    self._summary[self._phase] = {
+                            'succeeded': None,
+                            'duration': event['time'] -
+                                        self._phase_started_at}
+                self._phase = event['phase']
+                self._phase_started_at = event['time']
+            elif name == 'suite_finished':
+                self._summary['test_suites'].append({
+                        'label': event['label'], 'status': event['status'],
+                        'duration': event['duration'],
+                        'timeout_exceeded': False})
+                if event['status'] == 'pass':
+                    self.last_successes = dict(self.last_successes or {})
+                    self.last_successes[event['label']] = event['time']
+            else:
+                return
+
+            write_metrics(self.metrics_fp, build_run_metrics(self._summary,
+                    last_successes=self.last_successes, resumes=self.resumes,
+                    in_progress=True, now=event['time']))
+
+
+def _escape_label_value(label_value):
+    """Escapes a label's value for Prometheus' text format."""
+    return label_value.replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+def _format_value(value):
+    """Formats a sample's value for Prometheus' text format."""
+    if isinstance(value, bool) or isinstance(value, int):
+        return str(int(value))
+    return repr(float(value))
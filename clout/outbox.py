@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to spool emails to disk and deliver them reliably.
+
+Emails are written to an on-disk outbox before any attempt is made to send
+them, so an SMTP problem at the end of a multi-hour run can't lose the results.
+The outbox is then flushed: every pending email is delivered over a single
+authenticated SMTP connection, reconnecting with exponential backoff if the
+connection fails. Anything that still can't be delivered stays in the outbox
+until the next flush (e.g. with 'clout flush-outbox').
+"""
+
+from datetime import datetime
+from errno import ENOENT
+from fcntl import flock, LOCK_EX, LOCK_UN
+from json import dumps, loads
+from os import listdir, unlink
+from os.path import join
+from smtplib import (SMTP, SMTPAuthenticationError, SMTPDataError,
+                     SMTPException, SMTPRecipientsRefused, SMTPSenderRefused)
+from socket import error as socket_error
+from time import sleep, time
+from uuid import uuid4
+
+from clout.util import (connect_to_smtp_server, create_dir,
+                        write_file_atomically)
+
+class Outbox(object):
+    """A directory of emails waiting to be delivered.
+
+    Each email is stored as two files: the message itself (<id>.eml) and a
+    small JSON file describing it (<id>.json), which is written last. An email
+    is only considered pending once its JSON file exists, so a crash while
+    spooling never results in a partial email being sent.
+    """
+
+    def __init__(self, outbox_dir):
+        """Initializes an outbox, creating outbox_dir if necessary.
+
+        Arguments:
+            outbox_dir - the directory that pending emails are stored in
+        """
+        self.outbox_dir = create_dir(outbox_dir)
+
+    def add(self, sender, recipients, msg):
+        """Adds an email to the outbox and returns its ID.
+
+        Arguments:
+            sender - the sender email address
+            recipients - a list of email addresses to send the email to
+            msg - the message (e.g. the output of
+                clout.util.build_email_message())
+        """
+        # Include microseconds so that emails sort in the order they were
+        # added.
+        msg_id = '%s-%s' % (datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                            uuid4().hex[:8])
+        write_file_atomically(join(self.outbox_dir, '%s.eml' % msg_id), msg)
+        self._write_info(msg_id, {'sender': sender, 'recipients': recipients,
+                                  'queued_at': time(), 'attempts': 0,
+                                  'last_error': None})
+        return msg_id
+
+    def pending(self):
+        """Returns the IDs of the emails waiting to be delivered, oldest first.
+        """
+        return sorted([fn[:-len('.json')] for fn in listdir(self.outbox_dir)
+                       if fn.endswith('.json')])
+
+    def get_info(self, msg_id):
+        """Returns the dictionary describing a pending email."""
+        info_f = open(join(self.outbox_dir, '%s.json' % msg_id), 'U')
+        try:
+            return loads(info_f.read())
+        finally:
+            info_f.close()
+
+    def flush(self, host, port, sender, password, max_attempts=5,
+              retry_delay=30.0, smtp_class=SMTP):
+        """Delivers every pending email, reusing one SMTP connection.
+
+        If connecting to the server or sending an email fails because of a
+        (possibly temporary) connection or server problem, the connection is
+        reopened and the email is retried, waiting retry_delay seconds before
+        the first retry and doubling the wait before each further retry. After
+        max_attempts failed attempts in a row, the flush gives up and the
+        remaining emails are left in the outbox. Emails that the server
+        permanently rejects (e.g. every recipient was refused) are also left
+        in the outbox, with the error recorded, so that they can be inspected.
+
+        Only one process flushes the outbox at a time, so an email is never
+        sent twice by concurrent flushes.
+
+        Returns a 2-element tuple containing the list of IDs of the emails
+        that were delivered and the list of IDs of the emails that are still
+        pending.
+
+        Arguments:
+            host - the SMTP server to send the emails with
+            port - the port number of the SMTP server to connect to
+            sender - the email address to log into the SMTP server with
+            password - the password to log into the SMTP server with
+            max_attempts - the number of times to try connecting and sending
+                before giving up
+            retry_delay - the number of seconds to wait before the first retry
+            smtp_class - the class used to connect to the SMTP server (e.g. to
+                substitute a stand-in server when testing)
+        """
+        lock_f = open(join(self.outbox_dir, '.flush.lock'), 'a')
+        flock(lock_f.fileno(), LOCK_EX)
+        try:
+            return self._flush(host, port, sender, password, max_attempts,
+                               retry_delay, smtp_class)
+        finally:
+            flock(lock_f.fileno(), LOCK_UN)
+            lock_f.close()
+
+    def _flush(self, host, port, sender, password, max_attempts, retry_delay,
+               smtp_class):
+        """Delivers the pending emails. The caller must hold the flush lock.
+        """
+        delivered, rejected = [], []
+        server = None
+        failed_attempts = 0
+
+        pending = self.pending()
+        while pending:
+            msg_id = pending[0]
+            info = self.get_info(msg_id)
+            try:
+                if server is None:
+                    server = connect_to_smtp_server(host, port, sender,
+                                                    password, smtp_class)
+                msg_f = open(join(self.outbox_dir, '%s.eml' % msg_id), 'U')
+                try:
+                    msg = msg_f.read()
+                finally:
+                    msg_f.close()
+                server.sendmail(info['sender'], info['recipients'], msg)
+            except (SMTPRecipientsRefused, SMTPSenderRefused,
+                    SMTPDataError) as e:
+                if isinstance(e, SMTPDataError) and e.smtp_code < 500:
+                    # A temporary failure; retry as for a connection problem.
+                    server = self._handle_failure(msg_id, info, e, server)
+                    failed_attempts += 1
+                else:
+                    self._record_failure(msg_id, info, e)
+                    rejected.append(pending.pop(0))
+                    continue
+            except SMTPAuthenticationError:
+                # Retrying won't help, and could lock the account.
+                self._close(server)
+                raise
+            except (SMTPException, socket_error) as e:
+                server = self._handle_failure(msg_id, info, e, server)
+                failed_attempts += 1
+            else:
+                self._remove(msg_id)
+                delivered.append(pending.pop(0))
+                failed_attempts = 0
+                continue
+
+            if failed_attempts >= max_attempts:
+                break
+            sleep(retry_delay * 2 ** (failed_attempts - 1))
+
+        self._close(server)
+        return delivered, rejected + pending
+
+    def _handle_failure(self, msg_id, info, error, server):
+        """Records a failed attempt and closes the (possibly broken) server.
+
+        Returns None, the new value of the server connection.
+        """
+        self._record_failure(msg_id, info, error)
+        self._close(server)
+        return None
+
+    def _record_failure(self, msg_id, info, error):
+        """Records a failed delivery attempt in the email's JSON file."""
+        info['attempts'] += 1
+        info['last_error'] = '%s: %s' % (error.__class__.__name__, error)
+        self._write_info(msg_id, info)
+
+    def _close(self, server):
+        """Closes an SMTP connection, ignoring any errors in doing so."""
+        if server is not None:
+            try:
+                server.quit()
+            except (SMTPException, socket_error):
+                pass
+
+    def _write_info(self, msg_id, info):
+        """Writes the dictionary describing an email to its JSON file."""
+        write_file_atomically(join(self.outbox_dir, '%s.json' % msg_id),
+                              dumps(info))
+
+    def _remove(self, msg_id):
+        """Removes a delivered email from the outbox."""
+        # Remove the JSON file first so that the email stops being pending
+        # even if we crash before removing the message itself.
+        for ext in ('json', 'eml'):
+            try:
+                unlink(join(self.outbox_dir, '%s.%s' % (msg_id, ext)))
+            except OSError as e:
+                if e.errno != ENOENT:
+                    raise
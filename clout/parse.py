@@ -16,7 +16,8 @@ def parse_config_file(config_f):
 
     Returns a list of lists containing the test suite label as the first
     element and the command string needed to execute the test suite as the
-    second element.
+    second element. Any per-suite options (see parse_suite_options()) are
+    validated but not returned.
 
     Arguments:
         config_f - the input configuration file describing test suites
@@ -26,20 +27,45 @@ def parse_config_file(config_f):
     for line in config_f:
         if not _can_ignore(line):
             fields = line.strip().split('\t')
-            if len(fields) != 2:
+            if len(fields) < 2:
                 raise ValueError("Each line in the config file must contain "
-                                 "exactly two fields separated by tabs.")
+                                 "a label and a command separated by a tab, "
+                                 "optionally followed by tab-separated "
+                                 "key=value options.")
             if fields[0] in used_test_suite_names:
                 raise ValueError("The test suite label '%s' has already been "
                                  "used. Each test suite label must be unique."
                                  % fields[0])
-            results.append(fields)
+            _parse_key_value_pairs(fields[2:], 'config file', line)
+            results.append(fields[:2])
             used_test_suite_names.append(fields[0])
     if len(results) == 0:
         raise ValueError("The config file must contain at least one test "
                          "suite to run.")
     return results
 
+def parse_suite_options(config_f):
+    """Parses the per-suite options in a test suite configuration file.
+
+    Options are given as tab-separated key=value fields after a test suite's
+    command (e.g. 'results=junit').
+
+    Returns a dictionary mapping each test suite's label to a dictionary of
+    its options (an empty dictionary if it has none).
+
+    Arguments:
+        config_f - the input configuration file describing test suites. It
+            should already have been validated with parse_config_file()
+    """
+    suite_options = {}
+    for line in config_f:
+        if not _can_ignore(line):
+            fields = line.strip().split('\t')
+            suite_options[fields[0]] = _parse_key_value_pairs(fields[2:],
+                                                              'config file',
+                                                              line)
+    return suite_options
+
 def parse_email_list(email_list_f):
     """Parses and validates a file containing email addresses.
     
@@ -89,6 +115,63 @@ def parse_email_settings(email_settings_f):
                 "more of the following required fields: %r" % required_fields)
     return settings
 
+def parse_schedule_file(schedule_f):
+    """Parses and validates a file describing when runs should be queued.
+
+    Each line contains a time of day (24-hour HH:MM format) followed by one or
+    more tab-separated key=value pairs describing the run to queue at that
+    time (see clout.serve for the recognized keys).
+
+    Returns a list of 3-element tuples containing the hour, the minute, and a
+    dictionary of the run's key/value pairs.
+
+    Arguments:
+        schedule_f - the input file containing the run schedule
+    """
+    schedule = []
+    for line in schedule_f:
+        if not _can_ignore(line):
+            fields = line.strip().split('\t')
+            if len(fields) < 2:
+                raise ValueError("Each line in the schedule file must contain "
+                                 "a time followed by at least one key=value "
+                                 "pair, separated by tabs.")
+            try:
+                hour, minute = map(int, fields[0].split(':'))
+            except ValueError:
+                raise ValueError("The time '%s' in the schedule file must be "
+                                 "in HH:MM format." % fields[0])
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError("The time '%s' in the schedule file is not a "
+                                 "valid time of day." % fields[0])
+
+            run_options = _parse_key_value_pairs(fields[1:], 'schedule file',
+                                                 line)
+            schedule.append((hour, minute, run_options))
+    return schedule
+
+def _parse_key_value_pairs(fields, file_desc, line):
+    """Returns a dictionary of the key=value pairs in a line's fields.
+
+    Arguments:
+        fields - the fields containing key=value pairs
+        file_desc - a description of the file being parsed (e.g. 'schedule
+            file'), for error messages
+        line - the line that the fields came from, for error messages
+    """
+    pairs = {}
+    for field in fields:
+        if '=' not in field:
+            raise ValueError("The field '%s' in the %s must be a key=value "
+                             "pair." % (field, file_desc))
+        key, val = field.split('=', 1)
+        if key.strip() in pairs:
+            raise ValueError("The key '%s' is defined more than once in the "
+                             "%s line '%s'." % (key.strip(), file_desc,
+                                                line.strip()))
+        pairs[key.strip()] = val.strip()
+    return pairs
+
 def _can_ignore(line):
     """Returns True if the line can be ignored (comment or blank line)."""
     return False if line.strip() != '' and not line.strip().startswith('#') \
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to share a limited number of clusters between concurrent runs.
+
+Every Clout process on a machine that uses the same pool directory shares one
+pool of clusters. A run asks the pool for a cluster instead of using its own
+cluster tag: the pool hands it an idle (warm) cluster that was booted from the
+same cluster template, or a new cluster tag to start a cluster under. The pool
+never has more than max_clusters clusters, or more than max_instances nodes
+across them. When it is full, runs wait in a queue (first come, first served)
+until a cluster is released, and idle clusters that no waiting run can reuse
+are terminated to make room.
+
+The pool's state is kept in pool.json, which is only read and written while
+holding an exclusive lock on pool.lock. Every change to the pool is also
+appended to usage.jsonl as a JSON object with 'event' and 'time' keys:
+
+    run_queued          'run_id', 'num_nodes'
+    cluster_leased      'run_id', 'cluster_tag', 'num_nodes', 'reused',
+                        'queue_wait' (the number of seconds the run waited)
+    cluster_released    'run_id', 'cluster_tag', 'reusable'
+    cluster_terminated  'cluster_tag', 'succeeded'
+"""
+
+from fcntl import flock, LOCK_EX, LOCK_UN
+from json import dumps, loads
+from os import getpid
+from os.path import exists, join
+from socket import gethostname
+from tempfile import TemporaryFile
+from time import sleep, time
+
+from clout.progress import is_process_running
+from clout.util import CommandExecutor, create_dir, write_file_atomically
+
+def terminate_pooled_cluster(cluster):
+    """Terminates a cluster that is no longer needed by the pool.
+
+    This is the default terminator used by ClusterPool. Returns the same
+    value as the first element returned by CommandExecutor.__call__().
+
+    Arguments:
+        cluster - the pool's record of the cluster, containing the
+            'terminate_cmd' to run and its 'terminate_timeout' (in minutes)
+    """
+    cmd_executor = CommandExecutor([cluster['terminate_cmd']],
+                                   TemporaryFile(prefix='clout_log',
+                                                 suffix='.txt'))
+    return cmd_executor(cluster['terminate_timeout'])[0]
+
+
+class ClusterPool(object):
+    """Pool of clusters shared by every Clout process using pool_dir.
+
+    A lease on a cluster is a dictionary containing the 'cluster_tag' that
+    the run should use, the 'run_id' it was leased to, the number of nodes
+    in the cluster ('num_nodes'), whether the cluster is already running and
+    should be reused instead of started ('reused'), and the number of
+    seconds that the run waited for the pool ('queue_wait').
+
+    A run that crashes keeps its lease (its cluster is still running), so
+    that the run can be resumed on the same cluster with reacquire().
+    Waiting runs that crash are removed from the queue.
+    """
+
+    def __init__(self, pool_dir, max_clusters=5, max_instances=20,
+                 idle_timeout=0.0, poll_interval=5.0,
+                 terminator=terminate_pooled_cluster,
+                 tag_prefix='clout_pool_'):
+        """Initializes a new object to access the pool.
+
+        Arguments:
+            pool_dir - the directory that the pool's state is stored in
+            max_clusters - the maximum number of clusters in the pool
+            max_instances - the maximum number of nodes across the clusters
+                in the pool
+            idle_timeout - the number of minutes to keep an idle cluster
+                running in case a later run can reuse it. Idle clusters that
+                a waiting run can reuse are always kept
+            poll_interval - the number of seconds to wait between checks of
+                the pool while waiting for a cluster
+            terminator - the function used to terminate clusters that the
+                pool no longer needs. Must accept the pool's record of the
+                cluster (see terminate_pooled_cluster())
+            tag_prefix - the prefix of the cluster tags handed out by the
+                pool. Each tag is the prefix followed by a number
+        """
+        if max_clusters < 1:
+            raise ValueError("The maximum number of clusters in the pool "
+                             "must be at least one.")
+        if max_instances < 1:
+            raise ValueError("The maximum number of instances in the pool "
+                             "must be at least one.")
+
+        self.pool_dir = create_dir(pool_dir)
+        self.max_clusters = max_clusters
+        self.max_instances = max_instances
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.terminator = terminator
+        self.tag_prefix = tag_prefix
+
+        self.state_fp = join(pool_dir, 'pool.json')
+        self.lock_fp = join(pool_dir, 'pool.lock')
+        self.usage_fp = join(pool_dir, 'usage.jsonl')
+
+    def acquire(self, run_id, cluster_key, num_nodes, terminate_cmd,
+                terminate_timeout=20.0):
+        """Leases a cluster to a run, waiting until the pool has room.
+
+        Returns the lease (see the class docstring).
+
+        Arguments:
+            run_id - the ID of the run that the cluster is leased to
+            cluster_key - identifies the kind of cluster the run needs (see
+                clout.backend.StarClusterBackend.cluster_key()). Only idle
+                clusters with the same key and number of nodes are reused
+            num_nodes - the number of nodes in the run's cluster
+            terminate_cmd - a function that is passed a cluster tag and
+                returns the command that terminates the cluster (e.g.
+                clout.backend.StarClusterBackend.build_terminate_cmd)
+            terminate_timeout - the number of minutes to allow the cluster to
+                be terminated, once the pool no longer needs it
+        """
+        if num_nodes > self.max_instances:
+            raise ValueError("The run's cluster has %d node(s), but the pool "
+                             "only allows %d instance(s)." %
+                             (num_nodes, self.max_instances))
+
+        cluster_key = list(cluster_key)
+        queued_at = time()
+        while True:
+            evicted = []
+            with _PoolLock(self.lock_fp):
+                state = self._load()
+                waiters = state['waiting']
+                waiter = None
+                for entry in waiters:
+                    if entry['run_id'] == run_id:
+                        waiter = entry
+                if waiter is None:
+                    waiter = {'run_id': run_id, 'cluster_key': cluster_key,
+                              'num_nodes': num_nodes, 'pid': getpid(),
+                              'hostname': gethostname(),
+                              'queued_at': queued_at}
+                    waiters.append(waiter)
+
+                cluster = self._find_idle_cluster(state, cluster_key,
+                                                  num_nodes)
+                if cluster is None and waiters[0] is waiter:
+                    # Only the run at the front of the queue may start a new
+                    # cluster, so that large clusters aren't starved.
+                    evicted = self._make_room(state, num_nodes)
+                    if evicted is not None:
+                        cluster = {'cluster_tag': self._new_tag(state),
+                                   'cluster_key': cluster_key,
+                                   'num_nodes': num_nodes, 'started': False,
+                                   'started_at': time()}
+                        state['clusters'].append(cluster)
+
+                if cluster is None:
+                    if not waiter.get('recorded'):
+                        waiter['recorded'] = True
+                        self._record('run_queued', run_id=run_id,
+                                     num_nodes=num_nodes)
+                    self._save(state)
+                else:
+                    waiters.remove(waiter)
+                    reused = cluster['started']
+                    cluster.update(state='busy', run_id=run_id,
+                                   pid=getpid(), hostname=gethostname(),
+                                   started=True, idle_since=None,
+                                   terminate_cmd=terminate_cmd(
+                                           cluster['cluster_tag']),
+                                   terminate_timeout=terminate_timeout)
+                    lease = {'cluster_tag': cluster['cluster_tag'],
+                             'run_id': run_id, 'num_nodes': num_nodes,
+                             'reused': reused,
+                             'queue_wait': time() - queued_at}
+                    self._record('cluster_leased', **lease)
+                    self._save(state)
+
+            if cluster is not None:
+                self._terminate(evicted)
+                return lease
+            sleep(self.poll_interval)
+
+    def reacquire(self, lease):
+        """Takes back a lease that is held by a run that crashed, so that the
+        run can be resumed on the same cluster.
+
+        Returns the lease. Raises a ValueError if the cluster is no longer
+        leased to the run.
+        """
+        with _PoolLock(self.lock_fp):
+            state = self._load()
+            for cluster in state['clusters']:
+                if cluster['cluster_tag'] == lease['cluster_tag'] and \
+                   cluster.get('run_id') == lease['run_id'] and \
+                   cluster['state'] == 'busy':
+                    cluster.update(pid=getpid(), hostname=gethostname())
+                    self._save(state)
+                    return lease
+        raise ValueError("The cluster '%s' is no longer leased to the run "
+                         "'%s'." % (lease['cluster_tag'], lease['run_id']))
+
+    def release(self, lease, reusable=True):
+        """Returns a leased cluster to the pool.
+
+        The cluster is kept running if another run can reuse it (or for
+        idle_timeout minutes), and is terminated otherwise.
+
+        Arguments:
+            lease - the lease returned by acquire() or reacquire()
+            reusable - if False, the cluster is terminated instead of being
+                kept for other runs (e.g. because it failed to start)
+        """
+        with _PoolLock(self.lock_fp):
+            state = self._load()
+            for cluster in state['clusters']:
+                if cluster['cluster_tag'] == lease['cluster_tag'] and \
+                   cluster.get('run_id') == lease['run_id']:
+                    cluster.update(state='idle', run_id=None, pid=None,
+                                   hostname=None, idle_since=time())
+                    if not reusable:
+                        # Make sure that nobody reuses it before it is
+                        # terminated below.
+                        cluster['idle_since'] = 0.0
+                        cluster['cluster_key'] = None
+                    self._record('cluster_released',
+                                 run_id=lease['run_id'],
+                                 cluster_tag=lease['cluster_tag'],
+                                 reusable=reusable)
+                    break
+            self._save(state)
+        self.terminate_idle_clusters()
+
+    def terminate_idle_clusters(self):
+        """Terminates the idle clusters that have been idle for longer than
+        idle_timeout and that no waiting run can reuse.
+
+        Returns a list of the terminated clusters' tags.
+        """
+        with _PoolLock(self.lock_fp):
+            state = self._load()
+            expired = []
+            for cluster in state['clusters']:
+                if cluster['state'] != 'idle':
+                    continue
+                idle_minutes = (time() - cluster['idle_since']) / 60.0
+                wanted = False
+                for waiter in state['waiting']:
+                    if waiter['cluster_key'] == cluster['cluster_key'] and \
+                       waiter['num_nodes'] == cluster['num_nodes']:
+                        wanted = True
+                if not wanted and idle_minutes >= self.idle_timeout:
+                    expired.append(cluster)
+            for cluster in expired:
+                state['clusters'].remove(cluster)
+            self._save(state)
+        self._terminate(expired)
+        return [cluster['cluster_tag'] for cluster in expired]
+
+    def status(self):
+        """Returns a dictionary describing the pool.
+
+        The dictionary contains the pool's 'clusters' (each with its
+        'cluster_tag', 'state' ('busy', 'idle', or 'orphaned' if the run
+        that leased it is no longer running), 'num_nodes', the 'run_id' it is
+        leased to, and the number of seconds it has been running for
+        ('running_for')), the 'waiting' runs (each with its 'run_id',
+        'num_nodes', and the number of seconds it has waited for
+        ('waiting_for')), and the number of 'instances' in use.
+        """
+        with _PoolLock(self.lock_fp):
+            state = self._load()
+            self._save(state)
+
+        now = time()
+        clusters = []
+        for cluster in state['clusters']:
+            cluster_state = cluster['state']
+            if cluster_state == 'busy' and not _is_owner_running(cluster):
+                cluster_state = 'orphaned'
+            clusters.append({'cluster_tag': cluster['cluster_tag'],
+                             'state': cluster_state,
+                             'num_nodes': cluster['num_nodes'],
+                             'run_id': cluster.get('run_id'),
+                             'running_for': now - cluster['started_at']})
+        waiting = [{'run_id': waiter['run_id'],
+                    'num_nodes': waiter['num_nodes'],
+                    'waiting_for': now - waiter['queued_at']}
+                   for waiter in state['waiting']]
+        return {'clusters': clusters, 'waiting': waiting,
+                'instances': sum([cluster['num_nodes']
+                                  for cluster in state['clusters']])}
+
+    def read_usage(self):
+        """Returns the events in the pool's usage log, oldest first."""
+        if not exists(self.usage_fp):
+            return []
+        usage_f = open(self.usage_fp, 'U')
+        try:
+            return [loads(line) for line in usage_f if line.strip()]
+        finally:
+            usage_f.close()
+
+    def _find_idle_cluster(self, state, cluster_key, num_nodes):
+        """Returns an idle cluster that can be reused, or None."""
+        for cluster in state['clusters']:
+            if cluster['state'] == 'idle' and \
+               cluster['cluster_key'] == cluster_key and \
+               cluster['num_nodes'] == num_nodes:
+                return cluster
+        return None
+
+    def _make_room(self, state, num_nodes):
+        """Makes room in the pool for a new cluster with num_nodes nodes.
+
+        Returns the idle clusters that were removed from the pool to make
+        room (the oldest idle clusters first), or None if there isn't enough
+        room even without the idle clusters.
+        """
+        idle_clusters = sorted([cluster for cluster in state['clusters']
+                                if cluster['state'] == 'idle'],
+                               key=lambda cluster: cluster['idle_since'])
+        evicted = []
+        while True:
+            clusters = [cluster for cluster in state['clusters']
+                        if cluster not in evicted]
+            instances = sum([cluster['num_nodes'] for cluster in clusters])
+            if len(clusters) < self.max_clusters and \
+               instances + num_nodes <= self.max_instances:
+                break
+            if not idle_clusters:
+                return None
+            evicted.append(idle_clusters.pop(0))
+
+        for cluster in evicted:
+            state['clusters'].remove(cluster)
+        return evicted
+
+    def _new_tag(self, state):
+        """Returns the lowest-numbered cluster tag that isn't in use."""
+        tags = [cluster['cluster_tag'] for cluster in state['clusters']]
+        tag_number = 1
+        while '%s%d' % (self.tag_prefix, tag_number) in tags:
+            tag_number += 1
+        return '%s%d' % (self.tag_prefix, tag_number)
+
+    def _terminate(self, clusters):
+        """Terminates clusters that were removed from the pool."""
+        for cluster in clusters:
+            succeeded = None
+            if cluster.get('terminate_cmd') is not None:
+                succeeded = self.terminator(cluster)
+            with _PoolLock(self.lock_fp):
+                self._record('cluster_terminated',
+                             cluster_tag=cluster['cluster_tag'],
+                             succeeded=succeeded)
+
+    def _load(self):
+        """Reads the pool's state and removes waiting runs that crashed.
+
+        The caller must hold the pool's lock.
+        """
+        state = {'clusters': [], 'waiting': []}
+        if exists(self.state_fp):
+            state_f = open(self.state_fp, 'U')
+            try:
+                state = loads(state_f.read())
+            finally:
+                state_f.close()
+        state['waiting'] = [waiter for waiter in state['waiting']
+                            if _is_owner_running(waiter)]
+        return state
+
+    def _save(self, state):
+        """Writes the pool's state. The caller must hold the pool's lock."""
+        write_file_atomically(self.state_fp, dumps(state))
+
+    def _record(self, event, **fields):
+        """Appends an event to the usage log.
+
+        The caller must hold the pool's lock.
+        """
+        usage_f = open(self.usage_fp, 'a')
+        try:
+            usage_f.write(dumps(dict(fields, event=event, time=time()),
+                                sort_keys=True) + '\n')
+        finally:
+            usage_f.close()
+
+
+class _PoolLock(object):
+    """Exclusive lock on the pool's state, held for the duration of a with
+    statement.
+
+    The lock is released by the operating system if the process holding it
+    crashes.
+    """
+
+    def __init__(self, lock_fp):
+        self.lock_fp = lock_fp
+        self._lock_f = None
+
+    def __enter__(self):
+        self._lock_f = open(self.lock_fp, 'a')
+        flock(self._lock_f.fileno(), LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        flock(self._lock_f.fileno(), LOCK_UN)
+        self._lock_f.close()
+        self._lock_f = None
+
+
+def _is_owner_running(entry):
+    """Returns True if the process that owns a pool entry may be running.
+
+    We can only check whether processes on this machine are alive. Entries
+    owned by other machines (e.g. with a shared pool_dir) are trusted.
+    """
+    if entry.get('pid') is None:
+        return False
+    if entry['hostname'] != gethostname():
+        return True
+    return is_process_running(entry['pid'])
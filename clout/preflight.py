@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to check a run's settings before any cluster is started.
+
+Many problems with a run's settings only show up once a cluster has been
+running for hours (e.g. a test suite command that doesn't parse), or at the
+very end of the run (e.g. a bad SMTP password, which means the results are
+never sent). Preflight checks catch these problems in a few seconds, without
+starting a cluster:
+
+    SMTP login          logs into the SMTP server that the results will be
+                        sent with (and logs out again without sending
+                        anything)
+    StarCluster config  the StarCluster config file defines the cluster
+                        template, the template names a key, and the key's
+                        file exists and is only readable by its owner (ssh
+                        refuses to use it otherwise)
+    StarCluster         the starcluster executable can be found
+    executable
+    command syntax      every test suite command (and matrix setup command)
+                        parses in the shell, without being run
+
+The checks are independent, so they are run at the same time (see
+run_preflight_checks()).
+"""
+
+from ConfigParser import RawConfigParser
+from os import access, environ, pathsep, R_OK, stat, X_OK
+from os.path import expanduser, isfile, join
+from smtplib import SMTP
+from subprocess import PIPE, Popen
+from threading import Thread
+from time import time
+
+from clout.backend import StarClusterBackend
+from clout.util import connect_to_smtp_server
+
+# The number of seconds that the checks may take altogether.
+default_preflight_timeout = 15.0
+
+# The shell that test suite commands are checked with, unless the backend
+# runs them with a different shell.
+default_shell = '/bin/bash'
+
+def check_smtp_login(email_settings, timeout=default_preflight_timeout,
+                     smtp_class=SMTP):
+    """Logs into the SMTP server that the results will be sent with.
+
+    Raises an exception if the server can't be reached or the login fails.
+
+    Arguments:
+        email_settings - the output of clout.parse.parse_email_settings()
+        timeout - the number of seconds to wait for the server to respond
+        smtp_class - same as for clout.util.connect_to_smtp_server(). It is
+            also passed the timeout
+    """
+    def connect(host, port):
+        return smtp_class(host, port, timeout=timeout)
+    server = connect_to_smtp_server(email_settings['smtp_server'],
+                                    email_settings['smtp_port'],
+                                    email_settings['sender'],
+                                    email_settings['password'], connect)
+    server.quit()
+
+def check_starcluster_config(sc_config_fp, cluster_template=None):
+    """Checks a StarCluster config file's cluster template and key.
+
+    Raises a ValueError if the config file can't be read, the cluster
+    template isn't defined, the template (or a template that it extends)
+    doesn't name a key, or the key's file is missing, unreadable, or can be
+    accessed by other users.
+
+    Arguments:
+        sc_config_fp - the StarCluster config file
+        cluster_template - the cluster template that the run uses. If not
+            provided, the config file's default template is checked
+    """
+    config = RawConfigParser()
+    if not config.read(sc_config_fp):
+        raise ValueError("The StarCluster config file '%s' could not be "
+                         "read." % sc_config_fp)
+    if cluster_template is None:
+        if not config.has_option('global', 'default_template'):
+            raise ValueError("No cluster template was given, and the "
+                             "StarCluster config file '%s' doesn't set a "
+                             "DEFAULT_TEMPLATE." % sc_config_fp)
+        cluster_template = config.get('global', 'default_template')
+
+    key_name = _get_template_setting(config, cluster_template, 'keyname')
+    if key_name is None:
+        raise ValueError("The cluster template '%s' doesn't set a KEYNAME." %
+                         cluster_template)
+    key_section = 'key %s' % key_name
+    if not config.has_option(key_section, 'key_location'):
+        raise ValueError("The key '%s' used by the cluster template '%s' "
+                         "isn't defined with a KEY_LOCATION." % (key_name,
+                         cluster_template))
+    check_key_permissions(expanduser(config.get(key_section,
+                                                'key_location')))
+
+def check_key_permissions(key_fp):
+    """Checks that ssh will use a private key file.
+
+    Raises a ValueError if the file doesn't exist, can't be read, or can be
+    accessed by users other than its owner.
+
+    Arguments:
+        key_fp - the private key file
+    """
+    try:
+        mode = stat(key_fp).st_mode
+    except OSError:
+        raise ValueError("The key file '%s' does not exist." % key_fp)
+    if not access(key_fp, R_OK):
+        raise ValueError("The key file '%s' can't be read." % key_fp)
+    if mode & 0o077:
+        raise ValueError("The key file '%s' can be accessed by other users "
+                         "(its permissions are %03o), so ssh will refuse to "
+                         "use it. Run 'chmod 400 %s' to fix this." % (key_fp,
+                         mode & 0o777, key_fp))
+
+def check_executable(exe_fp):
+    """Checks that an executable exists (on the PATH, if it isn't a path).
+
+    Raises a ValueError if it doesn't.
+
+    Arguments:
+        exe_fp - the executable's path or name
+    """
+    if '/' in exe_fp:
+        candidates = [expanduser(exe_fp)]
+    else:
+        candidates = [join(path_dir, exe_fp) for path_dir in
+                      environ.get('PATH', '').split(pathsep)]
+    for candidate in candidates:
+        if isfile(candidate) and access(candidate, X_OK):
+            return
+    raise ValueError("The executable '%s' could not be found." % exe_fp)
+
+def check_cmd_syntax(cmds, shell=default_shell):
+    """Checks that shell commands parse, without running them.
+
+    Raises a ValueError listing the commands that don't parse, along with the
+    shell's error messages.
+
+    Arguments:
+        cmds - a list of 2-element lists containing a label for each command
+            (e.g. its test suite's label) and the command
+        shell - the shell to parse the commands with
+    """
+    errors = []
+    for label, cmd in cmds:
+        proc = Popen([shell, '-n', '-c', cmd], stdout=PIPE, stderr=PIPE,
+                     universal_newlines=True)
+        stderr = proc.communicate()[1]
+        if proc.returncode != 0:
+            errors.append('%s: %s' % (label, stderr.strip() or
+                                      'exit code %d' % proc.returncode))
+    if errors:
+        raise ValueError("The following command(s) have syntax errors:\n%s" %
+                         '\n'.join(errors))
+
+def build_preflight_checks(test_suites, email_settings, backend,
+                           matrices=None, timeout=default_preflight_timeout):
+    """Returns the preflight checks for a run.
+
+    Returns a list of 2-element tuples containing the name of each check and
+    a function that performs the check (raising an exception if it fails).
+
+    Arguments:
+        test_suites - the output of clout.parse.parse_config_file() (after
+            any matrices were expanded)
+        email_settings - the output of clout.parse.parse_email_settings()
+        backend - the backend that the run uses (see clout.backend). The
+            StarCluster checks are only done for a StarClusterBackend, and
+            the commands are checked with the backend's shell if it has one
+        matrices - the matrices returned by clout.matrix.expand_matrices().
+            Their setup commands are checked along with the test suites'
+        timeout - the number of seconds that the SMTP login may take
+    """
+    cmds = [[label, cmd] for label, cmd in test_suites]
+    for matrix in matrices or []:
+        for setup_cmd, setup_values in matrix['setup']:
+            cmds.append(['%s setup' % matrix['label'], setup_cmd])
+    shell = getattr(backend, 'shell', default_shell)
+
+    checks = [('SMTP login',
+               lambda: check_smtp_login(email_settings, timeout))]
+    if isinstance(backend, StarClusterBackend):
+        checks.append(('StarCluster config',
+                       lambda: check_starcluster_config(backend.sc_config_fp,
+                               backend.cluster_template)))
+        checks.append(('StarCluster executable',
+                       lambda: check_executable(backend.sc_exe_fp)))
+    checks.append(('command syntax', lambda: check_cmd_syntax(cmds, shell)))
+    return checks
+
+def run_preflight_checks(checks, timeout=default_preflight_timeout):
+    """Runs preflight checks at the same time.
+
+    Returns a list of dictionaries (in the same order as checks) with the
+    'name' of each check, the 'error' that it failed with (None if it
+    passed), and its 'duration' in seconds (None if it didn't finish in
+    time, in which case it failed).
+
+    Arguments:
+        checks - the output of build_preflight_checks()
+        timeout - the number of seconds to wait for all of the checks to
+            finish
+    """
+    results = [{'name': name, 'error': None, 'duration': None}
+               for name, check in checks]
+    def run_check(result, check):
+        start_time = time()
+        try:
+            check()
+        except Exception as e:
+            result['error'] = str(e) or e.__class__.__name__
+        result['duration'] = time() - start_time
+
+    # A check that hangs (e.g. on an unresponsive server) is left running in
+    # the background rather than holding up the run.
+    threads = []
+    for result, (name, check) in zip(results, checks):
+        thread = Thread(target=run_check, args=(result, check))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time() + timeout
+    for result, thread in zip(results, threads):
+        thread.join(max(0, deadline - time()))
+        if thread.is_alive():
+            result['error'] = ("The check did not finish within %s "
+                               "second(s)." % str(timeout))
+    return results
+
+def _get_template_setting(config, cluster_template, setting):
+    """Returns a cluster template's setting, or None if it isn't set.
+
+    Settings that a template doesn't set itself are inherited from the
+    template that it EXTENDS. Raises a ValueError if the template (or a
+    template that it extends) isn't defined.
+    """
+    seen_templates = []
+    while cluster_template not in seen_templates:
+        section = 'cluster %s' % cluster_template
+        if not config.has_section(section):
+            raise ValueError("The cluster template '%s' isn't defined in "
+                             "the StarCluster config file." %
+                             cluster_template)
+        if config.has_option(section, setting):
+            return config.get(section, setting)
+        if not config.has_option(section, 'extends'):
+            return None
+        seen_templates.append(cluster_template)
+        cluster_template = config.get(section, 'extends')
+    return None
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to profile test suites while they run on the cluster.
+
+A test suite's 'profile' option selects one of profile_modes. A profiled test
+suite's command is wrapped so that it runs under GNU time (which records its
+peak memory use, CPU time, and I/O counts) and, in 'python' mode, so that every
+Python process it starts is profiled with cProfile. Each test suite's profile
+is written to its own directory under remote_profiles_dir on the cluster, and
+all of them are copied back in a single transfer once the test suites have
+finished:
+
+    <remote_profiles_dir>/python_hook/sitecustomize.py
+    <remote_profiles_dir>/<test suite>/resources.txt     GNU time output
+    <remote_profiles_dir>/<test suite>/python-<pid>.prof cProfile output
+
+GNU time must be installed as time_exe_fp on the cluster.
+"""
+
+from os import listdir
+from os.path import basename, exists, isdir, join
+from pstats import Stats
+from re import compile
+from tarfile import open as open_tarfile
+
+from clout.state import get_safe_filename
+from clout.util import create_dir
+
+# The possible values of a test suite's 'profile' option.
+profile_modes = ['none', 'resources', 'python']
+
+# Where profiles are written on the cluster, relative to the directory that
+# commands are run from (the user's home directory on a StarCluster cluster).
+remote_profiles_dir = '.clout_profiles'
+
+time_exe_fp = '/usr/bin/time'
+
+# Installed as sitecustomize.py on the cluster so that it is imported by
+# every Python process that has its directory on the PYTHONPATH. Each process
+# writes its profile to CLOUT_PROFILE_DIR when it exits, and then the
+# sitecustomize module that this one hides (if any) is imported as usual.
+python_profiler_hook = """import os
+import sys
+
+def _start_clout_profiler():
+    profile_dir = os.environ.get('CLOUT_PROFILE_DIR')
+    if not profile_dir:
+        return
+    try:
+        import atexit
+        import cProfile
+    except ImportError:
+        return
+
+    profiler = cProfile.Profile()
+    def save_profile():
+        profiler.disable()
+        try:
+            profiler.dump_stats(os.path.join(profile_dir,
+                                             'python-%d.prof' % os.getpid()))
+        except (IOError, OSError):
+            pass
+    atexit.register(save_profile)
+    profiler.enable()
+
+def _import_hidden_sitecustomize():
+    hook_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path = [path for path in sys.path
+                if os.path.abspath(path or '.') != hook_dir]
+    # Keep this module alive under another name (Python 2 clears the globals
+    # of modules that are garbage collected, which would break
+    # save_profile()).
+    sys.modules['_clout_profiler_hook'] = sys.modules.pop('sitecustomize')
+    try:
+        import sitecustomize
+    except ImportError:
+        pass
+
+_start_clout_profiler()
+_import_hidden_sitecustomize()
+"""
+
+# Maps the labels that GNU time -v uses to the keys of the dictionary
+# returned by parse_resource_usage().
+_resource_labels = {
+    'User time (seconds)': 'user_time',
+    'System time (seconds)': 'system_time',
+    'Maximum resident set size (kbytes)': 'max_rss_kb',
+    'Major (requiring I/O) page faults': 'major_page_faults',
+    'File system inputs': 'fs_inputs',
+    'File system outputs': 'fs_outputs',
+    'Voluntary context switches': 'voluntary_context_switches',
+    'Involuntary context switches': 'involuntary_context_switches'
+}
+_resource_re = compile(r'^\s*(?P<label>[^:]+):\s*(?P<val>\S+)\s*$')
+
+def get_profile_dir_name(label):
+    """Returns the name of the directory that a test suite's profile is in."""
+    return get_safe_filename(label)
+
+def build_profiled_cmd(cmd, label, profile_mode):
+    """Wraps a test suite's command so that it is profiled when it runs.
+
+    The wrapped command is run from the same directory as remote_profiles_dir
+    and returns the same exit code as cmd.
+
+    Arguments:
+        cmd - the test suite's command
+        label - the test suite's label
+        profile_mode - one of profile_modes. If 'none', cmd is returned as-is
+    """
+    if profile_mode == 'none':
+        return cmd
+
+    profile_dir = '%s/%s' % (remote_profiles_dir, get_profile_dir_name(label))
+    env = ''
+    if profile_mode == 'python':
+        env = ('CLOUT_PROFILE_DIR="$PWD/%s" '
+               'PYTHONPATH="$PWD/%s/python_hook${PYTHONPATH:+:$PYTHONPATH}" ' %
+               (profile_dir, remote_profiles_dir))
+    return 'mkdir -p %s && %s%s -v -o %s/resources.txt sh -c "%s"' % (
+            profile_dir, env, time_exe_fp, profile_dir,
+            _escape_double_quoted(cmd))
+
+def write_python_profiler_hook(hook_dir):
+    """Writes the Python profiler hook to hook_dir/sitecustomize.py."""
+    hook_f = open(join(create_dir(hook_dir), 'sitecustomize.py'), 'w')
+    try:
+        hook_f.write(python_profiler_hook)
+    finally:
+        hook_f.close()
+
+def parse_resource_usage(resources_f):
+    """Parses the output of GNU time -v.
+
+    Returns a dictionary containing 'user_time' and 'system_time' (in
+    seconds), 'max_rss_kb', 'major_page_faults', 'fs_inputs', 'fs_outputs',
+    'voluntary_context_switches', and 'involuntary_context_switches'. Values
+    that aren't in the output are None.
+
+    Arguments:
+        resources_f - the file containing the output of GNU time -v
+    """
+    usage = dict([(key, None) for key in _resource_labels.values()])
+    for line in resources_f:
+        match = _resource_re.match(line)
+        if match is None or match.group('label') not in _resource_labels:
+            continue
+        try:
+            val = float(match.group('val'))
+        except ValueError:
+            continue
+        key = _resource_labels[match.group('label')]
+        usage[key] = val if key.endswith('_time') else int(val)
+    return usage
+
+def get_python_hotspots(profile_fps, num_hotspots=10):
+    """Returns the functions that the profiled Python processes spent the
+    most time in.
+
+    Returns a list of 4-element lists containing the function (as
+    'file:line(name)'), the number of times it was called, the number of
+    seconds spent in the function itself, and the number of seconds spent in
+    it and the functions it called, sorted by the time spent in the function
+    itself (most first).
+
+    Arguments:
+        profile_fps - the cProfile output files to combine. Files that can't
+            be read (e.g. written by a different version of Python) are
+            skipped
+        num_hotspots - the number of functions to return
+    """
+    stats = None
+    for profile_fp in profile_fps:
+        try:
+            if stats is None:
+                stats = Stats(profile_fp)
+            else:
+                stats.add(profile_fp)
+        except (EOFError, IOError, TypeError, ValueError):
+            continue
+    if stats is None:
+        return []
+
+    hotspots = []
+    for (file_fp, line, name), (prim_calls, num_calls, tot_time, cum_time,
+                                callers) in stats.stats.items():
+        if file_fp == '~':
+            # A built-in function.
+            function = name
+        else:
+            function = '%s:%d(%s)' % (file_fp, line, name)
+        hotspots.append([function, num_calls, tot_time, cum_time])
+    hotspots.sort(key=lambda hotspot: (-hotspot[2], hotspot[0]))
+    return hotspots[:num_hotspots]
+
+def summarize_profile(profile_dir, num_hotspots=10):
+    """Summarizes a test suite's profile.
+
+    Returns a dictionary containing the output of parse_resource_usage()
+    ('resources', None if GNU time's output isn't there) and the output of
+    get_python_hotspots() ('hotspots'), or None if profile_dir doesn't exist
+    (e.g. the profile couldn't be copied back from the cluster).
+
+    Arguments:
+        profile_dir - the directory containing the test suite's profile
+        num_hotspots - same as for get_python_hotspots()
+    """
+    if not isdir(profile_dir):
+        return None
+
+    resources = None
+    resources_fp = join(profile_dir, 'resources.txt')
+    if exists(resources_fp):
+        resources_f = open(resources_fp, 'U')
+        try:
+            resources = parse_resource_usage(resources_f)
+        finally:
+            resources_f.close()
+
+    profile_fps = [join(profile_dir, fn) for fn in sorted(listdir(profile_dir))
+                   if fn.endswith('.prof')]
+    return {'resources': resources,
+            'hotspots': get_python_hotspots(profile_fps, num_hotspots)}
+
+def archive_profile(profile_dir, out_fp):
+    """Writes a test suite's profile directory to a gzipped tar file."""
+    archive = open_tarfile(out_fp, 'w:gz')
+    try:
+        archive.add(profile_dir, arcname=basename(profile_dir.rstrip('/')))
+    finally:
+        archive.close()
+
+def _escape_double_quoted(text):
+    """Escapes text so that it can be placed inside double quotes in a shell
+    command.
+    """
+    for char in '\\', '"', '$', '`':
+        text = text.replace(char, '\\' + char)
+    return text
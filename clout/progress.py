@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to report a run's progress while it executes.
+
+A run's journal (see clout.state) only records what is needed to resume the
+run. The progress stream records what is useful to someone watching it: the
+phase the run is in, when each test suite starts and finishes, and periodic
+heartbeats while a test suite's output is arriving. Each event is a JSON
+object with 'event' and 'time' keys, written as one line to an append-only
+status file (which 'clout status' tails) and optionally sent as a UDP
+datagram to a localhost port (so that another program can watch the run
+without polling the file).
+
+The events are:
+
+    run_started      'run_id', 'pid', 'cluster_tag', 'test_suites' (labels)
+    phase_changed    'phase' (one of run_phases)
+    suite_started    'label'
+    output           'label', 'bytes' and 'lines' (received so far), and
+                     'last_line'
+    suite_interrupted
+                     'label', 'node' (that was lost), 'duration' (of the
+                     interrupted attempt); the test suite is run again
+    suite_finished   'label', 'status', 'ret_val', 'duration'
+    run_finished     'succeeded'
+"""
+
+from errno import ESRCH
+from json import dumps, loads
+from os import kill
+from os.path import exists
+from socket import AF_INET, error as socket_error, SOCK_DGRAM, socket
+from threading import Lock
+from time import sleep, time
+
+# The phases of a run, in the order they happen.
+run_phases = ['waiting_for_cluster', 'setup', 'staging', 'matrix_setup',
+              'test_suites', 'collecting', 'teardown', 'reporting']
+
+# The longest last line of output included in an 'output' event.
+max_line_length = 200
+
+class ProgressReporter(object):
+    """Writes a run's progress events as they happen.
+
+    Events may be reported from any thread.
+    """
+
+    def __init__(self, status_fp=None, port=None, heartbeat_interval=30.0,
+                 listeners=None):
+        """Initializes a new progress reporter.
+
+        Arguments:
+            status_fp - the file that events are appended to, one JSON object
+                per line. If None, events aren't written to a file
+            port - the localhost UDP port that events are sent to. If None,
+                events aren't sent. Events are sent whether or not anything
+                is listening, and are never retried
+            heartbeat_interval - the minimum number of seconds between
+                'output' events for the same test suite
+            listeners - a list of objects whose update() methods are called
+                with each event after it is written (e.g. a
+                clout.metrics.RunMetrics or a clout.trace.Tracer)
+        """
+        self.status_fp = status_fp
+        self.port = port
+        self.heartbeat_interval = heartbeat_interval
+        self.listeners = listeners or []
+
+        self._lock = Lock()
+        self._status_f = None
+        if status_fp is not None:
+            self._status_f = open(status_fp, 'a')
+        self._socket = None
+        if port is not None:
+            self._socket = socket(AF_INET, SOCK_DGRAM)
+        self._output = {}
+
+    def report(self, event, **fields):
+        """Reports an event and returns it."""
+        entry = dict(fields, event=event, time=time())
+        line = dumps(entry, sort_keys=True)
+        with self._lock:
+            if self._status_f is not None:
+                self._status_f.write(line + '\n')
+                self._status_f.flush()
+            if self._socket is not None:
+                try:
+                    self._socket.sendto(line, ('127.0.0.1', self.port))
+                except socket_error:
+                    # Progress is best-effort; it must never stop a run.
+                    pass
+        for listener in self.listeners:
+            listener.update(entry)
+        return entry
+
+    def output_received(self, label, data):
+        """Records output from a running test suite.
+
+        An 'output' heartbeat is reported for the first output and then at
+        most once every heartbeat_interval seconds.
+
+        Arguments:
+            label - the label of the test suite
+            data - the output that was received (one or more lines)
+        """
+        with self._lock:
+            output = self._output.setdefault(label, {'bytes': 0, 'lines': 0,
+                                                     'reported_at': None})
+            output['bytes'] += len(data)
+            output['lines'] += data.count('\n')
+            if output['reported_at'] is not None and \
+               time() - output['reported_at'] < self.heartbeat_interval:
+                return
+            output['reported_at'] = time()
+            num_bytes, num_lines = output['bytes'], output['lines']
+
+        last_line = data.rstrip('\n').rsplit('\n', 1)[-1][:max_line_length]
+        self.report('output', label=label, bytes=num_bytes, lines=num_lines,
+                    last_line=last_line)
+
+    def close(self):
+        """Closes the status file and socket."""
+        with self._lock:
+            if self._status_f is not None:
+                self._status_f.close()
+                self._status_f = None
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+
+def read_progress(status_fp, offset=0):
+    """Reads the events in a status file.
+
+    Returns a 2-element tuple containing the list of events and the offset to
+    pass in to read the events written after them. A partially-written last
+    line is left to be read next time.
+
+    Arguments:
+        status_fp - the status file written by a ProgressReporter
+        offset - the position in the file to start reading from
+    """
+    if not exists(status_fp):
+        return [], offset
+
+    status_f = open(status_fp, 'U')
+    try:
+        status_f.seek(offset)
+        data = status_f.read()
+    finally:
+        status_f.close()
+
+    events = []
+    complete_data = data[:data.rfind('\n') + 1]
+    for line in complete_data.splitlines():
+        try:
+            events.append(loads(line))
+        except ValueError:
+            continue
+    return events, offset + len(complete_data)
+
+def follow_progress(status_fp, offset=0, pid=None, poll_interval=1.0):
+    """Yields the events in a status file as they are written.
+
+    Stops after the 'run_finished' event, or when the process running the
+    run has exited.
+
+    Arguments:
+        status_fp - same as for read_progress()
+        offset - same as for read_progress()
+        pid - the ID of the process running the run, if known (e.g. from the
+            'run_started' event before offset). Otherwise it is taken from the
+            next 'run_started' event
+        poll_interval - the number of seconds to wait between checks for new
+            events
+    """
+    while True:
+        events, offset = read_progress(status_fp, offset)
+        for event in events:
+            yield event
+            if event['event'] == 'run_started':
+                pid = event.get('pid')
+            elif event['event'] == 'run_finished':
+                return
+        if not events and pid is not None and not is_process_running(pid):
+            return
+        sleep(poll_interval)
+
+def summarize_progress(events, now=None):
+    """Summarizes where a run is, based on its progress events.
+
+    Returns a dictionary containing the 'run_id', the 'pid' of the process
+    running the run, the current 'phase' (None if unknown), the 'running'
+    test suite's label (None if no test suite is running), the number of
+    seconds it has been running for ('running_for'), the 'finished_suites'
+    (a list of [label, status] lists), the labels of the
+    'remaining_suites', the number of seconds since the last event
+    ('idle_for', None if there are no events), and whether the run has
+    finished ('run_finished'). If the run was resumed, the summary describes
+    the latest attempt, but test suites that finished before the run was
+    interrupted are still listed as finished.
+
+    Arguments:
+        events - the run's events, oldest first
+        now - the current time (defaults to time())
+    """
+    if now is None:
+        now = time()
+
+    summary = {'run_id': None, 'pid': None, 'phase': None, 'running': None,
+               'running_for': None, 'finished_suites': [],
+               'remaining_suites': [], 'idle_for': None,
+               'run_finished': False}
+    test_suites = []
+    for event in events:
+        name = event['event']
+        if name == 'run_started':
+            summary['run_id'] = event.get('run_id')
+            summary['pid'] = event.get('pid')
+            summary['run_finished'] = False
+            summary['running'] = None
+            summary['running_for'] = None
+            test_suites = event.get('test_suites', [])
+        elif name == 'phase_changed':
+            summary['phase'] = event['phase']
+        elif name == 'suite_started':
+            summary['running'] = event['label']
+            summary['running_for'] = now - event['time']
+        elif name == 'suite_interrupted':
+            if summary['running'] == event['label']:
+                summary['running'] = None
+                summary['running_for'] = None
+        elif name == 'suite_finished':
+            summary['finished_suites'].append([event['label'],
+                                               event['status']])
+            if summary['running'] == event['label']:
+                summary['running'] = None
+                summary['running_for'] = None
+        elif name == 'run_finished':
+            summary['run_finished'] = True
+        summary['idle_for'] = now - event['time']
+
+    finished_labels = [label for label, status in summary['finished_suites']]
+    summary['remaining_suites'] = [label for label in test_suites
+                                   if label not in finished_labels and
+                                   label != summary['running']]
+    return summary
+
+def is_process_running(pid):
+    """Returns True if a process with the given ID exists on this machine."""
+    try:
+        kill(pid, 0)
+    except OSError as e:
+        return e.errno != ESRCH
+    return True
@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to write the results of a run as a static HTML/JSON report.
+
+Each run's report is a self-contained directory under a report root, so the
+report root can be published as-is by any static web server:
+
+    <report_root>/index.html                  list of every run
+    <report_root>/<run_id>/index.html         test suite status, durations,
+                                              and trends from past runs
+    <report_root>/<run_id>/summary.json       the same data for other tools
+    <report_root>/<run_id>/view.html          log viewer
+    <report_root>/<run_id>/logs/<name>.gz     compressed logs
+    <report_root>/<run_id>/logs/<name>.gz.idx.json
+    <report_root>/<run_id>/profiles/<name>.tar.gz  profiles of test suites
+                                                   (see clout.profiling)
+    <report_root>/<run_id>/artifacts/<name>/  artifacts of test suites (see
+                                              clout.artifacts)
+
+Logs are compressed as a series of independent gzip members (a valid gzip file
+that any tool can decompress as a whole). The index file records where each
+member starts, so the log viewer only has to fetch (with an HTTP range request)
+and decompress the part of a large log that is being looked at.
+"""
+
+from cgi import escape
+from gzip import GzipFile
+from json import dumps, loads
+from os import listdir
+from os.path import exists, isdir, join
+from shutil import copytree, rmtree
+from StringIO import StringIO
+from time import localtime, strftime, time
+from urllib import quote
+
+from clout.artifacts import get_artifacts_dir_name
+from clout.format import (format_duration, format_node_hours, format_size,
+                          format_snapshot_status, format_test_suite_status)
+from clout.profiling import archive_profile
+from clout.state import get_safe_filename
+from clout.util import create_dir, write_file_atomically
+
+# The possible statuses of a test suite in a run summary.
+test_suite_statuses = ['pass', 'fail', 'timeout', 'not_run']
+
+def write_report(report_root, run_id, run_summary, logs, max_history=10,
+                 chunk_size=262144, profiles=None, artifacts=None):
+    """Writes a run's report and returns the directory it was written to.
+
+    The report is written to <report_root>/<run_id>/ (overwriting any existing
+    report for the run) and the list of runs in <report_root>/index.html is
+    updated.
+
+    Arguments:
+        report_root - the directory that run reports are written under
+        run_id - the ID of the run (used as the name of its report directory)
+        run_summary - a JSON-serializable dictionary describing the run. Must
+            contain a 'test_suites' list of dictionaries with 'label',
+            'status' (one of test_suite_statuses), 'ret_val', 'duration' (in
+            seconds, or None), and 'log_name' keys, and may contain
+            'cluster_tag', 'started_at', 'finished_at', 'setup', and
+            'teardown' (dictionaries with 'succeeded' and 'duration' keys).
+            It may also contain 'artifacts' (a dictionary with 'succeeded',
+            'duration', and 'size' keys describing the transfer of the
+            artifacts), in which case each test suite with artifacts has an
+            'artifacts' list of the [path, size] of each artifact
+        logs - a list of 2-element tuples containing a log's name (as it is
+            referred to by 'log_name' in run_summary) and the open log file,
+            positioned at the beginning. Each file is left positioned at the
+            beginning again
+        max_history - the number of past runs (from report_root) to include
+            in each test suite's trend
+        chunk_size - the number of uncompressed bytes in each independently
+            decompressable part of a compressed log
+        profiles - a list of 2-element tuples containing a test suite's label
+            and the directory containing its profile. Each directory is
+            included in the report as a gzipped tar file
+        artifacts - a list of 2-element tuples containing a test suite's
+            label and the directory containing its artifacts. Each directory
+            is copied into the report as-is, so that the artifacts can be
+            viewed directly (e.g. coverage reports or plots)
+    """
+    run_dir = create_dir(join(report_root, run_id))
+    logs_dir = create_dir(join(run_dir, 'logs'))
+
+    log_files = {}
+    for log_name, log_f in logs:
+        log_fn = '%s.gz' % get_safe_filename(log_name)
+        write_chunked_log(log_f, join(logs_dir, log_fn), chunk_size)
+        log_files[log_name] = 'logs/%s' % log_fn
+
+    profile_files = {}
+    if profiles:
+        profiles_dir = create_dir(join(run_dir, 'profiles'))
+        for label, profile_dir in profiles:
+            profile_fn = '%s.tar.gz' % get_safe_filename(label)
+            archive_profile(profile_dir, join(profiles_dir, profile_fn))
+            profile_files[label] = 'profiles/%s' % profile_fn
+
+    artifact_dirs = {}
+    if artifacts:
+        artifacts_dir = create_dir(join(run_dir, 'artifacts'))
+        for label, test_suite_artifacts_dir in artifacts:
+            dir_name = get_artifacts_dir_name(label)
+            out_dir = join(artifacts_dir, dir_name)
+            if exists(out_dir):
+                rmtree(out_dir)
+            copytree(test_suite_artifacts_dir, out_dir)
+            artifact_dirs[label] = 'artifacts/%s' % dir_name
+
+    summary = dict(run_summary, run_id=run_id, log_files=log_files,
+                   profile_files=profile_files, artifact_dirs=artifact_dirs,
+                   generated_at=time())
+    summary['succeeded'] = is_successful_run(summary)
+    history = load_report_history(report_root, max_history, before=run_id)
+
+    write_file_atomically(join(run_dir, 'summary.json'),
+                          dumps(summary, indent=2, sort_keys=True))
+    write_file_atomically(join(run_dir, 'index.html'),
+                          format_run_report(summary, history))
+    write_file_atomically(join(run_dir, 'view.html'), log_viewer_html)
+    write_file_atomically(join(report_root, 'index.html'),
+            format_report_index(load_report_history(report_root)))
+    return run_dir
+
+def write_chunked_log(log_f, out_fp, chunk_size=262144):
+    """Compresses a log into independently decompressable gzip members.
+
+    Writes the compressed log to out_fp and its index to out_fp + '.idx.json'.
+    The index is a JSON object containing the log's uncompressed 'size', the
+    'chunk_size', and a list of 'chunks', each a 3-element list containing the
+    uncompressed offset, compressed offset, and compressed length of a member.
+
+    Arguments:
+        log_f - the open log file to compress, positioned at the beginning.
+            It is left positioned at the beginning again
+        out_fp - the filepath to write the compressed log to
+        chunk_size - the number of uncompressed bytes in each member
+    """
+    chunks = []
+    size = 0
+    offset = 0
+
+    out_f = open(out_fp, 'wb')
+    try:
+        while True:
+            data = log_f.read(chunk_size)
+            if not data:
+                break
+
+            member = StringIO()
+            gzip_f = GzipFile(fileobj=member, mode='wb', mtime=0)
+            gzip_f.write(data)
+            gzip_f.close()
+            member = member.getvalue()
+
+            out_f.write(member)
+            chunks.append([size, offset, len(member)])
+            size += len(data)
+            offset += len(member)
+    finally:
+        out_f.close()
+    log_f.seek(0, 0)
+
+    write_file_atomically(out_fp + '.idx.json',
+                          dumps({'size': size, 'chunk_size': chunk_size,
+                                 'chunks': chunks}))
+
+def load_report_history(report_root, max_runs=None, before=None):
+    """Returns the summaries of the runs in a report root, oldest first.
+
+    Arguments:
+        report_root - the directory that run reports are written under
+        max_runs - the maximum number of (most recent) summaries to return.
+            All summaries are returned if not provided
+        before - if provided, only runs whose IDs sort before this run ID are
+            included (run IDs begin with a timestamp, so these are the runs
+            that came before it)
+    """
+    if not isdir(report_root):
+        return []
+
+    run_ids = sorted([run_id for run_id in listdir(report_root)
+                      if exists(join(report_root, run_id, 'summary.json'))])
+    if before is not None:
+        run_ids = [run_id for run_id in run_ids if run_id < before]
+    if max_runs is not None:
+        run_ids = run_ids[-max_runs:] if max_runs > 0 else []
+
+    history = []
+    for run_id in run_ids:
+        summary_f = open(join(report_root, run_id, 'summary.json'), 'U')
+        try:
+            try:
+                history.append(loads(summary_f.read()))
+            except ValueError:
+                # Ignore reports that were written by something else or are
+                # corrupt.
+                continue
+        finally:
+            summary_f.close()
+    return history
+
+def is_successful_run(summary):
+    """Returns True if every phase of a run and every test suite passed."""
+    for phase in 'setup', 'teardown':
+        if phase in summary and not summary[phase]['succeeded']:
+            return False
+    return all([test_suite['status'] == 'pass'
+                for test_suite in summary['test_suites']])
+
+def get_test_suite_trend(label, history):
+    """Returns a test suite's status and duration in each past run.
+
+    Returns a list of 2-element tuples (oldest first) containing the test
+    suite's status and duration in each run in history that included it.
+
+    Arguments:
+        label - the test suite's label
+        history - the output of load_report_history()
+    """
+    trend = []
+    for summary in history:
+        for test_suite in summary['test_suites']:
+            if test_suite['label'] == label:
+                trend.append((test_suite['status'], test_suite['duration']))
+                break
+    return trend
+
+def format_run_report(summary, history):
+    """Returns the HTML report of a single run.
+
+    Arguments:
+        summary - the summary of the run (as written to summary.json)
+        history - the summaries of the runs that came before it (the output
+            of load_report_history())
+    """
+    rows = []
+    for test_suite in summary['test_suites']:
+        trend = get_test_suite_trend(test_suite['label'], history)
+        past_durations = [duration for status, duration in trend
+                          if status == 'pass' and duration is not None]
+        typical_duration = None
+        if past_durations:
+            typical_duration = sorted(past_durations)[len(past_durations) // 2]
+
+        log_link = '-'
+        log_fp = summary['log_files'].get(test_suite['log_name'])
+        if log_fp is not None:
+            log_link = '<a href="view.html?log=%s">log</a>' % escape(log_fp,
+                                                                     True)
+
+        # Reports written before profiling was added have no profile files.
+        profile_fp = summary.get('profile_files', {}).get(test_suite['label'])
+        if profile_fp is not None:
+            resources = (test_suite.get('profile') or {}).get('resources')
+            peak_memory = ''
+            if resources and resources['max_rss_kb'] is not None:
+                peak_memory = ' (peak memory %s)' % format_size(
+                        resources['max_rss_kb'] * 1024)
+            log_link += ' | <a href="%s">profile</a>%s' % (
+                    escape(profile_fp, True), peak_memory)
+
+        rows.append('<tr><td>%s</td><td class="%s">%s</td><td>%s</td>'
+                    '<td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                    escape(test_suite['label']), test_suite['status'],
+                    format_test_suite_status(test_suite['status']),
+                    format_duration(test_suite['duration']),
+                    format_duration(typical_duration),
+                    _format_trend(trend + [(test_suite['status'],
+                                            test_suite['duration'])]),
+                    log_link))
+
+    phases = []
+    for phase, name in ('setup', 'Cluster setup'), \
+                       ('teardown', 'Cluster termination'):
+        if phase in summary:
+            succeeded = summary[phase]['succeeded']
+            status = {True: 'pass', False: 'fail', None: 'timeout'}[succeeded]
+            phases.append('<li>%s: <span class="%s">%s</span> (%s)</li>' % (
+                          name, status, format_test_suite_status(status),
+                          format_duration(summary[phase]['duration'])))
+
+    if summary.get('artifacts') is not None:
+        collection = summary['artifacts']
+        status = {True: 'pass', False: 'fail',
+                  None: 'timeout'}[collection['succeeded']]
+        phases.append('<li>Artifact collection: <span class="%s">%s</span> '
+                      '(%s, %s)</li>' % (status,
+                      format_test_suite_status(status),
+                      format_duration(collection['duration']),
+                      format_size(collection['size'])))
+
+    # Reports written before artifacts were added have no artifact
+    # directories.
+    artifacts = []
+    for test_suite in summary['test_suites']:
+        artifacts_dir = summary.get('artifact_dirs', {}).get(
+                test_suite['label'])
+        if artifacts_dir is None or not test_suite.get('artifacts'):
+            continue
+        links = ['<a href="%s">%s</a> (%s)' % (escape(quote('%s/%s' % (
+                 artifacts_dir, path)), True), escape(path), format_size(size))
+                 for path, size in test_suite['artifacts']]
+        artifacts.append('<li>%s: %s</li>' % (escape(test_suite['label']),
+                                               ', '.join(links)))
+    if artifacts:
+        artifacts = '\n<h2>Artifacts</h2>\n<ul>%s</ul>' % ''.join(artifacts)
+    else:
+        artifacts = ''
+
+    # Reports written before steps were added have no steps.
+    steps = []
+    for test_suite in summary['test_suites']:
+        if test_suite.get('steps'):
+            steps.append('<li>%s: %s</li>' % (escape(test_suite['label']),
+                    ', '.join(['%s (%s)' % (escape(step['name']),
+                                            format_duration(step['duration']))
+                               for step in test_suite['steps']])))
+    if steps:
+        steps = '\n<h2>Steps</h2>\n<ul>%s</ul>' % ''.join(steps)
+    else:
+        steps = ''
+
+    # Reports written before autoscaling was added have no cluster plan.
+    cluster_plan = summary.get('cluster_plan')
+    if cluster_plan is not None:
+        phases.append('<li>Cluster size: %d node(s) for a deadline of %s '
+                      'minute(s) (predicted %s and %s, actual %s and %s)</li>'
+                      % (cluster_plan['num_nodes'],
+                         str(cluster_plan['deadline']),
+                         format_duration(cluster_plan['predicted_duration']),
+                         format_node_hours(cluster_plan['predicted_cost']),
+                         format_duration(cluster_plan['actual_duration']),
+                         format_node_hours(cluster_plan['actual_cost'])))
+
+    # Reports written before spot instances were supported have no
+    # interrupted attempts.
+    interrupted_attempts = ['%s on %s after %s' % (
+            escape(test_suite['label']), escape(attempt['node']),
+            format_duration(attempt['duration']))
+            for test_suite in summary['test_suites']
+            for attempt in test_suite.get('interrupted_attempts') or []]
+    if interrupted_attempts:
+        phases.append('<li>Interrupted by lost nodes (and run again): %s</li>'
+                      % ', '.join(interrupted_attempts))
+
+    # Reports written before snapshots were added have no snapshots.
+    snapshots = ['%s: %s' % (escape(snapshot['label']),
+                             escape(format_snapshot_status(snapshot)))
+                 for snapshot in summary.get('snapshots') or []]
+    if snapshots:
+        phases.append('<li>Setup snapshots: %s</li>' % '; '.join(snapshots))
+
+    # Reports written before the cluster pool was added have no lease.
+    cluster_lease = summary.get('cluster_lease')
+    if cluster_lease is not None:
+        phases.append('<li>Cluster pool: ran on %s (%s) after waiting %s</li>'
+                      % (escape(cluster_lease['cluster_tag']),
+                         'reused' if cluster_lease['reused'] else 'started',
+                         format_duration(cluster_lease['queue_wait'])))
+
+    complete_log = summary['log_files'].get('complete_log.txt')
+    if complete_log is not None:
+        phases.append('<li><a href="view.html?log=%s">Complete log</a></li>' %
+                      escape(complete_log, True))
+
+    title = 'Clout run %s' % summary['run_id']
+    details = []
+    if summary.get('cluster_tag') is not None:
+        details.append('Cluster tag: %s' % escape(summary['cluster_tag']))
+    if summary.get('started_at') is not None:
+        details.append('Started: %s' % _format_time(summary['started_at']))
+    if summary.get('started_at') is not None and \
+       summary.get('finished_at') is not None:
+        details.append('Duration: %s' % format_duration(
+                summary['finished_at'] - summary['started_at']))
+    details.append('<a href="summary.json">summary.json</a>')
+
+    body = ('<p><a href="../index.html">All runs</a></p>\n'
+            '<h1>%s: <span class="%s">%s</span></h1>\n<p>%s</p>\n'
+            '<ul>%s</ul>\n<table>\n<tr><th>Test suite</th><th>Status</th>'
+            '<th>Duration</th><th>Typical duration</th><th>Trend (oldest '
+            'first)</th><th>Log</th></tr>\n%s\n</table>%s' % (
+            escape(title), 'pass' if summary['succeeded'] else 'fail',
+            'Pass' if summary['succeeded'] else 'Fail',
+            ' | '.join(details), ''.join(phases), '\n'.join(rows),
+            steps + artifacts))
+    return _format_html_page(title, body)
+
+def format_report_index(history):
+    """Returns the HTML list of every run in a report root.
+
+    Arguments:
+        history - the output of load_report_history()
+    """
+    rows = []
+    for summary in reversed(history):
+        counts = dict([(status, 0) for status in test_suite_statuses])
+        for test_suite in summary['test_suites']:
+            counts[test_suite['status']] += 1
+
+        run_id = escape(summary['run_id'], True)
+        started_at = summary.get('started_at')
+        rows.append('<tr><td><a href="%s/index.html">%s</a></td><td>%s</td>'
+                    '<td>%s</td><td class="%s">%s</td><td>%d</td><td>%d</td>'
+                    '<td>%d</td><td>%d</td></tr>' % (
+                    run_id, run_id, escape(summary.get('cluster_tag') or '-'),
+                    _format_time(started_at) if started_at else '-',
+                    'pass' if summary['succeeded'] else 'fail',
+                    'Pass' if summary['succeeded'] else 'Fail',
+                    counts['pass'], counts['fail'], counts['timeout'],
+                    counts['not_run']))
+
+    body = ('<h1>Clout runs</h1>\n<table>\n<tr><th>Run</th><th>Cluster tag'
+            '</th><th>Started</th><th>Status</th><th>Passed</th><th>Failed'
+            '</th><th>Timed out</th><th>Not run</th></tr>\n%s\n</table>' %
+            '\n'.join(rows))
+    return _format_html_page('Clout runs', body)
+
+def _format_trend(trend):
+    """Returns a row of colored boxes, one per status in a trend."""
+    return ''.join(['<span class="trend %s" title="%s, %s">&#9632;</span>' %
+                    (status, format_test_suite_status(status),
+                     format_duration(duration))
+                    for status, duration in trend])
+
+def _format_time(timestamp):
+    """Formats a timestamp (in seconds since the epoch) as local time."""
+    return strftime('%Y-%m-%d %H:%M:%S', localtime(timestamp))
+
+def _format_html_page(title, body):
+    """Wraps the body of an HTML page in the report's boilerplate."""
+    return report_page_template % {'title': escape(title), 'body': body}
+
+
+report_page_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #ccc; padding: 0.3em 0.6em; text-align: left; }
+.pass { color: #080; }
+.fail, .timeout { color: #c00; }
+.not_run { color: #888; }
+.trend { font-size: 1.2em; }
+</style>
+</head>
+<body>
+%(body)s
+</body>
+</html>
+"""
+
+# Fetches and decompresses one chunk of a log at a time (see
+# write_chunked_log()). Requires a browser that supports DecompressionStream.
+log_viewer_html = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Clout log viewer</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+pre { border: 1px solid #ccc; padding: 0.5em; white-space: pre-wrap; }
+</style>
+</head>
+<body>
+<p><a href="index.html">Back to the report</a> | <span id="name"></span>
+| <a id="download">Download the whole log</a></p>
+<p>
+<button id="first">First</button>
+<button id="prev">Previous</button>
+<span id="position"></span>
+<button id="next">Next</button>
+<button id="last">Last</button>
+</p>
+<pre id="log">Loading...</pre>
+<script>
+var match = /[?&]log=([^&]*)/.exec(location.search);
+var log = match ? decodeURIComponent(match[1]) : '';
+var index = null;
+var current = 0;
+
+function $(id) { return document.getElementById(id); }
+
+function fetchChunk(i) {
+  var chunk = index.chunks[i];
+  var range = 'bytes=' + chunk[1] + '-' + (chunk[1] + chunk[2] - 1);
+  return fetch(log, {headers: {Range: range}}).then(function (response) {
+    if (!response.ok) {
+      throw new Error('HTTP status ' + response.status);
+    }
+    return response.arrayBuffer().then(function (data) {
+      // Servers that don't support range requests send the whole file.
+      if (response.status !== 206) {
+        data = data.slice(chunk[1], chunk[1] + chunk[2]);
+      }
+      var stream = new Blob([data]).stream().pipeThrough(
+          new DecompressionStream('gzip'));
+      return new Response(stream).text();
+    });
+  });
+}
+
+function show(i) {
+  if (index.chunks.length === 0) {
+    $('log').textContent = '(empty log)';
+    $('position').textContent = '';
+    return;
+  }
+  current = Math.max(0, Math.min(i, index.chunks.length - 1));
+  var start = index.chunks[current][0];
+  var end = current + 1 < index.chunks.length ?
+      index.chunks[current + 1][0] : index.size;
+  $('position').textContent = 'Bytes ' + start + '-' + end + ' of ' +
+      index.size + ' (part ' + (current + 1) + ' of ' +
+      index.chunks.length + ')';
+  $('log').textContent = 'Loading...';
+  fetchChunk(current).then(function (text) {
+    $('log').textContent = text;
+  }, function (error) {
+    $('log').textContent = 'Unable to load the log: ' + error;
+  });
+}
+
+if (!/^logs\\/[A-Za-z0-9._-]+$/.test(log)) {
+  $('log').textContent = 'Invalid log.';
+} else {
+  $('name').textContent = log;
+  $('download').href = log;
+  fetch(log + '.idx.json').then(function (response) {
+    return response.json();
+  }).then(function (data) {
+    index = data;
+    $('first').onclick = function () { show(0); };
+    $('prev').onclick = function () { show(current - 1); };
+    $('next').onclick = function () { show(current + 1); };
+    $('last').onclick = function () { show(index.chunks.length - 1); };
+    // The end of a log is usually the interesting part.
+    show(index.chunks.length - 1);
+  }, function (error) {
+    $('log').textContent = 'Unable to load the log index: ' + error;
+  });
+}
+</script>
+</body>
+</html>
+"""
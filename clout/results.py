@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to parse individual test results out of test suite output.
+
+A test suite's return code only says whether the whole suite passed. The
+parsers in this module read a test suite's log one line at a time (so even
+very large logs are never loaded into memory) and pull out the name, status,
+and (where the output includes it) duration of each individual test.
+
+Each parser has a feed() method that is passed one line of output at a time,
+and a close() method that returns the list of results found. Each result is a
+dictionary with 'name', 'status' (one of test_statuses), and 'duration' (in
+seconds, or None if unknown) keys. New parsers can be added to result_parsers.
+"""
+
+from re import compile
+from xml.etree.ElementTree import ParseError, XMLParser
+
+# The possible statuses of an individual test.
+test_statuses = ['pass', 'fail', 'error', 'skip']
+
+class VerboseRunnerParser(object):
+    """Base class for parsers of '<test> ... <status>' style output.
+
+    Subclasses define status_words, which maps the words the test runner
+    prints after '...' to test statuses.
+    """
+
+    status_words = {}
+
+    _result_re = compile(r'^(?P<desc>\S.*?) \.\.\. ?(?P<rest>.*)$')
+    _test_id_re = compile(r'^(?P<method>\w+) \((?P<test_class>[\w.]+)\)$')
+
+    def __init__(self):
+        self.results = []
+        self._pending_name = None
+        self._prev_line = None
+
+        # Match the longest status words first (e.g. 'expected failure'
+        # before 'ERROR').
+        self._sorted_status_words = sorted(self.status_words, key=len,
+                                           reverse=True)
+
+    def feed(self, line):
+        """Parses one line of output."""
+        line = line.rstrip('\r\n')
+        match = self._result_re.match(line)
+        if match is not None:
+            name = self._get_test_name(match.group('desc'))
+            status = self._get_status(match.group('rest'))
+            if status is None:
+                # The test printed output before its status.
+                self._pending_name = name
+            else:
+                self._add_result(name, status)
+        elif self._pending_name is not None:
+            status = self._get_status(line)
+            if status is not None:
+                self._add_result(self._pending_name, status)
+        self._prev_line = line
+
+    def close(self):
+        """Returns the list of results that were found."""
+        return self.results
+
+    def _get_test_name(self, desc):
+        """Returns the full name of a test from its description.
+
+        Unittest describes tests as 'test_method (module.TestClass)'. If the
+        test has a docstring, Python 2.7 prints the test ID on the line before
+        the docstring instead.
+        """
+        match = self._test_id_re.match(desc)
+        if match is None and self._prev_line is not None:
+            match = self._test_id_re.match(self._prev_line)
+        if match is None:
+            return desc
+
+        method = match.group('method')
+        test_class = match.group('test_class')
+        if test_class.endswith('.' + method):
+            # Python 3.11+ includes the method name inside the parentheses.
+            return test_class
+        return '%s.%s' % (test_class, method)
+
+    def _get_status(self, text):
+        """Returns the status that text begins with, or None."""
+        text = text.strip()
+        for word in self._sorted_status_words:
+            if text == word or text.startswith(word + ' ') or \
+               text.startswith(word + ':'):
+                return self.status_words[word]
+        return None
+
+    def _add_result(self, name, status):
+        self.results.append({'name': name, 'status': status,
+                             'duration': None})
+        self._pending_name = None
+
+
+class UnittestParser(VerboseRunnerParser):
+    """Parses the output of Python's unittest module run with -v."""
+
+    status_words = {'ok': 'pass', 'FAIL': 'fail', 'ERROR': 'error',
+                    'skipped': 'skip', 'expected failure': 'pass',
+                    'unexpected success': 'fail'}
+
+
+class NoseParser(VerboseRunnerParser):
+    """Parses the output of nose run with -v."""
+
+    status_words = {'ok': 'pass', 'FAIL': 'fail', 'ERROR': 'error',
+                    'SKIP': 'skip', 'DEPRECATED': 'skip'}
+
+
+class JUnitXmlParser(object):
+    """Parses JUnit XML reports (e.g. from nose --with-xunit or py.test
+    --junitxml) that are included in a test suite's output.
+
+    The report must be printed as part of the output (e.g. by ending the test
+    suite's command with '&& cat nosetests.xml'). Output before and after the
+    report is ignored, and there may be more than one report.
+    """
+
+    def __init__(self):
+        self.results = []
+        self._parser = None
+        self._target = None
+
+    def feed(self, line):
+        """Parses one line of output."""
+        if self._parser is None:
+            start = line.find('<testsuite')
+            if start == -1:
+                return
+            line = line[start:]
+            self._target = _JUnitXmlTarget()
+            self._parser = XMLParser(target=self._target)
+
+        try:
+            self._parser.feed(line)
+        except ParseError:
+            # Not a report after all, or a corrupt one. Look for another.
+            self._parser = None
+            return
+
+        if self._target.finished:
+            self.results.extend(self._target.results)
+            self._parser = None
+
+    def close(self):
+        """Returns the list of results that were found."""
+        return self.results
+
+
+class _JUnitXmlTarget(object):
+    """Builds results from the elements of a JUnit XML report."""
+
+    def __init__(self):
+        self.results = []
+        self.finished = False
+        self._depth = 0
+        self._test = None
+
+    def start(self, tag, attrib):
+        if tag in ('testsuite', 'testsuites'):
+            self._depth += 1
+        elif tag == 'testcase':
+            name = attrib.get('name', '')
+            if attrib.get('classname'):
+                name = '%s.%s' % (attrib['classname'], name)
+            try:
+                duration = float(attrib['time'])
+            except (KeyError, ValueError):
+                duration = None
+            self._test = {'name': name, 'status': 'pass',
+                          'duration': duration}
+        elif self._test is not None:
+            status = {'failure': 'fail', 'error': 'error',
+                      'skipped': 'skip'}.get(tag)
+            if status is not None:
+                self._test['status'] = status
+
+    def end(self, tag):
+        if tag in ('testsuite', 'testsuites'):
+            self._depth -= 1
+            if self._depth == 0:
+                self.finished = True
+        elif tag == 'testcase' and self._test is not None:
+            self.results.append(self._test)
+            self._test = None
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+# Maps the names that can be given with a test suite's 'results' option to
+# parser classes.
+result_parsers = {'unittest': UnittestParser, 'nose': NoseParser,
+                  'junit': JUnitXmlParser}
+
+# The order in which parsers are preferred when the format is detected
+# automatically. JUnit XML comes first because it includes durations.
+auto_result_parsers = ['junit', 'unittest', 'nose']
+
+def get_result_parser_names(parser_name):
+    """Returns the names of the parsers to use for a 'results' option value.
+
+    'auto' tries every parser (in order of preference) and 'none' disables
+    parsing.
+    """
+    if parser_name == 'auto':
+        return auto_result_parsers + sorted(set(result_parsers) -
+                                            set(auto_result_parsers))
+    elif parser_name == 'none':
+        return []
+    elif parser_name in result_parsers:
+        return [parser_name]
+    raise ValueError("Unrecognized test results format '%s'. Valid formats "
+                     "are %s." % (parser_name, ', '.join(
+                     ['auto', 'none'] + sorted(result_parsers))))
+
+def parse_test_results(log_f, parser_name='auto'):
+    """Parses individual test results out of a test suite's log.
+
+    Returns a 2-element tuple containing the name of the parser whose results
+    were used (None if no results were found) and the list of results.
+
+    Arguments:
+        log_f - the open log file. It is read from its current position and
+            is left positioned at the end
+        parser_name - the name of a parser in result_parsers. If 'auto',
+            every parser is tried and the one that finds the most results is
+            used. JUnit XML results are always used if found, and ties go to
+            the parser that comes first in auto_result_parsers. If 'none', no
+            parsing is done
+    """
+    parsers = [(name, result_parsers[name]())
+               for name in get_result_parser_names(parser_name)]
+    if not parsers:
+        return None, []
+
+    for line in log_f:
+        for name, parser in parsers:
+            parser.feed(line)
+
+    best_name, best_results = None, []
+    for name, parser in parsers:
+        results = parser.close()
+        if name == 'junit' and results:
+            return name, results
+        if len(results) > len(best_results):
+            best_name, best_results = name, results
+    return best_name, best_results
+
+def summarize_test_results(results, num_slowest=5):
+    """Summarizes a test suite's individual test results.
+
+    Returns a dictionary containing the number of tests with each status
+    ('counts'), a list of the [name, status] of each test that failed or had
+    an error ('failures'), a list of the [name, duration] of the num_slowest
+    slowest tests, slowest first ('slowest'), and a dictionary mapping each
+    test with a known duration to its duration ('durations').
+
+    Arguments:
+        results - a list of results, as returned by parse_test_results()
+        num_slowest - the number of slowest tests to include
+    """
+    counts = dict([(status, 0) for status in test_statuses])
+    failures = []
+    durations = {}
+    for result in results:
+        counts[result['status']] += 1
+        if result['status'] in ('fail', 'error'):
+            failures.append([result['name'], result['status']])
+        if result['duration'] is not None:
+            durations[result['name']] = result['duration']
+
+    slowest = sorted(durations.items(), key=lambda item: (-item[1], item[0]))
+    return {'counts': counts, 'failures': failures,
+            'slowest': [list(item) for item in slowest[:num_slowest]],
+            'durations': durations}
@@ -11,28 +11,109 @@ __email__ = "jai.rideout@gmail.com"
 
 """Module to run test suites and publish the results."""
 
-from tempfile import TemporaryFile
+from contextlib import contextmanager
+from hashlib import sha1
+from json import dumps
+from os import fsync, getpid
+from os.path import abspath, basename, exists, getsize, isdir, join
+from pipes import quote
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from threading import Lock
+from time import time
 
-from clout.format import format_email_summary
+from clout.artifacts import (build_collect_artifacts_cmd, extract_artifacts,
+                             get_artifacts_dir_name, parse_artifact_globs)
+from clout.autoscale import (get_cluster_cost, get_node_name,
+                             plan_cluster_size, predict_durations)
+from clout.backend import (get_backend_params, load_backend,
+                           StarClusterBackend)
+from clout.format import (format_artifacts_summary,
+                          format_cluster_lease_summary,
+                          format_cluster_plan_summary, format_email_summary,
+                          format_interrupted_attempts_summary,
+                          format_matrix_summary, format_preflight_results,
+                          format_profiles_summary,
+                          format_snapshots_summary, format_steps_summary,
+                          format_test_regressions,
+                          format_test_results_summary,
+                          format_test_suite_regressions)
+from clout.filters import parse_output_filters
+from clout.history import (find_test_regressions, find_test_suite_regression,
+                           get_adaptive_timeout, RunHistory)
+from clout.lock import RunLock
+from clout.logarchive import LogArchive
+from clout.matrix import expand_matrices, get_variant_label, substitute_values
+from clout.metrics import (build_run_metrics, estimate_run_cost,
+                           get_log_sizes, get_metrics_fp, RunMetrics,
+                           write_metrics)
+from clout.outbox import Outbox
 from clout.parse import (parse_config_file, parse_email_list,
-                         parse_email_settings)
-from clout.util import CommandExecutor, send_email
+                         parse_email_settings, parse_suite_options)
+from clout.pool import ClusterPool
+from clout.preflight import (build_preflight_checks,
+                             default_preflight_timeout, run_preflight_checks)
+from clout.progress import ProgressReporter
+from clout.profiling import (build_profiled_cmd, get_profile_dir_name,
+                             profile_modes, remote_profiles_dir,
+                             summarize_profile, write_python_profiler_hook)
+from clout.report import write_report
+from clout.results import (get_result_parser_names, parse_test_results,
+                           summarize_test_results)
+from clout.snapshot import (build_capture_snapshot_cmd,
+                            build_restore_snapshot_cmd, evict_snapshots,
+                            get_snapshot_fp, get_snapshot_key,
+                            mark_snapshot_used, parse_snapshot_dirs)
+from clout.stage import (build_staged_cmd, create_stage_links,
+                         get_remote_stage_dir, remote_stage_dir)
+from clout.state import create_run_id, prune_runs, RunState
+from clout.steps import build_stepped_cmd, step_modes, StepTimeline
+from clout.trace import load_trace_events, Tracer
+from clout.util import (build_email_message, CommandExecutor, create_dir,
+                        send_email)
+
+# The options that can be given for each test suite in the config file, and
+# their default values.
+default_suite_options = {'results': 'auto', 'profile': 'none',
+                         'timeout': 'auto', 'stage': None, 'artifacts': None,
+                         'steps': 'markers', 'filters': None}
+
+# How a spot node that was lost while running test suites is replaced: by
+# another spot node, falling back to an on-demand node if that fails
+# ('on_demand'), only by another spot node ('spot'), or not at all ('none').
+spot_fallbacks = ['on_demand', 'spot', 'none']
+
+# The number of minutes to allow for checking whether a node was lost.
+node_check_timeout = 1.0
 
 def run_test_suites(config_f, sc_config_fp, recipients_f, email_settings_f,
                     cluster_tag, cluster_template=None,
                     user='root', setup_timeout=20.0, test_suites_timeout=240.0,
-                    teardown_timeout=20.0, sc_exe_fp='starcluster'):
+                    teardown_timeout=20.0, sc_exe_fp='starcluster',
+                    start_cluster=True, terminate_cluster=True, backend=None,
+                    state_dir=None, report_dir=None, report_url=None,
+                    progress_port=None, autoscale_deadline=None,
+                    max_cluster_size=10, use_pool=False, max_pool_clusters=5,
+                    max_pool_instances=20, pool_idle_timeout=0.0,
+                    cluster_size=1, metrics_dir=None,
+                    metrics_during_run=False, spot_bid=None,
+                    spot_fallback='on_demand', snapshot_max_size=10240.0,
+                    snapshot_max_age=30.0, output_filters='none',
+                    keep_unfiltered_logs=False, preflight=True,
+                    preflight_timeout=default_preflight_timeout,
+                    summary_callback=None):
     """Runs the suite(s) of tests and emails the results to the recipients.
 
-    This function does not return anything. This function is not unit-tested
-    because there isn't a clean way to test it since it sends an email, starts
-    up a cluster on Amazon EC2, etc. Nearly every other 'private' function that
-    this function calls has been extensively unit-tested (whenever possible).
-    Thus, the amount of untested code has been minimized and contained here.
+    Returns the body of the email that was sent. This function is not
+    unit-tested because there isn't a clean way to test it since it sends an
+    email, starts up a cluster on Amazon EC2, etc. Nearly every other
+    'private' function that this function calls has been extensively
+    unit-tested (whenever possible). Thus, the amount of untested code has
+    been minimized and contained here.
 
     Arguments:
         config_f - the input configuration file describing the test suites to
-            be run
+            be run (and any per-suite options; see default_suite_options)
         sc_config_fp - the starcluster config filepath that will be used to
             start/terminate the remote cluster that the tests will be run on
         recipients_f - the file containing email addresses of those who should
@@ -51,40 +132,1007 @@ def run_test_suites(config_f, sc_config_fp, recipients_f, email_settings_f,
             allow for fractions of a minute
         test_suites_timeout - the number of minutes to allow *all* test suites
             to run before terminating the cluster. Must be a float, to allow
-            for fractions of a minute
+            for fractions of a minute. Each test suite may also have its own
+            timeout (see the 'timeout' option in default_suite_options and
+            _get_test_suite_timeouts())
         teardown_timeout - the number of minutes to allow the cluster to be
             terminated before aborting. Must be a float, to allow for fractions
             of a minute
         sc_exe_fp - path to the starcluster executable
+        start_cluster - if False, the cluster labelled with cluster_tag is
+            assumed to already be running (e.g. it was kept warm by a previous
+            run) and will not be started
+        terminate_cluster - if False, the cluster will be left running after
+            the test suites finish so that it can be reused by another run
+        backend - the backend used to build the cluster commands (see
+            clout.backend). If not provided, a StarClusterBackend is built from
+            sc_config_fp, cluster_template, user, and sc_exe_fp
+        state_dir - the directory that Clout keeps state in across runs. If
+            provided, the run holds a lock on cluster_tag (see
+            clout.lock.RunLock) while it executes. If an identical run already
+            holds the lock, this run waits for it to finish and returns its
+            email body instead of starting a second cluster (and sending a
+            second email). If that run fails before sending its email, this run
+            goes on to acquire the lock and run itself. The run's progress is
+            also journaled under this directory (see clout.state.RunState) and
+            its logs are kept there, so that the run can be resumed with
+            resume_run() if it is interrupted. The email is spooled to an
+            outbox in this directory before it is sent (see
+            clout.outbox.Outbox), so if it can't be sent, it is kept and a
+            RuntimeError is raised. Finally, the results of recent runs are
+            kept in this directory (see clout.history.RunHistory), the email
+            lists any tests and test suites that took much longer than they
+            usually do, and each test suite's timeout is based on how long it
+            usually takes. The logs of recent runs are also kept there,
+            compressed and indexed so that they can be searched (see
+            clout.logarchive.LogArchive)
+        report_dir - if provided, a static HTML/JSON report of the run is
+            written under this directory (see clout.report), and the email
+            links to the report instead of attaching the logs
+        report_url - the URL that report_dir is published at. If provided, the
+            email links to the report's URL instead of its local path
+        progress_port - if provided, the run's progress events (see
+            clout.progress) are sent to this localhost UDP port as they
+            happen. If state_dir is provided, they are also appended to
+            status.jsonl in the run's directory
+        autoscale_deadline - if provided, the number of minutes that the test
+            suites should take to run. The cluster is started with the fewest
+            nodes (up to max_cluster_size) that are predicted to run the test
+            suites in that time, based on how long they usually take (see
+            clout.autoscale), instead of the number of nodes in the cluster
+            template. The test suites run on every node, and nodes are
+            removed once they have no test suites left to run. Only used if
+            the run starts and terminates its own cluster
+        max_cluster_size - the largest number of nodes that autoscale_deadline
+            may start the cluster with
+        use_pool - if True, the run leases its cluster from the pool of
+            clusters shared by every run using state_dir (see
+            clout.pool.ClusterPool) instead of starting a cluster labelled
+            with cluster_tag. The run waits until the pool has room for its
+            cluster, reuses an idle cluster booted from the same cluster
+            template if there is one, and hands its cluster back to the pool
+            when it is done instead of terminating it. cluster_tag still
+            identifies the run (e.g. in its history). Requires state_dir, and
+            can't be used with autoscale_deadline or with a cluster that is
+            kept warm by the daemon
+        max_pool_clusters - the maximum number of clusters in the pool
+        max_pool_instances - the maximum number of nodes across the clusters
+            in the pool
+        pool_idle_timeout - the number of minutes that the pool keeps the
+            run's cluster running once the run is done, in case another run
+            can reuse it
+        cluster_size - the number of nodes in the cluster template, which is
+            counted against max_pool_instances. Only used if use_pool is True
+        metrics_dir - the directory that node_exporter's textfile collector
+            reads. If provided, the run's metrics (e.g. how long each test
+            suite took and whether it passed) are written to it for
+            Prometheus once the run is done (see clout.metrics)
+        metrics_during_run - if True, the metrics are also updated while
+            the run executes, whenever a phase of the run starts or a test
+            suite finishes. Only used if metrics_dir is provided
+        spot_bid - if provided, the nodes of the autoscaled cluster (other
+            than the master) are spot instances, bid for at this maximum
+            price in dollars per hour. When a test suite fails on a spot
+            node, the node is checked: if it was lost (e.g. it was
+            reclaimed), the attempt is reported as interrupted rather than
+            failed, and the test suite is run again on the next node that is
+            free. Requires autoscale_deadline
+        spot_fallback - how a lost spot node is replaced (one of
+            spot_fallbacks)
+        snapshot_max_size - the maximum total size (in megabytes) of the
+            snapshots of matrix test suites' setups that are kept in
+            state_dir (see clout.snapshot). Once a run is done, the least
+            recently used snapshots are removed until the rest fit. If None,
+            the size isn't limited
+        snapshot_max_age - the number of days that a snapshot is kept after
+            it was last used. If None, snapshots are only removed to limit
+            their total size
+        output_filters - the filters that are applied to each test suite's
+            output as it is captured (see clout.filters), unless the test
+            suite's 'filters' option overrides them. Only the filtered
+            output is logged and attached to the email, but individual test
+            results are parsed from the unfiltered output
+        keep_unfiltered_logs - if True, the unfiltered log of each test
+            suite whose output is filtered is kept in the run's directory
+            ('<label>_results_unfiltered.txt'). Only used if state_dir is
+            provided
+        preflight - if True, the run's settings are checked before anything
+            else is done (see clout.preflight and check_test_suites()). If a
+            check fails, a RuntimeError listing the failures is raised
+            before any cluster is started
+        preflight_timeout - the number of seconds that the preflight checks
+            may take altogether
+        summary_callback - if provided, called with the run's summary (see
+            _execute_commands_and_build_email()) once its test suites have
+            run, e.g. so that the daemon knows whether the cluster was set up
+            (run_summary['setup']['succeeded']). It isn't called if the run
+            attached to an identical run (see state_dir)
     """
     if setup_timeout <= 0 or test_suites_timeout <= 0 or teardown_timeout <= 0:
         raise ValueError("The timeout (in minutes) must be greater than zero.")
+    if use_pool:
+        if state_dir is None:
+            raise ValueError("A state directory is required to lease "
+                             "clusters from the cluster pool.")
+        if autoscale_deadline is not None:
+            raise ValueError("Autoscaled clusters shrink as their test suites "
+                             "finish, so they can't be leased from the "
+                             "cluster pool.")
+        if not start_cluster or not terminate_cluster:
+            raise ValueError("Clusters leased from the cluster pool are "
+                             "started and terminated by the pool.")
+    if spot_bid is not None:
+        if autoscale_deadline is None:
+            raise ValueError("Spot instances are only used for the nodes of "
+                             "autoscaled clusters, so an autoscale deadline "
+                             "is required.")
+        if spot_bid <= 0:
+            raise ValueError("The spot bid (in dollars per hour) must be "
+                             "greater than zero.")
+    if spot_fallback not in spot_fallbacks:
+        raise ValueError("Unrecognized spot fallback '%s'. Must be one of: "
+                         "%s" % (spot_fallback, ', '.join(spot_fallbacks)))
+    if (snapshot_max_size is not None and snapshot_max_size <= 0) or \
+       (snapshot_max_age is not None and snapshot_max_age <= 0):
+        raise ValueError("The maximum size (in megabytes) and age (in days) "
+                         "of the snapshot store must be greater than zero.")
+    parse_output_filters(output_filters)
+    if preflight_timeout <= 0:
+        raise ValueError("The preflight timeout (in seconds) must be greater "
+                         "than zero.")
 
     # Parse the various configuration files first so that we know if there's
     # any outstanding problems with file formats before continuing.
-    test_suites = parse_config_file(config_f)
+    test_suites, suite_options, matrices = _parse_test_suites_config(config_f)
+    if state_dir is None and [matrix for matrix in matrices
+                              if matrix.get('snapshot') is not None]:
+        raise ValueError("Snapshots of matrix test suites' setups are kept "
+                         "in the state directory, so one is required to use "
+                         "the 'snapshot' option.")
     recipients = parse_email_list(recipients_f)
     email_settings = parse_email_settings(email_settings_f)
 
-    # Get the commands that need to be executed (these include launching a
-    # cluster, running the test suites, and terminating the cluster).
-    setup_cmds, test_suites_cmds, teardown_cmds = \
-            _build_test_execution_commands(test_suites, sc_config_fp,
-                                           cluster_tag, cluster_template, user,
-                                           sc_exe_fp)
-
-    # Execute the commands and build up the body of an email with the
-    # summarized results as well as the output in log file attachments.
-    email_body, attachments = _execute_commands_and_build_email(
-            test_suites, setup_cmds, test_suites_cmds, teardown_cmds,
-            setup_timeout, test_suites_timeout, teardown_timeout, cluster_tag)
-
-    # Send the email.
-    # TODO: this should be configurable by the user.
-    subject = "Test suite results [Clout testing system]"
-    send_email(email_settings['smtp_server'], email_settings['smtp_port'],
-                email_settings['sender'], email_settings['password'],
-                recipients, subject, email_body, attachments)
+    if backend is None:
+        backend = StarClusterBackend(sc_config_fp, cluster_template, user,
+                                     sc_exe_fp)
+
+    # Catch problems that would otherwise only show up once the cluster is
+    # running (or once the results can't be emailed).
+    if preflight:
+        results = run_preflight_checks(build_preflight_checks(test_suites,
+                email_settings, backend, matrices, preflight_timeout),
+                preflight_timeout)
+        if [result for result in results if result['error'] is not None]:
+            raise RuntimeError("The run's preflight checks failed, so no "
+                               "cluster was started:\n\n%s" %
+                               format_preflight_results(results))
+
+    # Size the cluster based on how long the test suites usually take. A
+    # cluster that was already running (or that is kept running for another
+    # run) keeps the size it was started with.
+    cluster_plan = None
+    if autoscale_deadline is not None and start_cluster and \
+       terminate_cluster:
+        run_history = None
+        if state_dir is not None:
+            run_history = RunHistory(join(state_dir, 'history.jsonl'))
+        cluster_plan = plan_cluster_size(test_suites,
+                predict_durations(test_suites, run_history, cluster_tag),
+                autoscale_deadline, max_cluster_size)
+        if spot_bid is not None:
+            cluster_plan.update(spot_bid=spot_bid,
+                                spot_fallback=spot_fallback)
+
+    # Everything needed to resume the run if it is interrupted. The email
+    # password isn't stored, only where to read it from.
+    email_settings_fp = getattr(email_settings_f, 'name', None)
+    if email_settings_fp is not None:
+        email_settings_fp = abspath(email_settings_fp)
+    run_params = {'test_suites': test_suites, 'suite_options': suite_options,
+                  'matrices': matrices, 'recipients': recipients,
+                  'email_settings_fp': email_settings_fp,
+                  'cluster_tag': cluster_tag,
+                  'backend': get_backend_params(backend),
+                  'setup_timeout': setup_timeout,
+                  'test_suites_timeout': test_suites_timeout,
+                  'teardown_timeout': teardown_timeout,
+                  'start_cluster': start_cluster,
+                  'terminate_cluster': terminate_cluster,
+                  'report_dir': report_dir and abspath(report_dir),
+                  'report_url': report_url,
+                  'progress_port': progress_port,
+                  'cluster_plan': cluster_plan,
+                  'pool': None,
+                  'metrics_dir': metrics_dir and abspath(metrics_dir),
+                  'metrics_during_run': metrics_during_run,
+                  'snapshots': {'max_size': snapshot_max_size,
+                                'max_age': snapshot_max_age},
+                  'output_filters': output_filters,
+                  'keep_unfiltered_logs': keep_unfiltered_logs}
+    if use_pool:
+        run_params.update(start_cluster=False, terminate_cluster=False,
+                          pool={'max_clusters': max_pool_clusters,
+                                'max_instances': max_pool_instances,
+                                'idle_timeout': pool_idle_timeout,
+                                'cluster_size': cluster_size})
+    return _run_and_send_results(run_params, backend, email_settings,
+                                 state_dir, summary_callback=summary_callback)
+
+def check_test_suites(config_f, sc_config_fp, email_settings_f,
+                      cluster_template=None, user='root',
+                      sc_exe_fp='starcluster', backend=None,
+                      timeout=default_preflight_timeout):
+    """Runs the preflight checks for a run without running it.
+
+    Returns the output of clout.preflight.run_preflight_checks(). Like
+    run_test_suites(), raises a ValueError if the configuration files are
+    invalid.
+
+    Arguments:
+        config_f - same as for run_test_suites()
+        sc_config_fp - same as for run_test_suites()
+        email_settings_f - same as for run_test_suites()
+        cluster_template - same as for run_test_suites()
+        user - same as for run_test_suites()
+        sc_exe_fp - same as for run_test_suites()
+        backend - same as for run_test_suites()
+        timeout - the number of seconds that the checks may take altogether
+    """
+    if timeout <= 0:
+        raise ValueError("The preflight timeout (in seconds) must be greater "
+                         "than zero.")
+    test_suites, suite_options, matrices = _parse_test_suites_config(config_f)
+    email_settings = parse_email_settings(email_settings_f)
+    if backend is None:
+        backend = StarClusterBackend(sc_config_fp, cluster_template, user,
+                                     sc_exe_fp)
+    return run_preflight_checks(build_preflight_checks(test_suites,
+            email_settings, backend, matrices, timeout), timeout)
+
+def resume_run(state_dir, run_id, email_settings_f=None):
+    """Resumes a run that was interrupted before its results were sent.
+
+    The run's journal (see clout.state.RunState) determines what is left to
+    do. If the cluster was started, the run reattaches to it instead of
+    starting a new one. Test suites that already finished are not run again
+    (their logs are reused), and the remaining test suites, cluster
+    termination, and email are completed as usual. Returns the body of the
+    email that was sent. Like run_test_suites, this function is not
+    unit-tested because it sends an email.
+
+    Arguments:
+        state_dir - the state_dir that was passed to run_test_suites when the
+            run was started
+        run_id - the ID of the run to resume
+        email_settings_f - the file containing email (SMTP) settings. If not
+            provided, the email settings file that the run was started with is
+            used
+    """
+    run_state = RunState.load(join(state_dir, 'runs'), run_id)
+    if run_state.is_finished():
+        raise ValueError("The run '%s' has already finished." % run_id)
+
+    if email_settings_f is None:
+        if run_state.params['email_settings_fp'] is None:
+            raise ValueError("The email settings file that the run '%s' was "
+                             "started with is unknown, so it must be "
+                             "provided." % run_id)
+        email_settings_f = open(run_state.params['email_settings_fp'], 'U')
+    email_settings = parse_email_settings(email_settings_f)
+
+    run_state.record('run_resumed')
+    return _run_and_send_results(run_state.params,
+                                 load_backend(run_state.params['backend']),
+                                 email_settings, state_dir, run_state)
+
+def _run_and_send_results(run_params, backend, email_settings, state_dir=None,
+                          run_state=None, summary_callback=None):
+    """Executes a run and emails the results; returns the email body.
+
+    Arguments:
+        run_params - a dictionary of the run's parameters, as built by
+            run_test_suites
+        backend - the backend to build the cluster commands with
+        email_settings - the output of parse_email_settings()
+        state_dir - same as for run_test_suites()
+        run_state - the state of the run if it is being resumed. If not
+            provided and state_dir is provided, the state of a new run is
+            created
+        summary_callback - same as for run_test_suites()
+    """
+    test_suites = run_params['test_suites']
+    recipients = run_params['recipients']
+    cluster_tag = run_params['cluster_tag']
+    suite_options = run_params.get('suite_options')
+    cluster_plan = run_params.get('cluster_plan')
+
+    run_lock = None
+    if state_dir is not None:
+        run_lock = RunLock(join(state_dir, 'locks'), cluster_tag,
+                           _get_run_config_hash(run_params, backend))
+        if not run_lock.acquire():
+            return run_lock.coalesced_result
+
+    email_body = None
+    profiles_dir = None
+    stage_links_dir = None
+    artifacts_dir = None
+    progress = None
+    tracer = None
+    metrics_fp = None
+    run_succeeded = False
+    cluster_pool = None
+    cluster_lease = None
+    cluster_reusable = False
+    try:
+        if state_dir is not None and run_state is None:
+            run_state = RunState.create(join(state_dir, 'runs'), run_params)
+
+        # Export the run's metrics for Prometheus, optionally keeping them up
+        # to date as the run progresses.
+        run_metrics = None
+        last_successes = {}
+        resumes = 0
+        if run_params.get('metrics_dir') is not None:
+            metrics_fp = get_metrics_fp(create_dir(run_params['metrics_dir']),
+                                        cluster_tag)
+            if run_state is not None:
+                last_successes = _get_last_successes(test_suites,
+                        RunHistory(join(state_dir, 'history.jsonl')),
+                        cluster_tag, run_state.run_id)
+                resumes = len(run_state.get_events('run_resumed'))
+            if run_params.get('metrics_during_run'):
+                run_metrics = RunMetrics(metrics_fp, cluster_tag,
+                                         last_successes, resumes)
+
+        # Trace where the run's time goes. A resumed run's trace continues
+        # the trace of its earlier attempts.
+        if run_state is not None:
+            trace_fp = join(run_state.run_dir, 'trace.json')
+            tracer = Tracer('clout run %s (attempt %d)' % (run_state.run_id,
+                    len(run_state.get_events('run_resumed')) + 1),
+                    load_trace_events(trace_fp))
+
+        # Report the run's progress as it happens, so that a long run can be
+        # watched (e.g. with 'clout status').
+        status_fp = None
+        if run_state is not None:
+            status_fp = join(run_state.run_dir, 'status.jsonl')
+        listeners = [listener for listener in (run_metrics, tracer)
+                     if listener is not None]
+        if status_fp is not None or listeners or \
+           run_params.get('progress_port') is not None:
+            progress = ProgressReporter(status_fp,
+                                        run_params.get('progress_port'),
+                                        listeners=listeners)
+        _report_progress(progress, 'run_started',
+                         run_id=None if run_state is None
+                                     else run_state.run_id,
+                         pid=getpid(), cluster_tag=cluster_tag,
+                         test_suites=[label for label, cmd in test_suites])
+
+        # Lease a cluster from the pool (or take back the lease of the run
+        # that is being resumed), and run everything on the leased cluster.
+        start_cluster = run_params['start_cluster']
+        backend_cluster_tag = cluster_tag
+        if run_params.get('pool') is not None:
+            _report_progress(progress, 'phase_changed',
+                             phase='waiting_for_cluster')
+            cluster_pool = _build_cluster_pool(state_dir, run_params['pool'])
+            lease_event = _get_last_event(run_state, 'cluster_leased')
+            if lease_event is None:
+                cluster_lease = cluster_pool.acquire(run_state.run_id,
+                        backend.cluster_key(),
+                        run_params['pool']['cluster_size'],
+                        backend.build_terminate_cmd,
+                        run_params['teardown_timeout'])
+                _record_event(run_state, 'cluster_leased', **cluster_lease)
+            else:
+                cluster_lease = cluster_pool.reacquire(dict(
+                        [(key, val) for key, val in lease_event.items()
+                         if key not in ('event', 'time')]))
+            start_cluster = not cluster_lease['reused']
+            backend_cluster_tag = cluster_lease['cluster_tag']
+
+        # Get the commands that need to be executed (these include launching
+        # a cluster, running the test suites, and terminating the cluster).
+        setup_cmds, test_suites_cmds, teardown_cmds = \
+                _build_backend_commands(test_suites, backend,
+                                        backend_cluster_tag, suite_options,
+                                        cluster_plan)
+        node_removal_cmds = None
+        node_check_cmds = None
+        node_replacement_cmds = None
+        if cluster_plan is not None:
+            node_removal_cmds = _build_node_removal_commands(backend,
+                    backend_cluster_tag, cluster_plan['num_nodes'])
+            if cluster_plan.get('spot_bid') is not None:
+                node_check_cmds, node_replacement_cmds = \
+                        _build_spot_node_commands(backend,
+                                backend_cluster_tag,
+                                cluster_plan['num_nodes'],
+                                cluster_plan['spot_bid'],
+                                cluster_plan['spot_fallback'])
+        if not start_cluster:
+            setup_cmds = []
+        if not run_params['terminate_cluster']:
+            teardown_cmds = []
+
+        # The links that staged directories are synced through are kept in
+        # the run's directory (or a temporary directory if the run has no
+        # state).
+        stage_cmds = None
+        if _get_staged_dirs(test_suites, suite_options):
+            if run_state is None:
+                stage_links_dir = mkdtemp(prefix='clout_stage_')
+            else:
+                stage_links_dir = join(run_state.run_dir, 'stage')
+            stage_cmds = _build_stage_commands(test_suites, backend,
+                    backend_cluster_tag, suite_options, stage_links_dir)
+
+        # Matrix test suites' shared setup commands are run once, before any
+        # of the test suites.
+        matrices = run_params.get('matrices') or []
+        matrix_setup_cmds = _build_matrix_setup_commands(matrices,
+                backend, backend_cluster_tag, suite_options)
+
+        # Snapshotted setups are restored from the snapshots kept in the
+        # state directory instead of being run again, if they can be.
+        snapshot_cmds = None
+        snapshots_dir = None
+        if state_dir is not None:
+            snapshots_dir = join(state_dir, 'snapshots')
+            snapshot_cmds = _build_snapshot_commands(matrices, backend,
+                    backend_cluster_tag, suite_options, snapshots_dir)
+
+        # Artifacts are streamed back from the cluster into the run's
+        # directory (or a temporary directory if the run has no state).
+        artifact_cmds = None
+        if _get_artifact_test_suites(test_suites, suite_options):
+            if run_state is None:
+                artifacts_dir = mkdtemp(prefix='clout_artifacts_')
+            else:
+                artifacts_dir = join(run_state.run_dir, 'artifacts')
+            artifact_cmds = _build_artifact_commands(test_suites, backend,
+                    backend_cluster_tag, suite_options, artifacts_dir)
+
+        # Profiles are copied back from the cluster into the run's directory
+        # (or a temporary directory if the run has no state).
+        profile_cmds = None
+        if _get_profiled_test_suites(test_suites, suite_options):
+            if run_state is None:
+                profiles_dir = mkdtemp(prefix='clout_profiles_')
+            else:
+                profiles_dir = join(run_state.run_dir, 'profiles')
+            profile_cmds = _build_profile_commands(test_suites, backend,
+                    backend_cluster_tag, suite_options, profiles_dir)
+
+        if run_state is None:
+            started_at = time()
+        else:
+            started_at = run_state.get_events('run_started')[0]['time']
+
+        run_history = None
+        if state_dir is not None:
+            run_history = RunHistory(join(state_dir, 'history.jsonl'))
+        test_suites_timeouts = _get_test_suite_timeouts(test_suites,
+                suite_options, run_history, cluster_tag,
+                run_params['test_suites_timeout'],
+                None if run_state is None else run_state.run_id)
+
+        # Execute the commands and build up the body of an email with the
+        # summarized results as well as the output in log file attachments.
+        email_body, attachments, run_summary = \
+                _execute_commands_and_build_email(test_suites, setup_cmds,
+                        test_suites_cmds, teardown_cmds,
+                        run_params['setup_timeout'],
+                        run_params['test_suites_timeout'],
+                        run_params['teardown_timeout'], backend_cluster_tag,
+                        run_state=run_state, suite_options=suite_options,
+                        profile_cmds=profile_cmds, profiles_dir=profiles_dir,
+                        test_suites_timeouts=test_suites_timeouts,
+                        stage_cmds=stage_cmds, artifact_cmds=artifact_cmds,
+                        artifacts_dir=artifacts_dir, progress=progress,
+                        matrix_setup_cmds=matrix_setup_cmds,
+                        snapshot_cmds=snapshot_cmds,
+                        matrices=matrices, cluster_plan=cluster_plan,
+                        node_removal_cmds=node_removal_cmds, tracer=tracer,
+                        node_check_cmds=node_check_cmds,
+                        node_replacement_cmds=node_replacement_cmds,
+                        test_suites_output_filters=
+                                _get_test_suites_output_filters(test_suites,
+                                        suite_options,
+                                        run_params.get('output_filters',
+                                                       'none')),
+                        keep_unfiltered_logs=run_params.get(
+                                'keep_unfiltered_logs', False))
+        _report_progress(progress, 'phase_changed', phase='reporting')
+        if snapshot_cmds is not None:
+            _evict_snapshots(snapshots_dir, run_params.get('snapshots'))
+        run_summary.update(cluster_tag=cluster_tag, started_at=started_at,
+                           finished_at=time())
+        if summary_callback is not None:
+            summary_callback(run_summary)
+        if cluster_lease is not None:
+            # A cluster that started properly can be reused by other runs.
+            cluster_reusable = bool(run_summary['setup']['succeeded'])
+            run_summary['cluster_lease'] = cluster_lease
+            email_body += format_cluster_lease_summary(cluster_lease)
+
+        if metrics_fp is not None:
+            num_nodes = 1
+            if run_params.get('pool') is not None:
+                num_nodes = run_params['pool']['cluster_size']
+            write_metrics(metrics_fp, build_run_metrics(run_summary,
+                    get_log_sizes(attachments), last_successes,
+                    estimate_run_cost(run_summary, num_nodes), resumes))
+
+        if run_history is not None:
+            # Point out any tests and test suites that were much slower than
+            # usual, then add this run to the history.
+            email_body += _find_test_regressions(run_summary, run_history,
+                                                 run_state.run_id)
+            run_history.add_run(run_state.run_id, run_summary)
+
+            # Keep the logs searchable after the email has been sent.
+            LogArchive(join(state_dir, 'log_archive')).add_run(
+                    run_state.run_id, run_summary, attachments)
+
+        # Publish the full results as a report, and link to it from the email
+        # instead of sending the (potentially huge) logs as attachments.
+        report_root = run_params.get('report_dir')
+        if report_root is not None:
+            report_run_id = create_run_id() if run_state is None \
+                                            else run_state.run_id
+            report_dir = write_report(report_root, report_run_id, run_summary,
+                    attachments, profiles=_get_profile_dirs(run_summary,
+                                                            profiles_dir),
+                    artifacts=_get_artifact_dirs(run_summary, artifacts_dir))
+            email_body += ("The complete results and logs are available at "
+                           "%s\n\n" % _get_report_location(report_dir,
+                           report_run_id, run_params.get('report_url')))
+            attachments = None
+        elif artifacts_dir is not None and \
+             exists(_get_artifacts_archive_fp(artifacts_dir)):
+            # Without a report, the artifacts are attached in the compressed
+            # archive they were transferred in.
+            attachments.append(('artifacts.tar.gz',
+                    open(_get_artifacts_archive_fp(artifacts_dir), 'rb')))
+
+        # Send the email.
+        # TODO: this should be configurable by the user.
+        subject = "Test suite results [Clout testing system]"
+        if state_dir is None:
+            send_email(email_settings['smtp_server'],
+                       email_settings['smtp_port'], email_settings['sender'],
+                       email_settings['password'], recipients, subject,
+                       email_body, attachments)
+        else:
+            # Spool the email to the outbox first so that the results aren't
+            # lost if it can't be sent. Once it is spooled, the run is done.
+            outbox = Outbox(join(state_dir, 'outbox'))
+            with _trace_span(tracer, 'spool email', category='email'):
+                msg_id = outbox.add(email_settings['sender'], recipients,
+                        build_email_message(email_settings['sender'],
+                                            recipients, subject, email_body,
+                                            attachments))
+            run_state.record('run_finished')
+
+            with _trace_span(tracer, 'send email', category='email',
+                             recipients=len(recipients)):
+                undelivered = outbox.flush(email_settings['smtp_server'],
+                                           email_settings['smtp_port'],
+                                           email_settings['sender'],
+                                           email_settings['password'])[1]
+            if msg_id in undelivered:
+                raise RuntimeError("The email containing the test suite "
+                                   "results could not be sent, so it has been "
+                                   "kept in the outbox (%s). Run 'clout "
+                                   "flush-outbox' to try sending it again." %
+                                   outbox.outbox_dir)
+        run_succeeded = True
+    finally:
+        if progress is not None:
+            progress.report('run_finished', succeeded=run_succeeded)
+            progress.close()
+        if tracer is not None:
+            tracer.write(trace_fp)
+        if run_state is None:
+            for temp_dir in profiles_dir, stage_links_dir, artifacts_dir:
+                if temp_dir is not None:
+                    rmtree(temp_dir, ignore_errors=True)
+        # A run that can still be resumed keeps its lease so that it is
+        # resumed on the same cluster.
+        if cluster_lease is not None and run_state.is_finished():
+            cluster_pool.release(cluster_lease, cluster_reusable)
+        # By the time a run has finished, its logs are in the log archive and
+        # its email is in the outbox, so only the directories of the most
+        # recently finished runs are kept.
+        if run_state is not None and run_state.is_finished():
+            prune_runs(join(state_dir, 'runs'))
+        # Runs attached to this one only get its result if it sent its email.
+        # Otherwise, one of them runs instead.
+        if run_lock is not None:
+            run_lock.release(email_body, run_succeeded)
+    return email_body
+
+def _build_cluster_pool(state_dir, pool_params):
+    """Returns the cluster pool that a run leases its cluster from.
+
+    Arguments:
+        state_dir - same as for run_test_suites()
+        pool_params - the run's pool parameters, as built by run_test_suites
+    """
+    return ClusterPool(join(state_dir, 'pool'), pool_params['max_clusters'],
+                       pool_params['max_instances'],
+                       pool_params['idle_timeout'])
+
+def _get_last_successes(test_suites, run_history, cluster_tag, run_id):
+    """Returns when each test suite last passed in an earlier run.
+
+    Returns a dictionary mapping the label of each test suite that has passed
+    to the time of its latest passing run.
+
+    Arguments:
+        test_suites - the test suites of the run
+        run_history - the clout.history.RunHistory of past runs
+        cluster_tag - the cluster tag of the run
+        run_id - the ID of the run, which is left out if it was resumed after
+            it was added to the history
+    """
+    last_successes = {}
+    for label, cmd in test_suites:
+        last_success = run_history.get_last_success(label, cluster_tag,
+                                                    run_id)
+        if last_success is not None:
+            last_successes[label] = last_success
+    return last_successes
+
+def _parse_test_suites_config(config_f):
+    """Parses and validates the config file describing the test suites.
+
+    Returns the test suites, their options, and the matrices that they were
+    expanded from (see clout.matrix.expand_matrices()). Raises a ValueError
+    if the config file or any of the options are invalid.
+
+    Arguments:
+        config_f - same as for run_test_suites()
+    """
+    config_lines = list(config_f)
+    test_suites = parse_config_file(config_lines)
+    suite_options = parse_suite_options(config_lines)
+    test_suites, suite_options, matrices = expand_matrices(test_suites,
+                                                           suite_options)
+    _validate_suite_options(suite_options)
+    # Staged directories are stored as absolute paths so that the run can be
+    # resumed from any directory.
+    for options in suite_options.values():
+        if 'stage' in options:
+            options['stage'] = abspath(options['stage'])
+    _validate_matrix_snapshots(matrices)
+    return test_suites, suite_options, matrices
+
+def _validate_suite_options(suite_options):
+    """Raises a ValueError if any per-suite option is invalid.
+
+    Arguments:
+        suite_options - the output of clout.parse.parse_suite_options()
+    """
+    for label, options in suite_options.items():
+        for key, val in options.items():
+            if key not in default_suite_options:
+                raise ValueError("Unrecognized option '%s' for the test suite "
+                                 "'%s'. Valid options are %s." % (key, label,
+                                 ', '.join(sorted(default_suite_options))))
+        get_result_parser_names(_get_suite_option(suite_options, label,
+                                                  'results'))
+        profile_mode = _get_suite_option(suite_options, label, 'profile')
+        if profile_mode not in profile_modes:
+            raise ValueError("Unrecognized profile mode '%s' for the test "
+                             "suite '%s'. Valid modes are %s." % (
+                             profile_mode, label, ', '.join(profile_modes)))
+        _parse_suite_timeout(_get_suite_option(suite_options, label,
+                                               'timeout'), label)
+        stage_dir = _get_suite_option(suite_options, label, 'stage')
+        if stage_dir is not None and not isdir(stage_dir):
+            raise ValueError("The directory '%s' staged by the test suite "
+                             "'%s' does not exist." % (stage_dir, label))
+        artifact_globs = _get_suite_option(suite_options, label, 'artifacts')
+        if artifact_globs is not None:
+            parse_artifact_globs(artifact_globs)
+        steps_mode = _get_suite_option(suite_options, label, 'steps')
+        if steps_mode not in step_modes:
+            raise ValueError("Unrecognized steps mode '%s' for the test "
+                             "suite '%s'. Valid modes are %s." % (
+                             steps_mode, label, ', '.join(step_modes)))
+        output_filters = _get_suite_option(suite_options, label, 'filters')
+        if output_filters is not None:
+            parse_output_filters(output_filters)
+
+def _validate_matrix_snapshots(matrices):
+    """Raises a ValueError if a matrix test suite's snapshot is invalid.
+
+    The local inputs of each snapshot are made absolute, so that the run can
+    be resumed from any directory.
+
+    Arguments:
+        matrices - the matrices returned by clout.matrix.expand_matrices()
+    """
+    for matrix in matrices:
+        snapshot = matrix.get('snapshot')
+        if snapshot is None:
+            continue
+        if snapshot['inputs'] is not None:
+            snapshot['inputs'] = ','.join([abspath(input_fp.strip())
+                    for input_fp in snapshot['inputs'].split(',')
+                    if input_fp.strip()])
+        for setup_cmd, setup_values in matrix['setup']:
+            parse_snapshot_dirs(substitute_values(snapshot['dirs'],
+                                                  setup_values))
+            for input_fp in _get_snapshot_inputs(snapshot, setup_values):
+                if not exists(input_fp):
+                    raise ValueError("The snapshot input '%s' of the test "
+                                     "suite '%s' does not exist." % (
+                                     input_fp, matrix['label']))
+
+def _get_snapshot_inputs(snapshot, setup_values):
+    """Returns the local inputs of a matrix test suite's snapshotted setup.
+
+    Arguments:
+        snapshot - the 'snapshot' of one of the matrices returned by
+            clout.matrix.expand_matrices()
+        setup_values - the values that the setup command was built from
+    """
+    if snapshot['inputs'] is None:
+        return []
+    return [input_fp.strip() for input_fp in substitute_values(
+            snapshot['inputs'], setup_values).split(',') if input_fp.strip()]
+
+def _parse_suite_timeout(timeout, label):
+    """Parses a test suite's 'timeout' option.
+
+    Returns 'auto' (the timeout is based on the test suite's history), None
+    (the test suite doesn't have its own timeout), or the timeout in minutes.
+    Raises a ValueError if the option is invalid.
+
+    Arguments:
+        timeout - the value of the option
+        label - the test suite's label (used in the error message)
+    """
+    if timeout == 'auto':
+        return timeout
+    elif timeout == 'none':
+        return None
+
+    try:
+        minutes = float(timeout)
+    except ValueError:
+        minutes = 0
+    if minutes <= 0:
+        raise ValueError("Invalid timeout '%s' for the test suite '%s'. The "
+                         "timeout must be 'auto', 'none', or a number of "
+                         "minutes greater than zero." % (timeout, label))
+    return minutes
+
+def _get_test_suite_timeouts(test_suites, suite_options, run_history,
+                             cluster_tag, test_suites_timeout, run_id=None):
+    """Returns the number of minutes that each test suite may run for.
+
+    Returns a list containing each test suite's timeout, or None if the test
+    suite doesn't have its own timeout (only the timeout for all of the test
+    suites applies). Test suites whose 'timeout' option is 'auto' get a
+    timeout based on how long they took in previous runs (see
+    clout.history.get_adaptive_timeout()), if there is enough history.
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        suite_options - same as for _get_suite_option()
+        run_history - the clout.history.RunHistory of past runs, or None if
+            there is no history
+        cluster_tag - same as for run_test_suites() (only runs with the same
+            cluster tag are considered)
+        test_suites_timeout - same as for run_test_suites(). No test suite's
+            timeout is longer than this
+        run_id - the ID of the run (which is excluded from the history, in
+            case the run was resumed after it was added)
+    """
+    timeouts = []
+    for label, cmd in test_suites:
+        timeout = _parse_suite_timeout(_get_suite_option(suite_options, label,
+                                                         'timeout'), label)
+        if timeout == 'auto':
+            timeout = None
+            if run_history is not None:
+                timeout = get_adaptive_timeout(
+                        run_history.get_test_suite_history(label, cluster_tag,
+                                                           run_id),
+                        ceiling=test_suites_timeout)
+        timeouts.append(timeout)
+    return timeouts
+
+def _get_suite_option(suite_options, label, key):
+    """Returns a test suite's option, or the option's default value.
+
+    Arguments:
+        suite_options - the output of clout.parse.parse_suite_options(), or
+            None if no options were given (e.g. a run from an older version
+            of Clout is being resumed)
+        label - the test suite's label
+        key - the name of the option
+    """
+    if suite_options is None:
+        return default_suite_options[key]
+    return suite_options.get(label, {}).get(key, default_suite_options[key])
+
+def _get_test_suites_output_filters(test_suites, suite_options,
+                                    output_filters):
+    """Returns the output filters applied to each test suite's output.
+
+    Returns a list containing the output of
+    clout.filters.parse_output_filters() for each test suite, or None if no
+    test suite's output is filtered.
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        suite_options - same as for _get_suite_option()
+        output_filters - same as for run_test_suites(). Used for test suites
+            that don't have their own 'filters' option
+    """
+    test_suites_filters = []
+    for label, cmd in test_suites:
+        suite_filters = _get_suite_option(suite_options, label, 'filters')
+        if suite_filters is None:
+            suite_filters = output_filters
+        test_suites_filters.append(parse_output_filters(suite_filters))
+    if not [filters for filters in test_suites_filters
+            if filters is not None]:
+        return None
+    return test_suites_filters
+
+def _find_test_regressions(run_summary, run_history, run_id):
+    """Returns the part of the email listing test suites and tests that
+    regressed (took much longer than usual).
+
+    Arguments:
+        run_summary - the summary of the run, as returned by
+            _execute_commands_and_build_email()
+        run_history - the clout.history.RunHistory of past runs
+        run_id - the ID of the run (which is excluded from the history, in
+            case the run was resumed after it was added)
+    """
+    test_suite_regressions = []
+    test_suites_regressions = []
+    for test_suite in run_summary['test_suites']:
+        test_suite_history = run_history.get_test_suite_history(
+                test_suite['label'], run_summary['cluster_tag'], run_id)
+
+        usual_duration = find_test_suite_regression(test_suite['duration'],
+                                                    test_suite_history)
+        if usual_duration is not None:
+            test_suite_regressions.append([test_suite['label'],
+                                           test_suite['duration'],
+                                           usual_duration])
+
+        if test_suite.get('tests') is not None:
+            test_suites_regressions.append((test_suite['label'],
+                    find_test_regressions(test_suite['tests']['durations'],
+                                          test_suite_history)))
+    return (format_test_suite_regressions(test_suite_regressions) +
+            format_test_regressions(test_suites_regressions))
+
+def _get_profiled_test_suites(test_suites, suite_options):
+    """Returns the labels of the test suites that are profiled.
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        suite_options - same as for _get_suite_option()
+    """
+    return [label for label, cmd in test_suites
+            if _get_suite_option(suite_options, label, 'profile') != 'none']
+
+def _get_staged_dirs(test_suites, suite_options):
+    """Returns the distinct local directories that the test suites stage.
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        suite_options - same as for _get_suite_option()
+    """
+    staged_dirs = []
+    for label, cmd in test_suites:
+        stage_dir = _get_suite_option(suite_options, label, 'stage')
+        if stage_dir is not None and stage_dir not in staged_dirs:
+            staged_dirs.append(stage_dir)
+    return staged_dirs
+
+def _get_artifact_test_suites(test_suites, suite_options):
+    """Returns the labels of the test suites that have artifacts.
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        suite_options - same as for _get_suite_option()
+    """
+    return [label for label, cmd in test_suites
+            if _get_suite_option(suite_options, label, 'artifacts')
+            is not None]
+
+def _get_artifact_dirs(run_summary, artifacts_dir):
+    """Returns the local directories of the artifacts that were collected.
+
+    Returns a list of 2-element tuples containing the label of each test
+    suite that has at least one artifact and the directory its artifacts
+    were extracted to.
+
+    Arguments:
+        run_summary - the run summary built by
+            _execute_commands_and_build_email()
+        artifacts_dir - the directory that artifacts were streamed back to,
+            or None if no test suites have artifacts
+    """
+    if artifacts_dir is None:
+        return []
+    return [(test_suite['label'],
+             _get_local_artifacts_dir(artifacts_dir, test_suite['label']))
+            for test_suite in run_summary['test_suites']
+            if test_suite.get('artifacts')]
+
+def _get_artifacts_archive_fp(artifacts_dir):
+    """Returns where the archive of artifacts is streamed back to."""
+    return join(artifacts_dir, 'artifacts.tar.gz')
+
+def _get_local_artifacts_dir(artifacts_dir, label):
+    """Returns where a test suite's artifacts are once they are extracted."""
+    return join(artifacts_dir, 'files', get_artifacts_dir_name(label))
+
+def _get_profile_dirs(run_summary, profiles_dir):
+    """Returns the local directories of the profiles that were collected.
+
+    Returns a list of 2-element tuples containing a test suite's label and
+    the directory its profile was copied back to.
+
+    Arguments:
+        run_summary - the summary of the run, as returned by
+            _execute_commands_and_build_email()
+        profiles_dir - the directory that profiles were copied back to, or
+            None if no test suites were profiled
+    """
+    return [(test_suite['label'],
+             _get_local_profile_dir(profiles_dir, test_suite['label']))
+            for test_suite in run_summary['test_suites']
+            if test_suite.get('profile') is not None]
+
+def _get_local_profile_dir(profiles_dir, label):
+    """Returns where a test suite's profile is once it is copied back."""
+    return join(profiles_dir, remote_profiles_dir, get_profile_dir_name(label))
+
+def _get_report_location(report_dir, report_run_id, report_url=None):
+    """Returns where a run's report can be viewed.
+
+    Arguments:
+        report_dir - the directory that the run's report was written to
+        report_run_id - the ID that the run's report was written under
+        report_url - the URL that the report root is published at, if any
+    """
+    if report_url is None:
+        return join(report_dir, 'index.html')
+    return '%s/%s/index.html' % (report_url.rstrip('/'), report_run_id)
+
+def _get_run_config_hash(run_params, backend):
+    """Returns a string that is identical for identically-configured runs.
+
+    Runs are configured identically if they run the same test suites with the
+    same options and timeouts, on the same backend, and send their results to
+    the same recipients.
+
+    Arguments:
+        run_params - a dictionary of the run's parameters, as built by
+            run_test_suites
+        backend - the backend that the run's commands are built with
+    """
+    config = [run_params['test_suites'], run_params.get('suite_options'),
+              run_params['setup_timeout'], run_params['test_suites_timeout'],
+              run_params['teardown_timeout'], backend.__class__.__name__,
+              sorted(vars(backend).items()), run_params['recipients']]
+    return sha1(dumps(config, sort_keys=True)).hexdigest()
 
 def _build_test_execution_commands(test_suites, sc_config_fp, cluster_tag,
                                    cluster_template=None, user='root',
@@ -107,38 +1155,326 @@ def _build_test_execution_commands(test_suites, sc_config_fp, cluster_tag,
         cluster_template - same as for run_test_suites()
         sc_exe_fp - same as for run_test_suites()
     """
-    setup_cmds, test_suite_cmds, teardown_cmds = [], [], []
+    backend = StarClusterBackend(sc_config_fp, cluster_template, user,
+                                 sc_exe_fp)
+    return _build_backend_commands(test_suites, backend, cluster_tag)
+
+def _build_backend_commands(test_suites, backend, cluster_tag,
+                            suite_options=None, cluster_plan=None):
+    """Builds up the commands needed to run the test suites on a backend.
 
-    sc_start_cmd = "%s -c %s start " % (sc_exe_fp, sc_config_fp)
-    if cluster_template is not None:
-        sc_start_cmd += "-c %s " % cluster_template
-    sc_start_cmd += "%s" % cluster_tag
-    setup_cmds.append(sc_start_cmd)
+    Returns the same 3-element tuple as _build_test_execution_commands(), but
+    the commands are built by the given backend (see clout.backend) instead of
+    always being starcluster commands.
 
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        suite_options - same as for _get_suite_option(). Test suites with a
+            'stage' option are run from their staged directory (see
+            clout.stage), test suites with a 'profile' option are wrapped
+            so that they are profiled (see clout.profiling), and test suites
+            whose 'steps' are their commands are wrapped so that they mark
+            each step (see clout.steps)
+        cluster_plan - the output of clout.autoscale.plan_cluster_size(), if
+            the cluster is autoscaled. The cluster is started with the
+            planned number of nodes (as spot instances, if the plan has a
+            'spot_bid') and, if there is more than one, each test suite's
+            command is a list of commands that run it on each node (see
+            clout.util.CommandExecutor)
+    """
+    num_nodes = None
+    spot_bid = None
+    if cluster_plan is not None:
+        num_nodes = cluster_plan['num_nodes']
+        spot_bid = cluster_plan.get('spot_bid')
+    setup_cmds = [backend.build_start_cmd(cluster_tag, num_nodes, spot_bid)]
+    test_suite_cmds = []
     for test_suite_name, test_suite_exec in test_suites:
-        # To have the next command work without getting prompted to accept the
-        # new host, the user must have 'StrictHostKeyChecking no' in their SSH
-        # config (on the local machine). TODO: try to get starcluster devs to
-        # add this feature to sshmaster.
-        test_suite_cmds.append("%s -c %s sshmaster -u %s %s '%s'" %
-                (sc_exe_fp, sc_config_fp, user, cluster_tag, test_suite_exec))
-
-    # The second -c tells starcluster not to prompt us for termination
-    # confirmation.
-    teardown_cmds.append("%s -c %s terminate -c %s" % (sc_exe_fp, sc_config_fp,
-                                                       cluster_tag))
+        cmd = build_stepped_cmd(test_suite_exec,
+                _get_suite_option(suite_options, test_suite_name, 'steps'))
+        cmd = build_profiled_cmd(build_staged_cmd(cmd,
+                _get_suite_option(suite_options, test_suite_name, 'stage')),
+                test_suite_name,
+                _get_suite_option(suite_options, test_suite_name, 'profile'))
+        if num_nodes is None or num_nodes == 1:
+            test_suite_cmds.append(backend.build_run_cmd(cluster_tag, cmd))
+        else:
+            test_suite_cmds.append([backend.build_run_cmd(cluster_tag, cmd,
+                                                          get_node_name(i))
+                                    for i in range(num_nodes)])
+    teardown_cmds = [backend.build_terminate_cmd(cluster_tag)]
     return setup_cmds, test_suite_cmds, teardown_cmds
 
+def _build_node_removal_commands(backend, cluster_tag, num_nodes):
+    """Builds up the commands that remove idle nodes from the cluster.
+
+    Returns a list containing the command that removes each node (None for
+    the master node, which is never removed).
+
+    Arguments:
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        num_nodes - the number of nodes the cluster was started with
+    """
+    return [None] + [backend.build_remove_node_cmd(cluster_tag,
+                                                   get_node_name(i))
+                     for i in range(1, num_nodes)]
+
+def _build_spot_node_commands(backend, cluster_tag, num_nodes, spot_bid,
+                              spot_fallback):
+    """Builds up the commands that check for and replace lost spot nodes.
+
+    Returns a 2-element tuple containing a list of the command that checks
+    whether each node is still reachable, and a list of the commands that
+    replace each node once it is lost, in the order to try them, as
+    2-element tuples of the kind of node each one adds ('spot' or
+    'on_demand') and the command. Both lists have None for the master node,
+    which isn't a spot instance.
+
+    Arguments:
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        num_nodes - the number of nodes the cluster was started with
+        spot_bid - same as for run_test_suites()
+        spot_fallback - same as for run_test_suites()
+    """
+    check_cmds = [None]
+    replacement_cmds = [None]
+    for node_index in range(1, num_nodes):
+        node = get_node_name(node_index)
+        check_cmds.append(backend.build_check_node_cmd(cluster_tag, node))
+        node_replacement_cmds = []
+        if spot_fallback != 'none':
+            node_replacement_cmds.append(('spot', backend.build_add_node_cmd(
+                    cluster_tag, node, spot_bid)))
+        if spot_fallback == 'on_demand':
+            node_replacement_cmds.append(('on_demand',
+                    backend.build_add_node_cmd(cluster_tag, node)))
+        replacement_cmds.append(node_replacement_cmds)
+    return check_cmds, replacement_cmds
+
+def _build_stage_commands(test_suites, backend, cluster_tag, suite_options,
+                          links_dir):
+    """Builds up the commands needed to stage local directories on the
+    cluster.
+
+    Returns a list containing the single command that syncs every staged
+    directory to the cluster in one transfer.
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        suite_options - same as for _get_suite_option()
+        links_dir - the local directory that links to the staged directories
+            are created in (see clout.stage.create_stage_links())
+    """
+    link_fps = create_stage_links(_get_staged_dirs(test_suites,
+                                                   suite_options), links_dir)
+    return [backend.build_sync_cmd(cluster_tag, link_fps, remote_stage_dir)]
+
+def _build_matrix_setup_commands(matrices, backend, cluster_tag,
+                                 suite_options):
+    """Builds up the commands that run matrix test suites' shared setup.
+
+    Returns a list of commands (one for each distinct setup command of each
+    matrix test suite), or None if no matrix test suite has a setup command.
+    Each setup command is run from the same directory as the variants that
+    share it.
+
+    Arguments:
+        matrices - the matrices returned by clout.matrix.expand_matrices()
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        suite_options - same as for _get_suite_option()
+    """
+    setup_cmds = []
+    for matrix in matrices:
+        for setup_cmd, setup_values in matrix['setup']:
+            setup_cmds.append(backend.build_run_cmd(cluster_tag,
+                    build_staged_cmd(setup_cmd, _get_matrix_setup_stage(
+                            matrix, setup_values, suite_options))))
+    return setup_cmds or None
+
+def _build_snapshot_commands(matrices, backend, cluster_tag, suite_options,
+                             snapshots_dir):
+    """Builds up the commands that restore and capture the snapshots of
+    matrix test suites' shared setup.
+
+    Returns a list with an element for each of the commands returned by
+    _build_matrix_setup_commands(): None if the setup isn't snapshotted, or
+    a dictionary containing the setup's 'label' (the label of its test suite
+    and the values it was built from), the 'key' and local filepath ('fp')
+    of its snapshot, the command that restores the snapshot on the cluster
+    ('restore_cmd'), and the command that captures the snapshot once the
+    setup succeeds ('capture_cmd'). Returns None if no setup is
+    snapshotted.
+
+    Arguments:
+        matrices - the matrices returned by clout.matrix.expand_matrices()
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        suite_options - same as for _get_suite_option()
+        snapshots_dir - the local directory that snapshots are stored in
+            (see clout.snapshot)
+    """
+    snapshot_cmds = []
+    for matrix in matrices:
+        snapshot = matrix.get('snapshot')
+        for setup_cmd, setup_values in matrix['setup']:
+            if snapshot is None:
+                snapshot_cmds.append(None)
+                continue
+            snapshot_dirs = parse_snapshot_dirs(substitute_values(
+                    snapshot['dirs'], setup_values))
+            stage_dir = _get_matrix_setup_stage(matrix, setup_values,
+                                                suite_options)
+            key = get_snapshot_key(build_staged_cmd(setup_cmd, stage_dir),
+                                   snapshot_dirs, backend.cluster_key(),
+                                   _get_snapshot_inputs(snapshot,
+                                                        setup_values))
+            snapshot_fp = get_snapshot_fp(snapshots_dir, key)
+
+            # Snapshots are captured to a temporary file first, so that a
+            # partial snapshot is never restored.
+            partial_fp = '%s.%d.tmp' % (snapshot_fp, getpid())
+            restore_cmd = '%s < %s' % (backend.build_run_cmd(cluster_tag,
+                    build_staged_cmd(build_restore_snapshot_cmd(
+                            snapshot_dirs), stage_dir)), quote(snapshot_fp))
+            capture_cmd = ('mkdir -p %s && { %s > %s && mv %s %s; } || '
+                           '{ rm -f %s; false; }' % (quote(snapshots_dir),
+                           backend.build_run_cmd(cluster_tag,
+                                   build_staged_cmd(build_capture_snapshot_cmd(
+                                           snapshot_dirs), stage_dir)),
+                           quote(partial_fp), quote(partial_fp),
+                           quote(snapshot_fp), quote(partial_fp)))
+            snapshot_cmds.append({'label': get_variant_label(matrix['label'],
+                                                             setup_values),
+                                  'key': key, 'fp': snapshot_fp,
+                                  'restore_cmd': restore_cmd,
+                                  'capture_cmd': capture_cmd})
+    if not [snapshot for snapshot in snapshot_cmds if snapshot is not None]:
+        return None
+    return snapshot_cmds
+
+def _get_matrix_setup_stage(matrix, setup_values, suite_options):
+    """Returns the local directory staged by the variants that share a
+    matrix test suite's setup command (or None if they don't stage one).
+
+    Arguments:
+        matrix - one of the matrices returned by
+            clout.matrix.expand_matrices()
+        setup_values - the values that the setup command was built from
+        suite_options - same as for _get_suite_option()
+    """
+    variant_label = [label for label, values in matrix['variants']
+                     if all([value in values for value in setup_values])][0]
+    return _get_suite_option(suite_options, variant_label, 'stage')
+
+def _evict_snapshots(snapshots_dir, snapshot_policy):
+    """Removes old snapshots from the snapshot store.
+
+    Arguments:
+        snapshots_dir - the local directory that snapshots are stored in
+        snapshot_policy - the 'snapshots' of a run's parameters (a
+            dictionary with the store's 'max_size' in megabytes and
+            'max_age' in days)
+    """
+    snapshot_policy = snapshot_policy or {}
+    max_size = snapshot_policy.get('max_size')
+    if max_size is not None:
+        max_size *= 1024 * 1024
+    evict_snapshots(snapshots_dir, max_size, snapshot_policy.get('max_age'))
+
+def _build_artifact_commands(test_suites, backend, cluster_tag,
+                             suite_options, artifacts_dir):
+    """Builds up the commands needed to collect the test suites' artifacts.
+
+    Returns a list of commands that stream every test suite's artifacts back
+    from the cluster in a single gzipped tar archive (see clout.artifacts).
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        suite_options - same as for _get_suite_option()
+        artifacts_dir - the local directory that the archive is written to
+    """
+    test_suites_artifacts = []
+    for label in _get_artifact_test_suites(test_suites, suite_options):
+        # Globs are relative to the directory that the test suite's commands
+        # start in.
+        stage_dir = _get_suite_option(suite_options, label, 'stage')
+        start_dir = '.' if stage_dir is None \
+                        else get_remote_stage_dir(stage_dir)
+        test_suites_artifacts.append((label, start_dir, parse_artifact_globs(
+                _get_suite_option(suite_options, label, 'artifacts'))))
+    return ['mkdir -p %s' % quote(artifacts_dir),
+            '%s > %s' % (backend.build_run_cmd(cluster_tag,
+                         build_collect_artifacts_cmd(test_suites_artifacts)),
+                         quote(_get_artifacts_archive_fp(artifacts_dir)))]
+
+def _build_profile_commands(test_suites, backend, cluster_tag, suite_options,
+                            profiles_dir):
+    """Builds up the commands needed to profile the test suites.
+
+    Returns a 2-element tuple containing the list of commands that prepare
+    the cluster for profiling (run before the test suites) and the list of
+    commands that copy every profile back from the cluster in one transfer
+    (run after the test suites).
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        backend - the backend to build the commands with
+        cluster_tag - same as for run_test_suites()
+        suite_options - same as for _get_suite_option()
+        profiles_dir - the local directory that profiles are copied back to.
+            If a test suite is profiled in 'python' mode, the Python profiler
+            hook is written here so that it can be copied to the cluster
+    """
+    # Profiles left behind by a previous run on the same cluster are removed
+    # first.
+    prepare_cmds = [backend.build_run_cmd(cluster_tag,
+                    'rm -rf %s && mkdir -p %s' % (remote_profiles_dir,
+                                                  remote_profiles_dir))]
+    profile_modes_used = [_get_suite_option(suite_options, label, 'profile')
+                          for label, cmd in test_suites]
+    if 'python' in profile_modes_used:
+        hook_dir = join(profiles_dir, 'python_hook')
+        write_python_profiler_hook(hook_dir)
+        prepare_cmds.append(backend.build_put_cmd(cluster_tag, hook_dir,
+                                                  remote_profiles_dir))
+    collect_cmds = ['mkdir -p %s' % quote(profiles_dir),
+                    backend.build_get_cmd(cluster_tag, remote_profiles_dir,
+                                          profiles_dir)]
+    return prepare_cmds, collect_cmds
+
 def _execute_commands_and_build_email(test_suites, setup_cmds,
                                       test_suites_cmds, teardown_cmds,
                                       setup_timeout, test_suites_timeout,
-                                      teardown_timeout, cluster_tag):
+                                      teardown_timeout, cluster_tag,
+                                      run_state=None, suite_options=None,
+                                      profile_cmds=None, profiles_dir=None,
+                                      test_suites_timeouts=None,
+                                      stage_cmds=None, artifact_cmds=None,
+                                      artifacts_dir=None, progress=None,
+                                      matrix_setup_cmds=None, matrices=None,
+                                      cluster_plan=None, snapshot_cmds=None,
+                                      node_removal_cmds=None, tracer=None,
+                                      node_check_cmds=None,
+                                      node_replacement_cmds=None,
+                                      test_suites_output_filters=None,
+                                      keep_unfiltered_logs=False):
     """Executes the test suite commands and builds the body of an email.
 
     Returns the body of an email containing the summarized results and any
     error message or issues that should be brought to the recipient's
-    attention, and a list of attachments, which are the log files from running
-    the commands.
+    attention, a list of attachments, which are the log files from running
+    the commands, and a summary of the run suitable for
+    clout.report.write_report() (the status and duration of each phase and
+    test suite).
 
     Arguments:
         test_suites - the output of _parse_config_file()
@@ -149,19 +1485,115 @@ def _execute_commands_and_build_email(test_suites, setup_cmds,
         test_suites_timeout - same as for run_test_suites()
         teardown_timeout - same as for run_test_suites()
         cluster_tag - same as for run_test_suites()
+        run_state - the clout.state.RunState of the run. If provided, logs are
+            kept in the run's directory instead of in temporary files, and
+            each phase and test suite is journaled as it finishes. Phases and
+            test suites that the journal shows have already finished (i.e. the
+            run is being resumed) are not executed again
+        suite_options - the output of clout.parse.parse_suite_options(). If
+            not provided, every test suite uses the default options
+        profile_cmds - the output of _build_profile_commands(), if any test
+            suites are profiled. The commands that prepare the cluster are run
+            with setup_timeout and the commands that copy the profiles back
+            are run with teardown_timeout
+        profiles_dir - the directory that profile_cmds copy the profiles back
+            to
+        test_suites_timeouts - the output of _get_test_suite_timeouts(). If
+            not provided, only test_suites_timeout applies
+        stage_cmds - the output of _build_stage_commands(), if any test
+            suites stage a local directory. The commands are run with
+            setup_timeout once the cluster has started
+        artifact_cmds - the output of _build_artifact_commands(), if any test
+            suites have artifacts. The commands are run with teardown_timeout
+            once the test suites have finished
+        artifacts_dir - the directory that artifact_cmds stream the artifacts
+            back to. The artifacts are extracted under it
+        progress - the clout.progress.ProgressReporter to report the run's
+            progress to, if any
+        matrix_setup_cmds - the output of _build_matrix_setup_commands(), if
+            any matrix test suites have shared setup commands. The commands
+            are run with setup_timeout before the test suites
+        matrices - the matrices returned by clout.matrix.expand_matrices(),
+            if any test suites were expanded from a matrix. Their variants
+            may run at the same time (see _execute_test_suites()), and their
+            results are summarized as a grid
+        cluster_plan - the output of clout.autoscale.plan_cluster_size(), if
+            the cluster is autoscaled. The plan, along with how long the test
+            suites actually took and what they cost, is added to the email
+            and the run summary
+        node_removal_cmds - the output of _build_node_removal_commands(), if
+            the cluster is autoscaled. Each node other than the master is
+            removed (with teardown_timeout) once it has no test suites left
+            to run
+        tracer - the clout.trace.Tracer to record each command that is
+            executed in, if any
+        node_check_cmds - the first element of the output of
+            _build_spot_node_commands(), if the cluster's nodes are spot
+            instances. A test suite that fails on a node that is no longer
+            reachable is run again, and its interrupted attempts are added
+            to the email and the run summary (separately from its result)
+        node_replacement_cmds - the second element of the output of
+            _build_spot_node_commands(). Lost nodes are replaced (with
+            setup_timeout) once they are removed
+        snapshot_cmds - the output of _build_snapshot_commands(), if any
+            matrix test suites' setups are snapshotted. Whether each
+            snapshot was restored is added to the email and the run summary
+        test_suites_output_filters - the output of
+            _get_test_suites_output_filters(). The individual test results
+            of a test suite whose output is filtered are parsed from its
+            unfiltered log
+        keep_unfiltered_logs - same as for run_test_suites()
     """
     email_body = ""
     attachments = []
 
-    # Create a unique temporary file to hold the results of all commands.
-    log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+    if run_state is None:
+        # Create a unique temporary file to hold the results of all commands.
+        log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+    else:
+        log_f = run_state.open_log('complete_log.txt')
+        if run_state.get_events('run_resumed'):
+            email_body += ("This run was interrupted and has been resumed. "
+                           "Test suites that had already finished were not "
+                           "run again.\n\n")
     attachments.append(('complete_log.txt', log_f))
 
     # Build up the body of the email as we execute the commands. First, execute
-    # the setup commands.
-    cmd_executor = CommandExecutor(setup_cmds, log_f,
-                                   stop_on_first_failure=True)
-    setup_cmds_succeeded = cmd_executor(setup_timeout)[0]
+    # the setup commands (unless the cluster was already started before the
+    # run was interrupted, in which case we reattach to it).
+    _report_progress(progress, 'phase_changed', phase='setup')
+    setup_event = _get_last_event(run_state, 'setup_finished')
+    if setup_event is None:
+        if _get_last_event(run_state, 'setup_started') is not None:
+            # The run was interrupted while starting the cluster, so terminate
+            # whatever was started and start over.
+            CommandExecutor(teardown_cmds, log_f,
+                            tracer=tracer)(teardown_timeout)
+        _record_event(run_state, 'setup_started')
+        start_time = time()
+        cmd_executor = CommandExecutor(setup_cmds, log_f,
+                                       stop_on_first_failure=True,
+                                       tracer=tracer)
+        setup_cmds_succeeded = cmd_executor(setup_timeout)[0]
+        setup_duration = time() - start_time
+        _record_event(run_state, 'setup_finished',
+                      succeeded=setup_cmds_succeeded, duration=setup_duration)
+    else:
+        setup_cmds_succeeded = setup_event['succeeded']
+        setup_duration = setup_event.get('duration')
+    run_summary = {'setup': {'succeeded': setup_cmds_succeeded,
+                             'duration': setup_duration},
+                   'test_suites': []}
+    if cluster_plan is not None:
+        run_summary['cluster_plan'] = dict(cluster_plan, actual_duration=None,
+                                           actual_cost=None,
+                                           removed_nodes=[], lost_nodes=[])
+
+    if not setup_cmds_succeeded:
+        # None of the test suites could be run.
+        run_summary['test_suites'] = [_build_test_suite_summary(label,
+                                                                'not_run')
+                                      for label, cmd in test_suites]
 
     if setup_cmds_succeeded is None:
         email_body += ("The maximum allowable cluster setup time of %s "
@@ -177,11 +1609,97 @@ def _execute_commands_and_build_email(test_suites, setup_cmds,
         # names, we'll also specify what we want the file to be called when it
         # is attached to the email (we don't have to worry about having unique
         # filenames at that point).
-        cmd_executor.cmds = test_suites_cmds
-        cmd_executor.stop_on_first_failure = False
-        cmd_executor.log_individual_cmds = True
-        test_suites_cmds_succeeded, test_suites_cmds_status = \
-                cmd_executor(test_suites_timeout)
+        if stage_cmds is not None:
+            _report_progress(progress, 'phase_changed', phase='staging')
+            if not _execute_journaled_commands(stage_cmds, 'stage_synced',
+                                               setup_timeout, log_f,
+                                               run_state, tracer=tracer):
+                email_body += ("There were problems in staging local "
+                               "directories on the remote cluster, so the "
+                               "test suites that use them may fail. Please "
+                               "check the attached log for more details.\n\n")
+        if matrix_setup_cmds is not None:
+            _report_progress(progress, 'phase_changed', phase='matrix_setup')
+            matrix_setup_succeeded, snapshots = \
+                    _execute_matrix_setup_commands(matrix_setup_cmds,
+                            snapshot_cmds, setup_timeout, log_f, run_state,
+                            tracer)
+            if snapshots:
+                run_summary['snapshots'] = snapshots
+            if not matrix_setup_succeeded:
+                email_body += ("There were problems in running the shared "
+                               "setup commands of the matrix test suites, so "
+                               "the variants that depend on them may fail. "
+                               "Please check the attached log for more "
+                               "details.\n\n")
+        if profile_cmds is not None:
+            _execute_journaled_commands(profile_cmds[0], 'profiling_prepared',
+                                        setup_timeout, log_f, run_state,
+                                        tracer=tracer)
+        _report_progress(progress, 'phase_changed', phase='test_suites')
+        # An autoscaled cluster's cost is measured from when the test suites
+        # first started.
+        test_suites_started = _get_last_event(run_state,
+                                              'test_suites_started')
+        if test_suites_started is None:
+            test_suites_started_at = time()
+            if cluster_plan is not None:
+                _record_event(run_state, 'test_suites_started')
+        else:
+            test_suites_started_at = test_suites_started['time']
+        removed_nodes = {}
+        interrupted_attempts = {}
+        lost_nodes = []
+        unfiltered_logs = {}
+        test_suites_cmds_succeeded, test_suites_cmds_status, \
+                test_suites_durations, test_suites_timeouts_exceeded, \
+                test_suites_timeouts_occurred, test_suites_steps = \
+                _execute_test_suites(test_suites, test_suites_cmds,
+                                     test_suites_timeout, log_f, run_state,
+                                     test_suites_timeouts, progress, matrices,
+                                     node_removal_cmds, teardown_timeout,
+                                     removed_nodes, tracer, node_check_cmds,
+                                     node_replacement_cmds, setup_timeout,
+                                     interrupted_attempts, lost_nodes,
+                                     test_suites_output_filters,
+                                     keep_unfiltered_logs, unfiltered_logs)
+        if cluster_plan is not None:
+            # Each node cost from when the test suites started until it was
+            # removed (or the test suites finished, for nodes that weren't).
+            test_suites_event = _get_last_event(run_state,
+                                                'test_suites_finished')
+            test_suites_finished_at = time() if test_suites_event is None \
+                                             else test_suites_event['time']
+            run_summary['cluster_plan'].update(
+                    actual_duration=test_suites_finished_at -
+                                    test_suites_started_at,
+                    actual_cost=get_cluster_cost([removed_nodes.get(
+                            node_index, test_suites_finished_at) -
+                            test_suites_started_at for node_index in
+                            range(cluster_plan['num_nodes'])]),
+                    removed_nodes=[get_node_name(node_index) for node_index
+                                   in sorted(removed_nodes)],
+                    lost_nodes=lost_nodes)
+        if profile_cmds is not None or artifact_cmds is not None:
+            _report_progress(progress, 'phase_changed', phase='collecting')
+        if profile_cmds is not None:
+            _execute_journaled_commands(profile_cmds[1],
+                                        'profiles_collected',
+                                        teardown_timeout, log_f, run_state,
+                                        tracer=tracer)
+        collected_artifacts = {}
+        if artifact_cmds is not None:
+            run_summary['artifacts'] = _collect_artifacts(artifact_cmds,
+                    teardown_timeout, log_f, run_state,
+                    _get_artifacts_archive_fp(artifacts_dir), tracer)
+            collected_artifacts = extract_artifacts(
+                    _get_artifacts_archive_fp(artifacts_dir),
+                    join(artifacts_dir, 'files'))
+            if not run_summary['artifacts']['succeeded']:
+                email_body += ("There were problems in collecting the test "
+                               "suites' artifacts from the remote cluster. "
+                               "Please check the attached log for more "
+                               "details.\n\n")
 
         # It is okay if there are fewer test suites that got executed than
         # there were input test suites (which is possible if we encounter a
@@ -192,8 +1710,76 @@ def _execute_commands_and_build_email(test_suites, setup_cmds,
             label_to_ret_val.append((label, ret_val))
             attachments.append(('%s_results.txt' % label, test_suite_log_f))
 
-        # Build a summary of the test suites that passed and those that didn't.
+        for test_suite_index, (label, cmd) in enumerate(test_suites):
+            if test_suite_index >= len(test_suites_cmds_status):
+                run_summary['test_suites'].append(
+                        _build_test_suite_summary(label, 'not_run'))
+                continue
+
+            test_suite_log_f, ret_val = \
+                    test_suites_cmds_status[test_suite_index]
+            timeout_exceeded = test_suites_timeouts_exceeded[test_suite_index]
+            if timeout_exceeded or \
+               test_suites_timeouts_occurred[test_suite_index] or \
+               (test_suites_cmds_succeeded is None and
+                test_suite_index == len(test_suites_cmds_status) - 1):
+                status = 'timeout'
+            else:
+                status = 'pass' if ret_val == 0 else 'fail'
+            profile = None
+            if profiles_dir is not None and _get_suite_option(suite_options,
+                    label, 'profile') != 'none':
+                profile = summarize_profile(_get_local_profile_dir(
+                        profiles_dir, label))
+            artifacts = None
+            if _get_suite_option(suite_options, label,
+                                 'artifacts') is not None:
+                artifacts = collected_artifacts.get(
+                        get_artifacts_dir_name(label), [])
+            run_summary['test_suites'].append(_build_test_suite_summary(
+                    label, status, ret_val,
+                    test_suites_durations[test_suite_index],
+                    '%s_results.txt' % label,
+                    _summarize_test_suite_results(
+                            unfiltered_logs.get(label, test_suite_log_f),
+                            _get_suite_option(suite_options, label,
+                                              'results')), profile,
+                    _get_test_suite_timeout(test_suites_timeouts,
+                                            test_suite_index),
+                    timeout_exceeded, artifacts,
+                    test_suites_steps[test_suite_index],
+                    interrupted_attempts.get(label)))
+        for unfiltered_log_f in unfiltered_logs.values():
+            unfiltered_log_f.close()
+
+        # Build a summary of the test suites that passed and those that didn't,
+        # followed by a grid of the results of each matrix test suite.
         email_body += format_email_summary(label_to_ret_val)
+        statuses = dict([(test_suite['label'], test_suite['status'])
+                         for test_suite in run_summary['test_suites']])
+        for matrix in matrices or []:
+            email_body += format_matrix_summary(matrix, statuses)
+        email_body += format_snapshots_summary(run_summary.get('snapshots',
+                                                               []))
+        if cluster_plan is not None:
+            email_body += format_cluster_plan_summary(
+                    run_summary['cluster_plan'])
+        email_body += format_interrupted_attempts_summary(
+                [(test_suite['label'], test_suite['interrupted_attempts'])
+                 for test_suite in run_summary['test_suites']])
+
+        timed_out_suites = []
+        for test_suite in run_summary['test_suites']:
+            if test_suite['timeout_exceeded']:
+                timed_out_suite = test_suite['label']
+                if test_suite['timeout'] is not None:
+                    timed_out_suite += ' (%s minute(s))' % str(
+                            test_suite['timeout'])
+                timed_out_suites.append(timed_out_suite)
+        if timed_out_suites:
+            email_body += ("The following test suites took longer than their "
+                           "own timeouts and were stopped: %s\n\n" %
+                           ', '.join(timed_out_suites))
 
         if test_suites_cmds_succeeded is None:
             timeout_test_suite = \
@@ -208,16 +1794,49 @@ def _execute_commands_and_build_email(test_suites, setup_cmds,
                 email_body += (" The following test suites were not tested: "
                                "%s\n\n" % ', '.join(untested_suites))
 
+        # List the individual tests that failed and the slowest tests,
+        # summarize the profiles of any profiled test suites, list how long
+        # each test suite's steps took, and list the artifacts that were
+        # collected.
+        tests_summary = format_test_results_summary(
+                [(test_suite['label'], test_suite['tests'])
+                 for test_suite in run_summary['test_suites']])
+        tests_summary += format_profiles_summary(
+                [(test_suite['label'], test_suite['profile'])
+                 for test_suite in run_summary['test_suites']])
+        tests_summary += format_steps_summary(
+                [(test_suite['label'], test_suite['steps'])
+                 for test_suite in run_summary['test_suites']])
+        if 'artifacts' in run_summary:
+            tests_summary += format_artifacts_summary(
+                    [(test_suite['label'], test_suite['artifacts'])
+                     for test_suite in run_summary['test_suites']],
+                    run_summary['artifacts'])
+        if tests_summary and not email_body.endswith('\n\n'):
+            email_body += '\n\n'
+        email_body += tests_summary
+
     # Lastly, execute the teardown commands.
     cluster_termination_msg = ("IMPORTANT: You should check that the cluster "
                                "labelled with the tag '%s' was properly "
                                "terminated. If not, you should manually "
                                "terminate it.\n\n" % cluster_tag)
 
-    cmd_executor.cmds = teardown_cmds
-    cmd_executor.stop_on_first_failure = False
-    cmd_executor.log_individual_cmds = False
-    teardown_cmds_succeeded = cmd_executor(teardown_timeout)[0]
+    _report_progress(progress, 'phase_changed', phase='teardown')
+    teardown_event = _get_last_event(run_state, 'teardown_finished')
+    if teardown_event is None:
+        start_time = time()
+        cmd_executor = CommandExecutor(teardown_cmds, log_f, tracer=tracer)
+        teardown_cmds_succeeded = cmd_executor(teardown_timeout)[0]
+        teardown_duration = time() - start_time
+        _record_event(run_state, 'teardown_finished',
+                      succeeded=teardown_cmds_succeeded,
+                      duration=teardown_duration)
+    else:
+        teardown_cmds_succeeded = teardown_event['succeeded']
+        teardown_duration = teardown_event.get('duration')
+    run_summary['teardown'] = {'succeeded': teardown_cmds_succeeded,
+                               'duration': teardown_duration}
 
     if teardown_cmds_succeeded is None:
         email_body += ("The maximum allowable cluster termination time of "
@@ -230,8 +1849,617 @@ def _execute_commands_and_build_email(test_suites, setup_cmds,
 
     # Set our file position to the beginning for all attachments since we are
     # in read/write mode and we need to read from the beginning again. Closing
-    # the file will delete it.
+    # the file will delete it (unless it is kept in the run's directory).
     for attachment in attachments:
+        attachment[1].flush()
         attachment[1].seek(0, 0)
 
-    return email_body, attachments
+    return email_body, attachments, run_summary
+
+def _build_test_suite_summary(label, status, ret_val=None, duration=None,
+                              log_name=None, tests=None, profile=None,
+                              timeout=None, timeout_exceeded=False,
+                              artifacts=None, steps=None,
+                              interrupted_attempts=None):
+    """Returns the summary of a test suite's result, for a run summary."""
+    return {'label': label, 'status': status, 'ret_val': ret_val,
+            'duration': duration, 'log_name': log_name, 'tests': tests,
+            'profile': profile, 'timeout': timeout,
+            'timeout_exceeded': timeout_exceeded, 'artifacts': artifacts,
+            'steps': steps or [],
+            'interrupted_attempts': interrupted_attempts or []}
+
+def _get_test_suite_log_name(label, test_suite_index, log_type):
+    """Returns the name of one of a test suite's logs in its run's directory.
+
+    The name includes the test suite's index, since labels that only differ
+    in characters that aren't safe in filenames (e.g. 'a b' and 'a/b') would
+    otherwise share the same log file.
+
+    Arguments:
+        label - the test suite's label
+        test_suite_index - the test suite's index in the run's test suites
+        log_type - the type of log (e.g. 'results' or 'timeline')
+    """
+    return '%s_%d_%s.txt' % (label, test_suite_index, log_type)
+
+def _get_test_suite_timeout(test_suites_timeouts, test_suite_index):
+    """Returns a test suite's own timeout, or None if it doesn't have one.
+    """
+    if test_suites_timeouts is None:
+        return None
+    return test_suites_timeouts[test_suite_index]
+
+def _summarize_test_suite_results(log_f, results_format):
+    """Parses and summarizes the individual test results in a suite's log.
+
+    Returns the output of clout.results.summarize_test_results() (plus the
+    name of the parser that was used), or None if no test results were found.
+
+    Arguments:
+        log_f - the test suite's log file. It is left positioned at the
+            beginning
+        results_format - the test suite's 'results' option
+    """
+    log_f.flush()
+    log_f.seek(0, 0)
+    parser_name, results = parse_test_results(log_f, results_format)
+    log_f.seek(0, 0)
+
+    if parser_name is None:
+        return None
+    return dict(summarize_test_results(results), parser=parser_name)
+
+def _execute_test_suites(test_suites, test_suites_cmds, test_suites_timeout,
+                         log_f, run_state=None, test_suites_timeouts=None,
+                         progress=None, matrices=None, node_removal_cmds=None,
+                         node_removal_timeout=None, removed_nodes=None,
+                         tracer=None, node_check_cmds=None,
+                         node_replacement_cmds=None,
+                         node_replacement_timeout=None,
+                         interrupted_attempts=None, lost_nodes=None,
+                         output_filters=None, keep_unfiltered_logs=False,
+                         unfiltered_logs=None):
+    """Executes the test suite commands that haven't already finished.
+
+    Returns the same 2-element tuple as CommandExecutor.__call__() with
+    log_individual_cmds set to True, covering both the test suites that
+    finished before the run was interrupted (if it was) and the test suites
+    that were executed by this call, plus a third element: the list of the
+    number of seconds that each of those test suites took to run (None if
+    unknown), a fourth element: a list of whether each of those test suites
+    was stopped because it exceeded its own timeout, a fifth element: a list
+    of whether each of those test suites was still running when the timeout
+    for all of the test suites occurred, and a sixth element: a list of the
+    steps that each of those test suites' output marked (see
+    clout.steps.StepTimeline.get_steps()). If there is a run state, each
+    test suite's output is also written to a timeline with the time that
+    each line was received ('<label>_timeline.txt').
+
+    Arguments:
+        test_suites - the output of _parse_config_file()
+        test_suites_cmds - the output of _build_test_execution_commands()
+        test_suites_timeout - same as for run_test_suites()
+        log_f - the file to write the complete log to
+        run_state - same as for _execute_commands_and_build_email()
+        test_suites_timeouts - same as for _execute_commands_and_build_email()
+        progress - same as for _execute_commands_and_build_email()
+        matrices - same as for _execute_commands_and_build_email(). The
+            variants of a matrix test suite with more than one worker are run
+            at the same time, up to that number at once
+        node_removal_cmds - same as for _execute_commands_and_build_email().
+            If test_suites_cmds run each test suite on any of several nodes,
+            the test suites are run on every node at the same time (each
+            starting on the next node that is free), and each node other
+            than the master is removed with its command once there are no
+            test suites left for it. Nodes that were removed before the run
+            was interrupted aren't used again
+        node_removal_timeout - the number of minutes to allow each node to be
+            removed
+        removed_nodes - a dictionary that the index of each node that was
+            removed is added to, mapped to the time it was removed
+        tracer - same as for _execute_commands_and_build_email(). Each test
+            suite's span is named after its label, and the removal (or
+            replacement) of each node is recorded on its own track
+        node_check_cmds - same as for _execute_commands_and_build_email().
+            When a test suite fails on a node whose check fails (or times
+            out), the node was lost: the test suite is run again on the next
+            node that is free, and the lost node is removed and replaced
+            with node_replacement_cmds. A lost node that can't be replaced
+            counts as removed
+        node_replacement_cmds - same as for
+            _execute_commands_and_build_email()
+        node_replacement_timeout - the number of minutes to allow each of
+            the commands that replace a node to run
+        interrupted_attempts - a dictionary that each test suite's label is
+            added to, mapped to a list of its interrupted attempts (the
+            'node' that was lost and how many seconds the attempt ran for,
+            as its 'duration'), including attempts interrupted before the
+            run was
+        lost_nodes - a list that each node that was lost is added to, as a
+            dictionary of its name ('node') and the kind of node that
+            replaced it ('replacement': 'spot', 'on_demand', or None if it
+            wasn't replaced)
+        output_filters - the output of _get_test_suites_output_filters()
+        keep_unfiltered_logs - same as for run_test_suites()
+        unfiltered_logs - a dictionary that the label of each test suite
+            whose output is filtered is added to, mapped to its unfiltered
+            log file (a temporary file, unless it is kept in the run's
+            directory). Unfiltered logs that were kept before the run was
+            interrupted are reopened
+    """
+    # Attempts interrupted by lost nodes before the run was interrupted are
+    # still reported.
+    if interrupted_attempts is None:
+        interrupted_attempts = {}
+    if lost_nodes is None:
+        lost_nodes = []
+    if unfiltered_logs is None:
+        unfiltered_logs = {}
+    if run_state is not None:
+        for event in run_state.get_events('test_suite_interrupted'):
+            interrupted_attempts.setdefault(event['label'], []).append(
+                    {'node': event['node'], 'duration': event['duration']})
+        for event in run_state.get_events('node_lost'):
+            lost_nodes.append({'node': get_node_name(event['node']),
+                               'replacement': event['replacement']})
+
+    test_suites_event = _get_last_event(run_state, 'test_suites_finished')
+
+    # Test suites are started in order, so the ones that finished before the
+    # run was interrupted are the first ones (variants that were running at
+    # the same time may have finished out of order, so any that finished
+    # after a test suite that didn't are run again). A test suite that was
+    # killed because of a timeout only counts as finished if the run got as
+    # far as recording the timeout.
+    finished_status = []
+    durations = []
+    timeouts_exceeded = []
+    timeouts_occurred = []
+    steps = []
+    if run_state is not None:
+        finished_events = {}
+        for event in run_state.get_events('test_suite_finished'):
+            if event['timeout_occurred'] and test_suites_event is None:
+                continue
+            finished_events[event['label']] = event
+        for label, cmd in test_suites:
+            if label not in finished_events:
+                break
+            event = finished_events[label]
+            finished_status.append((run_state.open_log(event['log_name']),
+                                    event['ret_val']))
+            if event.get('unfiltered_log_name') is not None:
+                unfiltered_logs[label] = run_state.open_log(
+                        event['unfiltered_log_name'])
+            durations.append(event.get('duration'))
+            timeouts_exceeded.append(event.get('timeout_exceeded', False))
+            timeouts_occurred.append(event['timeout_occurred'])
+            steps.append(event.get('steps', []))
+
+    if test_suites_event is not None:
+        return (test_suites_event['succeeded'], finished_status, durations,
+                timeouts_exceeded, timeouts_occurred, steps)
+
+    remaining_test_suites = test_suites[len(finished_status):]
+    remaining_cmds = test_suites_cmds[len(finished_status):]
+    remaining_timeouts = None
+    if test_suites_timeouts is not None:
+        remaining_timeouts = test_suites_timeouts[len(finished_status):]
+    remaining_filters = None
+    if output_filters is not None:
+        remaining_filters = output_filters[len(finished_status):]
+    cmd_batches = _get_test_suite_batches(remaining_test_suites, matrices)
+
+    # Each worker runs test suites on its own node.
+    if removed_nodes is None:
+        removed_nodes = {}
+    if run_state is not None:
+        for event in run_state.get_events('node_removed'):
+            removed_nodes[event['node']] = event['time']
+    nodes = None
+    if remaining_cmds and isinstance(remaining_cmds[0], list):
+        nodes = [node_index for node_index in range(len(remaining_cmds[0]))
+                 if node_index not in removed_nodes]
+        remaining_cmds = [[cmd[node_index] for node_index in nodes]
+                          for cmd in remaining_cmds]
+        cmd_batches = [[len(remaining_cmds), len(nodes)]]
+
+    spot_nodes = nodes is not None and node_check_cmds is not None
+
+    def log_f_factory(cmd_index):
+        if run_state is None:
+            return TemporaryFile(prefix='clout_log', suffix='.txt')
+        return run_state.open_log(_get_test_suite_log_name(
+                remaining_test_suites[cmd_index][0],
+                len(finished_status) + cmd_index, 'results'))
+
+    # A test suite's individual test results are parsed from its unfiltered
+    # log, which is only kept in the run's directory if it was asked for.
+    def unfiltered_log_f_factory(cmd_index):
+        label = remaining_test_suites[cmd_index][0]
+        if run_state is None or not keep_unfiltered_logs:
+            unfiltered_log_f = TemporaryFile(prefix='clout_log',
+                                             suffix='.txt')
+        else:
+            unfiltered_log_f = run_state.open_log(_get_test_suite_log_name(
+                    label, len(finished_status) + cmd_index,
+                    'results_unfiltered'))
+        unfiltered_logs[label] = unfiltered_log_f
+        return unfiltered_log_f
+
+    # Each line of a test suite's output is timestamped as it is received,
+    # which times the steps that the output marks.
+    timelines = {}
+    def report_test_suite_started(cmd_index):
+        label = remaining_test_suites[cmd_index][0]
+        if cmd_index in timelines and \
+           timelines[cmd_index].timeline_f is not None:
+            # The test suite is being run again after its node was lost.
+            timelines[cmd_index].timeline_f.close()
+        timeline_f = None
+        if run_state is not None:
+            timeline_f = run_state.open_log(_get_test_suite_log_name(
+                    label, len(finished_status) + cmd_index, 'timeline'))
+        timelines[cmd_index] = StepTimeline(time(), timeline_f)
+        _report_progress(progress, 'suite_started', label=label)
+
+    def report_output(cmd_index, stream_name, line):
+        timelines[cmd_index].line_received(stream_name, line, time())
+        if progress is not None:
+            progress.output_received(remaining_test_suites[cmd_index][0],
+                                     line)
+
+    # Nodes are removed from separate threads (see worker_idle_callback), so
+    # their logs are kept separate until the test suites have finished.
+    journal_lock = Lock()
+    node_removal_logs = []
+    def remove_idle_node(worker_index):
+        node_index = nodes[worker_index]
+        if node_removal_cmds is None or node_removal_cmds[node_index] is None:
+            return
+        node_removal_log_f = TemporaryFile(prefix='clout_log', suffix='.txt')
+        node_removal_logs.append(node_removal_log_f)
+        node_removal_executor = CommandExecutor(
+                [node_removal_cmds[node_index]], node_removal_log_f)
+        with _trace_span(tracer, 'remove %s' % get_node_name(node_index),
+                         track='node removal', category='command'):
+            succeeded = node_removal_executor(node_removal_timeout)[0]
+        with journal_lock:
+            removed_nodes[node_index] = time()
+            _record_event(run_state, 'node_removed', node=node_index,
+                          succeeded=succeeded)
+        return True
+
+    # A test suite that fails on a spot node may have failed because the node
+    # was lost, in which case its attempt is interrupted rather than failed.
+    # The check runs in the event loop (so the output of the commands on the
+    # other nodes waits while it runs), but only when a test suite fails.
+    def check_lost_node(cmd_index, worker_index, ret_val, duration):
+        node_index = nodes[worker_index]
+        if node_check_cmds[node_index] is None:
+            return False
+        node_check_executor = CommandExecutor([node_check_cmds[node_index]],
+                                              log_f)
+        if node_check_executor(node_check_timeout)[0]:
+            return False
+
+        label = remaining_test_suites[cmd_index][0]
+        node = get_node_name(node_index)
+        interrupted_attempts.setdefault(label, []).append(
+                {'node': node, 'duration': duration})
+        _report_progress(progress, 'suite_interrupted', label=label,
+                         node=node, duration=duration)
+        with journal_lock:
+            _record_event(run_state, 'test_suite_interrupted', label=label,
+                          node=node, ret_val=ret_val, duration=duration)
+        return True
+
+    # Lost nodes are removed (so that they no longer cost anything) and
+    # replaced from a separate thread, trying each kind of node in turn.
+    def replace_lost_node(worker_index):
+        node_index = nodes[worker_index]
+        node = get_node_name(node_index)
+        node_replacement_log_f = TemporaryFile(prefix='clout_log',
+                                               suffix='.txt')
+        node_removal_logs.append(node_replacement_log_f)
+        replacement = None
+        with _trace_span(tracer, 'replace %s' % node,
+                         track='node replacement', category='command'):
+            removal_succeeded = CommandExecutor(
+                    [node_removal_cmds[node_index]],
+                    node_replacement_log_f)(node_removal_timeout)[0]
+            for kind, cmd in node_replacement_cmds[node_index]:
+                if CommandExecutor([cmd], node_replacement_log_f)(
+                        node_replacement_timeout)[0]:
+                    replacement = kind
+                    break
+        with journal_lock:
+            if replacement is None:
+                removed_nodes[node_index] = time()
+                _record_event(run_state, 'node_removed', node=node_index,
+                              succeeded=removal_succeeded)
+            lost_nodes.append({'node': node, 'replacement': replacement})
+            _record_event(run_state, 'node_lost', node=node_index,
+                          replacement=replacement)
+        return replacement is not None
+
+    # Test suites that run at the same time may finish in any order.
+    finished = {}
+    def journal_test_suite(cmd_index, test_suite_log_f, ret_val,
+                           timeout_occurred, duration):
+        timeout_exceeded = cmd_index in cmd_executor.timed_out_cmds
+        timeline = timelines.pop(cmd_index)
+        if timeline.timeline_f is not None:
+            timeline.timeline_f.close()
+        test_suite_steps = timeline.get_steps(timeline.start_time + duration)
+        finished[cmd_index] = (duration, timeout_exceeded, timeout_occurred,
+                               test_suite_steps)
+        if timeout_occurred or timeout_exceeded:
+            status = 'timeout'
+        else:
+            status = 'pass' if ret_val == 0 else 'fail'
+        _report_progress(progress, 'suite_finished',
+                         label=remaining_test_suites[cmd_index][0],
+                         status=status, ret_val=ret_val, duration=duration)
+        if run_state is not None:
+            # Make sure the logs are on disk before the journal says the test
+            # suite finished.
+            label = remaining_test_suites[cmd_index][0]
+            test_suite_log_f.flush()
+            fsync(test_suite_log_f.fileno())
+            unfiltered_log_name = None
+            if keep_unfiltered_logs and label in unfiltered_logs:
+                unfiltered_logs[label].flush()
+                fsync(unfiltered_logs[label].fileno())
+                unfiltered_log_name = basename(unfiltered_logs[label].name)
+            with journal_lock:
+                run_state.record('test_suite_finished', label=label,
+                                 log_name=basename(test_suite_log_f.name),
+                                 unfiltered_log_name=unfiltered_log_name,
+                                 ret_val=ret_val,
+                                 timeout_occurred=timeout_occurred,
+                                 timeout_exceeded=timeout_exceeded,
+                                 duration=duration, steps=test_suite_steps)
+
+    cmd_executor = CommandExecutor(remaining_cmds, log_f,
+                                   log_individual_cmds=True,
+                                   log_f_factory=log_f_factory,
+                                   cmd_finished_callback=journal_test_suite,
+                                   cmd_timeouts=remaining_timeouts,
+                                   cmd_started_callback=
+                                           report_test_suite_started,
+                                   output_callback=report_output,
+                                   cmd_batches=cmd_batches,
+                                   worker_idle_callback=None if nodes is None
+                                                        else remove_idle_node,
+                                   tracer=tracer,
+                                   trace_names=[label for label, cmd in
+                                                remaining_test_suites],
+                                   worker_lost_callback=check_lost_node
+                                           if spot_nodes else None,
+                                   replace_worker_callback=replace_lost_node
+                                           if spot_nodes else None,
+                                   output_filters=remaining_filters,
+                                   unfiltered_log_f_factory=
+                                           unfiltered_log_f_factory)
+    test_suites_cmds_succeeded, test_suites_cmds_status = \
+            cmd_executor(test_suites_timeout)
+    for node_removal_log_f in node_removal_logs:
+        node_removal_log_f.seek(0, 0)
+        log_f.write(node_removal_log_f.read())
+        node_removal_log_f.close()
+    for cmd_index in sorted(finished):
+        duration, timeout_exceeded, timeout_occurred, test_suite_steps = \
+                finished[cmd_index]
+        durations.append(duration)
+        timeouts_exceeded.append(timeout_exceeded)
+        timeouts_occurred.append(timeout_occurred)
+        steps.append(test_suite_steps)
+
+    # Test suites that finished before the run was interrupted still count
+    # towards whether all of the test suites passed.
+    if test_suites_cmds_succeeded and \
+       [ret_val for log_f, ret_val in finished_status if ret_val != 0]:
+        test_suites_cmds_succeeded = False
+    _record_event(run_state, 'test_suites_finished',
+                  succeeded=test_suites_cmds_succeeded)
+    return (test_suites_cmds_succeeded,
+            finished_status + test_suites_cmds_status, durations,
+            timeouts_exceeded, timeouts_occurred, steps)
+
+def _get_test_suite_batches(test_suites, matrices):
+    """Returns the batches that test suites are run in (see the cmd_batches
+    argument of clout.util.CommandExecutor).
+
+    Consecutive variants of a matrix test suite with more than one worker
+    form a batch. Every other test suite runs on its own.
+
+    Arguments:
+        test_suites - the test suites to run, in the same format as for
+            _execute_test_suites()
+        matrices - same as for _execute_test_suites()
+    """
+    matrix_workers = {}
+    for matrix_index, matrix in enumerate(matrices or []):
+        if matrix['workers'] > 1:
+            for label, values in matrix['variants']:
+                matrix_workers[label] = (matrix_index, matrix['workers'])
+
+    batches = []
+    prev_matrix = None
+    for label, cmd in test_suites:
+        matrix = matrix_workers.get(label)
+        if matrix is not None and matrix == prev_matrix:
+            batches[-1][0] += 1
+        else:
+            batches.append([1, 1 if matrix is None else matrix[1]])
+        prev_matrix = matrix
+    return batches
+
+def _execute_matrix_setup_commands(matrix_setup_cmds, snapshot_cmds,
+                                   timeout, log_f, run_state=None,
+                                   tracer=None):
+    """Executes matrix test suites' shared setup commands, restoring their
+    snapshots instead when they can be.
+
+    Returns a 2-element tuple containing the same value as
+    _execute_journaled_commands() and a list of dictionaries describing each
+    snapshotted setup: its 'label', the 'key' of its snapshot, its 'status'
+    ('hit' if its snapshot was restored, or 'miss' if the setup command was
+    run), and whether a new snapshot was 'captured'. A setup whose snapshot
+    can't be restored (e.g. because it was evicted by another run) is run
+    instead. Every setup command is run even if one of them fails, and the
+    setups are journaled as a single 'matrix_setup_finished' event.
+
+    Arguments:
+        matrix_setup_cmds - the output of _build_matrix_setup_commands()
+        snapshot_cmds - the output of _build_snapshot_commands(). If None,
+            the setup commands are run as-is
+        timeout - the number of minutes to allow all of the setups to run
+            (including restoring and capturing snapshots)
+        log_f - the file to write the complete log to
+        run_state - same as for _execute_commands_and_build_email()
+        tracer - same as for _execute_commands_and_build_email()
+    """
+    if snapshot_cmds is None:
+        return _execute_journaled_commands(matrix_setup_cmds,
+                'matrix_setup_finished', timeout, log_f, run_state,
+                stop_on_first_failure=False, tracer=tracer), []
+    event_entry = _get_last_event(run_state, 'matrix_setup_finished')
+    if event_entry is not None:
+        return event_entry['succeeded'], event_entry.get('snapshots', [])
+
+    deadline = time() + timeout * 60
+    def execute(cmd):
+        remaining = (deadline - time()) / 60
+        if remaining <= 0:
+            return None
+        return CommandExecutor([cmd], log_f, tracer=tracer)(remaining)[0]
+
+    succeeded = True
+    snapshots = []
+    for setup_cmd, snapshot in zip(matrix_setup_cmds, snapshot_cmds):
+        status = 'miss'
+        captured = False
+        if snapshot is not None and exists(snapshot['fp']):
+            restored = execute(snapshot['restore_cmd'])
+            if restored is None:
+                succeeded = None
+                break
+            if restored:
+                status = 'hit'
+                mark_snapshot_used(snapshot['fp'])
+        if status == 'miss':
+            setup_succeeded = execute(setup_cmd)
+            if setup_succeeded is None:
+                succeeded = None
+                break
+            elif not setup_succeeded:
+                succeeded = False
+            elif snapshot is not None:
+                captured = bool(execute(snapshot['capture_cmd']))
+        if snapshot is not None:
+            snapshots.append({'label': snapshot['label'],
+                              'key': snapshot['key'], 'status': status,
+                              'captured': captured})
+    _record_event(run_state, 'matrix_setup_finished', succeeded=succeeded,
+                  snapshots=snapshots)
+    return succeeded, snapshots
+
+def _execute_journaled_commands(cmds, event, timeout, log_f,
+                                run_state=None, stop_on_first_failure=True,
+                                tracer=None):
+    """Executes commands that stage directories, run matrix test suites'
+    shared setup, or prepare for or collect profiles.
+
+    Returns True if the commands succeeded, False if one of them failed, or
+    None if they timed out. The commands are journaled as the given event so
+    that they aren't run again if the run is resumed (in which case the
+    journaled result is returned). Their output is only written to the
+    complete log.
+
+    Arguments:
+        cmds - the list of commands to execute
+        event - the name of the event to journal once the commands finish
+        timeout - the number of minutes to allow the commands to run
+        log_f - the file to write the complete log to
+        run_state - same as for _execute_commands_and_build_email()
+        stop_on_first_failure - if True, the remaining commands aren't run
+            once one of them fails
+        tracer - same as for _execute_commands_and_build_email()
+    """
+    event_entry = _get_last_event(run_state, event)
+    if event_entry is not None:
+        return event_entry['succeeded']
+    succeeded = CommandExecutor(cmds, log_f,
+            stop_on_first_failure=stop_on_first_failure,
+            tracer=tracer)(timeout)[0]
+    _record_event(run_state, event, succeeded=succeeded)
+    return succeeded
+
+def _collect_artifacts(cmds, timeout, log_f, run_state, archive_fp,
+                       tracer=None):
+    """Streams the test suites' artifacts back from the cluster.
+
+    Returns a dictionary describing the transfer: whether it 'succeeded'
+    (None if it timed out), its 'duration' (in seconds), and the 'size' of
+    the archive that was transferred (in bytes, or None if it wasn't
+    written). The transfer is journaled so that it isn't repeated if the run
+    is resumed.
+
+    Arguments:
+        cmds - the output of _build_artifact_commands()
+        timeout - the number of minutes to allow the transfer to take
+        log_f - the file to write the complete log to
+        run_state - same as for _execute_commands_and_build_email()
+        archive_fp - the filepath that the archive is written to
+        tracer - same as for _execute_commands_and_build_email()
+    """
+    event = _get_last_event(run_state, 'artifacts_collected')
+    if event is None:
+        start_time = time()
+        succeeded = CommandExecutor(cmds, log_f, stop_on_first_failure=True,
+                                    tracer=tracer)(timeout)[0]
+        event = {'succeeded': succeeded, 'duration': time() - start_time,
+                 'size': getsize(archive_fp) if exists(archive_fp) else None}
+        _record_event(run_state, 'artifacts_collected', **event)
+    return {'succeeded': event['succeeded'], 'duration': event['duration'],
+            'size': event['size']}
+
+def _get_last_event(run_state, event):
+    """Returns the run's most recent journal entry of a type, or None.
+
+    Always returns None if there is no run state.
+    """
+    if run_state is None:
+        return None
+    return run_state.get_last_event(event)
+
+def _report_progress(progress, event, **fields):
+    """Reports a progress event if there is a progress reporter."""
+    if progress is not None:
+        progress.report(event, **fields)
+
+def _trace_span(tracer, name, **attributes):
+    """Returns a context manager that records a span if there is a tracer.
+
+    Arguments:
+        tracer - the clout.trace.Tracer to record the span in, or None
+        name - same as for clout.trace.Tracer.span()
+        attributes - the span's track, category, and attributes (same as for
+            clout.trace.Tracer.span())
+    """
+    if tracer is None:
+        return _untraced()
+    return tracer.span(name, **attributes)
+
+@contextmanager
+def _untraced():
+    """A context manager that records nothing (see _trace_span())."""
+    yield
+
+def _record_event(run_state, event, **fields):
+    """Journals an event if there is a run state to journal it to."""
+    if run_state is not None:
+        run_state.record(event, **fields)
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to run Clout as a long-running daemon with a persistent run queue.
+
+Runs can be queued from a schedule, from the command line (clout submit), or by
+POSTing to a small HTTP API that only listens on localhost. The daemon
+deduplicates identical queued runs, limits how many runs execute at once, and
+keeps a cluster warm between back-to-back runs that would boot an identical
+cluster.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+from hashlib import sha1
+from json import dumps, loads
+from os.path import exists, join
+from tempfile import TemporaryFile
+from threading import Lock, Thread
+from time import sleep, time
+from urllib2 import Request, urlopen
+from uuid import uuid4
+
+from clout.backend import StarClusterBackend
+from clout.run import run_test_suites
+from clout.util import CommandExecutor, create_dir, write_file_atomically
+
+# Keys that must be present in every run request, and the default values of the
+# keys that are optional. These correspond to run_test_suites' arguments.
+required_run_request_keys = ['config_fp', 'sc_config_fp', 'recipients_fp',
+                             'email_settings_fp', 'cluster_tag']
+optional_run_request_keys = {'cluster_template': None, 'user': 'root',
+                             'setup_timeout': 20.0,
+                             'test_suites_timeout': 240.0,
+                             'teardown_timeout': 20.0,
+                             'sc_exe_fp': 'starcluster', 'report_dir': None,
+                             'report_url': None}
+timeout_run_request_keys = ['setup_timeout', 'test_suites_timeout',
+                            'teardown_timeout']
+
+def build_run_request(options):
+    """Validates run options and returns a complete run request.
+
+    Returns a dictionary containing every required and optional run request
+    key, with defaults filled in for any optional keys that were not provided.
+
+    Arguments:
+        options - a dictionary of run options (e.g. from a parsed schedule
+            file or a JSON request body)
+    """
+    request = {}
+    for key in required_run_request_keys:
+        if options.get(key) in (None, ''):
+            raise ValueError("The run request is missing the required key "
+                             "'%s'." % key)
+        request[key] = options[key]
+
+    for key, default in optional_run_request_keys.items():
+        request[key] = options.get(key, default)
+
+    unrecognized_keys = set(options) - set(request)
+    if unrecognized_keys:
+        raise ValueError("Unrecognized key(s) in run request: %s" %
+                         ', '.join(sorted(unrecognized_keys)))
+
+    for key in timeout_run_request_keys:
+        try:
+            request[key] = float(request[key])
+        except (TypeError, ValueError):
+            raise ValueError("The run request key '%s' must be a number." %
+                             key)
+        if request[key] <= 0:
+            raise ValueError("The timeout (in minutes) must be greater than "
+                             "zero.")
+    return request
+
+def get_run_request_key(request):
+    """Returns a string that is identical for identical run requests."""
+    return sha1(dumps(request, sort_keys=True)).hexdigest()
+
+def build_backend(request):
+    """Returns the backend that a run request's cluster is managed with."""
+    return StarClusterBackend(request['sc_config_fp'],
+                              request['cluster_template'], request['user'],
+                              request['sc_exe_fp'])
+
+def run_request(request, start_cluster=True, terminate_cluster=True,
+                state_dir=None):
+    """Executes a run request by calling run_test_suites.
+
+    Returns True if the run's cluster was set up successfully, False if it
+    wasn't, or None if the run attached to an identical run instead of
+    managing a cluster itself (see clout.lock.RunLock).
+
+    This is the default runner used by RunServer. It is not unit-tested for
+    the same reasons as run_test_suites.
+    """
+    run_summaries = []
+    run_test_suites(open(request['config_fp'], 'U'), request['sc_config_fp'],
+                    open(request['recipients_fp'], 'U'),
+                    open(request['email_settings_fp'], 'U'),
+                    request['cluster_tag'], request['cluster_template'],
+                    request['user'], request['setup_timeout'],
+                    request['test_suites_timeout'],
+                    request['teardown_timeout'], request['sc_exe_fp'],
+                    start_cluster=start_cluster,
+                    terminate_cluster=terminate_cluster, state_dir=state_dir,
+                    report_dir=request['report_dir'],
+                    report_url=request['report_url'],
+                    summary_callback=run_summaries.append)
+    if not run_summaries:
+        return None
+    return bool(run_summaries[0]['setup']['succeeded'])
+
+def terminate_request_cluster(request):
+    """Terminates the cluster that a run request was executed on.
+
+    This is the default terminator used by RunServer to shut down warm
+    clusters that are no longer needed. Returns the same value as the first
+    element returned by CommandExecutor.__call__().
+    """
+    backend = build_backend(request)
+    cmd_executor = CommandExecutor(
+            [backend.build_terminate_cmd(request['cluster_tag'])],
+            TemporaryFile(prefix='clout_log', suffix='.txt'))
+    return cmd_executor(request['teardown_timeout'])[0]
+
+def submit_run(request, port, host='127.0.0.1'):
+    """Submits a run request to a running daemon's HTTP API.
+
+    Returns the daemon's response, a dictionary containing the run ID and
+    whether the run was queued (it won't be if an identical run is already
+    queued).
+    """
+    http_request = Request('http://%s:%d/runs' % (host, port), dumps(request),
+                           {'Content-Type': 'application/json'})
+    return loads(urlopen(http_request).read())
+
+
+class RunQueue(object):
+    """A queue of run requests that persists across daemon restarts.
+
+    The queue is stored as a JSON file that is rewritten (atomically) every
+    time the queue changes. An entry stays in the queue (marked as running)
+    while its run executes, so if the daemon stops before the run finishes,
+    the run is queued again when the daemon restarts.
+    """
+
+    def __init__(self, queue_fp):
+        """Initializes a queue, loading any entries that are stored in queue_fp.
+
+        Arguments:
+            queue_fp - the filepath that the queue is stored in
+        """
+        self.queue_fp = queue_fp
+        self._lock = Lock()
+
+        if exists(queue_fp):
+            queue_f = open(queue_fp, 'U')
+            try:
+                self._entries = loads(queue_f.read())
+            finally:
+                queue_f.close()
+        else:
+            self._entries = []
+
+        # Runs that were executing when the daemon stopped never finished.
+        for entry in self._entries:
+            entry['running'] = False
+
+    def put(self, request, source):
+        """Adds a run request to the end of the queue.
+
+        Returns a 2-element tuple containing the run ID and True if the
+        request was added. If an identical request is already queued (and
+        isn't running yet), the request is not added and the queued request's
+        run ID and False are returned instead.
+
+        Arguments:
+            request - the run request (the output of build_run_request())
+            source - a string describing where the request came from (e.g.
+                'schedule', 'cli', or 'http')
+        """
+        key = get_run_request_key(request)
+        with self._lock:
+            for entry in self._entries:
+                if entry['key'] == key and not entry['running']:
+                    return entry['run_id'], False
+
+            run_id = uuid4().hex
+            self._entries.append({'run_id': run_id, 'key': key,
+                                  'request': request, 'source': source,
+                                  'queued_at': time(), 'running': False})
+            self._save()
+        return run_id, True
+
+    def pending(self):
+        """Returns a list of the queued entries that aren't running, oldest
+        first.
+        """
+        with self._lock:
+            return [entry for entry in self._entries if not entry['running']]
+
+    def mark_running(self, run_id):
+        """Marks the entry with the given run ID as running."""
+        with self._lock:
+            for entry in self._entries:
+                if entry['run_id'] == run_id:
+                    entry['running'] = True
+            self._save()
+
+    def remove(self, run_id):
+        """Removes the entry with the given run ID from the queue (e.g. once
+        its run finished).
+        """
+        with self._lock:
+            self._entries = [entry for entry in self._entries
+                             if entry['run_id'] != run_id]
+            self._save()
+
+    def _save(self):
+        """Writes the queue to disk. The caller must hold self._lock."""
+        write_file_atomically(self.queue_fp, dumps(self._entries))
+
+
+class RunServer(object):
+    """Daemon that executes queued run requests.
+
+    Runs are executed in worker threads. At most max_concurrent_runs runs
+    execute at once, and runs using the same cluster tag never execute at the
+    same time. When a run finishes and the next queued run with the same
+    cluster tag would boot an identical cluster, the cluster is left running
+    and reused instead of being terminated and booted again.
+    """
+
+    def __init__(self, state_dir, runner=run_request, max_concurrent_runs=1,
+                 schedule=None, cluster_idle_timeout=30.0,
+                 terminator=terminate_request_cluster, max_finished_runs=100):
+        """Initializes a new daemon.
+
+        Arguments:
+            state_dir - the directory to store the run queue in. Runs are
+                passed this directory as their state_dir
+            runner - the function to execute run requests with. Must accept
+                the run request and the start_cluster, terminate_cluster, and
+                state_dir arguments of run_test_suites, and return the same
+                values as run_request(). A cluster is only kept warm if its
+                setup succeeded
+            max_concurrent_runs - the maximum number of runs to execute at
+                once
+            schedule - a list of 3-element tuples containing the hour, minute,
+                and run request to queue at that time each day
+            cluster_idle_timeout - the number of minutes to keep a warm
+                cluster running with no run using it before terminating it
+            terminator - the function used to terminate a warm cluster. Must
+                accept the run request that the cluster was started for
+            max_finished_runs - the number of finished runs to remember for
+                status reports
+        """
+        if max_concurrent_runs < 1:
+            raise ValueError("The maximum number of concurrent runs must be "
+                             "at least one.")
+
+        self.state_dir = create_dir(state_dir)
+        self.queue = RunQueue(join(state_dir, 'queue.json'))
+        self.runner = runner
+        self.max_concurrent_runs = max_concurrent_runs
+        self.schedule = schedule or []
+        self.cluster_idle_timeout = cluster_idle_timeout
+        self.terminator = terminator
+        self.max_finished_runs = max_finished_runs
+
+        self._lock = Lock()
+        self._active_runs = {}
+        self._finished_runs = []
+        self._warm_clusters = {}
+        self._last_schedule_check = datetime.now()
+        self._http_server = None
+        self._shutdown = False
+
+    def submit(self, options, source='cli'):
+        """Validates and queues a run request.
+
+        Returns the same 2-element tuple as RunQueue.put().
+        """
+        return self.queue.put(build_run_request(options), source)
+
+    def poll(self, now=None):
+        """Queues scheduled runs, retires idle warm clusters, and starts runs.
+
+        Returns a list of the worker threads that were started.
+
+        Arguments:
+            now - the current datetime (defaults to datetime.now())
+        """
+        if now is None:
+            now = datetime.now()
+        self._queue_scheduled_runs(now)
+        self._terminate_idle_clusters()
+        return self._dispatch()
+
+    def status(self):
+        """Returns a dictionary describing the state of the daemon."""
+        with self._lock:
+            running = [dict(run) for run in self._active_runs.values()]
+            finished = list(self._finished_runs)
+            warm_clusters = [{'cluster_tag': tag,
+                              'idle_since': warm['idle_since']}
+                             for tag, warm in self._warm_clusters.items()]
+        return {'queued': self.queue.pending(),
+                'running': sorted(running, key=lambda run: run['started_at']),
+                'finished': finished,
+                'warm_clusters': warm_clusters,
+                'max_concurrent_runs': self.max_concurrent_runs}
+
+    def serve_forever(self, port, poll_interval=5.0):
+        """Serves the HTTP API on localhost and executes runs until shutdown.
+
+        Arguments:
+            port - the port to listen on (0 picks a free port)
+            poll_interval - the number of seconds to wait between polls
+        """
+        self.start_http_server(port)
+        try:
+            while not self._shutdown:
+                self.poll()
+                sleep(poll_interval)
+        finally:
+            self.stop_http_server()
+
+    def shutdown(self):
+        """Makes serve_forever() return after its current poll."""
+        self._shutdown = True
+
+    def start_http_server(self, port):
+        """Starts the HTTP API in a background thread.
+
+        Returns the port that the server is listening on.
+        """
+        self._http_server = HTTPServer(('127.0.0.1', port),
+                                       _RunRequestHandler)
+        self._http_server.run_server = self
+        http_thread = Thread(target=self._http_server.serve_forever)
+        http_thread.daemon = True
+        http_thread.start()
+        return self._http_server.server_address[1]
+
+    def stop_http_server(self):
+        """Stops the HTTP API if it is running."""
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+
+    def _queue_scheduled_runs(self, now):
+        """Queues each scheduled run whose time passed since the last check."""
+        last_check, self._last_schedule_check = self._last_schedule_check, now
+        for hour, minute, request in self.schedule:
+            # Check yesterday's occurrence as well in case the last check was
+            # before midnight.
+            for days_ago in (1, 0):
+                scheduled = (now - timedelta(days=days_ago)).replace(
+                        hour=hour, minute=minute, second=0, microsecond=0)
+                if last_check < scheduled <= now:
+                    self.queue.put(request, 'schedule')
+
+    def _dispatch(self):
+        """Starts as many queued runs as the concurrency limits allow."""
+        started = []
+        with self._lock:
+            for entry in self.queue.pending():
+                if len(self._active_runs) >= self.max_concurrent_runs:
+                    break
+
+                cluster_tag = entry['request']['cluster_tag']
+                if cluster_tag in [run['cluster_tag'] for run in
+                                   self._active_runs.values()]:
+                    continue
+
+                self.queue.mark_running(entry['run_id'])
+                self._active_runs[entry['run_id']] = {
+                        'run_id': entry['run_id'], 'cluster_tag': cluster_tag,
+                        'source': entry['source'], 'started_at': time()}
+                worker = Thread(target=self._execute_run, args=(entry,))
+                worker.daemon = True
+                worker.start()
+                started.append(worker)
+        return started
+
+    def _execute_run(self, entry):
+        """Executes a queued run (code run in a worker thread)."""
+        request = entry['request']
+        cluster_tag = request['cluster_tag']
+        cluster_key = build_backend(request).cluster_key()
+
+        with self._lock:
+            warm = self._warm_clusters.pop(cluster_tag, None)
+        start_cluster = True
+        if warm is not None:
+            if warm['cluster_key'] == cluster_key:
+                start_cluster = False
+            else:
+                # The warm cluster uses the same tag but a different cluster
+                # template, so it can't be reused and is in the way.
+                self.terminator(warm['request'])
+
+        # Keep the cluster running if another queued run can reuse it.
+        terminate_cluster = True
+        for pending_entry in self.queue.pending():
+            pending_request = pending_entry['request']
+            if pending_request['cluster_tag'] == cluster_tag and \
+               build_backend(pending_request).cluster_key() == cluster_key:
+                terminate_cluster = False
+                break
+
+        error = None
+        setup_succeeded = None
+        try:
+            setup_succeeded = self.runner(request,
+                                          start_cluster=start_cluster,
+                                          terminate_cluster=terminate_cluster,
+                                          state_dir=self.state_dir)
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+
+        # A cluster that wasn't set up properly (or whose run failed) can't
+        # be reused, so it is terminated instead of being kept warm. A run
+        # that attached to an identical run didn't manage a cluster.
+        kept_warm = False
+        if not terminate_cluster:
+            if setup_succeeded and error is None:
+                kept_warm = True
+            elif setup_succeeded is not None or error is not None:
+                self.terminator(request)
+        self.queue.remove(entry['run_id'])
+
+        with self._lock:
+            run = self._active_runs.pop(entry['run_id'])
+            run.update({'finished_at': time(),
+                        'status': 'failed' if error else 'succeeded',
+                        'error': error,
+                        'reused_cluster': not start_cluster,
+                        'kept_cluster_warm': kept_warm})
+            self._finished_runs.append(run)
+            del self._finished_runs[:-self.max_finished_runs]
+
+            if kept_warm:
+                self._warm_clusters[cluster_tag] = {
+                        'request': request, 'cluster_key': cluster_key,
+                        'idle_since': time()}
+
+    def _terminate_idle_clusters(self):
+        """Terminates warm clusters that have been idle for too long."""
+        pending_tags = set([entry['request']['cluster_tag']
+                            for entry in self.queue.pending()])
+        expired = []
+        with self._lock:
+            for cluster_tag, warm in self._warm_clusters.items():
+                idle_minutes = (time() - warm['idle_since']) / 60.0
+                if cluster_tag not in pending_tags and \
+                   idle_minutes >= self.cluster_idle_timeout:
+                    expired.append(self._warm_clusters.pop(cluster_tag))
+
+        for warm in expired:
+            self.terminator(warm['request'])
+
+
+class _RunRequestHandler(BaseHTTPRequestHandler):
+    """Handles requests to the daemon's HTTP API.
+
+    GET /status returns the daemon's status and POST /runs queues the run
+    request in the (JSON) request body. All responses are JSON.
+    """
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self._respond(200, self.server.run_server.status())
+        else:
+            self._respond(404, {'error': "Unknown path '%s'." % self.path})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/runs':
+            self._respond(404, {'error': "Unknown path '%s'." % self.path})
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            run_id, queued = self.server.run_server.submit(loads(body),
+                                                          'http')
+        except ValueError as e:
+            self._respond(400, {'error': str(e)})
+        else:
+            self._respond(200, {'run_id': run_id, 'queued': queued})
+
+    def log_message(self, format, *args):
+        """Silences the default per-request logging to stderr."""
+        pass
+
+    def _respond(self, code, data):
+        body = dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
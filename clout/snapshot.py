@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to reuse the environments that matrix test suites' setups build.
+
+A matrix test suite's shared setup command (see clout.matrix) often spends
+most of its time building the same environment in every run (e.g. compiling a
+dependency stack). Its 'snapshot' option lists the directories that the setup
+command builds, relative to the directory it is run from. The first time the
+setup command succeeds, those directories are streamed back from the cluster
+as a gzipped tar archive (a snapshot) and kept in a local snapshot store.
+Later setups with the same snapshot key restore the snapshot instead of
+running the setup command again:
+
+    <store dir>/<key>.tar.gz
+
+A setup's snapshot key is a hash of everything its result depends on: the
+setup command, the directories that are snapshotted, the kind of cluster it
+runs on (see the backends' cluster_key() in clout.backend), and the contents
+of the local files and directories listed in the test suite's
+'snapshot_inputs' option (e.g. a requirements file). Changing any of them
+builds a new snapshot.
+
+A snapshot's modification time is when it was last captured or restored.
+evict_snapshots() removes the snapshots that haven't been used for too long,
+and then the least recently used snapshots until the store is small enough.
+"""
+
+from hashlib import sha1
+from os import listdir, remove, stat, utime, walk
+from os.path import isabs, isdir, join
+from re import compile
+from time import time
+
+# The suffix of the snapshots in a snapshot store.
+snapshot_suffix = '.tar.gz'
+
+# Directories are placed in shell commands unquoted, so only characters that
+# are safe there are allowed.
+_dir_re = compile(r'^[A-Za-z0-9_.+/-]+$')
+
+def parse_snapshot_dirs(dirs):
+    """Parses the value of a matrix test suite's 'snapshot' option.
+
+    Returns the list of directories. Raises a ValueError if a directory is
+    absolute, refers to (or is) the directory that the setup command is run
+    from or one of its parents, or contains characters other than letters,
+    digits, and '_.+/-'.
+
+    Arguments:
+        dirs - a comma-separated list of directories
+    """
+    parsed_dirs = []
+    for snapshot_dir in dirs.split(','):
+        snapshot_dir = snapshot_dir.strip().rstrip('/')
+        if not snapshot_dir:
+            continue
+        if _dir_re.match(snapshot_dir) is None or isabs(snapshot_dir) or \
+           [part for part in snapshot_dir.split('/') if part in ('.', '..')]:
+            raise ValueError("Invalid snapshot directory '%s'. Snapshot "
+                             "directories must be relative paths below the "
+                             "directory that the setup command is run from, "
+                             "and may only contain letters, digits, and "
+                             "'_.+/-'." % snapshot_dir)
+        parsed_dirs.append(snapshot_dir)
+    if not parsed_dirs:
+        raise ValueError("At least one snapshot directory must be provided.")
+    return parsed_dirs
+
+def get_snapshot_key(setup_cmd, snapshot_dirs, cluster_key, input_fps=None):
+    """Returns the key that a setup's snapshot is stored under.
+
+    Arguments:
+        setup_cmd - the setup command
+        snapshot_dirs - the output of parse_snapshot_dirs()
+        cluster_key - the cluster key of the backend that runs the setup
+            command
+        input_fps - local files and directories that the setup's result
+            depends on. The contents of every file (and the path of every
+            file below a directory) are hashed
+    """
+    key = sha1()
+    for part in [setup_cmd] + snapshot_dirs + [repr(tuple(cluster_key))]:
+        key.update(_to_bytes(part) + b'\0')
+    for input_fp in input_fps or []:
+        key.update(_to_bytes(input_fp) + b'\0')
+        if isdir(input_fp):
+            for dir_fp, dir_names, file_names in sorted(walk(input_fp)):
+                for file_name in sorted(file_names):
+                    file_fp = join(dir_fp, file_name)
+                    key.update(_to_bytes(file_fp[len(input_fp):]) + b'\0')
+                    _hash_file(key, file_fp)
+        else:
+            _hash_file(key, input_fp)
+    return key.hexdigest()
+
+def get_snapshot_fp(store_dir, key):
+    """Returns where the snapshot with the given key is stored."""
+    return join(store_dir, key + snapshot_suffix)
+
+def build_capture_snapshot_cmd(snapshot_dirs):
+    """Returns the command that writes the snapshotted directories to stdout
+    as a gzipped tar archive.
+
+    The command is run from the same directory as the setup command, and
+    fails if one of the directories doesn't exist.
+
+    Arguments:
+        snapshot_dirs - the output of parse_snapshot_dirs()
+    """
+    return 'tar czf - %s' % ' '.join(snapshot_dirs)
+
+def build_restore_snapshot_cmd(snapshot_dirs):
+    """Returns the command that restores the snapshotted directories from a
+    gzipped tar archive read from stdin.
+
+    The command is run from the same directory as the setup command. Any
+    existing copies of the directories (e.g. on a reused cluster) are
+    replaced.
+
+    Arguments:
+        snapshot_dirs - the output of parse_snapshot_dirs()
+    """
+    return 'rm -rf %s && tar xzf -' % ' '.join(snapshot_dirs)
+
+def mark_snapshot_used(snapshot_fp):
+    """Records that a snapshot was just restored, so that it isn't evicted
+    before snapshots that were used less recently.
+    """
+    try:
+        utime(snapshot_fp, None)
+    except OSError:
+        pass
+
+def evict_snapshots(store_dir, max_size=None, max_age=None, now=None):
+    """Removes old snapshots from a snapshot store.
+
+    Returns the keys of the snapshots that were removed, least recently used
+    first. Snapshots that are removed by another run at the same time are
+    skipped.
+
+    Arguments:
+        store_dir - the directory that the snapshots are stored in
+        max_size - the maximum total size of the snapshots, in bytes. The
+            least recently used snapshots are removed until the rest fit. If
+            None, the store's size isn't limited
+        max_age - the number of days that a snapshot is kept after it was
+            last used. If None, snapshots are kept until they are removed to
+            limit the store's size
+        now - the current time (defaults to time.time())
+    """
+    if not isdir(store_dir):
+        return []
+    if now is None:
+        now = time()
+
+    snapshots = []
+    for file_name in listdir(store_dir):
+        if not file_name.endswith(snapshot_suffix):
+            continue
+        try:
+            file_stat = stat(join(store_dir, file_name))
+        except OSError:
+            continue
+        snapshots.append((file_stat.st_mtime, file_stat.st_size,
+                          file_name[:-len(snapshot_suffix)]))
+    snapshots.sort()
+
+    total_size = sum([size for last_used, size, key in snapshots])
+    evicted = []
+    for last_used, size, key in snapshots:
+        if (max_age is None or now - last_used <= max_age * 86400) and \
+           (max_size is None or total_size <= max_size):
+            continue
+        try:
+            remove(get_snapshot_fp(store_dir, key))
+        except OSError:
+            continue
+        total_size -= size
+        evicted.append(key)
+    return evicted
+
+def _to_bytes(text):
+    """Returns text encoded as UTF-8, unless it is already encoded."""
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+def _hash_file(key, file_fp):
+    """Adds the contents of a file to a hash."""
+    input_f = open(file_fp, 'rb')
+    try:
+        for chunk in iter(lambda: input_f.read(65536), b''):
+            key.update(chunk)
+    finally:
+        input_f.close()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to stage local source trees on the cluster before test suites run.
+
+A test suite's 'stage' option names a local directory (e.g. a working copy
+checked out at the revision being tested). Before the test suites run, every
+staged directory is copied to remote_stage_dir on the cluster, and each
+staged test suite's command is run from its copy:
+
+    <remote_stage_dir>/<stage name>/     copy of a local directory
+
+All of the staged directories are copied with a single rsync command, so only
+one connection to the cluster is made no matter how many test suites are
+staged. The copies are left on the cluster, so when a cluster is reused (or
+its image already contains remote_stage_dir), rsync only transfers the files
+that changed since they were last staged.
+"""
+
+from os import remove, symlink
+from os.path import abspath, isdir, join, lexists
+
+from clout.state import get_safe_filename
+from clout.util import create_dir
+
+# Where staged directories are copied to on the cluster, relative to the
+# directory that commands are run from (the user's home directory on a
+# StarCluster cluster).
+remote_stage_dir = '.clout_stage'
+
+def get_stage_name(local_dir):
+    """Returns the name that a local directory is staged under.
+
+    Test suites that stage the same local directory share one copy of it.
+    """
+    return get_safe_filename(abspath(local_dir).strip('/'))
+
+def get_remote_stage_dir(local_dir):
+    """Returns where a local directory is staged on the cluster, relative to
+    the directory that commands are run from.
+    """
+    return '%s/%s' % (remote_stage_dir, get_stage_name(local_dir))
+
+def build_staged_cmd(cmd, local_dir):
+    """Wraps a test suite's command so that it runs from its staged copy.
+
+    Arguments:
+        cmd - the test suite's command
+        local_dir - the local directory the test suite stages, or None if it
+            doesn't stage one (in which case cmd is returned as-is)
+    """
+    if local_dir is None:
+        return cmd
+    return 'cd %s && %s' % (get_remote_stage_dir(local_dir), cmd)
+
+def create_stage_links(local_dirs, links_dir):
+    """Creates a directory of links to the local directories to stage.
+
+    Returns the list of links that were created, one for each distinct local
+    directory. Each link is named after its directory's stage name, so
+    syncing the links to remote_stage_dir (following them) copies every
+    local directory to where build_staged_cmd() expects it, in a single
+    transfer.
+
+    Arguments:
+        local_dirs - the local directories to stage
+        links_dir - the directory to create the links in (created if it
+            doesn't exist). Any existing links are replaced
+    """
+    create_dir(links_dir)
+    link_fps = []
+    for local_dir in local_dirs:
+        if not isdir(local_dir):
+            raise ValueError("The directory '%s' cannot be staged because it "
+                             "does not exist." % local_dir)
+        link_fp = join(links_dir, get_stage_name(local_dir))
+        if link_fp in link_fps:
+            continue
+        if lexists(link_fp):
+            remove(link_fp)
+        symlink(abspath(local_dir), link_fp)
+        link_fps.append(link_fp)
+    return link_fps
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to persist the state of a run so that it can be resumed.
+
+Each run gets its own directory containing the run's parameters, its log files,
+and a journal (one JSON object per line) of the phases and test suites that
+have finished. The journal is flushed to disk after every entry, so if the
+machine running Clout reboots or the process is killed, the run can be resumed
+from the last entry instead of being started over.
+
+Once a run has finished, its directory is only kept until enough newer runs
+have finished (see prune_runs()). By then, its logs are in the log archive
+and its email has been spooled to the outbox.
+"""
+
+from json import dumps, loads
+from os import fsync, listdir
+from os.path import exists, isdir, join
+from re import sub
+from shutil import rmtree
+from time import strftime, time
+from uuid import uuid4
+
+from clout.util import create_dir, write_file_atomically
+
+class RunState(object):
+    """The persistent state of a single run."""
+
+    def __init__(self, run_dir):
+        """Loads the run state stored in run_dir.
+
+        Use RunState.create() to create the state of a new run.
+
+        Arguments:
+            run_dir - the directory that the run's state is stored in
+        """
+        if not exists(join(run_dir, 'params.json')):
+            raise ValueError("The directory '%s' does not contain the state "
+                             "of a Clout run." % run_dir)
+
+        self.run_dir = run_dir
+        self.run_id = run_dir.rstrip('/').split('/')[-1]
+        self.journal_fp = join(run_dir, 'journal.txt')
+        self.log_dir = join(run_dir, 'logs')
+
+        params_f = open(join(run_dir, 'params.json'), 'U')
+        try:
+            self.params = loads(params_f.read())
+        finally:
+            params_f.close()
+
+    @classmethod
+    def create(cls, runs_dir, params):
+        """Creates the state of a new run and returns it.
+
+        Arguments:
+            runs_dir - the directory that run directories are created in
+            params - a JSON-serializable dictionary of the run's parameters
+                (everything needed to resume the run)
+        """
+        run_id = create_run_id()
+        run_dir = create_dir(join(runs_dir, run_id))
+        create_dir(join(run_dir, 'logs'))
+        write_file_atomically(join(run_dir, 'params.json'), dumps(params))
+        run_state = cls(run_dir)
+        run_state.record('run_started')
+        return run_state
+
+    @classmethod
+    def load(cls, runs_dir, run_id):
+        """Returns the state of an existing run.
+
+        Arguments:
+            runs_dir - the directory that run directories are created in
+            run_id - the ID of the run to load
+        """
+        run_dir = join(runs_dir, run_id)
+        if not isdir(run_dir):
+            raise ValueError("There is no run with the ID '%s'." % run_id)
+        return cls(run_dir)
+
+    def record(self, event, **fields):
+        """Appends an event to the journal and flushes it to disk.
+
+        Arguments:
+            event - the name of the event (e.g. 'setup_finished')
+            fields - any additional JSON-serializable data to store with the
+                event
+        """
+        entry = dict(fields, event=event, time=time())
+        journal_f = open(self.journal_fp, 'a')
+        try:
+            journal_f.write(dumps(entry) + '\n')
+            journal_f.flush()
+            fsync(journal_f.fileno())
+        finally:
+            journal_f.close()
+
+    def get_events(self, event=None):
+        """Returns the journal's entries, optionally only those of one type.
+
+        An incomplete last line (e.g. the process was killed while writing it)
+        is ignored.
+        """
+        if not exists(self.journal_fp):
+            return []
+
+        entries = []
+        journal_f = open(self.journal_fp, 'U')
+        try:
+            for line in journal_f:
+                try:
+                    entry = loads(line)
+                except ValueError:
+                    continue
+                if event is None or entry['event'] == event:
+                    entries.append(entry)
+        finally:
+            journal_f.close()
+        return entries
+
+    def get_last_event(self, event):
+        """Returns the most recent journal entry of the given type, or None."""
+        entries = self.get_events(event)
+        return entries[-1] if entries else None
+
+    def is_finished(self):
+        """Returns True if the run finished (i.e. its results were sent)."""
+        return self.get_last_event('run_finished') is not None
+
+    def open_log(self, name):
+        """Opens (creating if necessary) one of the run's log files.
+
+        The file is opened for reading and appending, so writes always go to
+        the end of the file, even after seeking to the beginning to read it.
+
+        Arguments:
+            name - the name of the log file (e.g. 'complete_log.txt'). Any
+                characters that aren't safe in a filename are replaced
+        """
+        return open(join(self.log_dir, get_safe_filename(name)), 'a+')
+
+
+def create_run_id():
+    """Returns a new, unique run ID.
+
+    Run IDs begin with the time that they were created, so sorting them sorts
+    runs from oldest to newest.
+    """
+    return '%s-%s' % (strftime('%Y%m%d-%H%M%S'), uuid4().hex[:8])
+
+def get_safe_filename(name):
+    """Returns name with characters that are unsafe in filenames replaced."""
+    return sub(r'[^A-Za-z0-9._-]', '_', name)
+
+def list_runs(runs_dir):
+    """Returns the state of every run in runs_dir, oldest first."""
+    if not isdir(runs_dir):
+        return []
+
+    runs = []
+    for run_id in sorted(listdir(runs_dir)):
+        if exists(join(runs_dir, run_id, 'params.json')):
+            runs.append(RunState(join(runs_dir, run_id)))
+    return runs
+
+def prune_runs(runs_dir, max_runs=100):
+    """Removes the directories of all but the most recently finished runs.
+
+    Runs that haven't finished are never removed, since they can still be
+    resumed. Returns the IDs of the runs that were removed.
+
+    Arguments:
+        runs_dir - the directory that run directories are created in
+        max_runs - the number of most recently finished runs to keep
+    """
+    finished_runs = []
+    for run_state in list_runs(runs_dir):
+        finished_event = run_state.get_last_event('run_finished')
+        if finished_event is not None:
+            finished_runs.append((finished_event['time'], run_state))
+    finished_runs.sort(key=lambda finished_run: finished_run[0])
+
+    pruned_run_ids = []
+    for finished_time, run_state in \
+            finished_runs[:max(0, len(finished_runs) - max_runs)]:
+        rmtree(run_state.run_dir, ignore_errors=True)
+        pruned_run_ids.append(run_state.run_id)
+    return pruned_run_ids
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to time the steps of a test suite from its output.
+
+Much of a test suite's time is often spent preparing for the tests (e.g.
+downloading and unpacking the code, or deploying an application) rather than
+running them. A test suite's output can mark where each of its steps starts
+with a line beginning with step_marker, followed by the step's name:
+
+    ::clout-step Downloading QIIME
+
+Each step lasts until the next step starts or the test suite finishes. A
+test suite's 'steps' option decides where its steps come from:
+
+    markers     the step markers that its commands print (the default)
+    commands    each of its '&&'-separated commands is a step. The commands
+                are wrapped so that they print a step marker naming
+                themselves before they run (see build_stepped_cmd())
+
+Each line of output is timestamped when it is received (see StepTimeline),
+so a step's duration is measured locally and includes the time its output
+took to arrive.
+"""
+
+from re import sub
+
+# The prefix of a line of output that marks the start of a step.
+step_marker = '::clout-step'
+
+# The values of the 'steps' option.
+step_modes = ['markers', 'commands']
+
+# The longest name given to a step built from a command.
+max_step_name_length = 60
+
+def split_cmd(cmd):
+    """Splits a shell command into its '&&'-separated commands.
+
+    Only '&&' operators outside of quotes, parentheses, braces, and
+    backquotes split the command, so the commands run in the same order and
+    with the same meaning when they are joined with '&&' again.
+
+    Arguments:
+        cmd - the shell command to split
+    """
+    cmds = []
+    current = ''
+    quote_char = None
+    depth = 0
+    i = 0
+    while i < len(cmd):
+        char = cmd[i]
+        if char == '\\' and quote_char != "'":
+            current += cmd[i:i + 2]
+            i += 2
+            continue
+
+        if quote_char is not None:
+            if char == quote_char:
+                quote_char = None
+        elif char in '\'"`':
+            quote_char = char
+        elif char in '({':
+            depth += 1
+        elif char in ')}':
+            depth = max(0, depth - 1)
+        elif cmd.startswith('&&', i) and depth == 0:
+            cmds.append(current.strip())
+            current = ''
+            i += 2
+            continue
+        current += char
+        i += 1
+    cmds.append(current.strip())
+    return [split for split in cmds if split]
+
+def build_stepped_cmd(cmd, steps_mode):
+    """Wraps a test suite's command so that it marks the start of each step.
+
+    Arguments:
+        cmd - the test suite's command
+        steps_mode - the test suite's 'steps' option (one of step_modes). If
+            'markers', cmd is returned as-is
+    """
+    if steps_mode == 'markers':
+        return cmd
+    stepped_cmds = []
+    for step_cmd in split_cmd(cmd):
+        # The marker is double-quoted because backends may wrap the whole
+        # command in single quotes (e.g. StarClusterBackend.build_run_cmd()).
+        marker = _escape_double_quoted('%s %s' % (step_marker,
+                                                  _get_step_name(step_cmd)))
+        stepped_cmds.append('echo "%s" && %s' % (marker, step_cmd))
+    return ' && '.join(stepped_cmds)
+
+def parse_step_marker(line):
+    """Returns the name of the step that a line of output starts, or None.
+
+    Arguments:
+        line - a line of a test suite's output
+    """
+    line = line.strip()
+    if not line.startswith(step_marker):
+        return None
+    return line[len(step_marker):].strip()
+
+def format_timeline_line(elapsed, stream_name, line):
+    """Formats a line of output for a timeline.
+
+    Arguments:
+        elapsed - the number of seconds between when the command started
+            and when the line was received
+        stream_name - the stream that the line was written to ('stdout' or
+            'stderr')
+        line - the line of output
+    """
+    return '%10.3f %-6s %s\n' % (elapsed, stream_name, line.rstrip('\n'))
+
+
+class StepTimeline(object):
+    """Times the steps of a command from its output as it arrives."""
+
+    def __init__(self, start_time, timeline_f=None):
+        """Initializes a new timeline for a command.
+
+        Arguments:
+            start_time - when the command started
+            timeline_f - the file to write each line of output to, prefixed
+                with the number of seconds between when the command started
+                and when the line was received (see format_timeline_line()).
+                If None, only the steps are timed
+        """
+        self.start_time = start_time
+        self.timeline_f = timeline_f
+        self._steps = []
+
+    def line_received(self, stream_name, line, received_at):
+        """Records a line of the command's output.
+
+        Arguments:
+            stream_name - same as for format_timeline_line()
+            line - same as for format_timeline_line()
+            received_at - when the line was received
+        """
+        elapsed = received_at - self.start_time
+        if self.timeline_f is not None:
+            self.timeline_f.write(format_timeline_line(elapsed, stream_name,
+                                                       line))
+        name = parse_step_marker(line)
+        if name is not None:
+            self._steps.append((name or 'step %d' % (len(self._steps) + 1),
+                                elapsed))
+
+    def get_steps(self, finished_at):
+        """Returns the steps that the command's output marked.
+
+        Returns a list of dictionaries (in the order the steps started) with
+        the 'name' of each step, when it 'start'ed (the number of seconds
+        after the command started), and its 'duration' (in seconds).
+
+        Arguments:
+            finished_at - when the command finished
+        """
+        steps = []
+        for step_index, (name, start) in enumerate(self._steps):
+            if step_index + 1 < len(self._steps):
+                end = self._steps[step_index + 1][1]
+            else:
+                end = finished_at - self.start_time
+            steps.append({'name': name, 'start': start,
+                          'duration': max(0.0, end - start)})
+        return steps
+
+
+def _get_step_name(step_cmd):
+    """Returns the name of a step built from a command."""
+    name = sub(r'\s+', ' ', step_cmd)
+    if len(name) > max_step_name_length:
+        name = name[:max_step_name_length - 3] + '...'
+    return name
+
+def _escape_double_quoted(text):
+    """Escapes text so that it can be placed inside double quotes in a shell
+    command.
+    """
+    for char in '\\', '"', '$', '`':
+        text = text.replace(char, '\\' + char)
+    return text
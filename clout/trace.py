@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module to trace where the time in a run goes.
+
+A Tracer records spans (named intervals with attributes) on tracks: the
+'run' track holds the run itself, each of its phases (from the run's progress
+events), and sending the email, while each command that a
+clout.util.CommandExecutor runs is recorded on the track of the worker that
+ran it, so that test suites running at the same time show up side by side.
+Spans on the same track nest by time.
+
+The trace is written in the Chrome trace event format (a JSON object whose
+'traceEvents' are complete 'X' events with microsecond timestamps), which can
+be opened in chrome://tracing or https://ui.perfetto.dev. Each attempt at a
+run (i.e. the original attempt and each time it was resumed) is a separate
+process in the trace.
+
+Recording a span only appends a dictionary to a list, so tracing adds
+nothing noticeable to a run.
+"""
+
+from contextlib import contextmanager
+from json import dumps, loads
+from os import getpid
+from os.path import exists
+from threading import Lock
+from time import time
+
+from clout.util import write_file_atomically
+
+class Tracer(object):
+    """Records the spans of a run and writes them as a Chrome trace.
+
+    Spans may be recorded from any thread.
+    """
+
+    def __init__(self, process_name='clout', events=None):
+        """Initializes a new tracer.
+
+        Arguments:
+            process_name - the name that the trace viewer shows for the
+                spans recorded by this tracer
+            events - trace events to include in the trace before the ones
+                recorded by this tracer (e.g. the output of
+                load_trace_events() for an earlier attempt at the run)
+        """
+        self.pid = getpid()
+
+        self._lock = Lock()
+        self._events = list(events or [])
+        self._tracks = {}
+        self._open_spans = {}
+        self._add_metadata('process_name', 0, process_name)
+
+    @contextmanager
+    def span(self, name, track='run', category='run', **attributes):
+        """Records the code run in a with statement as a span.
+
+        If the code raises an exception, the exception's type is added to the
+        span's attributes as 'error'.
+
+        Arguments:
+            name - the name of the span
+            track - the name of the track to record the span on
+            category - the category of the span (e.g. 'phase' or 'command')
+            attributes - attributes of the span, shown when it is selected
+        """
+        start = time()
+        try:
+            yield
+        except BaseException as e:
+            attributes['error'] = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, start, time(), track, category, **attributes)
+
+    def add_span(self, name, start, end, track='run', category='run',
+                 **attributes):
+        """Records a span whose start and end were measured elsewhere.
+
+        Arguments:
+            name - same as for span()
+            start - when the span started, in seconds since the epoch
+            end - when the span ended, in seconds since the epoch
+            track - same as for span()
+            category - same as for span()
+            attributes - same as for span()
+        """
+        with self._lock:
+            self._events.append(self._build_span(name, start, end, track,
+                                                 category, attributes))
+
+    def update(self, event):
+        """Records the run and its phases as spans from progress events.
+
+        This is meant to be passed as a listener of a
+        clout.progress.ProgressReporter. The run's span starts with the
+        'run_started' event, and each phase's span lasts until the next
+        phase starts or the run finishes.
+
+        Arguments:
+            event - the event, as returned by
+                clout.progress.ProgressReporter.report()
+        """
+        name = event['event']
+        if name == 'run_started':
+            self._start_span('run', 'run', event['time'],
+                             run_id=event.get('run_id'),
+                             cluster_tag=event.get('cluster_tag'))
+        elif name == 'phase_changed':
+            self._end_span('phase', event['time'])
+            self._start_span('phase', event['phase'], event['time'])
+        elif name == 'run_finished':
+            self._end_span('phase', event['time'])
+            self._end_span('run', event['time'],
+                           succeeded=event.get('succeeded'))
+
+    def get_trace(self):
+        """Returns the trace as a dictionary in the Chrome trace event format.
+
+        Spans that haven't ended (e.g. because the run was interrupted) end
+        now, and are marked as unfinished.
+        """
+        now = time()
+        with self._lock:
+            unfinished_spans = []
+            for key in 'phase', 'run':
+                if key in self._open_spans:
+                    name, start, attributes = self._open_spans[key]
+                    unfinished_spans.append(self._build_span(name, start, now,
+                            'run', key, dict(attributes, unfinished=True)))
+            events = self._events + unfinished_spans
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, trace_fp):
+        """Atomically writes the trace to a JSON file.
+
+        Arguments:
+            trace_fp - the file to write the trace to
+        """
+        write_file_atomically(trace_fp, dumps(self.get_trace(),
+                                              sort_keys=True))
+
+    def _start_span(self, key, name, start, **attributes):
+        """Starts a span on the 'run' track that is ended by _end_span()."""
+        with self._lock:
+            self._open_spans[key] = (name, start, attributes)
+
+    def _end_span(self, key, end, **attributes):
+        """Ends a span started by _start_span(), if it was started."""
+        with self._lock:
+            span = self._open_spans.pop(key, None)
+        if span is not None:
+            name, start, start_attributes = span
+            attributes.update(start_attributes)
+            self.add_span(name, start, end, 'run', key, **attributes)
+
+    def _build_span(self, name, start, end, track, category, attributes):
+        """Returns a span as a complete trace event.
+
+        Must be called while holding self._lock.
+        """
+        return {'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6,
+                'dur': max(0.0, end - start) * 1e6, 'pid': self.pid,
+                'tid': self._get_tid(track), 'args': attributes}
+
+    def _get_tid(self, track):
+        """Returns the ID of a track, naming the track if it is new.
+
+        Must be called while holding self._lock.
+        """
+        if track not in self._tracks:
+            self._tracks[track] = len(self._tracks) + 1
+            self._add_metadata('thread_name', self._tracks[track], track)
+            self._events.append({'name': 'thread_sort_index', 'ph': 'M',
+                                 'pid': self.pid, 'tid': self._tracks[track],
+                                 'args': {'sort_index': self._tracks[track]}})
+        return self._tracks[track]
+
+    def _add_metadata(self, name, tid, value):
+        """Names the process or one of its tracks in the trace."""
+        self._events.append({'name': name, 'ph': 'M', 'pid': self.pid,
+                             'tid': tid, 'args': {'name': value}})
+
+
+def load_trace_events(trace_fp):
+    """Returns the events of a trace written by Tracer.write().
+
+    Returns an empty list if the trace doesn't exist or can't be read (e.g.
+    it was written by an older version of Clout).
+
+    Arguments:
+        trace_fp - the file that the trace was written to
+    """
+    if not exists(trace_fp):
+        return []
+    trace_f = open(trace_fp, 'U')
+    try:
+        try:
+            return loads(trace_f.read())['traceEvents']
+        except (ValueError, KeyError, TypeError):
+            return []
+    finally:
+        trace_f.close()
@@ -16,26 +16,39 @@ from email.MIMEBase import MIMEBase
 from email.MIMEMultipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.Utils import formatdate
-from os import killpg, setsid
+from errno import EEXIST, EINTR
+from os import fdopen, killpg, makedirs, read, rename, setsid
+from os.path import dirname
+from select import error as select_error, select
 from signal import SIGTERM
 from smtplib import SMTP
 from subprocess import PIPE, Popen
-from tempfile import TemporaryFile
+from tempfile import mkstemp, TemporaryFile
 from threading import Lock, Thread
+from time import sleep, time
+
+from clout.filters import OutputFilter
 
 class CommandExecutor(object):
-    """Class to run commands in a separate thread.
+    """Class to run commands and supervise them from a single event loop.
 
     Provides support for timeouts (e.g. useful for commands that may hang
     indefinitely) and for capturing stdout, stderr, and return value of each
     command. Output is logged to a file (or optionally to separate files for
     each command).
 
+    All of the running commands are supervised by one select()-based event
+    loop in the thread that calls the executor: the loop starts commands as
+    workers become free, reads each command's output as it arrives, and
+    terminates commands whose timeouts have passed. Running many commands at
+    the same time therefore doesn't need any more threads, and the callbacks
+    are called from the calling thread (except for worker_idle_callback).
+
     This class is the single place in Clout that is not platform-independent
-    (it won't be able to terminate timed-out processes on Windows). The fix is
-    to not use shell=True in our call to Popen, but this would require changing
-    the way we support test suite config files and this (large) change will
-    have to wait.
+    (it won't be able to terminate timed-out processes on Windows, and
+    select() doesn't support pipes there). The fix is to not use shell=True in
+    our call to Popen, but this would require changing the way we support test
+    suite config files and this (large) change will have to wait.
 
     Some of the code in this class is based on ideas/code from QIIME's
     qiime.util.qiime_system_call function and the following posts:
@@ -43,12 +56,26 @@ class CommandExecutor(object):
         http://stackoverflow.com/a/4791612
     """
 
+    # The longest number of seconds that the event loop waits for output
+    # before checking whether a command has exited.
+    poll_interval = 0.1
+
     def __init__(self, cmds, log_f, stop_on_first_failure=False,
-                 log_individual_cmds=False):
+                 log_individual_cmds=False, log_f_factory=None,
+                 cmd_finished_callback=None, cmd_timeouts=None,
+                 cmd_started_callback=None, output_callback=None,
+                 cmd_batches=None, worker_idle_callback=None, tracer=None,
+                 trace_names=None, worker_lost_callback=None,
+                 replace_worker_callback=None, output_filters=None,
+                 unfiltered_log_f_factory=None):
         """Initializes a new object to execute multiple commands.
 
         Arguments:
-            cmds - list of commands to run (strings)
+            cmds - list of commands to run (strings). A command may also be
+                a list of strings, one for each worker in its batch (see
+                cmd_batches), in which case it is run as the string of
+                whichever worker runs it (e.g. so that each worker runs
+                commands on its own machine)
             log_f - the file to write command output to
             stop_on_first_failure - if True, will stop running all other
                 commands once a command has a nonzero exit code
@@ -56,11 +83,106 @@ class CommandExecutor(object):
                 command that is run and log the output separately (as well as
                 to log_f). Will also keep track of the return values for each
                 command
+            log_f_factory - a function that is passed the index of a command
+                in cmds and returns the file that the command's individual log
+                will be written to. If not provided, a TemporaryFile is used.
+                Only used if log_individual_cmds is True
+            cmd_finished_callback - a function that is called after each
+                command finishes. It is passed the index of the command in
+                cmds, its individual log file (None if log_individual_cmds is
+                False), its return code, True if a timeout occurred while the
+                command was running, and the number of seconds the command
+                took to run
+            cmd_timeouts - a list containing the number of minutes that each
+                command in cmds is allowed to run (None if only the overall
+                timeout applies). A command that exceeds its own timeout is
+                terminated and its index is added to timed_out_cmds (before
+                cmd_finished_callback is called), but the remaining commands
+                are still run
+            cmd_started_callback - a function that is called after each
+                command starts. It is passed the index of the command in cmds
+            output_callback - a function that is called as each line of a
+                command's output arrives (instead of only once the command
+                finishes). It is passed the index of the command in cmds, the
+                name of the stream ('stdout' or 'stderr'), and the line
+            cmd_batches - a list of 2-element lists containing the number of
+                consecutive commands in a batch and the number of them that
+                may run at the same time, covering cmds in order. If not
+                provided, the commands run one at a time. Commands are always
+                started in order, and every command in a batch that is
+                started finishes (or is terminated) before the next batch
+                starts, so the commands that have run are always the first
+                ones in cmds. The callbacks (apart from worker_idle_callback)
+                are never called at the same time
+            worker_idle_callback - a function that is called when a worker in
+                the last batch has no commands left to run, while the batch's
+                other commands may still be running. It is passed the index of
+                the worker, and is called from a separate thread (so it may
+                take as long as it needs without holding up the other
+                commands). It isn't called if no more commands were going to
+                be started (e.g. because of a timeout). If it returns a false
+                value, the worker may still run a command that is run again
+                after a lost worker interrupted it (see worker_lost_callback);
+                it should return True if the worker can't run any more
+                commands (e.g. because its machine was removed)
+            tracer - a clout.trace.Tracer that each command is recorded in,
+                as a span on the track of the worker that ran it
+            trace_names - a list of the names of the commands' spans (e.g.
+                the labels of the test suites that the commands run). If not
+                provided, each span is named after its command
+            worker_lost_callback - a function that is called when a command
+                fails (i.e. exits with a nonzero return code without being
+                terminated because of a timeout), to tell whether it failed
+                because the worker running it was lost (e.g. its machine was
+                reclaimed) rather than because the command itself failed. It
+                is passed the index of the command in cmds, the index of the
+                worker, the command's return code, and the number of seconds
+                the command ran for, and returns True if the worker was lost.
+                The interrupted attempt is logged to log_f and its index is
+                added to interrupted_cmds, but cmd_finished_callback isn't
+                called for it: instead, the command is run again by the next
+                free worker, before the rest of its batch. If no worker is
+                left to run it again, the interrupted attempt is the
+                command's result. A lost worker runs no more commands unless
+                replace_worker_callback replaces it. This is called from the
+                calling thread, so it should return quickly
+            replace_worker_callback - a function that is called, from a
+                separate thread, after a worker is lost. It is passed the
+                index of the worker and returns True if the worker was
+                replaced (e.g. by starting a new machine in place of the one
+                that was lost), in which case the worker runs commands again
+            output_filters - a list containing the output filters (the
+                output of clout.filters.parse_output_filters()) that are
+                applied to each command's output as it arrives, or None if
+                the command's output isn't filtered. Only the filtered output
+                is logged, but the output passed to output_callback isn't
+                filtered. If not provided, no output is filtered
+            unfiltered_log_f_factory - a function that is passed the index of
+                a command whose output is filtered and returns the file that
+                the command's unfiltered individual log will be written to
+                (e.g. so that its individual test results can still be
+                parsed). If not provided, the unfiltered output isn't kept.
+                Only used if log_individual_cmds is True
         """
         self.cmds = cmds
         self.log_f = log_f
         self.stop_on_first_failure = stop_on_first_failure
         self.log_individual_cmds = log_individual_cmds
+        self.log_f_factory = log_f_factory
+        self.cmd_finished_callback = cmd_finished_callback
+        self.cmd_timeouts = cmd_timeouts
+        self.cmd_started_callback = cmd_started_callback
+        self.output_callback = output_callback
+        self.cmd_batches = cmd_batches
+        self.worker_idle_callback = worker_idle_callback
+        self.tracer = tracer
+        self.trace_names = trace_names
+        self.worker_lost_callback = worker_lost_callback
+        self.replace_worker_callback = replace_worker_callback
+        self.output_filters = output_filters
+        self.unfiltered_log_f_factory = unfiltered_log_f_factory
+        self.timed_out_cmds = set()
+        self.interrupted_cmds = []
 
     def __call__(self, timeout):
         """Executes the commands within the given timeout, logging output.
@@ -84,88 +206,416 @@ class CommandExecutor(object):
                 minute
         """
         self._cmds_succeeded = True
-        self._individual_cmds_status = []
+        self._individual_cmds_status = {}
+        self.timed_out_cmds = set()
+        self.interrupted_cmds = []
+        self._timeout_occurred = False
 
-        # We must create locks for the next two variables because they are
-        # read/written in the main thread and worker thread. They allow
-        # the threads to communicate when a timeout has occurred, and the
-        # hung process that needs to be terminated.
-        self._running_process = None
-        self._running_process_lock = Lock()
+        # Whether to stop starting commands, the commands that are running
+        # (keyed by the index of the worker running them), and the threads
+        # running worker_idle_callback and replace_worker_callback.
+        self._stopped = False
+        self._running = {}
+        self._worker_threads = []
 
-        self._timeout_occurred = False
-        self._timeout_occurred_lock = Lock()
-
-        # Run the commands in a worker thread. Regain control after the
-        # specified timeout.
-        cmd_runner_thread = Thread(target=self._run_commands)
-        cmd_runner_thread.start()
-        cmd_runner_thread.join(float(timeout) * 60.0)
-
-        if cmd_runner_thread.is_alive():
-            # Timeout occurred, so terminate the current process and have the
-            # worker thread exit gracefully.
-            with self._timeout_occurred_lock:
-                self._timeout_occurred = True
-
-            with self._running_process_lock:
-                if self._running_process is not None:
-                    # We must kill the process group because the process was
-                    # launched with a shell. This code won't work on Windows.
-                    killpg(self._running_process.pid, SIGTERM)
-            cmd_runner_thread.join()
-
-        return self._cmds_succeeded, self._individual_cmds_status
-
-    def _run_commands(self):
-        """Code to be run in worker thread; actually executes the commands."""
-        for cmd in self.cmds:
-            # Check that there hasn't been a timeout before running the (next)
-            # command.
-            with self._timeout_occurred_lock:
-                if self._timeout_occurred:
-                    self._cmds_succeeded = None
+        # The interrupted attempts of the commands that are waiting to be run
+        # again (keyed by the index of the command), the workers that were
+        # lost, and the workers that may run commands again (added to by the
+        # worker threads).
+        self._interrupted = {}
+        self._lost_workers = set()
+        self._returned_workers = []
+        self._returned_workers_lock = Lock()
+
+        deadline = time() + float(timeout) * 60.0
+        cmd_batches = self.cmd_batches
+        if cmd_batches is None:
+            cmd_batches = [[1, 1]] * len(self.cmds)
+
+        batch_start = 0
+        for batch_index, (num_cmds, num_workers) in enumerate(cmd_batches):
+            cmd_indices = list(range(batch_start, batch_start + num_cmds))
+            batch_start += num_cmds
+            last_batch = batch_index == len(cmd_batches) - 1
+            batch_workers = max(1, min(num_workers, num_cmds))
+            free_workers = [worker_index for worker_index in
+                            range(batch_workers)
+                            if worker_index not in self._lost_workers]
+
+            while True:
+                for worker_index in self._get_returned_workers():
+                    if worker_index < batch_workers:
+                        free_workers.append(worker_index)
+                free_workers.sort()
+
+                # Each free worker runs the batch's next command, the
+                # lowest-numbered worker first.
+                while cmd_indices and free_workers and not self._stopped:
+                    self._start_cmd(cmd_indices.pop(0), free_workers.pop(0))
+                if not self._running and (not cmd_indices or self._stopped or
+                                          not self._workers_pending()):
                     break
+
+                finished_workers = self._supervise(deadline)
+
+                # Commands interrupted by a lost worker run again first.
+                interrupted = [cmd_index for cmd_index in
+                               sorted(self._interrupted)
+                               if cmd_index not in cmd_indices]
+                cmd_indices[:0] = interrupted
+                for worker_index in finished_workers:
+                    if cmd_indices:
+                        free_workers.append(worker_index)
+                    elif last_batch and not self._stopped and \
+                         self.worker_idle_callback is not None:
+                        self._start_worker_thread(self.worker_idle_callback,
+                                                  worker_index, False)
+
+            if cmd_indices and not self._stopped:
+                # Every worker was lost, so the rest of the commands can't be
+                # run.
+                self._cmds_succeeded = False
+                self._stopped = True
+            if self._stopped:
+                break
+
+        for worker_thread in self._worker_threads:
+            worker_thread.join()
+
+        # The interrupted attempts of the commands that couldn't be run again
+        # are their results.
+        for cmd_index in sorted(self._interrupted):
+            self._finish_cmd(self._interrupted.pop(cmd_index))
+
+        return self._cmds_succeeded, [self._individual_cmds_status[cmd_index]
+                for cmd_index in sorted(self._individual_cmds_status)]
+
+    def _start_worker_thread(self, callback, worker_index, returns_worker):
+        """Calls worker_idle_callback or replace_worker_callback from a
+        separate thread.
+
+        If the callback's return value is returns_worker, the worker may run
+        commands again once the callback returns.
+        """
+        def call_callback():
+            if bool(callback(worker_index)) == returns_worker:
+                with self._returned_workers_lock:
+                    self._returned_workers.append(worker_index)
+        worker_thread = Thread(target=call_callback)
+        worker_thread.start()
+        self._worker_threads.append(worker_thread)
+
+    def _get_returned_workers(self):
+        """Returns (and forgets) the workers that may run commands again."""
+        with self._returned_workers_lock:
+            returned_workers = self._returned_workers
+            self._returned_workers = []
+        for worker_index in returned_workers:
+            self._lost_workers.discard(worker_index)
+        return returned_workers
+
+    def _workers_pending(self):
+        """Returns True if a worker may still be able to run commands again.
+        """
+        # Threads only return workers before they exit, so the threads are
+        # checked first.
+        if [worker_thread for worker_thread in self._worker_threads
+            if worker_thread.is_alive()]:
+            return True
+        with self._returned_workers_lock:
+            return bool(self._returned_workers)
+
+    def _start_cmd(self, cmd_index, worker_index):
+        """Starts a command and adds it to the running commands."""
+        self._interrupted.pop(cmd_index, None)
+        cmd = self.cmds[cmd_index]
+        if isinstance(cmd, list):
+            cmd = cmd[worker_index]
+
+        # setsid makes the spawned shell the process group leader, so that we
+        # can kill it and its children.
+        start_time = time()
+        proc = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE,
+                     preexec_fn=setsid)
+
+        cmd_timeout = None
+        if self.cmd_timeouts is not None:
+            cmd_timeout = self.cmd_timeouts[cmd_index]
+        cmd_deadline = None
+        if cmd_timeout is not None:
+            cmd_deadline = start_time + float(cmd_timeout) * 60.0
+
+        # Each stream of a command whose output is filtered has its own
+        # filter. The unfiltered output is only kept if it is logged.
+        output_filters = None
+        unfiltered_output = None
+        if self.output_filters is not None and \
+           self.output_filters[cmd_index] is not None:
+            output_filters = {
+                    'stdout': OutputFilter(self.output_filters[cmd_index]),
+                    'stderr': OutputFilter(self.output_filters[cmd_index])}
+            if self.log_individual_cmds and \
+               self.unfiltered_log_f_factory is not None:
+                unfiltered_output = {'stdout': [], 'stderr': []}
+
+        self._running[worker_index] = {
+                'cmd_index': cmd_index, 'cmd': cmd, 'proc': proc,
+                'worker_index': worker_index, 'start_time': start_time,
+                'cmd_timeout': cmd_timeout,
+                'deadline': cmd_deadline,
+                'streams': {proc.stdout.fileno(): 'stdout',
+                            proc.stderr.fileno(): 'stderr'},
+                'output': {'stdout': [], 'stderr': []},
+                'partial_lines': {'stdout': '', 'stderr': ''},
+                'held_crs': {'stdout': '', 'stderr': ''},
+                'output_filters': output_filters,
+                'unfiltered_output': unfiltered_output}
+
+        if self.cmd_started_callback is not None:
+            self.cmd_started_callback(cmd_index)
+
+    def _supervise(self, deadline):
+        """Runs one iteration of the event loop.
+
+        Terminates commands whose timeouts have passed, reads any output that
+        has arrived, and finishes the commands that have exited. Returns the
+        indices of the workers whose commands finished.
+
+        Arguments:
+            deadline - the time at which the overall timeout occurs
+        """
+        now = time()
+        if now >= deadline and not self._timeout_occurred:
+            # The overall timeout occurred, so terminate the running commands
+            # and don't start any more.
+            self._timeout_occurred = True
+            self._cmds_succeeded = None
+            self._stopped = True
+            for running_cmd in self._running.values():
+                self._terminate(running_cmd)
+
+        wait = self.poll_interval
+        if not self._timeout_occurred:
+            wait = min(wait, deadline - now)
+        for running_cmd in self._running.values():
+            if running_cmd['deadline'] is None:
+                continue
+            if now >= running_cmd['deadline']:
+                # The command exceeded its own timeout, so terminate it (and
+                # only it).
+                running_cmd['deadline'] = None
+                self.timed_out_cmds.add(running_cmd['cmd_index'])
+                self._terminate(running_cmd)
+            else:
+                wait = min(wait, running_cmd['deadline'] - now)
+
+        fds = {}
+        for running_cmd in self._running.values():
+            for fd in running_cmd['streams']:
+                fds[fd] = running_cmd
+        if fds:
+            try:
+                readable_fds = select(list(fds), [], [], max(0, wait))[0]
+            except select_error as e:
+                if e.args[0] != EINTR:
+                    raise
+                readable_fds = []
+        else:
+            sleep(max(0, wait))
+            readable_fds = []
+        for fd in readable_fds:
+            self._read_output(fds[fd], fd)
+
+        finished_workers = []
+        for worker_index, running_cmd in sorted(self._running.items()):
+            if not running_cmd['streams'] and \
+               running_cmd['proc'].poll() is not None:
+                del self._running[worker_index]
+                if self._is_worker_lost(running_cmd):
+                    self._interrupt_cmd(running_cmd)
                 else:
-                    with self._running_process_lock:
-                        # setsid makes the spawned shell the process group
-                        # leader, so that we can kill it and its children from
-                        # the main thread.
-                        proc = Popen(cmd, shell=True, universal_newlines=True,
-                                     stdout=PIPE, stderr=PIPE,
-                                     preexec_fn=setsid)
-                        self._running_process = proc
-
-            # Communicate pulls all stdout/stderr from the PIPEs to avoid
-            # blocking-- don't remove this line! This call blocks until the
-            # command finishes (or is terminated by the main thread).
-            stdout, stderr = proc.communicate()
-            ret_val = proc.returncode
-
-            with self._running_process_lock:
-                self._running_process = None
-
-            cmd_str = 'Command:\n\n%s\n\n' % cmd
-            stdout_str = 'Stdout:\n\n%s\n' % stdout
-            stderr_str = 'Stderr:\n\n%s\n' % stderr
-            self.log_f.write(cmd_str + stdout_str + stderr_str)
-
-            if self.log_individual_cmds:
-                individual_cmd_log_f = TemporaryFile(
-                        prefix='clout_log', suffix='.txt')
-                individual_cmd_log_f.write(cmd_str + stdout_str + stderr_str)
-                self._individual_cmds_status.append(
-                        (individual_cmd_log_f, ret_val))
-
-            with self._timeout_occurred_lock:
-                if ret_val != 0:
-                    self._cmds_succeeded = False
-                if self._timeout_occurred:
-                    self._cmds_succeeded = None
-
-                if self._timeout_occurred or \
-                   (not self._cmds_succeeded and self.stop_on_first_failure):
-                    break
+                    self._finish_cmd(running_cmd)
+                    finished_workers.append(worker_index)
+        return finished_workers
+
+    def _is_worker_lost(self, running_cmd):
+        """Returns True if a command that exited failed because the worker
+        running it was lost.
+        """
+        ret_val = running_cmd['proc'].returncode
+        if self.worker_lost_callback is None or ret_val == 0 or \
+           self._timeout_occurred or \
+           running_cmd['cmd_index'] in self.timed_out_cmds:
+            return False
+        return bool(self.worker_lost_callback(running_cmd['cmd_index'],
+                running_cmd['worker_index'], ret_val,
+                time() - running_cmd['start_time']))
+
+    def _interrupt_cmd(self, running_cmd):
+        """Logs the attempt of a command that was interrupted by a lost
+        worker, and sets the command up to be run again.
+        """
+        cmd_index = running_cmd['cmd_index']
+        worker_index = running_cmd['worker_index']
+        running_cmd['proc'].stdout.close()
+        running_cmd['proc'].stderr.close()
+        running_cmd['interrupted'] = True
+        running_cmd['finish_time'] = time()
+        self._trace_cmd(running_cmd, running_cmd['finish_time'],
+                        interrupted=True)
+        self.log_f.write(self._format_cmd_log(running_cmd) +
+                         'Interrupted: the worker running the command was '
+                         'lost, so the command will be run again.\n\n')
+        self.interrupted_cmds.append(cmd_index)
+        self._interrupted[cmd_index] = running_cmd
+
+        self._lost_workers.add(worker_index)
+        if self.replace_worker_callback is not None:
+            self._start_worker_thread(self.replace_worker_callback,
+                                      worker_index, True)
+
+    def _read_output(self, running_cmd, fd):
+        """Reads the output that is available from one of a command's
+        streams, passing each complete line to output_callback.
+        """
+        stream_name = running_cmd['streams'][fd]
+        raw_data = read(fd, 65536)
+        output = running_cmd['output'][stream_name]
+        output_filters = running_cmd['output_filters']
+
+        # A '\r\n' line ending may be split across two reads, so a trailing
+        # '\r' is held back until the next read (or until the stream closes)
+        # before newlines are translated.
+        data = running_cmd['held_crs'][stream_name] + raw_data
+        running_cmd['held_crs'][stream_name] = ''
+        if raw_data and data.endswith('\r'):
+            running_cmd['held_crs'][stream_name] = '\r'
+            data = data[:-1]
+        data = _translate_newlines(data)
+
+        if output_filters is not None and raw_data:
+            # The filters see the original line endings, so that lines
+            # redrawn with carriage returns can be told apart.
+            output.append(output_filters[stream_name].feed(raw_data))
+        if data:
+            if output_filters is None:
+                output.append(data)
+            elif running_cmd['unfiltered_output'] is not None:
+                running_cmd['unfiltered_output'][stream_name].append(data)
+            if self.output_callback is not None:
+                lines = (running_cmd['partial_lines'][stream_name] +
+                         data).split('\n')
+                running_cmd['partial_lines'][stream_name] = lines.pop()
+                for line in lines:
+                    self.output_callback(running_cmd['cmd_index'],
+                                         stream_name, line + '\n')
+        if not raw_data:
+            # The stream was closed, so pass on the last line even if it
+            # doesn't end in a newline.
+            del running_cmd['streams'][fd]
+            if output_filters is not None:
+                output.append(output_filters[stream_name].close())
+            partial_line = running_cmd['partial_lines'][stream_name]
+            if partial_line and self.output_callback is not None:
+                self.output_callback(running_cmd['cmd_index'], stream_name,
+                                     partial_line)
+
+    def _finish_cmd(self, running_cmd):
+        """Logs the output of a command that exited and records its result."""
+        cmd_index = running_cmd['cmd_index']
+        proc = running_cmd['proc']
+        proc.stdout.close()
+        proc.stderr.close()
+        ret_val = proc.returncode
+        finish_time = time()
+        interrupted = running_cmd.get('interrupted', False)
+        interrupted_msg = ''
+        if interrupted:
+            # The interrupted attempt was logged and traced when it ended.
+            finish_time = running_cmd['finish_time']
+            interrupted_msg = ('Interrupted: the worker running the command '
+                               'was lost, and no worker was left to run it '
+                               'again.\n\n')
+            cmd_log = self._format_cmd_log(running_cmd) + interrupted_msg
+        else:
+            self._trace_cmd(running_cmd, finish_time)
+            cmd_log = self._format_cmd_log(running_cmd)
+            self.log_f.write(cmd_log)
+        duration = finish_time - running_cmd['start_time']
+
+        individual_cmd_log_f = None
+        if self.log_individual_cmds:
+            if self.log_f_factory is None:
+                individual_cmd_log_f = TemporaryFile(prefix='clout_log',
+                                                     suffix='.txt')
+            else:
+                individual_cmd_log_f = self.log_f_factory(cmd_index)
+            individual_cmd_log_f.write(cmd_log)
+            self._individual_cmds_status[cmd_index] = \
+                    (individual_cmd_log_f, ret_val)
+            if running_cmd['unfiltered_output'] is not None:
+                self.unfiltered_log_f_factory(cmd_index).write(
+                        self._format_cmd_log(running_cmd,
+                                             'unfiltered_output') +
+                        interrupted_msg)
+
+        if ret_val != 0:
+            self._cmds_succeeded = False
+        if self._timeout_occurred:
+            self._cmds_succeeded = None
+        if not self._cmds_succeeded and self.stop_on_first_failure:
+            self._stopped = True
+
+        if self.cmd_finished_callback is not None:
+            self.cmd_finished_callback(cmd_index, individual_cmd_log_f,
+                                       ret_val, self._timeout_occurred,
+                                       duration)
+
+    def _format_cmd_log(self, running_cmd, output_key='output'):
+        """Returns the log of a command's output (or of its unfiltered
+        output, if output_key is 'unfiltered_output').
+        """
+        stdout = ''.join(running_cmd[output_key]['stdout'])
+        stderr = ''.join(running_cmd[output_key]['stderr'])
+        cmd_str = 'Command:\n\n%s\n\n' % running_cmd['cmd']
+        stdout_str = 'Stdout:\n\n%s\n' % stdout
+        stderr_str = 'Stderr:\n\n%s\n' % stderr
+        if running_cmd['cmd_index'] in self.timed_out_cmds:
+            stderr_str += ('Terminated: the command exceeded its timeout '
+                           'of %s minute(s).\n\n' %
+                           str(running_cmd['cmd_timeout']))
+        return cmd_str + stdout_str + stderr_str
+
+    def _trace_cmd(self, running_cmd, finish_time, **attributes):
+        """Records a command in the tracer (if there is one)."""
+        if self.tracer is None:
+            return
+        cmd_index = running_cmd['cmd_index']
+        trace_name = running_cmd['cmd']
+        if self.trace_names is not None:
+            trace_name = self.trace_names[cmd_index]
+        self.tracer.add_span(trace_name, running_cmd['start_time'],
+                finish_time, 'worker %d' % running_cmd['worker_index'],
+                'command', cmd=running_cmd['cmd'],
+                ret_val=running_cmd['proc'].returncode,
+                timed_out=cmd_index in self.timed_out_cmds or
+                          self._timeout_occurred, **attributes)
+
+    def _terminate(self, running_cmd):
+        """Terminates a running command (and any processes it started)."""
+        # We must kill the process group because the process was launched
+        # with a shell. This code won't work on Windows.
+        try:
+            killpg(running_cmd['proc'].pid, SIGTERM)
+        except OSError:
+            # The command finished in the meantime.
+            pass
+
+def _translate_newlines(text):
+    """Converts '\\r\\n' and '\\r' line endings in text to '\\n' (as
+    Popen's universal_newlines would).
+    """
+    return text.replace('\r\n', '\n').replace('\r', '\n')
 
 def send_email(host, port, sender, password, recipients, subject, body,
                attachments=None):
@@ -192,6 +642,23 @@ def send_email(host, port, sender, password, recipients, subject, body,
             recipient will see it), and the second element is the file to be
             attached
     """
+    msg = build_email_message(sender, recipients, subject, body, attachments)
+    server = connect_to_smtp_server(host, port, sender, password)
+    server.sendmail(sender, recipients, msg)
+    server.quit()
+
+def build_email_message(sender, recipients, subject, body, attachments=None):
+    """Builds an email message (optionally with attachments).
+
+    Returns the message as a string, ready to be passed to SMTP.sendmail().
+
+    Arguments:
+        sender - same as for send_email()
+        recipients - same as for send_email()
+        subject - same as for send_email()
+        body - same as for send_email()
+        attachments - same as for send_email()
+    """
     msg = MIMEMultipart()
     msg['From'] = sender
     msg['To'] = ', '.join(recipients)
@@ -209,11 +676,48 @@ def send_email(host, port, sender, password, recipients, subject, body,
     part = MIMEText('text', 'plain')
     part.set_payload(body)
     msg.attach(part)
- 
-    server = SMTP(host, port)
+    return msg.as_string()
+
+def connect_to_smtp_server(host, port, sender, password, smtp_class=SMTP):
+    """Returns an authenticated connection to an SMTP server.
+
+    Arguments:
+        host - same as for send_email()
+        port - same as for send_email()
+        sender - same as for send_email()
+        password - same as for send_email()
+        smtp_class - the class used to connect to the server (e.g. to
+            substitute a stand-in server when testing)
+    """
+    server = smtp_class(host, port)
     server.ehlo()
     server.starttls()
-    server.ehlo
+    server.ehlo()
     server.login(sender, password)
-    server.sendmail(sender, recipients, msg.as_string())
-    server.quit()
+    return server
+
+def create_dir(dir_fp):
+    """Creates a directory (and any missing parent directories).
+
+    Does nothing if the directory already exists. Returns dir_fp.
+    """
+    try:
+        makedirs(dir_fp)
+    except OSError as e:
+        if e.errno != EEXIST:
+            raise
+    return dir_fp
+
+def write_file_atomically(fp, data):
+    """Writes data to fp so that readers never see a partially-written file.
+
+    The data is written to a temporary file in the same directory as fp, which
+    is then renamed over fp (renames are atomic on POSIX filesystems).
+    """
+    fd, tmp_fp = mkstemp(prefix='.clout_tmp', dir=dirname(fp) or '.')
+    tmp_f = fdopen(fd, 'w')
+    try:
+        tmp_f.write(data)
+    finally:
+        tmp_f.close()
+    rename(tmp_fp, fp)
@@ -1,15 +1,34 @@
 #!/usr/bin/env python
 """Run all Clout unit test suites by executing this script.
 
+The test files and the checks of Clout's scripts are run in parallel (see
+--workers), and each one is stopped if it runs for longer than --timeout. A
+test file passes if it exits with a return code of zero and its output ends
+with unittest's summary of a successful run ("Ran N tests" with N greater
+than zero, followed by "OK"). A script passes its check if it prints its
+usage text when it is passed -h. Once everything has run, a table of how long
+each file took is printed, slowest first.
+
+This script only uses the standard library (and not the clout package that
+it tests), so that a broken clout package is reported as failing tests
+rather than breaking this script.
+
 This script is adapted from the PyNAST project's tests/all_tests.py:
     http://qiime.org/pynast/
 """
 
-from os import walk
-from subprocess import PIPE, Popen
-from os.path import abspath, dirname, join, split
 from glob import glob
-import re
+from multiprocessing import cpu_count
+from optparse import make_option, OptionParser
+from os import killpg, setsid, walk
+from os.path import abspath, dirname, join, relpath, split
+from Queue import Empty, Queue
+from re import compile, MULTILINE
+from signal import SIGKILL
+from subprocess import Popen, STDOUT
+from tempfile import TemporaryFile
+from threading import Lock, Thread
+from time import sleep, time
 
 __author__ = "Rob Knight"
 __copyright__ = "Copyright 2012-2013, The Clout Project"
@@ -19,17 +38,37 @@ __version__ = "0.9-dev"
 __maintainer__ = "Jai Ram Rideout"
 __email__ = "jai.rideout@gmail.com"
 
+# The number of tests that unittest ran, and its summary of a successful run.
+unittest_ran_pattern = compile(r'^Ran (\d+) tests? in ', MULTILINE)
+unittest_ok_pattern = compile(r'^Ran \d+ tests? in [\d.]+s\s+OK\b',
+                              MULTILINE)
+
+options = [
+    make_option('-j', '--workers', type='int',
+        help='the number of test files and script checks to run at the same '
+        'time [default: %default]', default=cpu_count()),
+    make_option('--timeout', type='float',
+        help='the number of minutes that each test file or script check may '
+        'run for before it is stopped and fails [default: %default]',
+        default=10.0),
+    make_option('-v', '--verbose', action='store_true',
+        help='print the output of every test file and script check, not only '
+        'of those that fail [default: %default]', default=False)
+]
+parser = OptionParser(option_list=options)
+
 def main():
+    opts, args = parser.parse_args()
+    if opts.workers < 1 or opts.timeout <= 0:
+        parser.error("The number of workers and the timeout must be greater "
+                     "than zero.")
+
     clout_dir = abspath(join(dirname(__file__), '..'))
     tests_dir = join(clout_dir, 'tests')
     scripts_dir = join(clout_dir, 'scripts')
-
-    unit_test_good_pattern = re.compile('OK\s*$')
     python_name = 'python'
-    bad_tests = []
 
-    # Run through all of Clout's unit tests, and keep track of any files that
-    # fail unit tests.
+    # Find all of Clout's unit tests.
     unit_test_names = []
     for root, dirs, files in walk(tests_dir):
         for name in files:
@@ -37,37 +76,80 @@ def main():
                 unit_test_names.append(join(root, name))
     unit_test_names.sort()
 
-    for unit_test_name in unit_test_names:
-        print "Testing %s:\n" % unit_test_name
-        command = '%s %s -v' % (python_name, unit_test_name)
-        proc = Popen(command, shell=True, universal_newlines=True, stdout=PIPE,
-                     stderr=PIPE)
-        stdout, stderr =  proc.communicate()
-        print stderr
-
-        if not unit_test_good_pattern.search(stderr):
-            bad_tests.append(unit_test_name)
-
-    # Run through all of Clout's scripts, and pass -h to each one. If the
-    # resulting stdout does not begin with the usage text, that is an indicator
-    # of something being wrong with the script. Issues that would cause that
-    # are bad import statements in the script, SyntaxErrors, or other failures
+    # Find all of Clout's scripts. Each one is passed -h: if the resulting
+    # stdout does not begin with the usage text, that is an indicator of
+    # something being wrong with the script. Issues that would cause that are
+    # bad import statements in the script, SyntaxErrors, or other failures
     # prior to running parse_args().
-    script_names = []
     script_names = glob('%s/*' % scripts_dir)
     script_names.sort()
 
-    bad_scripts = []
-    for script_name in script_names:
-        script_good_pattern = re.compile('^Usage: %s' % split(script_name)[1])
-        print "Testing %s." % script_name
-        command = '%s %s -h' % (python_name, script_name)
-        proc = Popen(command, shell=True, universal_newlines=True, stdout=PIPE,
-                     stderr=PIPE)
-        stdout, stderr =  proc.communicate()
+    checks = [(name, 'test', '%s %s -v' % (python_name, name))
+              for name in unit_test_names]
+    checks += [(name, 'script', '%s %s -h' % (python_name, name))
+               for name in script_names]
+
+    # Each check's result is the status ('pass', 'fail', or 'timeout'), the
+    # number of tests that were run (None for script checks), and the number
+    # of seconds it took.
+    results = {}
+    print_lock = Lock()
+    def check_finished(check_index, output, ret_val, timed_out, duration):
+        name, kind, command = checks[check_index]
+        num_tests = None
+        if kind == 'test':
+            # A test file that ran no tests (e.g. because it doesn't call
+            # unittest.main()) fails.
+            ran = unittest_ran_pattern.search(output)
+            if ran is not None:
+                num_tests = int(ran.group(1))
+            passed = ret_val == 0 and bool(num_tests) and \
+                     unittest_ok_pattern.search(output) is not None
+        else:
+            passed = ret_val == 0 and \
+                     ('Usage: %s' % split(name)[1]) in output
+
+        if timed_out:
+            status = 'timeout'
+        else:
+            status = 'pass' if passed else 'fail'
+        results[check_index] = (status, num_tests, duration)
+
+        if status != 'pass' or opts.verbose:
+            with print_lock:
+                print "Testing %s (%s):\n\n%s" % (name, status, output)
+
+    check_queue = Queue()
+    for check_index in range(len(checks)):
+        check_queue.put(check_index)
+    workers = [Thread(target=run_checks,
+                      args=(check_queue, checks, opts.timeout * 60,
+                            check_finished))
+               for worker_index in range(min(opts.workers, len(checks)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # List how long each check took, slowest first, so that slow test files
+    # stand out.
+    print "Timing (slowest first):\n"
+    print "%9s  %-7s  %5s  %s" % ('Seconds', 'Status', 'Tests', 'File')
+    for check_index in sorted(results, key=lambda check_index:
+                              -results[check_index][2]):
+        status, num_tests, duration = results[check_index]
+        print "%9.2f  %-7s  %5s  %s" % (duration, status,
+                '-' if num_tests is None else num_tests,
+                relpath(checks[check_index][0], clout_dir))
 
-        if not script_good_pattern.search(stdout):
-            bad_scripts.append(script_name)
+    bad_tests = []
+    bad_scripts = []
+    for check_index, (name, kind, command) in enumerate(checks):
+        if check_index not in results or results[check_index][0] != 'pass':
+            if kind == 'test':
+                bad_tests.append(name)
+            else:
+                bad_scripts.append(name)
 
     if bad_tests:
         print "\nFailed the following unit tests.\n%s" % '\n'.join(bad_tests)
@@ -85,6 +167,45 @@ def main():
         return_code = 0
     return return_code
 
+def run_checks(check_queue, checks, timeout, check_finished):
+    """Runs checks from the queue until it is empty (code run in a worker
+    thread).
+
+    Each check's command is run with its output (stdout and stderr) captured
+    in a temporary file, and is killed (along with any processes it started)
+    if it runs for longer than timeout seconds. check_finished is called with
+    the check's index, output, return code, whether it timed out, and the
+    number of seconds it took.
+    """
+    while True:
+        try:
+            check_index = check_queue.get_nowait()
+        except Empty:
+            return
+
+        output_f = TemporaryFile(prefix='clout_all_tests', suffix='.txt')
+        start_time = time()
+        proc = Popen(checks[check_index][2], shell=True, stdout=output_f,
+                     stderr=STDOUT, preexec_fn=setsid)
+        timed_out = False
+        while proc.poll() is None:
+            if time() - start_time > timeout:
+                timed_out = True
+                try:
+                    killpg(proc.pid, SIGKILL)
+                except OSError:
+                    pass
+                proc.wait()
+                break
+            sleep(0.05)
+        duration = time() - start_time
+
+        output_f.seek(0, 0)
+        output = output_f.read()
+        output_f.close()
+        check_finished(check_index, output, proc.returncode, timed_out,
+                       duration)
+
 
 if __name__ == "__main__":
     exit(main())
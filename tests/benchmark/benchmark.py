@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""End-to-end benchmarks of the overhead that Clout adds around test suites.
+
+Each scenario runs Clout's full pipeline (parsing the config file, starting the
+cluster, running every test suite, terminating the cluster, building the
+email, and writing the HTML report) against fake_starcluster, a simulated
+starcluster executable with configurable latency, output volume, output rate,
+and hangs. Only the SMTP connection is skipped. Each scenario runs in its own
+process so that its peak memory and file descriptor use can be measured.
+
+The time that a perfect tool would take is known from the scenario's
+parameters, so Clout's overhead is the measured time minus that. For
+scenarios in which something hangs, the overhead is how late (or early) the
+timeout fired.
+
+Results are written as JSON, and can be compared with the results of a
+previous run (e.g. of the last release):
+
+    python benchmark.py -o results-0.9.json
+    python benchmark.py -o results-dev.json -c results-0.9.json
+"""
+
+from json import dumps, loads
+from optparse import make_option, OptionParser
+from os import listdir
+from os.path import abspath, dirname, join
+from platform import platform, python_version
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from sys import argv, executable, exit, platform as sys_platform
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import sleep, time
+
+fake_starcluster_fp = join(dirname(abspath(__file__)), 'fake_starcluster')
+
+# The defaults for every scenario parameter. Latencies and suite_duration are
+# in seconds; timeouts are in minutes (as for run_test_suites).
+default_scenario = {'num_suites': 1, 'suite_duration': 0,
+                    'boot_latency': 0, 'ssh_latency': 0,
+                    'terminate_latency': 0, 'output_bytes': 1024,
+                    'output_rate': 0, 'hang': [], 'setup_timeout': 10.0,
+                    'test_suites_timeout': 10.0, 'teardown_timeout': 10.0,
+                    'slow': False}
+
+scenarios = [
+    {'name': 'baseline', 'num_suites': 5},
+    {'name': 'many_suites', 'num_suites': 100},
+    {'name': 'cluster_latency', 'num_suites': 10, 'boot_latency': 2.0,
+     'ssh_latency': 0.5, 'terminate_latency': 1.0},
+    {'name': 'verbose_suites', 'num_suites': 10,
+     'output_bytes': 10 * 1024 * 1024},
+    {'name': 'slow_output', 'num_suites': 2, 'output_bytes': 1024 * 1024,
+     'output_rate': 512 * 1024},
+    {'name': 'hung_test_suite', 'num_suites': 3, 'hang': ['sshmaster'],
+     'test_suites_timeout': 0.1},
+    {'name': 'hung_setup', 'num_suites': 3, 'hang': ['start'],
+     'setup_timeout': 0.1},
+    {'name': 'large_log', 'num_suites': 1, 'output_bytes': 500 * 1024 * 1024,
+     'slow': True}
+]
+
+# The metrics that are compared between results files. Lower is better for
+# all of them.
+compared_metrics = ['overhead', 'email_time', 'report_time', 'peak_rss_kb',
+                    'peak_fds']
+
+def get_expected_time(scenario):
+    """Returns the number of seconds that a perfect tool would take.
+
+    This is the time spent by the simulated cluster and test suites, plus the
+    timeout itself if something hangs.
+    """
+    time_taken = scenario['boot_latency'] + scenario['terminate_latency']
+    if 'start' in scenario['hang']:
+        return scenario['setup_timeout'] * 60 + scenario['terminate_latency']
+    if 'sshmaster' in scenario['hang']:
+        return time_taken + scenario['test_suites_timeout'] * 60
+
+    time_per_suite = scenario['ssh_latency'] + scenario['suite_duration']
+    if scenario['output_rate'] > 0:
+        time_per_suite += scenario['output_bytes'] / scenario['output_rate']
+    return time_taken + scenario['num_suites'] * time_per_suite
+
+def run_scenario(scenario, work_dir):
+    """Runs a scenario in a separate process and returns its metrics.
+
+    Arguments:
+        scenario - a dictionary of scenario parameters
+        work_dir - a directory that the scenario's files can be written to
+    """
+    scenario = dict(default_scenario, **scenario)
+    scenario_fp = join(work_dir, 'scenario.json')
+    scenario_f = open(scenario_fp, 'w')
+    try:
+        scenario_f.write(dumps(dict(scenario, work_dir=work_dir)))
+    finally:
+        scenario_f.close()
+
+    proc = Popen([executable, abspath(__file__), '--worker', scenario_fp],
+                 stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("The '%s' scenario failed:\n\n%s" %
+                           (scenario['name'], stderr))
+
+    metrics = loads(stdout)
+    metrics['expected_time'] = get_expected_time(scenario)
+    metrics['overhead'] = metrics['execution_time'] - metrics['expected_time']
+    return metrics
+
+def run_worker(scenario_fp):
+    """Runs Clout's pipeline for a scenario in this process.
+
+    Prints the measured metrics as JSON. Called by run_scenario().
+    """
+    from clout.backend import StarClusterBackend
+    from clout.parse import parse_config_file
+    from clout.report import write_report
+    from clout.run import (_build_backend_commands,
+                           _execute_commands_and_build_email)
+    from clout.util import build_email_message
+
+    scenario = loads(open(scenario_fp, 'U').read())
+    work_dir = scenario['work_dir']
+
+    sc_config_fp = join(work_dir, 'fake_starcluster.json')
+    sc_config_f = open(sc_config_fp, 'w')
+    sc_config_f.write(dumps(dict((key, scenario[key]) for key in
+            ('boot_latency', 'ssh_latency', 'terminate_latency',
+             'output_bytes', 'output_rate', 'hang'))))
+    sc_config_f.close()
+
+    config_fp = join(work_dir, 'test_suites.txt')
+    config_f = open(config_fp, 'w')
+    for i in range(scenario['num_suites']):
+        config_f.write('Suite%d\tsleep %s\n' % (i, scenario['suite_duration']))
+    config_f.close()
+
+    fd_sampler = FileDescriptorSampler()
+    fd_sampler.start()
+    try:
+        start_time = time()
+        test_suites = parse_config_file(open(config_fp, 'U'))
+        backend = StarClusterBackend(sc_config_fp,
+                                     sc_exe_fp=fake_starcluster_fp)
+        setup_cmds, test_suites_cmds, teardown_cmds = \
+                _build_backend_commands(test_suites, backend, 'benchmark')
+        email_body, attachments, run_summary = \
+                _execute_commands_and_build_email(test_suites, setup_cmds,
+                        test_suites_cmds, teardown_cmds,
+                        scenario['setup_timeout'],
+                        scenario['test_suites_timeout'],
+                        scenario['teardown_timeout'], 'benchmark')
+        execution_time = time() - start_time
+
+        start_time = time()
+        write_report(join(work_dir, 'reports'), 'benchmark', run_summary,
+                     attachments)
+        report_time = time() - start_time
+
+        start_time = time()
+        msg = build_email_message('clout@localhost', ['dev@localhost'],
+                                  'Benchmark', email_body, attachments)
+        email_time = time() - start_time
+    finally:
+        fd_sampler.stop()
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on Mac OS X.
+    peak_rss_kb = getrusage(RUSAGE_SELF).ru_maxrss
+    if sys_platform == 'darwin':
+        peak_rss_kb //= 1024
+
+    print dumps({'execution_time': execution_time,
+                 'report_time': report_time, 'email_time': email_time,
+                 'email_size': len(msg), 'peak_rss_kb': peak_rss_kb,
+                 'peak_fds': fd_sampler.peak_fds})
+
+
+class FileDescriptorSampler(object):
+    """Periodically samples the number of file descriptors this process has.
+
+    Only works where /proc/self/fd exists (e.g. Linux); elsewhere, peak_fds
+    is None.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_fds = None
+        self._stopped = Event()
+        self._thread = Thread(target=self._sample)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stopped.is_set():
+            try:
+                num_fds = len(listdir('/proc/self/fd'))
+            except OSError:
+                return
+            self.peak_fds = max(self.peak_fds, num_fds)
+            sleep(self.interval)
+
+
+def compare_results(old_results, new_results):
+    """Returns a table comparing the metrics of two benchmark runs."""
+    lines = ['%-18s%-14s%14s%14s%10s' % ('Scenario', 'Metric', 'Old', 'New',
+                                         'Change')]
+    for name in sorted(new_results['scenarios']):
+        if name not in old_results['scenarios']:
+            continue
+        old_metrics = old_results['scenarios'][name]
+        new_metrics = new_results['scenarios'][name]
+        for metric in compared_metrics:
+            old_val = old_metrics.get(metric)
+            new_val = new_metrics.get(metric)
+            if old_val is None or new_val is None:
+                continue
+            change = '-'
+            if old_val:
+                change = '%+.1f%%' % ((new_val - old_val) / abs(old_val) * 100)
+            lines.append('%-18s%-14s%14.3f%14.3f%10s' % (name, metric, old_val,
+                                                         new_val, change))
+    return '\n'.join(lines)
+
+def format_results(results):
+    """Returns a table of the metrics of a benchmark run."""
+    lines = ['%-18s%13s%11s%10s%11s%10s%10s%9s' % ('Scenario',
+             'Expected (s)', 'Actual (s)', 'Overhead', 'Report (s)',
+             'Email (s)', 'Peak MB', 'Peak fds')]
+    for name in sorted(results['scenarios']):
+        metrics = results['scenarios'][name]
+        lines.append('%-18s%13.3f%11.3f%10.3f%11.3f%10.3f%10.1f%9s' % (name,
+                     metrics['expected_time'], metrics['execution_time'],
+                     metrics['overhead'], metrics['report_time'],
+                     metrics['email_time'], metrics['peak_rss_kb'] / 1024,
+                     metrics['peak_fds']))
+    return '\n'.join(lines)
+
+def get_median(vals):
+    """Returns the median of a list of numbers."""
+    vals = sorted(vals)
+    mid = len(vals) // 2
+    if len(vals) % 2:
+        return vals[mid]
+    return (vals[mid - 1] + vals[mid]) / 2
+
+
+usage = "usage: %prog [options]"
+
+description = """Runs end-to-end benchmarks of Clout against a simulated
+starcluster executable and reports the overhead Clout adds, its peak memory
+and file descriptor use, and how accurately timeouts fire."""
+
+options = [
+    make_option('-o', '--output_fp', type='string',
+        help='the file to write the results to as JSON [default: %default]',
+        default=None),
+    make_option('-c', '--compare_fp', type='string',
+        help='the results of a previous benchmark run (written with -o) to '
+        'compare against [default: %default]', default=None),
+    make_option('-s', '--scenarios', type='string',
+        help='comma-separated names of the scenarios to run [default: all '
+        'scenarios that are not slow]', default=None),
+    make_option('--include_slow', action='store_true',
+        help='also run the slow scenarios (e.g. 500 MB of logs) '
+        '[default: %default]', default=False),
+    make_option('-n', '--repeats', type='int',
+        help='the number of times to run each scenario. Times are the median '
+        'of the repeats, and memory and file descriptor use are the maximum '
+        '[default: %default]', default=1)
+]
+
+def main():
+    if len(argv) == 3 and argv[1] == '--worker':
+        run_worker(argv[2])
+        return
+
+    parser = OptionParser(usage=usage, description=description,
+                          option_list=options)
+    opts, args = parser.parse_args()
+
+    selected_scenarios = [s for s in scenarios
+                          if opts.include_slow or not s.get('slow', False)]
+    if opts.scenarios is not None:
+        names = opts.scenarios.split(',')
+        selected_scenarios = [s for s in scenarios if s['name'] in names]
+        unknown_names = set(names) - set([s['name'] for s in scenarios])
+        if unknown_names:
+            parser.error("Unrecognized scenario(s): %s" %
+                         ', '.join(sorted(unknown_names)))
+
+    from clout import __version__ as clout_version
+    results = {'clout_version': clout_version,
+               'python_version': python_version(), 'platform': platform(),
+               'generated_at': time(), 'repeats': opts.repeats,
+               'scenarios': {}}
+
+    for scenario in selected_scenarios:
+        print "Running the '%s' scenario..." % scenario['name']
+        repeats = []
+        for i in range(opts.repeats):
+            work_dir = mkdtemp(prefix='clout_benchmark_')
+            try:
+                repeats.append(run_scenario(scenario, work_dir))
+            finally:
+                rmtree(work_dir)
+
+        metrics = dict(repeats[0])
+        for metric, combine in (('execution_time', get_median),
+                                ('overhead', get_median),
+                                ('report_time', get_median),
+                                ('email_time', get_median),
+                                ('peak_rss_kb', max), ('peak_fds', max)):
+            metrics[metric] = combine([m[metric] for m in repeats])
+        metrics['params'] = dict(default_scenario, **scenario)
+        results['scenarios'][scenario['name']] = metrics
+
+    print
+    print format_results(results)
+
+    if opts.output_fp is not None:
+        output_f = open(opts.output_fp, 'w')
+        try:
+            output_f.write(dumps(results, indent=2, sort_keys=True))
+        finally:
+            output_f.close()
+
+    if opts.compare_fp is not None:
+        print
+        print compare_results(loads(open(opts.compare_fp, 'U').read()),
+                              results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the artifacts.py module."""
+
+from os import makedirs
+from os.path import exists, join
+from shutil import rmtree
+from StringIO import StringIO
+from subprocess import call
+from tarfile import open as open_tarfile, TarInfo
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.artifacts import (build_collect_artifacts_cmd, extract_artifacts,
+                             parse_artifact_globs)
+
+class ArtifactsTests(TestCase):
+    """Tests for the artifacts.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+
+        # A stand-in for the directory that commands run from on the
+        # cluster, with files left behind by two test suites.
+        self.cluster_dir = join(self.temp_dir, 'cluster')
+        makedirs(join(self.cluster_dir, 'plots'))
+        makedirs(join(self.cluster_dir, '.clout_stage', 'src', 'cov'))
+        for fp, data in (('junit.xml', '<testsuite/>'),
+                         ('plots/a.png', 'png'),
+                         ('.clout_stage/src/cov/coverage.xml', 'cov')):
+            open(join(self.cluster_dir, fp), 'w').write(data)
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def write_archive(self, members):
+        """Writes a gzipped tar archive containing the given (name, data)
+        members and returns its filepath.
+        """
+        archive_fp = join(self.temp_dir, 'artifacts.tar.gz')
+        archive = open_tarfile(archive_fp, 'w:gz')
+        for name, data in members:
+            member = TarInfo(name)
+            member.size = len(data)
+            archive.addfile(member, StringIO(data))
+        archive.close()
+        return archive_fp
+
+    def test_parse_artifact_globs(self):
+        """Test parsing the value of a test suite's 'artifacts' option."""
+        self.assertEqual(parse_artifact_globs('nosetests.xml, htmlcov/ ,'
+                                              'plots/*.[ps][nv]g'),
+                         ['nosetests.xml', 'htmlcov', 'plots/*.[ps][nv]g'])
+        for globs in '', ' , ', '/tmp/foo.xml', '../foo.xml', 'a/../../b', \
+                     'foo bar', '$(rm -rf ~)', '"foo"':
+            self.assertRaises(ValueError, parse_artifact_globs, globs)
+
+    def test_build_collect_artifacts_cmd(self):
+        """Test gathering test suites' artifacts into a single archive."""
+        cmd = build_collect_artifacts_cmd(
+                [('QIIME', '.', ['junit.xml', 'plots', 'missing*.txt']),
+                 ('Py Cogent', '.clout_stage/src', ['cov/*.xml']),
+                 ('PyNAST', 'no_such_dir', ['foo'])])
+        archive_fp = join(self.temp_dir, 'artifacts.tar.gz')
+        archive_f = open(archive_fp, 'wb')
+        ret_val = call(cmd, shell=True, cwd=self.cluster_dir,
+                       stdout=archive_f, stderr=open('/dev/null', 'w'))
+        archive_f.close()
+        self.assertEqual(ret_val, 0)
+
+        out_dir = join(self.temp_dir, 'out')
+        self.assertEqual(extract_artifacts(archive_fp, out_dir),
+                         {'QIIME': [['junit.xml', 12], ['plots/a.png', 3]],
+                          'Py_Cogent': [['cov/coverage.xml', 3]]})
+        self.assertEqual(open(join(out_dir, 'Py_Cogent', 'cov',
+                                   'coverage.xml')).read(), 'cov')
+
+    def test_extract_artifacts(self):
+        """Test that only safe, regular files are extracted."""
+        archive_fp = self.write_archive([('./QIIME/b.xml', 'b'),
+                                         ('QIIME/a.xml', 'aa'),
+                                         ('../evil.txt', 'evil'),
+                                         ('/tmp/evil.txt', 'evil'),
+                                         ('top_level.txt', 'foo')])
+        out_dir = join(self.temp_dir, 'out')
+        self.assertEqual(extract_artifacts(archive_fp, out_dir),
+                         {'QIIME': [['a.xml', 2], ['b.xml', 1]]})
+        self.assertFalse(exists(join(self.temp_dir, 'evil.txt')))
+        self.assertFalse(exists(join(out_dir, 'top_level.txt')))
+
+        # Archives that can't be read are treated as empty.
+        open(archive_fp, 'w').write('foo')
+        self.assertEqual(extract_artifacts(archive_fp, out_dir), {})
+        self.assertEqual(extract_artifacts(join(self.temp_dir, 'foo'),
+                                           out_dir), {})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the autoscale.py module."""
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.autoscale import (get_cluster_cost, get_node_name,
+                             plan_cluster_size, predict_durations,
+                             simulate_schedule)
+from clout.history import RunHistory
+
+class AutoscaleTests(TestCase):
+    """Tests for the autoscale.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.state_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.test_suites = [['QIIME', 'foo'], ['PyCogent', 'bar'],
+                            ['PyNAST', 'baz'], ['biom-format', 'qux']]
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.state_dir)
+
+    def test_predict_durations(self):
+        """Test predicting how long test suites will take."""
+        history = RunHistory(join(self.state_dir, 'history.jsonl'))
+        for run_id, duration in ('run1', 600.0), ('run2', 800.0):
+            history.add_run(run_id, {'cluster_tag': 'nightly_tests',
+                    'test_suites': [
+                    {'label': 'QIIME', 'status': 'pass',
+                     'duration': duration},
+                    {'label': 'PyCogent', 'status': 'fail',
+                     'duration': 30.0}]})
+
+        self.assertEqual(predict_durations(self.test_suites, history,
+                                           'nightly_tests'),
+                         [700.0, None, None, None])
+        self.assertEqual(predict_durations(self.test_suites, history,
+                                           'nightly_tests', 'run2'),
+                         [600.0, None, None, None])
+        self.assertEqual(predict_durations(self.test_suites, history,
+                                           'other_tests'),
+                         [None, None, None, None])
+        self.assertEqual(predict_durations(self.test_suites, None),
+                         [None, None, None, None])
+
+    def test_plan_cluster_size(self):
+        """Test picking the fewest nodes that meet the deadline."""
+        durations = [1800.0, 600.0, 600.0, 600.0]
+        obs = plan_cluster_size(self.test_suites, durations, 60, 10)
+        self.assertEqual(obs, {'num_nodes': 1, 'deadline': 60,
+                               'max_nodes': 10, 'predicted_duration': 3600.0,
+                               'predicted_cost': 1.0, 'meets_deadline': True,
+                               'unknown_suites': []})
+
+        # QIIME runs on the master while the other test suites share a
+        # second node, which is removed after 30 minutes.
+        obs = plan_cluster_size(self.test_suites, durations, 40, 10)
+        self.assertEqual(obs['num_nodes'], 2)
+        self.assertEqual(obs['predicted_duration'], 1800.0)
+        self.assertEqual(obs['predicted_cost'], 1.0)
+
+        # Test suites can't be split up, so the deadline can't be met.
+        obs = plan_cluster_size(self.test_suites, durations, 20, 10)
+        self.assertEqual(obs['num_nodes'], 4)
+        self.assertEqual(obs['max_nodes'], 10)
+        self.assertEqual(obs['predicted_duration'], 1800.0)
+        self.assertEqual(obs['meets_deadline'], False)
+
+        obs = plan_cluster_size(self.test_suites, durations, 20, 3)
+        self.assertEqual(obs['num_nodes'], 3)
+        self.assertEqual(obs['meets_deadline'], False)
+
+    def test_plan_cluster_size_unknown_durations(self):
+        """Test that test suites without history get a node to themselves."""
+        obs = plan_cluster_size(self.test_suites, [None, 600.0, 600.0, 600.0],
+                                30, 10)
+        self.assertEqual(obs['num_nodes'], 2)
+        self.assertEqual(obs['predicted_duration'], 1800.0)
+        self.assertEqual(obs['unknown_suites'], ['QIIME'])
+
+        obs = plan_cluster_size(self.test_suites, [None, 600.0, None, None],
+                                30, 10)
+        self.assertEqual(obs['num_nodes'], 4)
+        self.assertEqual(obs['unknown_suites'],
+                         ['QIIME', 'PyNAST', 'biom-format'])
+
+        obs = plan_cluster_size([], [], 30, 10)
+        self.assertEqual(obs['num_nodes'], 1)
+        self.assertEqual(obs['predicted_cost'], 0.0)
+
+    def test_plan_cluster_size_invalid_input(self):
+        """Test planning with an invalid deadline or size raises an error."""
+        self.assertRaises(ValueError, plan_cluster_size, self.test_suites,
+                          [None] * 4, 0, 10)
+        self.assertRaises(ValueError, plan_cluster_size, self.test_suites,
+                          [None] * 4, 30, 0)
+
+    def test_simulate_schedule(self):
+        """Test predicting when each node runs out of test suites."""
+        self.assertEqual(simulate_schedule([10.0, 5.0, 2.0, 4.0], 2),
+                         [10.0, 11.0])
+        self.assertEqual(simulate_schedule([10.0, 5.0], 3), [10.0, 5.0, 0.0])
+        self.assertEqual(simulate_schedule([], 1), [0.0])
+
+    def test_get_cluster_cost(self):
+        """Test computing the node-hours that a cluster was used for."""
+        self.assertEqual(get_cluster_cost([1800.0, 3600.0, 1800.0]), 2.5)
+        self.assertEqual(get_cluster_cost([3600.0]), 1.0)
+        self.assertEqual(get_cluster_cost([]), 0.0)
+
+    def test_get_node_name(self):
+        """Test naming the nodes of a cluster."""
+        self.assertEqual(get_node_name(0), 'master')
+        self.assertEqual(get_node_name(1), 'node001')
+        self.assertEqual(get_node_name(12), 'node012')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the backend.py module."""
+
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from unittest import main, TestCase
+
+from clout.backend import LocalBackend, StarClusterBackend
+from clout.util import CommandExecutor
+
+class BackendTests(TestCase):
+    """Tests for the backend.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.root_dir = mkdtemp(prefix='clout_temp_dir_')
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.root_dir)
+
+    def test_StarClusterBackend(self):
+        """Test building starcluster commands."""
+        backend = StarClusterBackend('sc_config', 'some_cluster_template',
+                                     'ubuntu', '/usr/local/bin/starcluster')
+        self.assertEqual(backend.build_start_cmd('nightly_tests'),
+                "/usr/local/bin/starcluster -c sc_config start -c "
+                "some_cluster_template nightly_tests")
+        self.assertEqual(backend.build_run_cmd('nightly_tests', 'echo foo'),
+                "/usr/local/bin/starcluster -c sc_config sshmaster -u ubuntu "
+                "nightly_tests 'echo foo'")
+        self.assertEqual(backend.build_terminate_cmd('nightly_tests'),
+                "/usr/local/bin/starcluster -c sc_config terminate -c "
+                "nightly_tests")
+        self.assertEqual(backend.build_start_cmd('nightly_tests', 3),
+                "/usr/local/bin/starcluster -c sc_config start -c "
+                "some_cluster_template -s 3 nightly_tests")
+        self.assertEqual(backend.build_run_cmd('nightly_tests', 'echo foo',
+                                               'master'),
+                "/usr/local/bin/starcluster -c sc_config sshmaster -u ubuntu "
+                "nightly_tests 'echo foo'")
+        self.assertEqual(backend.build_run_cmd('nightly_tests', 'echo foo',
+                                               'node002'),
+                "/usr/local/bin/starcluster -c sc_config sshnode -u ubuntu "
+                "nightly_tests node002 'echo foo'")
+        self.assertEqual(backend.build_remove_node_cmd('nightly_tests',
+                                                       'node002'),
+                "/usr/local/bin/starcluster -c sc_config removenode -c "
+                "nightly_tests node002")
+        self.assertEqual(backend.build_start_cmd('nightly_tests', 3, 0.05),
+                "/usr/local/bin/starcluster -c sc_config start -c "
+                "some_cluster_template -s 3 -b 0.05 nightly_tests")
+        self.assertEqual(backend.build_check_node_cmd('nightly_tests',
+                                                      'node002'),
+                "/usr/local/bin/starcluster -c sc_config sshnode -u ubuntu "
+                "nightly_tests node002 'true'")
+        self.assertEqual(backend.build_add_node_cmd('nightly_tests',
+                                                    'node002'),
+                "/usr/local/bin/starcluster -c sc_config addnode -a node002 "
+                "nightly_tests")
+        self.assertEqual(backend.build_add_node_cmd('nightly_tests',
+                                                    'node002', 0.05),
+                "/usr/local/bin/starcluster -c sc_config addnode -a node002 "
+                "-b 0.05 nightly_tests")
+        self.assertEqual(backend.build_put_cmd('nightly_tests', '/tmp/foo',
+                                               'bar baz'),
+                "/usr/local/bin/starcluster -c sc_config put -u ubuntu "
+                "nightly_tests /tmp/foo 'bar baz'")
+        self.assertEqual(backend.build_get_cmd('nightly_tests', '.foo',
+                                               '/tmp/bar'),
+                "/usr/local/bin/starcluster -c sc_config get -u ubuntu "
+                "nightly_tests .foo /tmp/bar")
+        self.assertEqual(backend.build_sync_cmd('nightly_tests',
+                                                ['/tmp/foo', '/tmp/bar baz'],
+                                                '.stage'),
+                "rsync -az --delete --copy-dirlinks -e '/usr/local/bin/"
+                "starcluster -c sc_config sshmaster -u ubuntu' /tmp/foo "
+                "'/tmp/bar baz' nightly_tests:.stage/")
+
+    def test_StarClusterBackend_cluster_key(self):
+        """Test that only backends booting identical clusters match."""
+        backend1 = StarClusterBackend('sc_config')
+        backend2 = StarClusterBackend('sc_config', user='ubuntu')
+        backend3 = StarClusterBackend('sc_config', 'some_cluster_template')
+        self.assertEqual(backend1.cluster_key(), backend2.cluster_key())
+        self.assertNotEqual(backend1.cluster_key(), backend3.cluster_key())
+
+    def test_LocalBackend(self):
+        """Test starting, using, and terminating a local stand-in cluster."""
+        backend = LocalBackend(self.root_dir)
+        cluster_dir = join(self.root_dir, 'test-cluster-tag')
+
+        log_f = TemporaryFile(prefix='clout_temp_file_', suffix='.txt')
+        cmd_exec = CommandExecutor(
+                [backend.build_start_cmd('test-cluster-tag'),
+                 backend.build_run_cmd('test-cluster-tag',
+                                       "echo 'foo bar' > baz.txt")],
+                log_f, stop_on_first_failure=True)
+        self.assertEqual(cmd_exec(1), (True, []))
+        self.assertEqual(open(join(cluster_dir, 'baz.txt')).read(),
+                         'foo bar\n')
+
+        cmd_exec.cmds = [backend.build_run_cmd('test-cluster-tag', 'exit 3')]
+        cmd_exec.log_individual_cmds = True
+        self.assertEqual(cmd_exec(1)[1][0][1], 3)
+
+        local_dir = join(self.root_dir, 'local')
+        cmd_exec.cmds = [
+                backend.build_get_cmd('test-cluster-tag', 'baz.txt',
+                                      local_dir),
+                backend.build_put_cmd('test-cluster-tag', local_dir, 'qux')]
+        cmd_exec.log_individual_cmds = False
+        self.assertEqual(cmd_exec(1), (True, []))
+        self.assertEqual(open(local_dir).read(), 'foo bar\n')
+        self.assertEqual(open(join(cluster_dir, 'qux')).read(), 'foo bar\n')
+
+        self.assertEqual(backend.build_sync_cmd('test-cluster-tag',
+                                                ['/tmp/foo'], '.stage'),
+                         "rsync -a --delete --copy-dirlinks /tmp/foo %s/"
+                         ".stage/" % cluster_dir)
+
+        # Every node shares the cluster's directory.
+        cmd_exec.cmds = [backend.build_run_cmd('test-cluster-tag',
+                                               'cat baz.txt', 'node001'),
+                         backend.build_remove_node_cmd('test-cluster-tag',
+                                                       'node001')]
+        self.assertEqual(cmd_exec(1), (True, []))
+
+        cmd_exec.cmds = [backend.build_terminate_cmd('test-cluster-tag')]
+        self.assertEqual(cmd_exec(1), (True, []))
+        self.assertFalse(exists(cluster_dir))
+
+    def test_LocalBackend_preempt_node(self):
+        """Test preempting the nodes of a local stand-in cluster."""
+        backend = LocalBackend(self.root_dir)
+        log_f = TemporaryFile(prefix='clout_temp_file_', suffix='.txt')
+        def run(cmd):
+            return CommandExecutor([cmd], log_f,
+                                   log_individual_cmds=True)(1)[1][0][1]
+
+        run(backend.build_start_cmd('tag'))
+        self.assertEqual(run(backend.build_run_cmd('tag', 'exit 3',
+                                                   'node001')), 3)
+        self.assertEqual(run(backend.build_check_node_cmd('tag', 'node001')),
+                         0)
+
+        # A node preempted while a command is running on it is lost.
+        self.assertEqual(run(backend.build_run_cmd('tag', 'touch '
+                '.clout_preempted_$CLOUT_NODE; echo done', 'node001')), 255)
+        self.assertEqual(run(backend.build_run_cmd('tag', 'true',
+                                                   'node001')), 255)
+        self.assertNotEqual(run(backend.build_check_node_cmd('tag',
+                                                             'node001')), 0)
+
+        # The other nodes are unaffected, and the node is back once it is
+        # added again.
+        self.assertEqual(run(backend.build_run_cmd('tag', 'true',
+                                                   'node002')), 0)
+        self.assertEqual(run(backend.build_run_cmd('tag', 'true')), 0)
+        self.assertEqual(run(backend.build_add_node_cmd('tag', 'node001')),
+                         0)
+        self.assertEqual(run(backend.build_run_cmd('tag', 'true',
+                                                   'node001')), 0)
+
+        self.assertEqual(run(backend.build_preempt_node_cmd('tag',
+                                                            'node002')), 0)
+        self.assertNotEqual(run(backend.build_check_node_cmd('tag',
+                                                             'node002')), 0)
+
+
+if __name__ == "__main__":
+    main()
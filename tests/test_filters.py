@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the filters.py module."""
+
+from unittest import main, TestCase
+
+from clout.filters import OutputFilter, parse_output_filters
+
+class FiltersTests(TestCase):
+    """Tests for the filters.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.wget_output = ''.join(['%5dK .......... .......... %3d%% '
+                                    '1.2M 3s\n' % (i * 20, i)
+                                    for i in range(1, 101)])
+        self.tar_output = ''.join(['QIIME/qiime/module%d.py\n' % i
+                                   for i in range(50)] +
+                                  ['QIIME/README\n', 'QIIME/setup.py\n'])
+
+    def filter_output(self, filters, chunks):
+        output_filter = OutputFilter(parse_output_filters(filters))
+        return ''.join([output_filter.feed(chunk) for chunk in chunks] +
+                       [output_filter.close()])
+
+    def test_parse_output_filters(self):
+        """Test parsing a list of output filters."""
+        self.assertEqual(parse_output_filters('none'), None)
+        self.assertEqual(parse_output_filters('progress, repeats'),
+                         {'progress': True, 'repeats': True, 'cap': None})
+        self.assertEqual(parse_output_filters('cap:50'),
+                         {'progress': False, 'repeats': False, 'cap': 50})
+        self.assertEqual(parse_output_filters('cap')['cap'], 200)
+        for filters in 'foo', 'progress,', 'cap:0', 'cap:foo', 'repeats:2':
+            self.assertRaises(ValueError, parse_output_filters, filters)
+
+    def test_OutputFilter_progress(self):
+        """Test resolving lines redrawn with carriage returns."""
+        self.assertEqual(self.filter_output('progress',
+                                            ['Downloading\r 10%\r 5',
+                                             '0%\r', '\n100%\r\nDone\r\n',
+                                             'a\rb']),
+                         ' 50%\n100%\nDone\nb')
+
+        # Without the filter, each carriage return starts a new line.
+        self.assertEqual(self.filter_output('repeats',
+                                            ['a\r\nb\r', '\nc\rd']),
+                         'a\nb\nc\nd')
+
+    def test_OutputFilter_repeats(self):
+        """Test collapsing runs of similar lines."""
+        self.assertEqual(self.filter_output('repeats', [self.wget_output]),
+                         '   20K .......... ..........   1% 1.2M 3s\n'
+                         '[98 similar line(s) omitted]\n'
+                         ' 2000K .......... .......... 100% 1.2M 3s\n')
+        self.assertEqual(self.filter_output('repeats',
+                                            ['ok 1\nok 2\nfoo\nok 3']),
+                         'ok 1\nok 2\nfoo\nok 3')
+
+    def test_OutputFilter_repeats_file_listing(self):
+        """Test collapsing the file listings of tar."""
+        # The output of 'tar zxvf', followed by a second archive's listing.
+        listing = ('QIIME-1.7.0/\nQIIME-1.7.0/ChangeLog.md\n'
+                   'QIIME-1.7.0/scripts/\nQIIME-1.7.0/scripts/pick_otus.py\n'
+                   'QIIME-1.7.0/scripts/align_seqs.py\nQIIME-1.7.0/setup.py\n'
+                   'QIIME-1.7.0/qiime/\nQIIME-1.7.0/qiime/__init__.py\n'
+                   'QIIME-1.7.0/qiime/util.py\n'
+                   'PyCogent-1.5.3/\nPyCogent-1.5.3/setup.py\n'
+                   'PyCogent-1.5.3/cogent/__init__.py\n')
+        self.assertEqual(self.filter_output('repeats', [listing]),
+                         'QIIME-1.7.0/\n[7 similar line(s) omitted]\n'
+                         'QIIME-1.7.0/qiime/util.py\n'
+                         'PyCogent-1.5.3/\n[1 similar line(s) omitted]\n'
+                         'PyCogent-1.5.3/cogent/__init__.py\n')
+
+        # BSD tar prefixes each path with 'x'. Lines that only share their
+        # last word's top-level directory aren't similar.
+        self.assertEqual(self.filter_output('repeats',
+                                            ['x ./q/a.py\nx ./q/b/c.py\n'
+                                             'x ./q/d.py\nSaving to q/e\n'
+                                             'Wrote q/f\n']),
+                         'x ./q/a.py\n[1 similar line(s) omitted]\n'
+                         'x ./q/d.py\nSaving to q/e\nWrote q/f\n')
+
+    def test_OutputFilter_cap(self):
+        """Test capping the number of lines of each step."""
+        output = ('::clout-step unpack\n' + self.tar_output +
+                  '::clout-step test\nok\n')
+        self.assertEqual(self.filter_output('cap:5', [output]),
+                         '::clout-step unpack\nQIIME/qiime/module0.py\n'
+                         'QIIME/qiime/module1.py\nQIIME/qiime/module2.py\n'
+                         '[47 line(s) omitted]\nQIIME/README\n'
+                         'QIIME/setup.py\n::clout-step test\nok\n')
+
+        # Output without any step markers is a single step.
+        self.assertEqual(self.filter_output('cap:1', ['a\nb\nc']),
+                         'a\n[2 line(s) omitted]\n')
+
+        # Failure blocks in the middle of a step are kept, up to their first
+        # blank line.
+        failure = ('=' * 70 + '\nFAIL: test_foo (__main__.FooTests)\n' +
+                   '-' * 70 + '\nTraceback (most recent call last):\n'
+                   '  File "test_foo.py", line 12, in test_foo\n'
+                   '    self.assertEqual(1, 2)\nAssertionError: 1 != 2\n\n')
+        output = ''.join(['test_%d ... ok\n' % i for i in range(20)] +
+                         [failure] +
+                         ['test_%d ... ok\n' % i for i in range(20, 40)])
+        self.assertEqual(self.filter_output('cap:4', [output]),
+                         'test_0 ... ok\ntest_1 ... ok\n'
+                         '[17 line(s) omitted]\ntest_19 ... ok\n' +
+                         failure.rstrip('\n') + '\n'
+                         '[19 line(s) omitted]\n'
+                         'test_38 ... ok\ntest_39 ... ok\n')
+
+        # Each of pytest's 'FAILED' summary lines is kept on its own, and the
+        # lines after them are capped again. Similar failure lines aren't
+        # collapsed.
+        failed = ''.join(['FAILED tests/test_a.py::test_%d - AssertionError\n'
+                          % i for i in range(1, 6)])
+        output = failed + ''.join(['tail a/b/c%d\n' % i for i in range(10)])
+        self.assertEqual(self.filter_output('cap:4', [output]),
+                         failed + 'tail a/b/c0\ntail a/b/c1\n'
+                         '[6 line(s) omitted]\n'
+                         'tail a/b/c8\ntail a/b/c9\n')
+        self.assertEqual(self.filter_output('repeats,cap:4', [output]),
+                         failed + 'tail a/b/c0\n'
+                         '[8 similar line(s) omitted]\ntail a/b/c9\n')
+        self.assertEqual(self.filter_output('repeats', [failed]), failed)
+
+    def test_OutputFilter_combined(self):
+        """Test that the filters shrink noisy output a line at a time."""
+        output = self.wget_output.replace('\n', '\r') + '\n' + \
+                 self.tar_output + self.wget_output
+        chunks = [output[i:i + 7] for i in range(0, len(output), 7)]
+        filtered = self.filter_output('progress,repeats,cap:6', chunks)
+        self.assertEqual(filtered,
+                         ' 2000K .......... .......... 100% 1.2M 3s\n'
+                         'QIIME/qiime/module0.py\n'
+                         '[50 similar line(s) omitted]\n'
+                         '[1 line(s) omitted]\n'
+                         '   20K .......... ..........   1% 1.2M 3s\n'
+                         '[98 similar line(s) omitted]\n'
+                         ' 2000K .......... .......... 100% 1.2M 3s\n')
+        self.assertTrue(len(filtered) * 10 < len(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,23 @@ __email__ = "jai.rideout@gmail.com"
 
 """Test suite for the format.py module."""
 
+from time import localtime, strftime
 from unittest import main, TestCase
 
-from clout.format import format_email_summary
+from clout.format import (format_artifacts_summary,
+                          format_cluster_lease_summary,
+                          format_cluster_plan_summary, format_duration,
+                          format_email_summary,
+                          format_interrupted_attempts_summary,
+                          format_matrix_summary,
+                          format_pool_status, format_preflight_results,
+                          format_profiles_summary,
+                          format_progress_event, format_progress_summary,
+                          format_size, format_snapshot_status,
+                          format_snapshots_summary, format_steps_summary,
+                          format_test_regressions,
+                          format_test_results_summary,
+                          format_test_suite_regressions)
 
 class FormatTests(TestCase):
     """Tests for the format.py module."""
@@ -41,6 +55,290 @@ class FormatTests(TestCase):
         obs = format_email_summary([])
         self.assertEqual(obs, '')
 
+    def test_format_duration(self):
+        """Test formatting durations of various lengths."""
+        self.assertEqual(format_duration(None), '-')
+        self.assertEqual(format_duration(0), '0s')
+        self.assertEqual(format_duration(0.254), '0.25s')
+        self.assertEqual(format_duration(44.6), '45s')
+        self.assertEqual(format_duration(185), '3m 05s')
+        self.assertEqual(format_duration(7269), '2h 01m 09s')
+
+    def test_format_size(self):
+        """Test formatting sizes of various magnitudes."""
+        self.assertEqual(format_size(None), '-')
+        self.assertEqual(format_size(512), '512 B')
+        self.assertEqual(format_size(1536), '1.5 KB')
+        self.assertEqual(format_size(200 * 1024 ** 2), '200.0 MB')
+        self.assertEqual(format_size(3 * 1024 ** 4), '3072.0 GB')
+
+    def test_format_test_results_summary(self):
+        """Test listing the failing and slowest tests of each test suite."""
+        tests = {'counts': {'pass': 2, 'fail': 1, 'error': 1, 'skip': 0},
+                 'failures': [['test_b', 'fail'], ['test_c', 'error']],
+                 'slowest': [['test_a', 65.0], ['test_b', 0.5]],
+                 'durations': {'test_a': 65.0, 'test_b': 0.5}}
+        obs = format_test_results_summary([('QIIME', tests),
+                                           ('PyNAST', None)])
+        self.assertEqual(obs, 'Failing tests:\n\nQIIME (2 of 4 tests):\n'
+                         '    FAIL: test_b\n    ERROR: test_c\n\n'
+                         'Slowest tests:\n\nQIIME:\n'
+                         '    1m 05s      test_a\n'
+                         '    0.50s       test_b\n\n')
+
+        obs = format_test_results_summary([('QIIME', tests)], max_failures=1)
+        self.assertTrue('    FAIL: test_b\n    ... and 1 more\n' in obs)
+
+        self.assertEqual(format_test_results_summary([('PyNAST', None)]), '')
+
+    def test_format_test_regressions(self):
+        """Test listing tests that took much longer than usual."""
+        obs = format_test_regressions([('QIIME', [['test_a', 65.0, 12.0]]),
+                                       ('PyNAST', [])])
+        self.assertEqual(obs, 'Tests that took much longer than usual:\n\n'
+                         'QIIME:\n    test_a: 1m 05s (usually 12s)\n\n')
+        self.assertEqual(format_test_regressions([('PyNAST', [])]), '')
+
+    def test_format_test_suite_regressions(self):
+        """Test listing test suites that took much longer than usual."""
+        obs = format_test_suite_regressions([['QIIME', 3600.0, 1200.0],
+                                             ['PyNAST', 185.0, 60.0]])
+        self.assertEqual(obs, 'Test suites that took much longer than usual:'
+                         '\n\nQIIME: 1h 00m 00s (usually 20m 00s)\n'
+                         'PyNAST: 3m 05s (usually 1m 00s)\n\n')
+        self.assertEqual(format_test_suite_regressions([]), '')
+
+    def test_format_profiles_summary(self):
+        """Test summarizing the profiles of profiled test suites."""
+        resources = {'user_time': 185.0, 'system_time': 2.5,
+                     'max_rss_kb': 204800, 'major_page_faults': 0,
+                     'fs_inputs': 16, 'fs_outputs': None,
+                     'voluntary_context_switches': 10,
+                     'involuntary_context_switches': 5}
+        hotspots = [['foo.py:12(bar)', 1000, 12.5, 20.0],
+                    ['len', 5, 0.25, 0.25]]
+        obs = format_profiles_summary([
+                ('QIIME', {'resources': resources, 'hotspots': hotspots}),
+                ('PyNAST', None),
+                ('PyCogent', {'resources': None, 'hotspots': []})],
+                max_hotspots=1)
+        self.assertEqual(obs, 'Profiles:\n\nQIIME:\n'
+                         '    Peak memory: 200.0 MB, CPU time: 3m 05s user, '
+                         '2.50s system, file system inputs/outputs: 16/-\n'
+                         '    Python hotspots (time in function, total time, '
+                         'calls):\n'
+                         '        13s       20s       1000      '
+                         'foo.py:12(bar)\n'
+                         'PyCogent:\n    Resource usage was not recorded.\n\n')
+        self.assertEqual(format_profiles_summary([('PyNAST', None)]), '')
+
+    def test_format_steps_summary(self):
+        """Test summarizing how long each test suite step took."""
+        steps = [{'name': 'download', 'start': 0.5, 'duration': 65.0},
+                 {'name': 'deploy', 'start': 65.5, 'duration': 3.25},
+                 {'name': 'test', 'start': 68.75, 'duration': 300.0}]
+        obs = format_steps_summary([('QIIME', steps), ('PyNAST', [])],
+                                   max_steps=2)
+        self.assertEqual(obs, 'Steps:\n\nQIIME:\n'
+                         '    1m 05s    download\n'
+                         '    3.25s     deploy\n'
+                         '    ... and 1 more step(s)\n\n')
+        self.assertEqual(format_steps_summary([('PyNAST', [])]), '')
+
+    def test_format_artifacts_summary(self):
+        """Test summarizing the artifacts collected from test suites."""
+        collection = {'size': 1536, 'duration': 3.0}
+        obs = format_artifacts_summary([
+                ('QIIME', [['coverage.xml', 1024], ['plots/a.png', 12],
+                           ['plots/b.png', 12]]),
+                ('PyNAST', None),
+                ('PyCogent', [])], collection, max_artifacts=2)
+        self.assertEqual(obs, 'Artifacts (1.5 KB transferred in 3s):\n\n'
+                         'QIIME: coverage.xml (1.0 KB), plots/a.png (12 B), '
+                         'and 1 more\nPyCogent: none found\n\n')
+        self.assertEqual(format_artifacts_summary([('PyNAST', None)],
+                                                  collection), '')
+
+    def test_format_progress_event(self):
+        """Test formatting progress events."""
+        prefix = '[%s] ' % strftime('%H:%M:%S', localtime(0))
+        self.assertEqual(format_progress_event({'event': 'run_started',
+                'time': 0, 'run_id': 'foo', 'test_suites': ['QIIME',
+                'PyCogent']}),
+                prefix + 'Run foo started (test suites: QIIME, PyCogent)')
+        self.assertEqual(format_progress_event({'event': 'phase_changed',
+                'time': 0, 'phase': 'setup'}), prefix + 'Starting the cluster')
+        self.assertEqual(format_progress_event({'event': 'output', 'time': 0,
+                'label': 'QIIME', 'bytes': 2048, 'lines': 12,
+                'last_line': 'ok'}),
+                prefix + 'QIIME: 2.0 KB of output (12 lines): ok')
+        self.assertEqual(format_progress_event({'event': 'suite_finished',
+                'time': 0, 'label': 'QIIME', 'status': 'timeout',
+                'ret_val': None, 'duration': 65}),
+                prefix + 'QIIME finished: Timeout (1m 05s)')
+        self.assertEqual(format_progress_event({'event': 'suite_interrupted',
+                'time': 0, 'label': 'QIIME', 'node': 'node002',
+                'duration': 30}),
+                prefix + 'QIIME interrupted: node002 was lost after 30s')
+        self.assertEqual(format_progress_event({'event': 'run_finished',
+                'time': 0, 'succeeded': False}), prefix + 'Run stopped early')
+
+    def test_format_progress_summary(self):
+        """Test formatting where a run is."""
+        summary = {'run_id': 'foo', 'pid': 42, 'phase': 'test_suites',
+                   'running': 'PyCogent', 'running_for': 50,
+                   'finished_suites': [['QIIME', 'fail']],
+                   'remaining_suites': ['PyNAST'], 'idle_for': 20,
+                   'run_finished': False}
+        self.assertEqual(format_progress_summary(summary),
+                         'Run foo: running the test suites\n'
+                         'Running: PyCogent (for 50s, last activity 20s '
+                         'ago)\nFinished: QIIME (Fail)\nRemaining: PyNAST\n')
+
+        summary.update({'phase': 'reporting', 'running': None,
+                        'run_finished': True})
+        self.assertEqual(format_progress_summary(summary),
+                         'Run foo: finished\nFinished: QIIME (Fail)\n')
+
+    def test_format_pool_status(self):
+        """Test formatting the clusters in the cluster pool."""
+        status = {'clusters': [{'cluster_tag': 'clout_pool_1',
+                                'state': 'busy', 'num_nodes': 2,
+                                'run_id': 'run1', 'running_for': 600.0},
+                               {'cluster_tag': 'clout_pool_2',
+                                'state': 'idle', 'num_nodes': 1,
+                                'run_id': None, 'running_for': 30.0}],
+                  'waiting': [{'run_id': 'run2', 'num_nodes': 4,
+                               'waiting_for': 90.0}],
+                  'instances': 3}
+        self.assertEqual(format_pool_status(status),
+                         'Clusters: 2 (3 instance(s))\n'
+                         '    clout_pool_1: busy, 2 node(s), up for 10m 00s '
+                         '(run run1)\n'
+                         '    clout_pool_2: idle, 1 node(s), up for 30s\n'
+                         'Waiting runs: 1\n'
+                         '    run2: 4 node(s), waiting for 1m 30s\n')
+
+    def test_format_preflight_results(self):
+        """Test formatting the results of a run's preflight checks."""
+        results = [{'name': 'SMTP login', 'error': None, 'duration': 0.5},
+                   {'name': 'command syntax', 'duration': 0.25,
+                    'error': 'The following command(s) have syntax errors:'
+                             '\nQIIME: syntax error'},
+                   {'name': 'StarCluster config', 'duration': None,
+                    'error': 'The check did not finish within 15 second(s).'}]
+        self.assertEqual(format_preflight_results(results),
+                         'SMTP login: passed (0.50 seconds)\n'
+                         'command syntax: failed (0.25 seconds)\n'
+                         '    The following command(s) have syntax errors:\n'
+                         '    QIIME: syntax error\n'
+                         'StarCluster config: failed (unfinished)\n'
+                         '    The check did not finish within 15 second(s).\n')
+
+    def test_format_cluster_plan_summary(self):
+        """Test formatting how a cluster was sized and what it cost."""
+        cluster_plan = {'num_nodes': 3, 'deadline': 60.0, 'max_nodes': 3,
+                        'predicted_duration': 3000.0, 'predicted_cost': 2.0,
+                        'meets_deadline': True, 'unknown_suites': [],
+                        'actual_duration': 3300.0, 'actual_cost': 2.25,
+                        'removed_nodes': ['node001', 'node002']}
+        exp = ('Cluster size: 3 node(s), to run the test suites within 60.0 '
+               'minute(s)\n    Predicted: 50m 00s, 2.00 node-hours\n'
+               '    Actual: 55m 00s, 2.25 node-hours\n'
+               '    Idle nodes removed early: node001, node002\n\n')
+        self.assertEqual(format_cluster_plan_summary(cluster_plan), exp)
+
+        cluster_plan.update(meets_deadline=False, actual_duration=None,
+                            removed_nodes=[], unknown_suites=['QIIME'])
+        exp = ('Cluster size: 3 node(s), to run the test suites within 60.0 '
+               'minute(s) (not predicted to be possible with up to 3 '
+               'node(s))\n    Predicted: 50m 00s, 2.00 node-hours\n'
+               '    Test suites without any history (assumed to take the '
+               'whole time): QIIME\n\n')
+        self.assertEqual(format_cluster_plan_summary(cluster_plan), exp)
+
+        cluster_plan.update(unknown_suites=[], spot_bid=0.05,
+                            lost_nodes=[{'node': 'node002',
+                                         'replacement': 'on_demand'},
+                                        {'node': 'node001',
+                                         'replacement': None}])
+        self.assertTrue(format_cluster_plan_summary(cluster_plan).endswith(
+                '    Spot instances: bid $0.05 per hour, lost node002 '
+                '(replaced by an on-demand instance), node001 (not '
+                'replaced)\n\n'))
+
+    def test_format_interrupted_attempts_summary(self):
+        """Test formatting the attempts that were interrupted by lost nodes.
+        """
+        obs = format_interrupted_attempts_summary([
+                ('QIIME', [{'node': 'node001', 'duration': 65.0},
+                           {'node': 'node002', 'duration': 3.5}]),
+                ('PyCogent', [])])
+        self.assertEqual(obs, 'The following test suites were interrupted '
+                         'because the node running them was lost, and were '
+                         'run again (their results above are from their last '
+                         'attempt):\n    QIIME: node001 after 1m 05s, '
+                         'node002 after 3.50s\n\n')
+        self.assertEqual(format_interrupted_attempts_summary(
+                [('PyCogent', [])]), '')
+
+    def test_format_snapshots_summary(self):
+        """Test formatting whether each setup was restored from a snapshot.
+        """
+        snapshots = [{'label': 'QIIME (python=2.7)', 'key': '3f2a9c0d1e4b5a6',
+                      'status': 'hit', 'captured': False},
+                     {'label': 'QIIME (python=3.3)', 'key': '8c7b6a5f4e3d2c1',
+                      'status': 'miss', 'captured': True},
+                     {'label': 'QIIME (python=3.4)', 'key': '0a1b2c3d4e5f6a7',
+                      'status': 'miss', 'captured': False}]
+        self.assertEqual(format_snapshots_summary(snapshots),
+                         'Setup snapshots:\n'
+                         '    QIIME (python=2.7): restored from snapshot '
+                         '3f2a9c0d1e4b\n'
+                         '    QIIME (python=3.3): rebuilt (no snapshot), '
+                         'captured snapshot 8c7b6a5f4e3d\n'
+                         '    QIIME (python=3.4): rebuilt (no snapshot), '
+                         'snapshot not captured\n\n')
+        self.assertEqual(format_snapshots_summary([]), '')
+        self.assertEqual(format_snapshot_status(snapshots[0]),
+                         'restored from snapshot 3f2a9c0d1e4b')
+
+    def test_format_cluster_lease_summary(self):
+        """Test formatting which pooled cluster a run used."""
+        cluster_lease = {'cluster_tag': 'clout_pool_2', 'run_id': 'run1',
+                         'num_nodes': 1, 'reused': False, 'queue_wait': 65.0}
+        self.assertEqual(format_cluster_lease_summary(cluster_lease),
+                         'Cluster: clout_pool_2 from the cluster pool '
+                         '(started for this run), after waiting 1m 05s for '
+                         'the pool.\n\n')
+
+        cluster_lease['reused'] = True
+        self.assertEqual(format_cluster_lease_summary(cluster_lease),
+                         'Cluster: clout_pool_2 from the cluster pool (an '
+                         'idle cluster that was reused), after waiting 1m '
+                         '05s for the pool.\n\n')
+
+    def test_format_matrix_summary(self):
+        """Test formatting a matrix test suite's variants as a grid."""
+        matrix = {'label': 'QIIME',
+                  'axes': [['python', ['2.6', '2.7']],
+                           ['deps', ['stable', 'dev']]]}
+        statuses = {'QIIME (python=2.6, deps=stable)': 'pass',
+                    'QIIME (python=2.6, deps=dev)': 'fail',
+                    'QIIME (python=2.7, deps=stable)': 'timeout'}
+        exp = ('QIIME:\n\n'
+               '            deps=stable  deps=dev\n'
+               'python=2.6  Pass         Fail\n'
+               'python=2.7  Timeout      Not run\n\n')
+        self.assertEqual(format_matrix_summary(matrix, statuses), exp)
+
+    def test_format_matrix_summary_single_axis(self):
+        """Test formatting a matrix test suite with a single axis."""
+        matrix = {'label': 'QIIME', 'axes': [['python', ['2.6', '2.7']]]}
+        exp = 'QIIME:\n\npython=2.6  Pass\npython=2.7  Not run\n\n'
+        self.assertEqual(format_matrix_summary(
+                matrix, {'QIIME (python=2.6)': 'pass'}), exp)
+
 
 if __name__ == "__main__":
     main()
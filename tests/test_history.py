@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the history.py module."""
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.history import (find_test_regressions, find_test_suite_regression,
+                           get_adaptive_timeout, get_median, get_percentile,
+                           get_usual_duration, RunHistory)
+
+class HistoryTests(TestCase):
+    """Tests for the history.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.state_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.history_fp = join(self.state_dir, 'history.jsonl')
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.state_dir)
+
+    def build_run_summary(self, duration, cluster_tag='nightly_tests'):
+        """Returns a run summary with a single test suite."""
+        tests = {'counts': {'pass': 1, 'fail': 1, 'error': 0, 'skip': 0},
+                 'failures': [['test_b', 'fail']], 'slowest': [],
+                 'durations': {'test_a': duration, 'test_b': 1.0}}
+        return {'cluster_tag': cluster_tag,
+                'test_suites': [{'label': 'QIIME', 'status': 'fail',
+                                 'ret_val': 1, 'duration': duration + 5,
+                                 'log_name': 'QIIME_results.txt',
+                                 'tests': tests,
+                                 'steps': [{'name': 'test', 'start': 0.5,
+                                            'duration': duration}]},
+                                {'label': 'PyNAST', 'status': 'not_run',
+                                 'ret_val': None, 'duration': None,
+                                 'log_name': None, 'tests': None}]}
+
+    def test_add_run(self):
+        """Test adding runs to the history and retrieving them."""
+        history = RunHistory(self.history_fp)
+        self.assertEqual(history.get_runs(), [])
+
+        history.add_run('run1', self.build_run_summary(1.0))
+        history.add_run('run2', self.build_run_summary(2.0, 'other'))
+        history.add_run('run3', self.build_run_summary(3.0))
+        self.assertEqual([r['run_id'] for r in history.get_runs()],
+                         ['run1', 'run2', 'run3'])
+        self.assertEqual([r['run_id'] for r in
+                          history.get_runs('nightly_tests')],
+                         ['run1', 'run3'])
+        self.assertEqual([r['run_id'] for r in
+                          history.get_runs(exclude_run_id='run2')],
+                         ['run1', 'run3'])
+
+        # Only the durations of passing tests are kept.
+        obs = history.get_test_suite_history('QIIME', 'nightly_tests')
+        self.assertEqual([(e['status'], e['duration'], e['test_durations'])
+                          for e in obs],
+                         [('fail', 6.0, {'test_a': 1.0}),
+                          ('fail', 8.0, {'test_a': 3.0})])
+        self.assertEqual(history.get_test_suite_history('PyNAST')[0]
+                         ['test_durations'], {})
+
+        # Only the names and durations of steps are kept.
+        self.assertEqual(obs[0]['steps'], [{'name': 'test', 'duration': 1.0}])
+        self.assertEqual(history.get_test_suite_history('PyNAST')[0]
+                         ['steps'], [])
+
+    def test_add_run_replace(self):
+        """Test adding a run that is already in the history."""
+        history = RunHistory(self.history_fp)
+        history.add_run('run1', self.build_run_summary(1.0))
+        history.add_run('run2', self.build_run_summary(2.0))
+        history.add_run('run1', self.build_run_summary(5.0))
+        self.assertEqual([(r['run_id'], r['test_suites'][0]['duration'])
+                          for r in history.get_runs()],
+                         [('run2', 7.0), ('run1', 10.0)])
+
+    def test_add_run_max_runs(self):
+        """Test only keeping the most recent runs."""
+        history = RunHistory(self.history_fp, max_runs=2)
+        for i in range(5):
+            history.add_run('run%d' % i, self.build_run_summary(i))
+            self.assertTrue(len(history._read_runs()) <= 4)
+        self.assertEqual([r['run_id'] for r in history.get_runs()],
+                         ['run3', 'run4'])
+
+    def test_truncated_entry(self):
+        """Test ignoring an entry that was only partially written."""
+        history = RunHistory(self.history_fp)
+        history.add_run('run1', self.build_run_summary(1.0))
+        history_f = open(self.history_fp, 'a')
+        history_f.write('{"run_id": "ru')
+        history_f.close()
+        self.assertEqual([r['run_id'] for r in history.get_runs()], ['run1'])
+
+    def test_get_last_success(self):
+        """Test finding when a test suite last passed."""
+        history = RunHistory(self.history_fp)
+        self.assertEqual(history.get_last_success('QIIME'), None)
+
+        for run_id, status, finished_at in (('run1', 'pass', 100.0),
+                                            ('run2', 'pass', None),
+                                            ('run3', 'pass', 300.0),
+                                            ('run4', 'fail', 400.0)):
+            run_summary = self.build_run_summary(1.0)
+            run_summary['test_suites'][0]['status'] = status
+            run_summary['finished_at'] = finished_at
+            history.add_run(run_id, run_summary)
+
+        self.assertEqual(history.get_last_success('QIIME'), 300.0)
+        self.assertEqual(history.get_last_success('QIIME', 'nightly_tests',
+                                                  'run3'), 100.0)
+        self.assertEqual(history.get_last_success('QIIME', 'other'), None)
+        self.assertEqual(history.get_last_success('PyNAST'), None)
+
+    def test_find_test_regressions(self):
+        """Test finding tests that took much longer than usual."""
+        history = [{'test_durations': {'a': 1.0, 'b': 0.1, 'c': 10.0}},
+                   {'test_durations': {'a': 1.2, 'b': 0.1, 'c': 11.0}},
+                   {'test_durations': {'a': 0.8, 'b': 0.2}}]
+        obs = find_test_regressions({'a': 5.0, 'b': 0.5, 'c': 100.0,
+                                     'd': 50.0}, history)
+        # b is more than twice as slow, but only by a fraction of a second. c
+        # and d don't have enough previous durations.
+        self.assertEqual(obs, [['a', 5.0, 1.0]])
+
+        obs = find_test_regressions({'a': 5.0, 'c': 100.0}, history,
+                                    min_samples=2)
+        self.assertEqual(obs, [['c', 100.0, 10.5], ['a', 5.0, 1.0]])
+
+    def test_find_test_suite_regression(self):
+        """Test finding whether a test suite took much longer than usual."""
+        history = [{'status': 'pass', 'duration': 100.0},
+                   {'status': 'fail', 'duration': 1000.0},
+                   {'status': 'pass', 'duration': 120.0},
+                   {'status': 'pass', 'duration': 110.0}]
+        self.assertEqual(find_test_suite_regression(200.0, history), 110.0)
+        self.assertEqual(find_test_suite_regression(150.0, history), None)
+        self.assertEqual(find_test_suite_regression(None, history), None)
+        self.assertEqual(find_test_suite_regression(200.0, history[:2]), None)
+
+        # Fast test suites must also take at least a minute longer.
+        history = [{'status': 'pass', 'duration': 10.0}] * 3
+        self.assertEqual(find_test_suite_regression(60.0, history), None)
+        self.assertEqual(find_test_suite_regression(70.0, history), 10.0)
+
+    def test_get_adaptive_timeout(self):
+        """Test computing a test suite's timeout from its history."""
+        history = [{'status': 'pass', 'duration': 60.0 * minutes}
+                   for minutes in range(10, 30)]
+        history.append({'status': 'fail', 'duration': 6000.0})
+        history.append({'status': 'not_run', 'duration': None})
+
+        # The 95th percentile is 28.05 minutes.
+        self.assertEqual(get_adaptive_timeout(history), 56.1)
+        self.assertEqual(get_adaptive_timeout(history, factor=1.5), 42.1)
+        self.assertEqual(get_adaptive_timeout(history, ceiling=30.0), 30.0)
+        self.assertEqual(get_adaptive_timeout(history, floor=60.0), 60.0)
+
+        # Not enough history.
+        self.assertEqual(get_adaptive_timeout(history[:4]), None)
+        self.assertEqual(get_adaptive_timeout([]), None)
+        self.assertEqual(get_adaptive_timeout(
+                [{'status': 'pass', 'duration': 1.0}] * 5), 5.0)
+
+        # The test suite gets to run without its own timeout after it exceeds
+        # it.
+        history.append({'status': 'timeout', 'duration': 3000.0,
+                        'timeout_exceeded': True})
+        self.assertEqual(get_adaptive_timeout(history), None)
+
+    def test_get_usual_duration(self):
+        """Test finding how long a test suite usually takes."""
+        history = [{'status': 'pass', 'duration': 100.0},
+                   {'status': 'fail', 'duration': 1000.0},
+                   {'status': 'pass', 'duration': 120.0},
+                   {'status': 'timeout', 'duration': None}]
+        self.assertEqual(get_usual_duration(history), 110.0)
+        self.assertEqual(get_usual_duration(history, min_samples=3), None)
+        self.assertEqual(get_usual_duration(history[1:2]), None)
+        self.assertEqual(get_usual_duration([]), None)
+
+    def test_add_run_timeout_exceeded(self):
+        """Test keeping whether a test suite exceeded its own timeout."""
+        history = RunHistory(self.history_fp)
+        run_summary = self.build_run_summary(1.0)
+        run_summary['test_suites'][0]['timeout_exceeded'] = True
+        history.add_run('run1', run_summary)
+        self.assertEqual([e['timeout_exceeded'] for e in
+                          history.get_runs()[0]['test_suites']],
+                         [True, False])
+
+    def test_get_percentile(self):
+        """Test computing percentiles of a list of numbers."""
+        self.assertEqual(get_percentile([5], 95), 5)
+        self.assertEqual(get_percentile([4, 1, 3, 2], 0), 1)
+        self.assertEqual(get_percentile([4, 1, 3, 2], 100), 4)
+        self.assertEqual(get_percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertAlmostEqual(get_percentile(range(1, 21), 95), 19.05)
+
+    def test_get_median(self):
+        """Test computing the median of a list of numbers."""
+        self.assertEqual(get_median([3, 1, 2]), 2)
+        self.assertEqual(get_median([4, 1, 2, 3]), 2.5)
+
+
+if __name__ == "__main__":
+    main()
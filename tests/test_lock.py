@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the lock.py module."""
+
+from json import dumps, loads
+from os import listdir
+from os.path import exists, join
+from shutil import rmtree
+from socket import gethostname
+from subprocess import Popen
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep, time
+from unittest import main, TestCase
+
+from clout.lock import RunLock
+
+class LockTests(TestCase):
+    """Tests for the lock.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.lock_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.lock_fp = join(self.lock_dir, 'nightly_tests.lock')
+
+        # The pid of a process that has exited.
+        proc = Popen(['true'])
+        proc.wait()
+        self.dead_pid = proc.pid
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.lock_dir)
+
+    def build_lock(self, config_hash):
+        return RunLock(self.lock_dir, 'nightly_tests', config_hash,
+                       poll_interval=0.01)
+
+    def acquire_in_thread(self, lock):
+        results = []
+        thread = Thread(target=lambda: results.append(lock.acquire()))
+        thread.start()
+        return thread, results
+
+    def test_acquire_release(self):
+        """Test acquiring and releasing an uncontested lock."""
+        lock = self.build_lock('abc')
+        self.assertTrue(lock.acquire())
+        self.assertTrue(exists(self.lock_fp))
+        lock.release('some result')
+        self.assertFalse(exists(self.lock_fp))
+        self.assertRaises(ValueError, lock.release)
+
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+    def test_coalesce_identical_run(self):
+        """Test attaching to an identical run and receiving its result."""
+        lock1 = self.build_lock('abc')
+        lock2 = self.build_lock('abc')
+        self.assertTrue(lock1.acquire())
+
+        thread, results = self.acquire_in_thread(lock2)
+        sleep(0.1)
+        self.assertEqual(results, [])
+        lock1.release('Test1: Pass\n\n')
+        thread.join()
+        self.assertEqual(results, [False])
+        self.assertEqual(lock2.coalesced_result, 'Test1: Pass\n\n')
+        self.assertFalse(exists(self.lock_fp))
+
+    def test_wait_for_different_run(self):
+        """Test waiting for a differently-configured run with the same tag."""
+        lock1 = self.build_lock('abc')
+        lock2 = self.build_lock('def')
+        self.assertTrue(lock1.acquire())
+
+        thread, results = self.acquire_in_thread(lock2)
+        sleep(0.1)
+        self.assertEqual(results, [])
+        lock1.release('Test1: Pass\n\n')
+        thread.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(loads(open(self.lock_fp).read())['config_hash'],
+                         'def')
+        lock2.release()
+
+    def test_attached_owner_fails(self):
+        """Test taking over when the run we attached to raises an error."""
+        lock1 = self.build_lock('abc')
+        lock2 = self.build_lock('abc')
+        self.assertTrue(lock1.acquire())
+        thread, results = self.acquire_in_thread(lock2)
+        sleep(0.1)
+
+        # The owner releases the lock the way clout.run does when a run
+        # raises an error before its email is sent.
+        try:
+            try:
+                raise RuntimeError("The cluster could not be started.")
+            finally:
+                lock1.release(None, False)
+        except RuntimeError:
+            pass
+        thread.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(lock2.coalesced_result, None)
+        self.assertEqual(loads(open(self.lock_fp).read())['token'],
+                         lock2.token)
+        lock2.release('Test1: Pass\n\n')
+
+    def test_reclaim_stale_lock(self):
+        """Test reclaiming a lock whose owner crashed."""
+        lock_f = open(self.lock_fp, 'w')
+        lock_f.write(dumps({'token': 'old', 'config_hash': 'abc',
+                            'pid': self.dead_pid, 'hostname': gethostname(),
+                            'acquired_at': time()}))
+        lock_f.close()
+
+        # An identical run must not attach to the crashed run.
+        lock = self.build_lock('abc')
+        self.assertTrue(lock.acquire())
+        self.assertNotEqual(loads(open(self.lock_fp).read())['token'], 'old')
+        lock.release()
+        self.assertEqual(listdir(self.lock_dir), ['nightly_tests.result'])
+
+    def test_reclaim_unreadable_lock(self):
+        """Test reclaiming a lock file that was never fully written."""
+        open(self.lock_fp, 'w').close()
+        lock = RunLock(self.lock_dir, 'nightly_tests', 'abc',
+                       poll_interval=0.01, stale_lock_timeout=0.05)
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+    def test_attached_owner_crashes(self):
+        """Test taking over when the run we attached to crashes."""
+        lock_f = open(self.lock_fp, 'w')
+        lock_f.write(dumps({'token': 'old', 'config_hash': 'abc',
+                            'pid': 1, 'hostname': 'some.other.host',
+                            'acquired_at': time()}))
+        lock_f.close()
+
+        lock = self.build_lock('abc')
+        thread, results = self.acquire_in_thread(lock)
+        sleep(0.1)
+        self.assertEqual(results, [])
+
+        # Simulate the other host's run dying without recording a result (an
+        # operator removed its lock).
+        open(self.lock_fp, 'w').close()
+        lock.stale_lock_timeout = 0
+        thread.join()
+        self.assertEqual(results, [True])
+        lock.release()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the logarchive.py module."""
+
+from gzip import GzipFile
+from os import listdir
+from os.path import exists, join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.logarchive import get_error_signatures, get_tokens, LogArchive
+
+class LogArchiveTests(TestCase):
+    """Tests for the logarchive.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.archive_dir = join(self.temp_dir, 'log_archive')
+
+        self.qiime_log = ''.join(['test_%d ... ok\n' % i for i in range(50)])
+        self.qiime_log += ('Traceback (most recent call last):\n'
+                           '  File "foo.py", line 12, in bar\n'
+                           'ValueError: invalid literal for int()\n')
+        self.run_summary = {'test_suites': [
+                {'label': 'QIIME', 'status': 'fail',
+                 'log_name': 'QIIME_results.txt',
+                 'tests': {'failures': [['test_bar (foo.BarTests)',
+                                         'error']]}},
+                {'label': 'PyCogent', 'status': 'pass',
+                 'log_name': 'PyCogent_results.txt', 'tests': None},
+                {'label': 'PyNAST', 'status': 'not_run', 'log_name': None,
+                 'tests': None}]}
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def add_run(self, log_archive, run_id, qiime_log=None):
+        """Archives a run's logs, returning the log files."""
+        logs = [('complete_log.txt', StringIO('Command:\n\necho setting up\n'
+                                              '\nStdout:\n\nsetting up\n')),
+                ('QIIME_results.txt', StringIO(qiime_log or self.qiime_log)),
+                ('PyCogent_results.txt', StringIO('Ran 3 tests\n\nOK\n'))]
+        log_archive.add_run(run_id, self.run_summary, logs)
+        return logs
+
+    def test_add_run(self):
+        """Test archiving a run's logs."""
+        log_archive = LogArchive(self.archive_dir, chunk_size=100)
+        logs = self.add_run(log_archive, '20130115-020001-a')
+        self.assertEqual([log_f.tell() for name, log_f in logs], [0, 0, 0])
+
+        obs = log_archive.get_logs()
+        self.assertEqual([(log['run_id'], log['name'], log['label'],
+                           log['status']) for log in obs],
+                         [('20130115-020001-a', 'complete_log.txt', None,
+                           None),
+                          ('20130115-020001-a', 'QIIME_results.txt', 'QIIME',
+                           'fail'),
+                          ('20130115-020001-a', 'PyCogent_results.txt',
+                           'PyCogent', 'pass')])
+        self.assertEqual(obs[1]['signatures'],
+                         ['ValueError', 'test_bar (foo.BarTests)'])
+        self.assertEqual(obs[1]['size'], len(self.qiime_log))
+        self.assertTrue(len(obs[1]['chunks']) > 1)
+
+        # The compressed log is a valid gzip file.
+        self.assertEqual(GzipFile(join(self.archive_dir,
+                                       obs[1]['fp'])).read(), self.qiime_log)
+
+    def test_add_run_replaced(self):
+        """Test that archiving a run again replaces its logs."""
+        log_archive = LogArchive(self.archive_dir)
+        self.add_run(log_archive, '20130115-020001-a')
+        self.add_run(log_archive, '20130115-020001-a', 'resumed\n')
+
+        self.assertEqual(len(log_archive.get_logs()), 3)
+        self.assertEqual(log_archive.search('ValueError'), [])
+        self.assertEqual([m['name'] for m in log_archive.search('resumed')],
+                         ['QIIME_results.txt'])
+
+    def test_add_run_retention(self):
+        """Test that old runs are removed and the index is compacted."""
+        log_archive = LogArchive(self.archive_dir, max_runs=2)
+        for run_id in 'a', 'b', 'c', 'd', 'e':
+            self.add_run(log_archive, run_id, 'run %s\n' % run_id)
+
+        self.assertEqual(sorted(set([log['run_id'] for log in
+                                     log_archive.get_logs()])), ['d', 'e'])
+        self.assertEqual(sorted(listdir(join(self.archive_dir, 'logs'))),
+                         ['d', 'e'])
+        self.assertEqual([m['run_id'] for m in log_archive.search('run')],
+                         ['d', 'e'])
+
+        # Once more logs had been removed than were left, they were
+        # compacted out of the list of logs and the index.
+        logs_f = open(join(self.archive_dir, 'logs.jsonl'), 'U')
+        self.assertEqual(len(logs_f.readlines()), 6)
+        logs_f.close()
+        for bucket_fn in listdir(join(self.archive_dir, 'index')):
+            bucket_f = open(join(self.archive_dir, 'index', bucket_fn), 'U')
+            self.assertTrue(len(bucket_f.readlines()) <= 6)
+            bucket_f.close()
+
+        # The most recent run is always kept.
+        log_archive = LogArchive(self.archive_dir, max_size=0)
+        self.add_run(log_archive, 'f')
+        self.assertEqual(set([log['run_id'] for log in
+                              log_archive.get_logs()]), set(['f']))
+
+    def test_search(self):
+        """Test searching the archived logs."""
+        log_archive = LogArchive(self.archive_dir, chunk_size=100)
+        self.assertEqual(log_archive.search('ValueError'), [])
+
+        self.add_run(log_archive, '20130115-020001-a', 'all ok\n')
+        self.add_run(log_archive, '20130116-020001-b')
+        self.add_run(log_archive, '20130117-020001-c')
+
+        obs = log_archive.search('valueerror: INVALID literal')
+        self.assertEqual([(m['run_id'], m['label']) for m in obs],
+                         [('20130116-020001-b', 'QIIME'),
+                          ('20130117-020001-c', 'QIIME')])
+        self.assertEqual(obs[0]['lines'],
+                         ['ValueError: invalid literal for int()'])
+        self.assertEqual(obs[0]['num_lines'], 1)
+
+        # Whole words must match at the ends of the pattern.
+        self.assertEqual(log_archive.search('ValueErr'), [])
+        self.assertEqual(len(log_archive.search('lueError')), 0)
+        self.assertEqual(len(log_archive.search('"foo.py", line')), 2)
+
+        obs = log_archive.search('ok', label='QIIME', max_lines=2)
+        self.assertEqual([(m['run_id'], m['label'], m['num_lines'])
+                          for m in obs],
+                         [('20130115-020001-a', 'QIIME', 1),
+                          ('20130116-020001-b', 'QIIME', 50),
+                          ('20130117-020001-c', 'QIIME', 50)])
+        self.assertEqual(obs[1]['lines'], ['test_0 ... ok', 'test_1 ... ok'])
+
+        obs = log_archive.search('setting up', label='QIIME')
+        self.assertEqual(obs, [])
+        self.assertEqual(len(log_archive.search('setting up')), 3)
+
+    def test_search_signatures(self):
+        """Test searching the archived logs' error signatures."""
+        log_archive = LogArchive(self.archive_dir)
+        self.add_run(log_archive, '20130115-020001-a')
+        obs = log_archive.search('test_bar', signatures_only=True)
+        self.assertEqual([(m['label'], m['lines']) for m in obs],
+                         [('QIIME', ['test_bar (foo.BarTests)'])])
+        self.assertEqual(log_archive.search('invalid literal',
+                                            signatures_only=True), [])
+
+    def test_search_partial_index(self):
+        """Test that postings of logs that were never archived are ignored."""
+        log_archive = LogArchive(self.archive_dir)
+        self.add_run(log_archive, '20130115-020001-a')
+
+        # Simulate a crash after the postings were written but before the
+        # log's entry was.
+        logs_fp = join(self.archive_dir, 'logs.jsonl')
+        lines = open(logs_fp, 'U').readlines()
+        open(logs_fp, 'w').write(''.join(lines[:2]) + lines[2][:10])
+        self.assertEqual(log_archive.search('Ran 3 tests'), [])
+        self.assertEqual(len(log_archive.search('ValueError')), 1)
+
+        self.add_run(log_archive, '20130116-020001-b')
+        self.assertEqual([m['run_id'] for m in
+                          log_archive.search('Ran 3 tests')],
+                         ['20130116-020001-b'])
+        self.assertTrue(exists(join(self.archive_dir, 'logs',
+                                    '20130116-020001-b')))
+
+    def test_get_tokens(self):
+        """Test finding the indexed words in text."""
+        self.assertEqual(get_tokens('ValueError: bad 0x7f3a in foo.bar_baz '
+                                    'at 12:30 x' + 'y' * 64),
+                         set(['valueerror', 'bad', 'foo', 'bar_baz']))
+
+    def test_get_error_signatures(self):
+        """Test finding the exceptions that tracebacks end with."""
+        self.assertEqual(get_error_signatures([
+                'Traceback (most recent call last):\n',
+                '  File "foo.py", line 1, in <module>\n',
+                'qiime.util.MissingFileError: foo.txt\n',
+                'AssertionError\n',
+                'This is not an Error: really\n',
+                'KeyboardInterrupt\n',
+                'AssertionError\n']),
+                ['qiime.util.MissingFileError', 'AssertionError',
+                 'KeyboardInterrupt'])
+
+
+if __name__ == "__main__":
+    main()
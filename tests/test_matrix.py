@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the matrix.py module."""
+
+from unittest import main, TestCase
+
+from clout.matrix import (expand_matrices, get_axis_combinations,
+                          get_variant_label, parse_matrix, parse_matrix_setup,
+                          substitute_values)
+
+class MatrixTests(TestCase):
+    """Tests for the matrix.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.axes = [['python', ['2.6', '2.7']], ['deps', ['stable', 'dev']]]
+        self.test_suites = [['PyCogent', 'cd $HOME; ./run_tests'],
+                            ['QIIME', 'python{python} tests/all_tests.py '
+                                      '--deps {deps}']]
+        self.suite_options = {'QIIME': {
+                'matrix': 'python:2.6,2.7;deps:stable,dev',
+                'setup': 'python:virtualenv -p python{python} env{python}',
+                'workers': '2', 'results': 'results_{python}.xml',
+                'timeout': '30'}}
+
+    def test_parse_matrix(self):
+        """Test parsing a matrix's axes."""
+        self.assertEqual(parse_matrix('python:2.6,2.7;deps:stable,dev'),
+                         self.axes)
+        self.assertEqual(parse_matrix(' python : 2.6 , 2.7 ;'),
+                         [['python', ['2.6', '2.7']]])
+
+    def test_parse_matrix_invalid(self):
+        """Test parsing an invalid matrix raises an error."""
+        self.assertRaises(ValueError, parse_matrix, '')
+        self.assertRaises(ValueError, parse_matrix, 'python')
+        self.assertRaises(ValueError, parse_matrix, '2py:2.6')
+        self.assertRaises(ValueError, parse_matrix, 'python:')
+        self.assertRaises(ValueError, parse_matrix, 'python:2.6,2.6')
+        self.assertRaises(ValueError, parse_matrix, 'python:2.6;python:2.7')
+
+    def test_parse_matrix_setup(self):
+        """Test parsing a matrix's setup command."""
+        self.assertEqual(parse_matrix_setup('python, deps:make {deps}',
+                                            self.axes),
+                         (['python', 'deps'], 'make {deps}'))
+        self.assertEqual(parse_matrix_setup('python:echo a:b', self.axes),
+                         (['python'], 'echo a:b'))
+
+        self.assertRaises(ValueError, parse_matrix_setup, 'make', self.axes)
+        self.assertRaises(ValueError, parse_matrix_setup, 'os:make',
+                          self.axes)
+        self.assertRaises(ValueError, parse_matrix_setup, ':make', self.axes)
+        self.assertRaises(ValueError, parse_matrix_setup, 'python: ',
+                          self.axes)
+
+    def test_get_variant_label(self):
+        """Test building a variant's label."""
+        self.assertEqual(get_variant_label('QIIME', [['python', '2.6'],
+                                                     ['deps', 'dev']]),
+                         'QIIME (python=2.6, deps=dev)')
+
+    def test_substitute_values(self):
+        """Test substituting a variant's values into text."""
+        self.assertEqual(substitute_values('python{python} ${HOME}/{deps} '
+                                           '{os}', [['python', '2.7'],
+                                                    ['deps', 'dev']]),
+                         'python2.7 ${HOME}/dev {os}')
+
+    def test_expand_matrices(self):
+        """Test expanding matrix test suites into their variants."""
+        obs_test_suites, obs_options, obs_matrices = expand_matrices(
+                self.test_suites, self.suite_options)
+
+        self.assertEqual(obs_test_suites, [
+                ['PyCogent', 'cd $HOME; ./run_tests'],
+                ['QIIME (python=2.6, deps=stable)',
+                 'python2.6 tests/all_tests.py --deps stable'],
+                ['QIIME (python=2.6, deps=dev)',
+                 'python2.6 tests/all_tests.py --deps dev'],
+                ['QIIME (python=2.7, deps=stable)',
+                 'python2.7 tests/all_tests.py --deps stable'],
+                ['QIIME (python=2.7, deps=dev)',
+                 'python2.7 tests/all_tests.py --deps dev']])
+        self.assertEqual(obs_options['PyCogent'], {})
+        self.assertEqual(obs_options['QIIME (python=2.7, deps=dev)'],
+                         {'results': 'results_2.7.xml', 'timeout': '30'})
+
+        self.assertEqual(len(obs_matrices), 1)
+        matrix = obs_matrices[0]
+        self.assertEqual(matrix['label'], 'QIIME')
+        self.assertEqual(matrix['axes'], self.axes)
+        self.assertEqual(matrix['workers'], 2)
+        self.assertEqual(matrix['variants'][1],
+                         ['QIIME (python=2.6, deps=dev)',
+                          [['python', '2.6'], ['deps', 'dev']]])
+        self.assertEqual(matrix['setup'],
+                         [['virtualenv -p python2.6 env2.6',
+                           [['python', '2.6']]],
+                          ['virtualenv -p python2.7 env2.7',
+                           [['python', '2.7']]]])
+        self.assertEqual(matrix['snapshot'], None)
+
+        # A snapshotted setup keeps its snapshot options for each setup to
+        # substitute its own values into.
+        self.suite_options['QIIME'].update(snapshot='env{python}',
+                                           snapshot_inputs='reqs{python}.txt')
+        obs_test_suites, obs_options, obs_matrices = expand_matrices(
+                self.test_suites, self.suite_options)
+        self.assertEqual(obs_matrices[0]['snapshot'],
+                         {'dirs': 'env{python}', 'inputs': 'reqs{python}.txt'})
+        self.assertFalse('snapshot' in
+                         obs_options['QIIME (python=2.7, deps=dev)'])
+
+    def test_expand_matrices_no_matrix(self):
+        """Test expanding test suites without any matrices."""
+        obs = expand_matrices(self.test_suites, {})
+        self.assertEqual(obs, (self.test_suites,
+                               {'PyCogent': {}, 'QIIME': {}}, []))
+
+    def test_expand_matrices_invalid(self):
+        """Test expanding invalid matrix test suites raises an error."""
+        self.assertRaises(ValueError, expand_matrices, self.test_suites,
+                          {'PyCogent': {'workers': '2'}})
+        self.assertRaises(ValueError, expand_matrices, self.test_suites,
+                          {'QIIME': {'matrix': 'python:2.7',
+                                     'workers': '0'}})
+        self.assertRaises(ValueError, expand_matrices, self.test_suites,
+                          {'QIIME': {'matrix': 'python:2.7',
+                                     'workers': 'many'}})
+        self.assertRaises(ValueError, expand_matrices, self.test_suites,
+                          {'QIIME': {'matrix': 'python:2.7',
+                                     'snapshot': 'env'}})
+        self.assertRaises(ValueError, expand_matrices, self.test_suites,
+                          {'QIIME': {'matrix': 'python:2.7',
+                                     'setup': 'python:make',
+                                     'snapshot_inputs': 'reqs.txt'}})
+        self.assertRaises(ValueError, expand_matrices, self.test_suites,
+                          {'PyCogent': {'snapshot': 'env'}})
+
+        # A variant's label can't clash with another test suite's label.
+        test_suites = self.test_suites + [['QIIME (python=2.7)', 'echo']]
+        self.assertRaises(ValueError, expand_matrices, test_suites,
+                          {'QIIME': {'matrix': 'python:2.7'}})
+
+    def test_get_axis_combinations(self):
+        """Test getting every combination of the axes' values."""
+        self.assertEqual(get_axis_combinations(self.axes),
+                         [[['python', '2.6'], ['deps', 'stable']],
+                          [['python', '2.6'], ['deps', 'dev']],
+                          [['python', '2.7'], ['deps', 'stable']],
+                          [['python', '2.7'], ['deps', 'dev']]])
+        self.assertEqual(get_axis_combinations([['os', ['linux']]]),
+                         [[['os', 'linux']]])
+        self.assertEqual(get_axis_combinations([]), [])
+
+
+if __name__ == "__main__":
+    main()
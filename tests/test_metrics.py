@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the metrics.py module."""
+
+from os.path import join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.metrics import (build_run_metrics, estimate_run_cost,
+                           format_metrics, get_log_sizes, get_metrics_fp,
+                           RunMetrics, write_metrics)
+
+class MetricsTests(TestCase):
+    """Tests for the metrics.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.metrics_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.metrics_fp = join(self.metrics_dir, 'clout_nightly.prom')
+
+        self.run_summary = {
+                'cluster_tag': 'nightly', 'started_at': 1000.0,
+                'finished_at': 4600.0,
+                'setup': {'succeeded': True, 'duration': 120.5},
+                'teardown': {'succeeded': True, 'duration': 30.0},
+                'test_suites': [
+                    {'label': 'QIIME', 'status': 'pass', 'duration': 600.0,
+                     'log_name': 'QIIME_results.txt',
+                     'timeout_exceeded': False,
+                     'interrupted_attempts': [{'node': 'node001',
+                                               'duration': 30.0}]},
+                    {'label': 'PyCogent', 'status': 'timeout',
+                     'duration': 900.0, 'log_name': 'PyCogent_results.txt',
+                     'timeout_exceeded': True},
+                    {'label': 'PyNAST', 'status': 'not_run',
+                     'duration': None, 'log_name': None}]}
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.metrics_dir)
+
+    def get_samples(self, metrics, name):
+        return [(dict(labels), value) for labels, value in metrics[name]]
+
+    def test_get_metrics_fp(self):
+        """Test naming the metrics file of a cluster tag."""
+        self.assertEqual(get_metrics_fp('/foo', 'nightly_tests'),
+                         '/foo/clout_nightly_tests.prom')
+        self.assertEqual(get_metrics_fp('/foo', 'my tests/1.0'),
+                         '/foo/clout_my_tests_1.0.prom')
+
+    def test_build_run_metrics(self):
+        """Test building the metrics of a finished run."""
+        metrics = build_run_metrics(self.run_summary,
+                {'complete_log.txt': 2048, 'QIIME_results.txt': 512},
+                {'PyCogent': 500.0, 'QIIME': 200.0}, 1.5, 2)
+
+        run_labels = {'cluster_tag': 'nightly'}
+        self.assertEqual(self.get_samples(metrics, 'clout_run_in_progress'),
+                         [(run_labels, 0)])
+        self.assertEqual(self.get_samples(metrics, 'clout_run_succeeded'),
+                         [(run_labels, 0)])
+        self.assertEqual(self.get_samples(metrics,
+                                          'clout_run_duration_seconds'),
+                         [(run_labels, 3600.0)])
+        self.assertEqual(self.get_samples(metrics, 'clout_run_resumes'),
+                         [(run_labels, 2)])
+        self.assertEqual(self.get_samples(metrics, 'clout_run_log_bytes'),
+                         [(run_labels, 2048)])
+        self.assertEqual(self.get_samples(metrics,
+                                          'clout_run_cost_node_hours'),
+                         [(run_labels, 1.5)])
+        self.assertEqual([(labels['phase'], value) for labels, value in
+                          self.get_samples(metrics,
+                                           'clout_phase_duration_seconds')],
+                         [('setup', 120.5), ('teardown', 30.0)])
+
+        # Only the test suite's current status is 1.
+        self.assertEqual([(labels['suite'], labels['status']) for
+                          labels, value in self.get_samples(metrics,
+                          'clout_test_suite_status') if value == 1],
+                         [('QIIME', 'pass'), ('PyCogent', 'timeout'),
+                          ('PyNAST', 'not_run')])
+        self.assertEqual(len(metrics['clout_test_suite_status']), 12)
+
+        # Unknown durations and log sizes are left out.
+        self.assertEqual([(labels['suite'], value) for labels, value in
+                          self.get_samples(metrics,
+                          'clout_test_suite_duration_seconds')],
+                         [('QIIME', 600.0), ('PyCogent', 900.0)])
+        self.assertEqual([(labels['suite'], value) for labels, value in
+                          self.get_samples(metrics,
+                          'clout_test_suite_timeout_exceeded')],
+                         [('QIIME', 0), ('PyCogent', 1), ('PyNAST', 0)])
+        self.assertEqual([(labels['suite'], value) for labels, value in
+                          self.get_samples(metrics,
+                          'clout_test_suite_interrupted_attempts')],
+                         [('QIIME', 1), ('PyCogent', 0), ('PyNAST', 0)])
+        self.assertEqual([(labels['suite'], value) for labels, value in
+                          self.get_samples(metrics,
+                          'clout_test_suite_log_bytes')],
+                         [('QIIME', 512)])
+
+        # A test suite that passed in this run last passed when the run
+        # finished.
+        self.assertEqual([(labels['suite'], value) for labels, value in
+                          self.get_samples(metrics,
+                          'clout_test_suite_last_success_timestamp_seconds')],
+                         [('QIIME', 4600.0), ('PyCogent', 500.0)])
+
+    def test_build_run_metrics_in_progress(self):
+        """Test building the metrics of a run that is still executing."""
+        self.run_summary['finished_at'] = None
+        del self.run_summary['teardown']
+        metrics = build_run_metrics(self.run_summary, in_progress=True,
+                                    now=1600.0)
+        self.assertEqual(metrics['clout_run_in_progress'][0][1], 1)
+        self.assertEqual(metrics['clout_run_succeeded'], [])
+        self.assertEqual(metrics['clout_run_duration_seconds'][0][1], 600.0)
+        self.assertEqual(len(metrics['clout_phase_duration_seconds']), 1)
+        self.assertEqual([value for labels, value in metrics[
+                          'clout_test_suite_last_success_timestamp_seconds']],
+                         [1600.0])
+
+    def test_estimate_run_cost(self):
+        """Test estimating the cost of a run's cluster."""
+        self.assertEqual(estimate_run_cost(self.run_summary), 1.0)
+        self.assertEqual(estimate_run_cost(self.run_summary, 3), 3.0)
+
+        self.run_summary['cluster_plan'] = {'actual_cost': 2.5}
+        self.assertEqual(estimate_run_cost(self.run_summary, 3), 2.5)
+
+        self.run_summary['cluster_plan'] = {'actual_cost': None}
+        self.run_summary['finished_at'] = None
+        self.assertEqual(estimate_run_cost(self.run_summary), None)
+
+    def test_format_metrics(self):
+        """Test formatting metrics in Prometheus' text format."""
+        metrics = build_run_metrics({'cluster_tag': 'a "b"\\c\nd',
+                                     'started_at': 1000.0,
+                                     'finished_at': 1012.5,
+                                     'test_suites': []})
+        self.assertEqual(format_metrics(metrics),
+                '# HELP clout_run_in_progress Whether the run is still '
+                'executing.\n'
+                '# TYPE clout_run_in_progress gauge\n'
+                'clout_run_in_progress{cluster_tag="a \\"b\\"\\\\c\\nd"} 0\n'
+                '# HELP clout_run_succeeded Whether every phase and test '
+                'suite of the run passed.\n'
+                '# TYPE clout_run_succeeded gauge\n'
+                'clout_run_succeeded{cluster_tag="a \\"b\\"\\\\c\\nd"} 1\n'
+                '# HELP clout_run_start_timestamp_seconds When the run '
+                'started, in seconds since the epoch.\n'
+                '# TYPE clout_run_start_timestamp_seconds gauge\n'
+                'clout_run_start_timestamp_seconds{cluster_tag='
+                '"a \\"b\\"\\\\c\\nd"} 1000.0\n'
+                '# HELP clout_run_duration_seconds How long the run took (so '
+                'far, if it is still executing).\n'
+                '# TYPE clout_run_duration_seconds gauge\n'
+                'clout_run_duration_seconds{cluster_tag="a \\"b\\"\\\\c\\nd"} '
+                '12.5\n'
+                '# HELP clout_run_resumes How many times the run was resumed '
+                'after being interrupted.\n'
+                '# TYPE clout_run_resumes gauge\n'
+                'clout_run_resumes{cluster_tag="a \\"b\\"\\\\c\\nd"} 0\n')
+
+    def test_get_log_sizes(self):
+        """Test measuring the size of each log."""
+        log_f = StringIO('foo\nbar\n')
+        log_f.read()
+        self.assertEqual(get_log_sizes([('complete_log.txt', log_f),
+                                        ('QIIME_results.txt', StringIO())]),
+                         {'complete_log.txt': 8, 'QIIME_results.txt': 0})
+        self.assertEqual(log_f.tell(), 0)
+
+    def test_write_metrics(self):
+        """Test writing metrics to a textfile."""
+        metrics = build_run_metrics(self.run_summary)
+        write_metrics(self.metrics_fp, metrics)
+        metrics_f = open(self.metrics_fp, 'U')
+        self.assertEqual(metrics_f.read(), format_metrics(metrics))
+        metrics_f.close()
+
+    def test_RunMetrics(self):
+        """Test updating the metrics file as a run progresses."""
+        run_metrics = RunMetrics(self.metrics_fp, 'nightly',
+                                 {'PyCogent': 500.0})
+        for event in [
+                {'event': 'run_started', 'time': 100.0, 'run_id': 'foo'},
+                {'event': 'phase_changed', 'time': 101.0, 'phase': 'setup'},
+                {'event': 'phase_changed', 'time': 160.0,
+                 'phase': 'test_suites'},
+                {'event': 'suite_started', 'time': 160.0, 'label': 'QIIME'},
+                {'event': 'suite_finished', 'time': 200.0, 'label': 'QIIME',
+                 'status': 'pass', 'ret_val': 0, 'duration': 40.0},
+                {'event': 'output', 'time': 230.0, 'label': 'PyCogent',
+                 'bytes': 10, 'lines': 1, 'last_line': 'ok'}]:
+            run_metrics.update(event)
+
+        metrics_f = open(self.metrics_fp, 'U')
+        lines = metrics_f.read().splitlines()
+        metrics_f.close()
+        self.assertTrue('clout_run_in_progress{cluster_tag="nightly"} 1' in
+                        lines)
+        self.assertTrue('clout_run_duration_seconds{cluster_tag="nightly"} '
+                        '100.0' in lines)
+        self.assertTrue('clout_phase_duration_seconds{cluster_tag="nightly",'
+                        'phase="setup"} 59.0' in lines)
+        self.assertTrue('clout_test_suite_status{cluster_tag="nightly",'
+                        'suite="QIIME",status="pass"} 1' in lines)
+        self.assertTrue('clout_test_suite_last_success_timestamp_seconds'
+                        '{cluster_tag="nightly",suite="QIIME"} 200.0' in
+                        lines)
+        self.assertFalse('PyCogent' in ''.join(lines))
+
+
+if __name__ == "__main__":
+    main()
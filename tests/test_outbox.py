@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the outbox.py module."""
+
+from shutil import rmtree
+from smtplib import SMTPAuthenticationError, SMTPRecipientsRefused
+from socket import error as socket_error
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.outbox import Outbox
+
+class FakeSMTP(object):
+    """Stand-in for smtplib.SMTP that records the emails it is sent.
+
+    failures is a list of exceptions (or None for success) that sendmail()
+    will raise, in order, before it starts succeeding.
+    """
+    connections = []
+    failures = []
+    login_error = None
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sent = []
+        self.closed = False
+        FakeSMTP.connections.append(self)
+
+    def ehlo(self):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        if FakeSMTP.login_error is not None:
+            raise FakeSMTP.login_error
+
+    def sendmail(self, sender, recipients, msg):
+        if FakeSMTP.failures:
+            failure = FakeSMTP.failures.pop(0)
+            if failure is not None:
+                raise failure
+        self.sent.append((sender, recipients, msg))
+
+    def quit(self):
+        self.closed = True
+
+
+class OutboxTests(TestCase):
+    """Tests for the outbox.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.outbox_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.outbox = Outbox(self.outbox_dir)
+        FakeSMTP.connections = []
+        FakeSMTP.failures = []
+        FakeSMTP.login_error = None
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.outbox_dir)
+
+    def flush(self, max_attempts=5):
+        """Flushes the outbox using the fake SMTP server."""
+        return self.outbox.flush('smtp.foo.com', 42, 'foo@foo.com', 'pass',
+                                 max_attempts, 0, FakeSMTP)
+
+    def test_add(self):
+        """Test adding emails to the outbox."""
+        self.assertEqual(self.outbox.pending(), [])
+        msg_id = self.outbox.add('foo@foo.com', ['bar@bar.com'], 'msg')
+        self.assertEqual(self.outbox.pending(), [msg_id])
+
+        info = self.outbox.get_info(msg_id)
+        self.assertEqual(info['sender'], 'foo@foo.com')
+        self.assertEqual(info['recipients'], ['bar@bar.com'])
+        self.assertEqual(info['attempts'], 0)
+        self.assertEqual(info['last_error'], None)
+
+    def test_flush(self):
+        """Test sending every pending email over a single connection."""
+        msg_id1 = self.outbox.add('foo@foo.com', ['bar@bar.com'], 'msg1')
+        msg_id2 = self.outbox.add('foo@foo.com', ['baz@baz.com'], 'msg2')
+
+        delivered, pending = self.flush()
+        self.assertEqual(sorted(delivered), sorted([msg_id1, msg_id2]))
+        self.assertEqual(pending, [])
+        self.assertEqual(self.outbox.pending(), [])
+
+        self.assertEqual(len(FakeSMTP.connections), 1)
+        server = FakeSMTP.connections[0]
+        self.assertEqual((server.host, server.port), ('smtp.foo.com', 42))
+        self.assertEqual(sorted(server.sent),
+                         [('foo@foo.com', ['bar@bar.com'], 'msg1'),
+                          ('foo@foo.com', ['baz@baz.com'], 'msg2')])
+        self.assertTrue(server.closed)
+
+    def test_flush_empty(self):
+        """Test flushing an empty outbox doesn't connect to the server."""
+        self.assertEqual(self.flush(), ([], []))
+        self.assertEqual(FakeSMTP.connections, [])
+
+    def test_flush_retry(self):
+        """Test reconnecting and retrying after a connection problem."""
+        msg_id = self.outbox.add('foo@foo.com', ['bar@bar.com'], 'msg')
+        FakeSMTP.failures = [socket_error('connection reset'), None]
+
+        self.assertEqual(self.flush(), ([msg_id], []))
+        self.assertEqual(len(FakeSMTP.connections), 2)
+        self.assertTrue(FakeSMTP.connections[0].closed)
+        self.assertEqual(FakeSMTP.connections[1].sent,
+                         [('foo@foo.com', ['bar@bar.com'], 'msg')])
+
+    def test_flush_give_up(self):
+        """Test leaving emails in the outbox after max_attempts failures."""
+        msg_id = self.outbox.add('foo@foo.com', ['bar@bar.com'], 'msg')
+        FakeSMTP.failures = [socket_error('connection reset')] * 3
+
+        self.assertEqual(self.flush(max_attempts=3), ([], [msg_id]))
+        self.assertEqual(len(FakeSMTP.connections), 3)
+        info = self.outbox.get_info(msg_id)
+        self.assertEqual(info['attempts'], 3)
+        self.assertTrue('connection reset' in info['last_error'])
+
+        # The email is delivered by the next flush.
+        self.assertEqual(self.flush(), ([msg_id], []))
+        self.assertEqual(self.outbox.pending(), [])
+
+    def test_flush_rejected(self):
+        """Test keeping emails the server permanently rejects."""
+        msg_id1 = self.outbox.add('foo@foo.com', ['bar@bar.com'], 'msg1')
+        msg_id2 = self.outbox.add('foo@foo.com', ['baz@baz.com'], 'msg2')
+        FakeSMTP.failures = [SMTPRecipientsRefused(
+                {'bar@bar.com': (550, 'No such user')}), None]
+
+        self.assertEqual(self.flush(), ([msg_id2], [msg_id1]))
+        self.assertEqual(len(FakeSMTP.connections), 1)
+        self.assertEqual(self.outbox.pending(), [msg_id1])
+        self.assertTrue('SMTPRecipientsRefused' in
+                        self.outbox.get_info(msg_id1)['last_error'])
+
+    def test_flush_authentication_error(self):
+        """Test not retrying when the SMTP server rejects the login."""
+        msg_id = self.outbox.add('foo@foo.com', ['bar@bar.com'], 'msg')
+        FakeSMTP.login_error = SMTPAuthenticationError(535, 'Bad password')
+
+        self.assertRaises(SMTPAuthenticationError, self.flush)
+        self.assertEqual(len(FakeSMTP.connections), 1)
+        self.assertEqual(self.outbox.pending(), [msg_id])
+
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,8 @@ __email__ = "jai.rideout@gmail.com"
 from unittest import main, TestCase
 
 from clout.parse import (parse_config_file, parse_email_list,
-                         parse_email_settings, _can_ignore)
+                         parse_email_settings, parse_schedule_file,
+                         parse_suite_options, _can_ignore)
 
 class ParseTests(TestCase):
     """Tests for the parse.py module."""
@@ -40,6 +41,15 @@ class ParseTests(TestCase):
         # Empty fields.
         self.config5 = ["QIIME\t/bin/tests.py", "\t/bin/foo.sh"]
 
+        # Per-suite options.
+        self.config6 = ["# a comment",
+                "QIIME\t/bin/tests.py\tresults=unittest\t profile = yes",
+                "PyCogent\t/foo.py"]
+
+        # Incorrectly-formatted per-suite options.
+        self.config7 = ["QIIME\t/bin/tests.py\tresults"]
+        self.config8 = ["QIIME\t/bin/tests.py\tresults=nose\tresults=junit"]
+
         # Standard email list with a comment.
         self.email_list1 = ["# some comment...", "foo@bar.baz",
                             "foo2@bar2.baz2"]
@@ -103,6 +113,21 @@ class ParseTests(TestCase):
         """Test parsing an config file with empty fields."""
         self.assertRaises(ValueError, parse_config_file, self.config5)
 
+    def test_parse_config_file_suite_options(self):
+        """Test parsing a config file with per-suite options."""
+        exp = [['QIIME', '/bin/tests.py'], ['PyCogent', '/foo.py']]
+        self.assertEqual(parse_config_file(self.config6), exp)
+        self.assertRaises(ValueError, parse_config_file, self.config7)
+        self.assertRaises(ValueError, parse_config_file, self.config8)
+
+    def test_parse_suite_options(self):
+        """Test parsing per-suite options."""
+        exp = {'QIIME': {'results': 'unittest', 'profile': 'yes'},
+               'PyCogent': {}}
+        self.assertEqual(parse_suite_options(self.config6), exp)
+        self.assertEqual(parse_suite_options(self.config1),
+                         {'QIIME': {}, 'PyCogent': {}})
+
     def test_parse_email_list_standard(self):
         """Test parsing a standard list of email addresses."""
         exp = ['foo@bar.baz', 'foo2@bar2.baz2']
@@ -142,6 +167,28 @@ class ParseTests(TestCase):
         self.assertRaises(ValueError,
                           parse_email_settings, self.email_settings5)
 
+    def test_parse_schedule_file_standard(self):
+        """Test parsing a standard schedule file."""
+        schedule = ["# a comment", "",
+                    "02:30\tcluster_tag=nightly_tests\tuser=ubuntu",
+                    "23:05\tcluster_tag=other_tests"]
+        exp = [(2, 30, {'cluster_tag': 'nightly_tests', 'user': 'ubuntu'}),
+               (23, 5, {'cluster_tag': 'other_tests'})]
+        obs = parse_schedule_file(schedule)
+        self.assertEqual(obs, exp)
+
+    def test_parse_schedule_file_invalid(self):
+        """Test parsing invalid schedule files."""
+        self.assertRaises(ValueError, parse_schedule_file, ["02:30"])
+        self.assertRaises(ValueError, parse_schedule_file,
+                          ["2pm\tcluster_tag=foo"])
+        self.assertRaises(ValueError, parse_schedule_file,
+                          ["24:00\tcluster_tag=foo"])
+        self.assertRaises(ValueError, parse_schedule_file,
+                          ["02:30\tcluster_tag"])
+        self.assertRaises(ValueError, parse_schedule_file,
+                          ["02:30\tcluster_tag=foo\tcluster_tag=bar"])
+
     def test_can_ignore(self):
         """Test whether comments and whitespace-only lines are ignored."""
         self.assertEqual(_can_ignore(self.email_list1[0]), True)
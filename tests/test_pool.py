@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the pool.py module."""
+
+from json import dumps
+from os.path import join
+from shutil import rmtree
+from socket import gethostname
+from subprocess import Popen
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep, time
+from unittest import main, TestCase
+
+from clout.pool import ClusterPool
+
+class PoolTests(TestCase):
+    """Tests for the pool.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.pool_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.key1 = ('starcluster', 'sc_config', 'smallcluster', 'starcluster')
+        self.key2 = ('starcluster', 'sc_config', 'largecluster', 'starcluster')
+        self.terminated = []
+
+        # The pid of a process that has exited.
+        proc = Popen(['true'])
+        proc.wait()
+        self.dead_pid = proc.pid
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.pool_dir)
+
+    def build_pool(self, max_clusters=2, max_instances=4, idle_timeout=0.0):
+        return ClusterPool(self.pool_dir, max_clusters, max_instances,
+                           idle_timeout, poll_interval=0.01,
+                           terminator=self.terminate)
+
+    def terminate(self, cluster):
+        self.terminated.append(cluster['cluster_tag'])
+        return True
+
+    def build_terminate_cmd(self, cluster_tag):
+        return 'terminate %s' % cluster_tag
+
+    def acquire(self, pool, run_id, cluster_key, num_nodes=1):
+        return pool.acquire(run_id, cluster_key, num_nodes,
+                            self.build_terminate_cmd, 5.0)
+
+    def acquire_in_thread(self, pool, run_id, cluster_key, num_nodes=1):
+        leases = []
+        thread = Thread(target=lambda: leases.append(
+                self.acquire(pool, run_id, cluster_key, num_nodes)))
+        thread.start()
+        return thread, leases
+
+    def test_init_invalid_input(self):
+        """Test creating a pool with invalid limits raises an error."""
+        self.assertRaises(ValueError, ClusterPool, self.pool_dir, 0)
+        self.assertRaises(ValueError, ClusterPool, self.pool_dir, 1, 0)
+
+    def test_acquire_release(self):
+        """Test leasing new clusters and terminating them once released."""
+        pool = self.build_pool()
+        lease1 = self.acquire(pool, 'run1', self.key1)
+        lease2 = self.acquire(pool, 'run2', self.key1, 3)
+        self.assertEqual(lease1['cluster_tag'], 'clout_pool_1')
+        self.assertEqual(lease1['reused'], False)
+        self.assertEqual(lease1['num_nodes'], 1)
+        self.assertEqual(lease2['cluster_tag'], 'clout_pool_2')
+        self.assertTrue(lease2['queue_wait'] < 1)
+
+        status = pool.status()
+        self.assertEqual([(cluster['cluster_tag'], cluster['state'],
+                           cluster['run_id'])
+                          for cluster in status['clusters']],
+                         [('clout_pool_1', 'busy', 'run1'),
+                          ('clout_pool_2', 'busy', 'run2')])
+        self.assertEqual(status['instances'], 4)
+        self.assertEqual(status['waiting'], [])
+
+        # Nobody can reuse the clusters, so they are terminated.
+        pool.release(lease1)
+        pool.release(lease2)
+        self.assertEqual(self.terminated, ['clout_pool_1', 'clout_pool_2'])
+        self.assertEqual(pool.status()['clusters'], [])
+        self.assertEqual(self.acquire(pool, 'run3', self.key1)['cluster_tag'],
+                         'clout_pool_1')
+
+        self.assertEqual([(event['event'], event.get('cluster_tag'))
+                          for event in pool.read_usage()],
+                         [('cluster_leased', 'clout_pool_1'),
+                          ('cluster_leased', 'clout_pool_2'),
+                          ('cluster_released', 'clout_pool_1'),
+                          ('cluster_terminated', 'clout_pool_1'),
+                          ('cluster_released', 'clout_pool_2'),
+                          ('cluster_terminated', 'clout_pool_2'),
+                          ('cluster_leased', 'clout_pool_1')])
+
+    def test_acquire_too_many_nodes(self):
+        """Test leasing a cluster larger than the pool raises an error."""
+        pool = self.build_pool()
+        self.assertRaises(ValueError, self.acquire, pool, 'run1', self.key1,
+                          5)
+
+    def test_reuse_idle_cluster(self):
+        """Test reusing an idle cluster with the same template and size."""
+        pool = self.build_pool(idle_timeout=30.0)
+        lease1 = self.acquire(pool, 'run1', self.key1)
+        pool.release(lease1)
+        self.assertEqual(self.terminated, [])
+        self.assertEqual(pool.status()['clusters'][0]['state'], 'idle')
+
+        # A cluster of a different size or template isn't reused.
+        lease2 = self.acquire(pool, 'run2', self.key1, 2)
+        self.assertEqual(lease2['cluster_tag'], 'clout_pool_2')
+        self.assertEqual(lease2['reused'], False)
+
+        lease3 = self.acquire(pool, 'run3', self.key1)
+        self.assertEqual(lease3['cluster_tag'], 'clout_pool_1')
+        self.assertEqual(lease3['reused'], True)
+
+        # A cluster that isn't reusable is terminated right away.
+        pool.release(lease3, reusable=False)
+        self.assertEqual(self.terminated, ['clout_pool_1'])
+
+    def test_queue_when_full(self):
+        """Test that runs wait for a cluster when the pool is full."""
+        pool = self.build_pool(max_clusters=1)
+        lease1 = self.acquire(pool, 'run1', self.key1)
+
+        thread, leases = self.acquire_in_thread(pool, 'run2', self.key1)
+        sleep(0.2)
+        self.assertEqual(leases, [])
+        self.assertEqual([waiter['run_id']
+                          for waiter in pool.status()['waiting']], ['run2'])
+
+        # The waiting run can reuse the cluster, so it is handed over instead
+        # of being terminated.
+        pool.release(lease1)
+        thread.join()
+        self.assertEqual(leases[0]['cluster_tag'], 'clout_pool_1')
+        self.assertEqual(leases[0]['reused'], True)
+        self.assertTrue(leases[0]['queue_wait'] >= 0.2)
+        self.assertEqual(self.terminated, [])
+        self.assertEqual([event['event'] for event in pool.read_usage()],
+                         ['cluster_leased', 'run_queued', 'cluster_released',
+                          'cluster_leased'])
+
+    def test_queue_instance_limit(self):
+        """Test that runs wait when the pool has too few instances left."""
+        pool = self.build_pool(max_clusters=3, max_instances=4)
+        lease1 = self.acquire(pool, 'run1', self.key1, 3)
+
+        thread, leases = self.acquire_in_thread(pool, 'run2', self.key2, 2)
+        sleep(0.2)
+        self.assertEqual(leases, [])
+
+        pool.release(lease1)
+        thread.join()
+        self.assertEqual(leases[0]['cluster_tag'], 'clout_pool_1')
+        self.assertEqual(leases[0]['reused'], False)
+        self.assertEqual(self.terminated, ['clout_pool_1'])
+
+    def test_evict_idle_cluster(self):
+        """Test terminating an idle cluster to make room for another run."""
+        pool = self.build_pool(max_clusters=1, idle_timeout=30.0)
+        pool.release(self.acquire(pool, 'run1', self.key1))
+        self.assertEqual(self.terminated, [])
+
+        lease = self.acquire(pool, 'run2', self.key2)
+        self.assertEqual(self.terminated, ['clout_pool_1'])
+        self.assertEqual(lease['cluster_tag'], 'clout_pool_1')
+        self.assertEqual(lease['reused'], False)
+
+    def test_reacquire(self):
+        """Test taking back the lease of a run that is being resumed."""
+        pool = self.build_pool()
+        lease = self.acquire(pool, 'run1', self.key1)
+        self.assertEqual(pool.reacquire(lease), lease)
+
+        pool.release(lease)
+        self.assertRaises(ValueError, pool.reacquire, lease)
+
+    def test_crashed_runs(self):
+        """Test that crashed waiting runs are dropped but leases are kept."""
+        pool = self.build_pool()
+        pool_f = open(join(self.pool_dir, 'pool.json'), 'w')
+        pool_f.write(dumps({
+                'clusters': [{'cluster_tag': 'clout_pool_1', 'state': 'busy',
+                              'cluster_key': list(self.key1), 'num_nodes': 1,
+                              'run_id': 'run1', 'pid': self.dead_pid,
+                              'hostname': gethostname(), 'started': True,
+                              'started_at': time()}],
+                'waiting': [{'run_id': 'run2', 'cluster_key': list(self.key1),
+                             'num_nodes': 1, 'pid': self.dead_pid,
+                             'hostname': gethostname(),
+                             'queued_at': time()}]}))
+        pool_f.close()
+
+        status = pool.status()
+        self.assertEqual(status['waiting'], [])
+        self.assertEqual(status['clusters'][0]['state'], 'orphaned')
+        self.assertEqual(self.acquire(pool, 'run3', self.key1)['cluster_tag'],
+                         'clout_pool_2')
+
+
+if __name__ == "__main__":
+    main()
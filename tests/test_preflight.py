@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the preflight.py module."""
+
+from os import chmod
+from os.path import join
+from shutil import rmtree
+from smtplib import SMTPAuthenticationError
+from tempfile import mkdtemp
+from time import sleep, time
+from unittest import main, TestCase
+
+from clout.backend import LocalBackend, StarClusterBackend
+from clout.preflight import (build_preflight_checks, check_cmd_syntax,
+                             check_executable, check_key_permissions,
+                             check_smtp_login, check_starcluster_config,
+                             run_preflight_checks)
+
+class FakeSMTP(object):
+    """Stand-in for smtplib.SMTP that records the connections made to it."""
+    connections = []
+    login_error = None
+
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.closed = False
+        FakeSMTP.connections.append(self)
+
+    def ehlo(self):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        if FakeSMTP.login_error is not None:
+            raise FakeSMTP.login_error
+
+    def quit(self):
+        self.closed = True
+
+
+class PreflightTests(TestCase):
+    """Tests for the preflight.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        FakeSMTP.connections = []
+        FakeSMTP.login_error = None
+        self.email_settings = {'smtp_server': 'smtp.gmail.com',
+                               'smtp_port': '587', 'sender': 'foo@bar.baz',
+                               'password': '1234'}
+
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.key_fp = join(self.temp_dir, 'clout_key.rsa')
+        self.write_file(self.key_fp, 'key\n')
+        chmod(self.key_fp, 0o400)
+        self.sc_config_fp = join(self.temp_dir, 'starcluster_config')
+        self.write_file(self.sc_config_fp,
+                        '[global]\nDEFAULT_TEMPLATE=clout\n\n'
+                        '[key clout_key]\nKEY_LOCATION=%s\n\n'
+                        '[cluster base]\nKEYNAME = clout_key\n\n'
+                        '[cluster clout]\nEXTENDS = base\nCLUSTER_SIZE = 1\n\n'
+                        '[cluster nokey]\nCLUSTER_SIZE = 1\n\n'
+                        '[cluster loop]\nEXTENDS = loop\n' % self.key_fp)
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def write_file(self, fp, contents):
+        out_f = open(fp, 'w')
+        out_f.write(contents)
+        out_f.close()
+
+    def test_check_smtp_login(self):
+        """Test logging into the SMTP server."""
+        check_smtp_login(self.email_settings, 5.0, FakeSMTP)
+        self.assertEqual(len(FakeSMTP.connections), 1)
+        connection = FakeSMTP.connections[0]
+        self.assertEqual((connection.host, connection.port,
+                          connection.timeout), ('smtp.gmail.com', '587', 5.0))
+        self.assertTrue(connection.closed)
+
+        FakeSMTP.login_error = SMTPAuthenticationError(535, 'Bad password')
+        self.assertRaises(SMTPAuthenticationError, check_smtp_login,
+                          self.email_settings, 5.0, FakeSMTP)
+
+    def test_check_starcluster_config(self):
+        """Test checking the cluster template and its key."""
+        # The default template inherits its key from the template it extends.
+        check_starcluster_config(self.sc_config_fp)
+        check_starcluster_config(self.sc_config_fp, 'base')
+
+        for cluster_template in 'missing', 'nokey', 'loop':
+            self.assertRaises(ValueError, check_starcluster_config,
+                              self.sc_config_fp, cluster_template)
+        self.assertRaises(ValueError, check_starcluster_config,
+                          join(self.temp_dir, 'missing_config'))
+
+        # A key without a location, or whose file is missing.
+        self.write_file(self.sc_config_fp,
+                        '[cluster clout]\nKEYNAME = clout_key\n')
+        self.assertRaises(ValueError, check_starcluster_config,
+                          self.sc_config_fp)
+        self.assertRaises(ValueError, check_starcluster_config,
+                          self.sc_config_fp, 'clout')
+        self.write_file(self.sc_config_fp,
+                        '[cluster clout]\nKEYNAME = clout_key\n\n'
+                        '[key clout_key]\nKEY_LOCATION = %s\n' %
+                        join(self.temp_dir, 'missing_key.rsa'))
+        self.assertRaises(ValueError, check_starcluster_config,
+                          self.sc_config_fp, 'clout')
+
+    def test_check_key_permissions(self):
+        """Test checking that ssh will use a key file."""
+        check_key_permissions(self.key_fp)
+        chmod(self.key_fp, 0o644)
+        self.assertRaises(ValueError, check_key_permissions, self.key_fp)
+        try:
+            check_key_permissions(self.key_fp)
+        except ValueError as e:
+            self.assertTrue('644' in str(e))
+            self.assertTrue('chmod 400' in str(e))
+        self.assertRaises(ValueError, check_key_permissions,
+                          join(self.temp_dir, 'missing_key.rsa'))
+
+    def test_check_executable(self):
+        """Test finding an executable by its path or on the PATH."""
+        check_executable('sh')
+        check_executable('/bin/sh')
+        self.assertRaises(ValueError, check_executable,
+                          'clout_missing_executable')
+        self.assertRaises(ValueError, check_executable, self.key_fp)
+
+    def test_check_cmd_syntax(self):
+        """Test checking that commands parse without running them."""
+        marker_fp = join(self.temp_dir, 'ran')
+        check_cmd_syntax([['QIIME', 'touch %s; if true; then echo ok; fi' %
+                           marker_fp]], '/bin/sh')
+        check_cmd_syntax([])
+
+        try:
+            check_cmd_syntax([['QIIME', 'echo ('], ['PyCogent', 'echo ok'],
+                              ['PyNAST', 'if true; then echo ok'],
+                              ['marker', 'touch %s' % marker_fp]],
+                             '/bin/sh')
+        except ValueError as e:
+            errors = str(e).split('\n')[1:]
+            self.assertEqual([error.split(':')[0] for error in errors],
+                             ['QIIME', 'PyNAST'])
+        else:
+            self.fail("The commands' syntax errors weren't reported.")
+
+        # None of the commands were run.
+        self.assertRaises(IOError, open, marker_fp)
+
+    def test_build_preflight_checks(self):
+        """Test building the checks for a run's backend."""
+        test_suites = [['QIIME', 'echo ok'], ['PyCogent', 'echo ok']]
+        matrices = [{'label': 'QIIME', 'setup': [['echo (', []]]}]
+        checks = build_preflight_checks(test_suites, self.email_settings,
+                                        LocalBackend(self.temp_dir),
+                                        matrices)
+        self.assertEqual([name for name, check in checks],
+                         ['SMTP login', 'command syntax'])
+        try:
+            checks[1][1]()
+        except ValueError as e:
+            self.assertTrue('QIIME setup:' in str(e))
+        else:
+            self.fail("The setup command's syntax error wasn't reported.")
+
+        backend = StarClusterBackend(self.sc_config_fp,
+                                     sc_exe_fp='clout_missing_executable')
+        checks = build_preflight_checks(test_suites, self.email_settings,
+                                        backend)
+        self.assertEqual([name for name, check in checks],
+                         ['SMTP login', 'StarCluster config',
+                          'StarCluster executable', 'command syntax'])
+        checks[1][1]()
+        self.assertRaises(ValueError, checks[2][1])
+        checks[3][1]()
+
+    def test_run_preflight_checks(self):
+        """Test running checks at the same time, within a timeout."""
+        def fail():
+            raise ValueError('bad settings')
+
+        start_time = time()
+        results = run_preflight_checks([('slow', lambda: sleep(0.3)),
+                                        ('also slow', lambda: sleep(0.3)),
+                                        ('fails', fail)], 5.0)
+        self.assertTrue(time() - start_time < 0.55)
+        self.assertEqual([(result['name'], result['error'])
+                          for result in results],
+                         [('slow', None), ('also slow', None),
+                          ('fails', 'bad settings')])
+        self.assertTrue(results[0]['duration'] >= 0.3)
+
+        # A check that hangs fails once the timeout passes.
+        results = run_preflight_checks([('hangs', lambda: sleep(5.0)),
+                                        ('passes', lambda: None)], 0.1)
+        self.assertEqual(results[0]['duration'], None)
+        self.assertEqual(results[0]['error'],
+                         'The check did not finish within 0.1 second(s).')
+        self.assertEqual(results[1]['error'], None)
+
+
+if __name__ == "__main__":
+    main()
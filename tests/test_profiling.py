@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the profiling.py module."""
+
+from cProfile import Profile
+from os import environ, listdir, mkdir
+from os.path import join
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from sys import executable
+from tarfile import open as open_tarfile
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.profiling import (archive_profile, build_profiled_cmd,
+                             get_python_hotspots, parse_resource_usage,
+                             summarize_profile, write_python_profiler_hook)
+
+class ProfilingTests(TestCase):
+    """Tests for the profiling.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+
+        # Output of GNU time -v.
+        self.resources = [
+            '\tCommand being timed: "sh -c ./tests.py"\n',
+            '\tUser time (seconds): 12.50\n',
+            '\tSystem time (seconds): 0.75\n',
+            '\tPercent of CPU this job got: 98%\n',
+            '\tElapsed (wall clock) time (h:mm:ss or m:ss): 0:13.46\n',
+            '\tMaximum resident set size (kbytes): 204800\n',
+            '\tMajor (requiring I/O) page faults: 3\n',
+            '\tVoluntary context switches: 1024\n',
+            '\tFile system inputs: 16\n',
+            '\tFile system outputs: 4096\n',
+            '\tExit status: 1\n']
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def write_profile(self, fn, func):
+        """Profiles a call to func and writes the profile to fn."""
+        profiler = Profile()
+        profiler.runcall(func)
+        profile_fp = join(self.temp_dir, fn)
+        profiler.dump_stats(profile_fp)
+        return profile_fp
+
+    def test_build_profiled_cmd(self):
+        """Test wrapping a test suite's command so that it is profiled."""
+        self.assertEqual(build_profiled_cmd('./tests.py', 'QIIME', 'none'),
+                         './tests.py')
+        self.assertEqual(build_profiled_cmd('cd "$HOME" && ./tests.py',
+                                            'Py Cogent', 'resources'),
+                'mkdir -p .clout_profiles/Py_Cogent && /usr/bin/time -v -o '
+                '.clout_profiles/Py_Cogent/resources.txt sh -c "cd \\"\\$HOME'
+                '\\" && ./tests.py"')
+        self.assertEqual(build_profiled_cmd('./tests.py', 'QIIME', 'python'),
+                'mkdir -p .clout_profiles/QIIME && CLOUT_PROFILE_DIR='
+                '"$PWD/.clout_profiles/QIIME" PYTHONPATH="$PWD/.clout_profiles'
+                '/python_hook${PYTHONPATH:+:$PYTHONPATH}" /usr/bin/time -v -o '
+                '.clout_profiles/QIIME/resources.txt sh -c "./tests.py"')
+
+    def test_build_profiled_cmd_runs(self):
+        """Test that the wrapped command is run by the shell unchanged."""
+        cmd = build_profiled_cmd('printf "%s|%s|%s\\n" "a  $((1 + 1))" '
+                                 '"x\\\\y" `echo c`', 'QIIME', 'resources')
+        cmd = cmd[cmd.index('sh -c'):]
+        proc = Popen(cmd, shell=True, stdout=PIPE, universal_newlines=True)
+        self.assertEqual(proc.communicate()[0], 'a  2|x\\y|c\n')
+
+    def test_python_profiler_hook(self):
+        """Test profiling a Python process with the profiler hook."""
+        hook_dir = join(self.temp_dir, 'python_hook')
+        profile_dir = join(self.temp_dir, 'QIIME')
+        mkdir(profile_dir)
+        write_python_profiler_hook(hook_dir)
+
+        env = dict(environ, PYTHONPATH=hook_dir, CLOUT_PROFILE_DIR=profile_dir)
+        proc = Popen([executable, '-c', 'print(sum(range(10)))'], env=env,
+                     stdout=PIPE, universal_newlines=True)
+        self.assertEqual(proc.communicate()[0], '45\n')
+        self.assertEqual(proc.returncode, 0)
+
+        profile_fns = listdir(profile_dir)
+        self.assertEqual(len(profile_fns), 1)
+        self.assertTrue(profile_fns[0].startswith('python-'))
+        # The code passed with -c shows up as the '<string>' module.
+        hotspots = get_python_hotspots([join(profile_dir, profile_fns[0])],
+                                       1000)
+        self.assertTrue('<string>:1(<module>)' in [h[0] for h in hotspots])
+
+    def test_parse_resource_usage(self):
+        """Test parsing the output of GNU time -v."""
+        obs = parse_resource_usage(self.resources)
+        self.assertEqual(obs, {'user_time': 12.5, 'system_time': 0.75,
+                               'max_rss_kb': 204800, 'major_page_faults': 3,
+                               'fs_inputs': 16, 'fs_outputs': 4096,
+                               'voluntary_context_switches': 1024,
+                               'involuntary_context_switches': None})
+
+    def test_get_python_hotspots(self):
+        """Test finding the functions that took the most time."""
+        def slow_function():
+            return sorted(range(100000), reverse=True)
+
+        profile_fps = [self.write_profile('a.prof', slow_function),
+                       self.write_profile('b.prof', slow_function)]
+        corrupt_fp = join(self.temp_dir, 'corrupt.prof')
+        open(corrupt_fp, 'w').write('foo')
+
+        obs = get_python_hotspots([corrupt_fp] + profile_fps, 2)
+        self.assertEqual(len(obs), 2)
+        self.assertTrue(obs[0][2] >= obs[1][2])
+        functions = dict([(h[0], h[1]) for h in
+                          get_python_hotspots(profile_fps)])
+        self.assertEqual([num_calls for function, num_calls in
+                          functions.items() if 'slow_function' in function],
+                         [2])
+        self.assertEqual(get_python_hotspots([corrupt_fp]), [])
+
+    def test_summarize_profile(self):
+        """Test summarizing a test suite's profile."""
+        self.assertEqual(summarize_profile(join(self.temp_dir, 'foo')), None)
+
+        profile_dir = join(self.temp_dir, 'QIIME')
+        mkdir(profile_dir)
+        self.assertEqual(summarize_profile(profile_dir),
+                         {'resources': None, 'hotspots': []})
+
+        open(join(profile_dir, 'resources.txt'), 'w').write(
+                ''.join(self.resources))
+        obs = summarize_profile(profile_dir)
+        self.assertEqual(obs['resources']['max_rss_kb'], 204800)
+
+    def test_archive_profile(self):
+        """Test archiving a test suite's profile."""
+        profile_dir = join(self.temp_dir, 'QIIME')
+        mkdir(profile_dir)
+        open(join(profile_dir, 'resources.txt'), 'w').write('foo\n')
+
+        archive_fp = join(self.temp_dir, 'QIIME.tar.gz')
+        archive_profile(profile_dir + '/', archive_fp)
+        archive = open_tarfile(archive_fp, 'r:gz')
+        self.assertEqual(sorted(archive.getnames()),
+                         ['QIIME', 'QIIME/resources.txt'])
+        self.assertEqual(archive.extractfile('QIIME/resources.txt').read(),
+                         'foo\n')
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the progress.py module."""
+
+from json import loads
+from os import getpid
+from os.path import join
+from shutil import rmtree
+from socket import AF_INET, SOCK_DGRAM, socket
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.progress import (follow_progress, is_process_running,
+                            ProgressReporter, read_progress,
+                            summarize_progress)
+
+class ProgressTests(TestCase):
+    """Tests for the progress.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.status_fp = join(self.temp_dir, 'status.jsonl')
+
+        self.events = [
+            {'event': 'run_started', 'time': 100, 'run_id': 'foo',
+             'pid': 42, 'cluster_tag': 'clout', 'test_suites': ['QIIME',
+             'PyCogent', 'PyNAST']},
+            {'event': 'phase_changed', 'time': 101, 'phase': 'setup'},
+            {'event': 'phase_changed', 'time': 160, 'phase': 'test_suites'},
+            {'event': 'suite_started', 'time': 160, 'label': 'QIIME'},
+            {'event': 'suite_finished', 'time': 200, 'label': 'QIIME',
+             'status': 'fail', 'ret_val': 1, 'duration': 40},
+            {'event': 'suite_started', 'time': 200, 'label': 'PyCogent'},
+            {'event': 'output', 'time': 230, 'label': 'PyCogent',
+             'bytes': 10, 'lines': 1, 'last_line': 'ok'}]
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def test_ProgressReporter(self):
+        """Test writing events to a status file and a socket."""
+        listener = socket(AF_INET, SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        try:
+            progress = ProgressReporter(self.status_fp,
+                                        listener.getsockname()[1])
+            entry = progress.report('suite_started', label='QIIME')
+            progress.close()
+
+            self.assertEqual(entry['event'], 'suite_started')
+            self.assertEqual(entry['label'], 'QIIME')
+            self.assertEqual(loads(listener.recv(4096)), entry)
+        finally:
+            listener.close()
+        self.assertEqual(read_progress(self.status_fp)[0], [entry])
+
+    def test_ProgressReporter_nothing_listening(self):
+        """Test that events sent to a port nothing is listening on are
+        dropped."""
+        listener = socket(AF_INET, SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        progress = ProgressReporter(port=port)
+        progress.report('phase_changed', phase='setup')
+        progress.report('phase_changed', phase='teardown')
+        progress.close()
+
+    def test_ProgressReporter_listener(self):
+        """Test passing each event to a listener."""
+        class Listener(object):
+            def __init__(self):
+                self.events = []
+            def update(self, event):
+                self.events.append(event)
+
+        listener = Listener()
+        progress = ProgressReporter(listeners=[listener])
+        entry = progress.report('phase_changed', phase='setup')
+        progress.output_received('QIIME', 'foo\n')
+        progress.close()
+        self.assertEqual(listener.events[0], entry)
+        self.assertEqual([e['event'] for e in listener.events],
+                         ['phase_changed', 'output'])
+
+    def test_ProgressReporter_output_received(self):
+        """Test that output heartbeats are throttled per test suite."""
+        progress = ProgressReporter(self.status_fp, heartbeat_interval=3600)
+        progress.output_received('QIIME', 'foo\nbar\n')
+        progress.output_received('QIIME', 'baz\n')
+        progress.output_received('PyCogent', 'x' * 500 + '\n')
+        progress.close()
+
+        events = read_progress(self.status_fp)[0]
+        self.assertEqual([(e['label'], e['bytes'], e['lines'], e['last_line'])
+                          for e in events],
+                         [('QIIME', 8, 2, 'bar'),
+                          ('PyCogent', 501, 1, 'x' * 200)])
+
+        progress = ProgressReporter(self.status_fp, heartbeat_interval=0)
+        progress.output_received('QIIME', 'foo\n')
+        progress.output_received('QIIME', 'bar\n')
+        progress.close()
+        self.assertEqual([e['bytes'] for e in
+                          read_progress(self.status_fp)[0][2:]], [4, 8])
+
+    def test_read_progress(self):
+        """Test reading events, leaving a partial last line unread."""
+        self.assertEqual(read_progress(self.status_fp), ([], 0))
+
+        status_f = open(self.status_fp, 'w')
+        status_f.write('{"event": "run_started", "time": 1}\nfoo\n'
+                       '{"event": "phase_')
+        status_f.close()
+        events, offset = read_progress(self.status_fp)
+        self.assertEqual(events, [{'event': 'run_started', 'time': 1}])
+        self.assertEqual(offset, 40)
+
+        status_f = open(self.status_fp, 'a')
+        status_f.write('changed", "time": 2, "phase": "setup"}\n')
+        status_f.close()
+        events, offset = read_progress(self.status_fp, offset)
+        self.assertEqual(events, [{'event': 'phase_changed', 'time': 2,
+                                   'phase': 'setup'}])
+        self.assertEqual(read_progress(self.status_fp, offset), ([], offset))
+
+    def test_follow_progress(self):
+        """Test following events until the run finishes."""
+        progress = ProgressReporter(self.status_fp)
+        progress.report('run_started', pid=getpid())
+        progress.report('phase_changed', phase='setup')
+        progress.report('run_finished', succeeded=True)
+        progress.report('run_started', pid=getpid())
+        progress.close()
+
+        obs = [e['event'] for e in follow_progress(self.status_fp,
+                                                   poll_interval=0)]
+        self.assertEqual(obs, ['run_started', 'phase_changed',
+                               'run_finished'])
+
+    def test_summarize_progress(self):
+        """Test summarizing a running run's events."""
+        obs = summarize_progress(self.events, now=250)
+        self.assertEqual(obs, {'run_id': 'foo', 'pid': 42,
+                               'phase': 'test_suites', 'running': 'PyCogent',
+                               'running_for': 50,
+                               'finished_suites': [['QIIME', 'fail']],
+                               'remaining_suites': ['PyNAST'],
+                               'idle_for': 20, 'run_finished': False})
+
+        self.assertEqual(summarize_progress([], now=250)['idle_for'], None)
+
+        # A test suite whose node was lost isn't running until it starts
+        # again.
+        obs = summarize_progress(self.events + [
+                {'event': 'suite_interrupted', 'time': 240,
+                 'label': 'PyCogent', 'node': 'node001', 'duration': 40}],
+                now=250)
+        self.assertEqual(obs['running'], None)
+        self.assertEqual(obs['remaining_suites'], ['PyCogent', 'PyNAST'])
+
+    def test_summarize_progress_resumed(self):
+        """Test summarizing the events of a resumed run."""
+        events = self.events + [
+            {'event': 'run_started', 'time': 300, 'run_id': 'foo',
+             'pid': 43, 'test_suites': ['QIIME', 'PyCogent', 'PyNAST']},
+            {'event': 'phase_changed', 'time': 300, 'phase': 'test_suites'},
+            {'event': 'suite_started', 'time': 301, 'label': 'PyNAST'},
+            {'event': 'suite_finished', 'time': 302, 'label': 'PyNAST',
+             'status': 'pass', 'ret_val': 0, 'duration': 1},
+            {'event': 'phase_changed', 'time': 303, 'phase': 'reporting'},
+            {'event': 'run_finished', 'time': 304, 'succeeded': True}]
+        obs = summarize_progress(events, now=310)
+        self.assertEqual(obs['pid'], 43)
+        self.assertEqual(obs['running'], None)
+        self.assertEqual(obs['finished_suites'], [['QIIME', 'fail'],
+                                                  ['PyNAST', 'pass']])
+        self.assertEqual(obs['remaining_suites'], ['PyCogent'])
+        self.assertTrue(obs['run_finished'])
+
+    def test_is_process_running(self):
+        """Test checking whether a process exists."""
+        self.assertTrue(is_process_running(getpid()))
+        self.assertFalse(is_process_running(2 ** 22 + 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the report.py module."""
+
+from gzip import GzipFile
+from json import loads
+from os import mkdir
+from os.path import exists, join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp, TemporaryFile
+from unittest import main, TestCase
+
+from clout.report import (format_report_index, format_run_report,
+                          get_test_suite_trend, is_successful_run,
+                          load_report_history, write_chunked_log,
+                          write_report)
+
+class ReportTests(TestCase):
+    """Tests for the report.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.report_root = mkdtemp(prefix='clout_temp_dir_')
+        self.run_summary = {
+            'cluster_tag': 'nightly_tests',
+            'started_at': 1357041600.0,
+            'finished_at': 1357045200.0,
+            'setup': {'succeeded': True, 'duration': 120.0},
+            'teardown': {'succeeded': True, 'duration': 30.0},
+            'test_suites': [
+                {'label': 'QIIME', 'status': 'pass', 'ret_val': 0,
+                 'duration': 2000.0, 'log_name': 'QIIME_results.txt'},
+                {'label': 'PyCogent <1.5>', 'status': 'timeout',
+                 'ret_val': -15, 'duration': 1200.0,
+                 'log_name': 'PyCogent <1.5>_results.txt'},
+                {'label': 'PyNAST', 'status': 'not_run', 'ret_val': None,
+                 'duration': None, 'log_name': None}]}
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.report_root)
+
+    def build_logs(self):
+        """Returns open log files matching self.run_summary."""
+        logs = []
+        for name, contents in (('complete_log.txt', 'complete\n'),
+                               ('QIIME_results.txt', 'QIIME\n' * 1000),
+                               ('PyCogent <1.5>_results.txt', '')):
+            log_f = TemporaryFile(prefix='clout_temp_file_')
+            log_f.write(contents)
+            log_f.seek(0, 0)
+            logs.append((name, log_f))
+        return logs
+
+    def test_write_report(self):
+        """Test writing the report of a run."""
+        logs = self.build_logs()
+        run_dir = write_report(self.report_root, '20130101-120000-aaaaaaaa',
+                               self.run_summary, logs)
+        self.assertEqual(run_dir,
+                         join(self.report_root, '20130101-120000-aaaaaaaa'))
+        for fn in ('index.html', 'summary.json', 'view.html',
+                   'logs/complete_log.txt.gz',
+                   'logs/QIIME_results.txt.gz.idx.json',
+                   'logs/PyCogent__1.5__results.txt.gz'):
+            self.assertTrue(exists(join(run_dir, fn)))
+        self.assertTrue(exists(join(self.report_root, 'index.html')))
+
+        # The log files can still be read (e.g. to attach them to an email).
+        self.assertEqual(logs[0][1].read(), 'complete\n')
+
+        summary = loads(open(join(run_dir, 'summary.json')).read())
+        self.assertEqual(summary['run_id'], '20130101-120000-aaaaaaaa')
+        self.assertEqual(summary['cluster_tag'], 'nightly_tests')
+        self.assertFalse(summary['succeeded'])
+        self.assertEqual(summary['log_files']['QIIME_results.txt'],
+                         'logs/QIIME_results.txt.gz')
+        self.assertEqual([t['status'] for t in summary['test_suites']],
+                         ['pass', 'timeout', 'not_run'])
+
+        html = open(join(run_dir, 'index.html')).read()
+        self.assertTrue('PyCogent &lt;1.5&gt;' in html)
+        self.assertTrue('view.html?log=logs/QIIME_results.txt.gz' in html)
+        self.assertTrue('33m 20s' in html)
+
+    def test_write_report_profiles(self):
+        """Test including test suite profiles in a run's report."""
+        profile_dir = join(self.report_root, 'QIIME_profile')
+        mkdir(profile_dir)
+        open(join(profile_dir, 'resources.txt'), 'w').write('foo\n')
+        self.run_summary['test_suites'][0]['profile'] = {
+                'resources': {'max_rss_kb': 2048}, 'hotspots': []}
+
+        run_dir = write_report(self.report_root, '20130101-120000-aaaaaaaa',
+                               self.run_summary, self.build_logs(),
+                               profiles=[('QIIME', profile_dir)])
+        self.assertTrue(exists(join(run_dir, 'profiles/QIIME.tar.gz')))
+        summary = loads(open(join(run_dir, 'summary.json')).read())
+        self.assertEqual(summary['profile_files'],
+                         {'QIIME': 'profiles/QIIME.tar.gz'})
+        html = open(join(run_dir, 'index.html')).read()
+        self.assertTrue('<a href="profiles/QIIME.tar.gz">profile</a> (peak '
+                        'memory 2.0 MB)' in html)
+
+    def test_write_report_artifacts(self):
+        """Test including test suite artifacts in a run's report."""
+        artifacts_dir = join(self.report_root, 'QIIME_artifacts')
+        mkdir(artifacts_dir)
+        mkdir(join(artifacts_dir, 'plots'))
+        open(join(artifacts_dir, 'plots', 'a b.svg'), 'w').write('<svg/>')
+        self.run_summary['artifacts'] = {'succeeded': True, 'duration': 2.5,
+                                         'size': 300}
+        self.run_summary['test_suites'][0]['artifacts'] = [['plots/a b.svg',
+                                                            6]]
+
+        for i in range(2):
+            # Rewriting the report replaces the copied artifacts.
+            run_dir = write_report(self.report_root,
+                                   '20130101-120000-aaaaaaaa',
+                                   self.run_summary, self.build_logs(),
+                                   artifacts=[('QIIME', artifacts_dir)])
+        self.assertEqual(open(join(run_dir, 'artifacts', 'QIIME', 'plots',
+                                   'a b.svg')).read(), '<svg/>')
+        summary = loads(open(join(run_dir, 'summary.json')).read())
+        self.assertEqual(summary['artifact_dirs'],
+                         {'QIIME': 'artifacts/QIIME'})
+        html = open(join(run_dir, 'index.html')).read()
+        self.assertTrue('<li>Artifact collection: <span class="pass">Pass'
+                        '</span> (2.50s, 300 B)</li>' in html)
+        self.assertTrue('<li>QIIME: <a href="artifacts/QIIME/plots/a%20b.svg">'
+                        'plots/a b.svg</a> (6 B)</li>' in html)
+
+    def test_write_report_history(self):
+        """Test including past runs' results in a run's report."""
+        write_report(self.report_root, '20130101-120000-aaaaaaaa',
+                     self.run_summary, [])
+        self.run_summary['test_suites'][0]['status'] = 'fail'
+        write_report(self.report_root, '20130102-120000-bbbbbbbb',
+                     self.run_summary, [])
+
+        history = load_report_history(self.report_root)
+        self.assertEqual([s['run_id'] for s in history],
+                         ['20130101-120000-aaaaaaaa',
+                          '20130102-120000-bbbbbbbb'])
+        self.assertEqual([s['run_id'] for s in
+                          load_report_history(self.report_root, 1)],
+                         ['20130102-120000-bbbbbbbb'])
+        self.assertEqual([s['run_id'] for s in load_report_history(
+                          self.report_root,
+                          before='20130102-120000-bbbbbbbb')],
+                         ['20130101-120000-aaaaaaaa'])
+        self.assertEqual(load_report_history(join(self.report_root, 'foo')),
+                         [])
+
+        # The second run's report shows the first run's result in its trend,
+        # and the index lists both runs (newest first).
+        html = open(join(self.report_root, '20130102-120000-bbbbbbbb',
+                         'index.html')).read()
+        self.assertTrue('title="Pass, 33m 20s"' in html)
+        html = open(join(self.report_root, 'index.html')).read()
+        self.assertTrue(html.index('20130102-120000-bbbbbbbb') <
+                        html.index('20130101-120000-aaaaaaaa'))
+
+    def test_write_chunked_log(self):
+        """Test compressing a log into independently readable chunks."""
+        log_f = TemporaryFile(prefix='clout_temp_file_')
+        contents = ''.join(['line %d\n' % i for i in range(1000)])
+        log_f.write(contents)
+        log_f.seek(0, 0)
+
+        out_fp = join(self.report_root, 'log.gz')
+        write_chunked_log(log_f, out_fp, chunk_size=1000)
+        index = loads(open(out_fp + '.idx.json').read())
+        self.assertEqual(index['size'], len(contents))
+        self.assertEqual(len(index['chunks']), 9)
+
+        # The whole file is a valid gzip file.
+        compressed = open(out_fp, 'rb').read()
+        self.assertEqual(GzipFile(fileobj=StringIO(compressed)).read(),
+                         contents)
+
+        # Each chunk can be decompressed on its own.
+        for i, (offset, compressed_offset, compressed_length) in \
+                enumerate(index['chunks']):
+            chunk = compressed[compressed_offset:
+                               compressed_offset + compressed_length]
+            self.assertEqual(GzipFile(fileobj=StringIO(chunk)).read(),
+                             contents[offset:offset + 1000])
+
+    def test_write_chunked_log_empty(self):
+        """Test compressing an empty log."""
+        out_fp = join(self.report_root, 'log.gz')
+        write_chunked_log(TemporaryFile(prefix='clout_temp_file_'), out_fp)
+        self.assertEqual(loads(open(out_fp + '.idx.json').read())['chunks'],
+                         [])
+
+    def test_is_successful_run(self):
+        """Test determining whether a run passed."""
+        self.assertFalse(is_successful_run(self.run_summary))
+        self.run_summary['test_suites'] = self.run_summary['test_suites'][:1]
+        self.assertTrue(is_successful_run(self.run_summary))
+        self.run_summary['teardown']['succeeded'] = None
+        self.assertFalse(is_successful_run(self.run_summary))
+
+    def test_get_test_suite_trend(self):
+        """Test finding a test suite's results in past runs."""
+        history = [{'test_suites': [{'label': 'QIIME', 'status': 'pass',
+                                     'duration': 10.0}]},
+                   {'test_suites': []},
+                   {'test_suites': [{'label': 'QIIME', 'status': 'fail',
+                                     'duration': 5.0}]}]
+        self.assertEqual(get_test_suite_trend('QIIME', history),
+                         [('pass', 10.0), ('fail', 5.0)])
+        self.assertEqual(get_test_suite_trend('PyNAST', history), [])
+
+    def test_format_run_report(self):
+        """Test formatting the HTML report of a run."""
+        summary = dict(self.run_summary, run_id='20130101-120000-aaaaaaaa',
+                       log_files={}, succeeded=False)
+        obs = format_run_report(summary, [])
+        self.assertTrue(obs.startswith('<!DOCTYPE html>'))
+        self.assertTrue('<title>Clout run 20130101-120000-aaaaaaaa</title>' in
+                        obs)
+        self.assertTrue('Cluster setup: <span class="pass">Pass</span> '
+                        '(2m 00s)' in obs)
+        self.assertTrue('<td class="not_run">Not run</td>' in obs)
+        self.assertFalse('Cluster size' in obs)
+        self.assertFalse('<h2>Steps</h2>' in obs)
+
+        summary['test_suites'][0]['steps'] = [
+                {'name': 'download', 'start': 0.0, 'duration': 65.0},
+                {'name': '<test>', 'start': 65.0, 'duration': 30.0}]
+        self.assertTrue('<h2>Steps</h2>\n<ul><li>QIIME: download (1m 05s), '
+                        '&lt;test&gt; (30s)</li></ul>' in
+                        format_run_report(summary, []))
+
+        summary['test_suites'][0]['interrupted_attempts'] = [
+                {'node': 'node001', 'duration': 30.0}]
+        self.assertTrue('<li>Interrupted by lost nodes (and run again): QIIME '
+                        'on node001 after 30s</li>' in
+                        format_run_report(summary, []))
+
+        summary['snapshots'] = [{'label': 'QIIME (python=2.7)',
+                                 'key': '3f2a9c0d1e4b5a6', 'status': 'hit',
+                                 'captured': False}]
+        self.assertTrue('<li>Setup snapshots: QIIME (python=2.7): restored '
+                        'from snapshot 3f2a9c0d1e4b</li>' in
+                        format_run_report(summary, []))
+
+        summary['cluster_plan'] = {'num_nodes': 2, 'deadline': 40.0,
+                                   'predicted_duration': 1800.0,
+                                   'predicted_cost': 1.0,
+                                   'actual_duration': 2000.0,
+                                   'actual_cost': 1.25}
+        self.assertTrue('<li>Cluster size: 2 node(s) for a deadline of 40.0 '
+                        'minute(s) (predicted 30m 00s and 1.00 node-hours, '
+                        'actual 33m 20s and 1.25 node-hours)</li>' in
+                        format_run_report(summary, []))
+
+        summary['cluster_lease'] = {'cluster_tag': 'clout_pool_1',
+                                    'run_id': 'run1', 'num_nodes': 1,
+                                    'reused': True, 'queue_wait': 30.0}
+        self.assertTrue('<li>Cluster pool: ran on clout_pool_1 (reused) after '
+                        'waiting 30s</li>' in format_run_report(summary, []))
+
+    def test_format_report_index(self):
+        """Test formatting the list of runs."""
+        obs = format_report_index([])
+        self.assertTrue('<h1>Clout runs</h1>' in obs)
+
+        summary = dict(self.run_summary, run_id='20130101-120000-aaaaaaaa',
+                       succeeded=False)
+        obs = format_report_index([summary])
+        self.assertTrue('<a href="20130101-120000-aaaaaaaa/index.html">' in
+                        obs)
+        self.assertTrue('<td>1</td><td>0</td><td>1</td><td>1</td>' in obs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the results.py module."""
+
+from StringIO import StringIO
+from unittest import main, TestCase
+
+from clout.results import (get_result_parser_names, JUnitXmlParser,
+                           NoseParser, parse_test_results,
+                           summarize_test_results, UnittestParser)
+
+class ResultsTests(TestCase):
+    """Tests for the results.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        # Python 2.7 unittest output (run with -v). Tests with docstrings have
+        # their ID printed on the line before.
+        self.unittest_output = [
+            "Command:\n", "\n", "python tests/all_tests.py\n", "\n",
+            "Stdout:\n", "\n",
+            "test_foo (test_util.UtilTests) ... ok\n",
+            "test_bar (test_util.UtilTests)\n",
+            "Test the bar function. ... FAIL\n",
+            "test_baz (test_util.UtilTests) ... some output\n",
+            "ERROR\n",
+            "test_skip (test_util.UtilTests) ... skipped 'not on Windows'\n",
+            "test_xfail (test_util.UtilTests) ... expected failure\n",
+            "\n",
+            "======================================================\n",
+            "FAIL: test_bar (test_util.UtilTests)\n",
+            "Ran 5 tests in 0.010s\n"]
+
+        # nose output (run with -v).
+        self.nose_output = [
+            "test_parse.test_function ... ok\n",
+            "Test a thing. ... FAIL\n",
+            "test_skip (test_parse.ParseTests) ... SKIP: no network\n",
+            "test_foo (test_parse.ParseTests) ... ok\n",
+            "Ran 4 tests in 0.010s\n"]
+
+        # A JUnit XML report printed after some other output.
+        self.junit_output = [
+            "Stdout:\n", "\n", "Some other output\n",
+            '<?xml version="1.0" encoding="UTF-8"?><testsuite name="nose" '
+            'tests="4" errors="1" failures="1" skip="1">'
+            '<testcase classname="test_parse.ParseTests" name="test_foo" '
+            'time="0.125"></testcase>\n',
+            '<testcase classname="test_parse.ParseTests" name="test_bar" '
+            'time="2.5"><failure type="AssertionError" message="1 != 2">\n',
+            'Traceback: 1 != 2 &lt;foo&gt;\n',
+            '</failure></testcase>\n',
+            '<testcase classname="test_parse" name="test_function" '
+            'time="0.001"><error type="ValueError"></error></testcase>\n',
+            '<testcase classname="test_parse" name="test_skip" time="0">'
+            '<skipped /></testcase></testsuite>\n',
+            "More output\n"]
+
+    def parse(self, parser, lines):
+        for line in lines:
+            parser.feed(line)
+        return [(r['name'], r['status'], r['duration'])
+                for r in parser.close()]
+
+    def test_unittest_parser(self):
+        """Test parsing Python unittest output."""
+        obs = self.parse(UnittestParser(), self.unittest_output)
+        self.assertEqual(obs,
+                         [('test_util.UtilTests.test_foo', 'pass', None),
+                          ('test_util.UtilTests.test_bar', 'fail', None),
+                          ('test_util.UtilTests.test_baz', 'error', None),
+                          ('test_util.UtilTests.test_skip', 'skip', None),
+                          ('test_util.UtilTests.test_xfail', 'pass', None)])
+
+    def test_unittest_parser_python3(self):
+        """Test parsing Python 3.11+ unittest output."""
+        obs = self.parse(UnittestParser(),
+                         ["test_foo (test_util.UtilTests.test_foo) ... ok\n"])
+        self.assertEqual(obs, [('test_util.UtilTests.test_foo', 'pass',
+                                None)])
+
+    def test_nose_parser(self):
+        """Test parsing nose output."""
+        obs = self.parse(NoseParser(), self.nose_output)
+        self.assertEqual(obs,
+                         [('test_parse.test_function', 'pass', None),
+                          ('Test a thing.', 'fail', None),
+                          ('test_parse.ParseTests.test_skip', 'skip', None),
+                          ('test_parse.ParseTests.test_foo', 'pass', None)])
+
+    def test_junit_xml_parser(self):
+        """Test parsing a JUnit XML report in a test suite's output."""
+        obs = self.parse(JUnitXmlParser(), self.junit_output)
+        self.assertEqual(obs,
+                         [('test_parse.ParseTests.test_foo', 'pass', 0.125),
+                          ('test_parse.ParseTests.test_bar', 'fail', 2.5),
+                          ('test_parse.test_function', 'error', 0.001),
+                          ('test_parse.test_skip', 'skip', 0.0)])
+
+        # Multiple reports, and a corrupt report, in the same output.
+        obs = self.parse(JUnitXmlParser(),
+                ['<testsuite><testcase name="a"/></testsuite>\n',
+                 '<testsuite><testcase name="b"></foo>\n',
+                 '<testsuites><testsuite><testcase name="c" time="1"/>\n',
+                 '</testsuite></testsuites>\n'])
+        self.assertEqual(obs, [('a', 'pass', None), ('c', 'pass', 1.0)])
+
+    def test_parse_test_results(self):
+        """Test detecting the format of a log and parsing it."""
+        log_f = StringIO(''.join(self.unittest_output))
+        parser_name, results = parse_test_results(log_f)
+        self.assertEqual(parser_name, 'unittest')
+        self.assertEqual(len(results), 5)
+
+        # JUnit XML is preferred, even if verbose output was also printed.
+        log_f = StringIO(''.join(self.unittest_output + self.junit_output))
+        parser_name, results = parse_test_results(log_f)
+        self.assertEqual(parser_name, 'junit')
+        self.assertEqual(len(results), 4)
+
+        log_f = StringIO(''.join(self.unittest_output + self.junit_output))
+        parser_name, results = parse_test_results(log_f, 'nose')
+        self.assertEqual(parser_name, 'nose')
+
+        self.assertEqual(parse_test_results(StringIO('foo\n')), (None, []))
+        self.assertEqual(parse_test_results(
+                StringIO(''.join(self.unittest_output)), 'none'), (None, []))
+
+    def test_get_result_parser_names(self):
+        """Test looking up the parsers for a results format."""
+        self.assertEqual(get_result_parser_names('auto'),
+                         ['junit', 'unittest', 'nose'])
+        self.assertEqual(get_result_parser_names('nose'), ['nose'])
+        self.assertEqual(get_result_parser_names('none'), [])
+        self.assertRaises(ValueError, get_result_parser_names, 'foo')
+
+    def test_summarize_test_results(self):
+        """Test summarizing individual test results."""
+        results = [{'name': 'a', 'status': 'pass', 'duration': 1.0},
+                   {'name': 'b', 'status': 'fail', 'duration': 3.0},
+                   {'name': 'c', 'status': 'error', 'duration': None},
+                   {'name': 'd', 'status': 'pass', 'duration': 2.0},
+                   {'name': 'e', 'status': 'skip', 'duration': 0.0}]
+        obs = summarize_test_results(results, num_slowest=2)
+        self.assertEqual(obs['counts'], {'pass': 2, 'fail': 1, 'error': 1,
+                                         'skip': 1})
+        self.assertEqual(obs['failures'], [['b', 'fail'], ['c', 'error']])
+        self.assertEqual(obs['slowest'], [['b', 3.0], ['d', 2.0]])
+        self.assertEqual(obs['durations'], {'a': 1.0, 'b': 3.0, 'd': 2.0,
+                                            'e': 0.0})
+
+
+if __name__ == "__main__":
+    main()
@@ -11,12 +11,32 @@ __email__ = "jai.rideout@gmail.com"
 
 """Test suite for the run.py module."""
 
+from os import getpid, mkdir
+from os.path import exists, join
 from re import sub
+from shlex import split
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import main, TestCase
 
+from clout.backend import LocalBackend, StarClusterBackend
+from clout.history import RunHistory
 from clout.parse import parse_config_file
-from clout.run import (_build_test_execution_commands,
-                       _execute_commands_and_build_email, run_test_suites)
+from clout.progress import ProgressReporter, read_progress
+from clout.matrix import expand_matrices
+from clout.run import (_build_artifact_commands, _build_backend_commands,
+                       _build_matrix_setup_commands,
+                       _build_node_removal_commands, _build_profile_commands,
+                       _build_snapshot_commands, _build_spot_node_commands,
+                       _build_stage_commands,
+                       _build_test_execution_commands,
+                       _execute_commands_and_build_email,
+                       _get_run_config_hash, _get_test_suite_batches,
+                       _get_test_suite_timeouts,
+                       _get_test_suites_output_filters,
+                       _validate_suite_options, check_test_suites,
+                       run_test_suites)
+from clout.state import RunState
 
 class RunTests(TestCase):
     """Tests for the run.py module."""
@@ -27,6 +47,11 @@ class RunTests(TestCase):
         self.config = ["# a comment", " ",
                 "QIIME\tsource /bin/setup.sh; cd /bin; ./tests.py",
                 "PyCogent\t/bin/cogent_tests"]
+        self.runs_dir = mkdtemp(prefix='clout_temp_dir_')
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.runs_dir)
 
     def test_run_test_suites_invalid_input(self):
         """Test passing in bad input to run_test_suites()."""
@@ -37,6 +62,60 @@ class RunTests(TestCase):
         self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, -1,
                 0, 0)
 
+        # The cluster pool needs a state directory, and can't be used with
+        # autoscaled or warm clusters.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, use_pool=True)
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, state_dir=self.runs_dir, use_pool=True,
+                autoscale_deadline=30.0)
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, state_dir=self.runs_dir, use_pool=True,
+                terminate_cluster=False)
+
+        # Spot instances need an autoscaled cluster and a positive bid.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, spot_bid=0.05)
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, autoscale_deadline=30.0, spot_bid=0)
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, autoscale_deadline=30.0, spot_bid=0.05,
+                spot_fallback='reserved')
+
+        # The snapshot store's limits must be positive.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, snapshot_max_size=0)
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, snapshot_max_age=-1.0)
+
+        # The output filters must be recognized.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, output_filters='progress,foo')
+
+        # The preflight checks must be given time to run.
+        self.assertRaises(ValueError, run_test_suites, 1, 1, 1, 1, 1, 1, 1, 10,
+                10, 10, preflight_timeout=0)
+
+    def test_check_test_suites(self):
+        """Test running a run's preflight checks without running it."""
+        config = ['QIIME\techo (\n', 'PyCogent\techo ok\n']
+        # Nothing listens on port 1, so the SMTP login fails right away.
+        email_settings = ['smtp_server\tlocalhost\n', 'smtp_port\t1\n',
+                          'sender\tfoo@bar.baz\n', 'password\t1234\n']
+        backend = LocalBackend(self.runs_dir)
+        results = check_test_suites(config, None, email_settings,
+                                    backend=backend)
+        self.assertEqual([result['name'] for result in results],
+                         ['SMTP login', 'command syntax'])
+        self.assertTrue(results[0]['error'] is not None)
+        self.assertTrue('QIIME:' in results[1]['error'])
+        self.assertFalse('PyCogent' in results[1]['error'])
+
+        self.assertRaises(ValueError, check_test_suites, config, None,
+                          email_settings, backend=backend, timeout=0)
+        self.assertRaises(ValueError, check_test_suites, ['QIIME\n'], None,
+                          email_settings, backend=backend)
+
     def test_build_test_execution_commands_standard(self):
         """Test building commands based on standard, valid input."""
         exp = (["starcluster -c sc_config start nightly_tests"],
@@ -90,6 +169,309 @@ class RunTests(TestCase):
         obs = _build_test_execution_commands([], 'sc_config', 'nightly_tests')
         self.assertEqual(obs, exp)
 
+    def test_build_backend_commands(self):
+        """Test building commands with a non-starcluster backend."""
+        exp = (["mkdir -p /foo/nightly_tests"],
+               ["cd /foo/nightly_tests && /bin/sh -c 'source /bin/setup.sh; "
+                "cd /bin; ./tests.py'",
+                "cd /foo/nightly_tests && /bin/sh -c /bin/cogent_tests"],
+               ["rm -rf /foo/nightly_tests"])
+
+        test_suites = parse_config_file(self.config)
+        obs = _build_backend_commands(test_suites, LocalBackend('/foo'),
+                                      'nightly_tests')
+        self.assertEqual(obs, exp)
+
+    def test_build_backend_commands_autoscaled(self):
+        """Test building commands for a cluster with several nodes."""
+        test_suites = parse_config_file(self.config)
+        backend = StarClusterBackend('sc_config')
+        obs = _build_backend_commands(test_suites, backend, 'nightly_tests',
+                                      cluster_plan={'num_nodes': 2})
+        self.assertEqual(obs[0], ["starcluster -c sc_config start -s 2 "
+                                  "nightly_tests"])
+        self.assertEqual(obs[1][1], ["starcluster -c sc_config sshmaster -u "
+                                     "root nightly_tests '/bin/cogent_tests'",
+                                     "starcluster -c sc_config sshnode -u "
+                                     "root nightly_tests node001 "
+                                     "'/bin/cogent_tests'"])
+
+        # A single node runs every test suite.
+        obs = _build_backend_commands(test_suites, backend, 'nightly_tests',
+                                      cluster_plan={'num_nodes': 1})
+        self.assertEqual(obs[0], ["starcluster -c sc_config start -s 1 "
+                                  "nightly_tests"])
+        self.assertEqual(obs[1][1], "starcluster -c sc_config sshmaster -u "
+                                    "root nightly_tests '/bin/cogent_tests'")
+
+        # The nodes of a cluster with a spot bid are spot instances.
+        obs = _build_backend_commands(test_suites, backend, 'nightly_tests',
+                                      cluster_plan={'num_nodes': 2,
+                                                    'spot_bid': 0.05})
+        self.assertEqual(obs[0], ["starcluster -c sc_config start -s 2 -b "
+                                  "0.05 nightly_tests"])
+
+    def test_build_node_removal_commands(self):
+        """Test building the commands that remove idle nodes."""
+        obs = _build_node_removal_commands(StarClusterBackend('sc_config'),
+                                           'nightly_tests', 3)
+        self.assertEqual(obs, [None, "starcluster -c sc_config removenode -c "
+                                     "nightly_tests node001",
+                               "starcluster -c sc_config removenode -c "
+                               "nightly_tests node002"])
+        self.assertEqual(_build_node_removal_commands(
+                StarClusterBackend('sc_config'), 'nightly_tests', 1), [None])
+
+    def test_build_spot_node_commands(self):
+        """Test building the commands that check for and replace lost spot
+        nodes.
+        """
+        backend = StarClusterBackend('sc_config')
+        obs = _build_spot_node_commands(backend, 'nightly_tests', 2, 0.05,
+                                        'on_demand')
+        self.assertEqual(obs, ([None, "starcluster -c sc_config sshnode -u "
+                                      "root nightly_tests node001 'true'"],
+                               [None, [('spot', "starcluster -c sc_config "
+                                                "addnode -a node001 -b 0.05 "
+                                                "nightly_tests"),
+                                       ('on_demand', "starcluster -c "
+                                                     "sc_config addnode -a "
+                                                     "node001 "
+                                                     "nightly_tests")]]))
+        self.assertEqual(_build_spot_node_commands(backend, 'nightly_tests',
+                                                   2, 0.05, 'spot')[1][1],
+                         [('spot', "starcluster -c sc_config addnode -a "
+                                   "node001 -b 0.05 nightly_tests")])
+        self.assertEqual(_build_spot_node_commands(backend, 'nightly_tests',
+                                                   3, 0.05, 'none')[1],
+                         [None, [], []])
+
+    def test_build_backend_commands_profiled(self):
+        """Test building commands for test suites that are profiled."""
+        test_suites = parse_config_file(self.config)
+        obs = _build_backend_commands(test_suites, LocalBackend('/foo'),
+                                      'nightly_tests',
+                                      {'QIIME': {}, 'PyCogent': {'profile':
+                                                                 'resources'}})
+        self.assertEqual(obs[1][0], "cd /foo/nightly_tests && /bin/sh -c "
+                         "'source /bin/setup.sh; cd /bin; ./tests.py'")
+        self.assertEqual(obs[1][1], "cd /foo/nightly_tests && /bin/sh -c "
+                         "'mkdir -p .clout_profiles/PyCogent && /usr/bin/time "
+                         "-v -o .clout_profiles/PyCogent/resources.txt sh -c "
+                         "\"/bin/cogent_tests\"'")
+
+    def test_build_backend_commands_staged(self):
+        """Test building commands for test suites that stage a directory."""
+        test_suites = parse_config_file(self.config)
+        obs = _build_backend_commands(test_suites, LocalBackend('/foo'),
+                                      'nightly_tests',
+                                      {'PyCogent': {'stage': '/src/cogent',
+                                                    'profile': 'resources'}})
+        self.assertEqual(obs[1][1], "cd /foo/nightly_tests && /bin/sh -c "
+                         "'mkdir -p .clout_profiles/PyCogent && /usr/bin/time "
+                         "-v -o .clout_profiles/PyCogent/resources.txt sh -c "
+                         "\"cd .clout_stage/src_cogent && "
+                         "/bin/cogent_tests\"'")
+
+    def test_build_backend_commands_steps(self):
+        """Test building commands for test suites whose commands are
+        steps."""
+        obs = _build_backend_commands([['QIIME', 'wget q.tgz && ./tests.py'],
+                                       ['PyCogent', 'wget c.tgz && a']],
+                                      LocalBackend('/foo'), 'nightly_tests',
+                                      {'QIIME': {'steps': 'commands'}})
+        self.assertEqual(obs[1][0], "cd /foo/nightly_tests && /bin/sh -c "
+                         "'echo \"::clout-step wget q.tgz\" && wget q.tgz && "
+                         "echo \"::clout-step ./tests.py\" && ./tests.py'")
+        self.assertEqual(obs[1][1], "cd /foo/nightly_tests && /bin/sh -c "
+                         "'wget c.tgz && a'")
+
+        # StarCluster wraps the remote command in single quotes, so the
+        # whole command (redirects included) must stay a single argument.
+        cmd = 'wget http://x/a.tgz > /dev/null && tar zxvf a.tgz && ./t.py'
+        obs = _build_backend_commands([['QIIME', cmd]],
+                                      StarClusterBackend('sc_config'),
+                                      'nightly_tests',
+                                      {'QIIME': {'steps': 'commands'}})
+        self.assertEqual(split(obs[1][0]),
+                         ['starcluster', '-c', 'sc_config', 'sshmaster', '-u',
+                          'root', 'nightly_tests',
+                          'echo "::clout-step wget http://x/a.tgz > '
+                          '/dev/null" && wget http://x/a.tgz > /dev/null && '
+                          'echo "::clout-step tar zxvf a.tgz" && tar zxvf '
+                          'a.tgz && echo "::clout-step ./t.py" && ./t.py'])
+
+    def test_build_stage_commands(self):
+        """Test building the command that syncs staged directories."""
+        test_suites = parse_config_file(self.config) + [['Foo', 'foo']]
+        links_dir = join(self.runs_dir, 'stage')
+        src_dir = join(self.runs_dir, 'src')
+        mkdir(src_dir)
+
+        # Test suites that stage the same directory share one copy of it.
+        obs = _build_stage_commands(test_suites, LocalBackend('/foo'),
+                                    'nightly_tests',
+                                    {'QIIME': {'stage': src_dir},
+                                     'Foo': {'stage': src_dir}}, links_dir)
+        self.assertEqual(obs, ["rsync -a --delete --copy-dirlinks %s/%s "
+                               "/foo/nightly_tests/.clout_stage/" % (links_dir,
+                               src_dir.strip('/').replace('/', '_'))])
+
+    def test_build_matrix_setup_commands(self):
+        """Test building the commands that run matrices' shared setup."""
+        test_suites, suite_options, matrices = expand_matrices(
+                parse_config_file(self.config),
+                {'QIIME': {'matrix': 'python:2.6,2.7;deps:stable,dev',
+                           'setup': 'python:virtualenv env{python}',
+                           'stage': '/src/qiime'}})
+        obs = _build_matrix_setup_commands(matrices, LocalBackend('/foo'),
+                                           'nightly_tests', suite_options)
+        self.assertEqual(obs, ["cd /foo/nightly_tests && /bin/sh -c 'cd "
+                               ".clout_stage/src_qiime && virtualenv "
+                               "env2.6'",
+                               "cd /foo/nightly_tests && /bin/sh -c 'cd "
+                               ".clout_stage/src_qiime && virtualenv "
+                               "env2.7'"])
+
+        # Matrices without a setup command don't need any commands.
+        matrices[0]['setup'] = []
+        self.assertEqual(_build_matrix_setup_commands(
+                matrices, LocalBackend('/foo'), 'nightly_tests',
+                suite_options), None)
+
+    def test_build_snapshot_commands(self):
+        """Test building the commands that restore and capture snapshots."""
+        test_suites, suite_options, matrices = expand_matrices(
+                parse_config_file(self.config),
+                {'QIIME': {'matrix': 'python:2.6,2.7;deps:stable,dev',
+                           'setup': 'python:virtualenv env{python}',
+                           'snapshot': 'env{python}',
+                           'stage': '/src/qiime'}})
+        backend = LocalBackend('/foo')
+        obs = _build_snapshot_commands(matrices, backend, 'nightly_tests',
+                                       suite_options, '/state/snapshots')
+        self.assertEqual([snapshot['label'] for snapshot in obs],
+                         ['QIIME (python=2.6)', 'QIIME (python=2.7)'])
+        self.assertNotEqual(obs[0]['key'], obs[1]['key'])
+
+        snapshot_fp = '/state/snapshots/%s.tar.gz' % obs[1]['key']
+        partial_fp = '%s.%d.tmp' % (snapshot_fp, getpid())
+        self.assertEqual(obs[1]['fp'], snapshot_fp)
+        self.assertEqual(obs[1]['restore_cmd'],
+                         "cd /foo/nightly_tests && /bin/sh -c 'cd "
+                         ".clout_stage/src_qiime && rm -rf env2.7 && tar xzf "
+                         "-' < %s" % snapshot_fp)
+        self.assertEqual(obs[1]['capture_cmd'],
+                         "mkdir -p /state/snapshots && { cd "
+                         "/foo/nightly_tests && /bin/sh -c 'cd "
+                         ".clout_stage/src_qiime && tar czf - env2.7' > %s "
+                         "&& mv %s %s; } || { rm -f %s; false; }" % (
+                         partial_fp, partial_fp, snapshot_fp, partial_fp))
+
+        # The same setup on a different kind of cluster has its own
+        # snapshot.
+        self.assertNotEqual(_build_snapshot_commands(matrices,
+                LocalBackend('/bar'), 'nightly_tests', suite_options,
+                '/state/snapshots')[1]['key'], obs[1]['key'])
+
+        # Setups that aren't snapshotted don't need any commands.
+        matrices[0]['snapshot'] = None
+        self.assertEqual(_build_snapshot_commands(matrices, backend,
+                'nightly_tests', suite_options, '/state/snapshots'), None)
+
+    def test_get_test_suite_batches(self):
+        """Test grouping matrix test suites' variants into batches."""
+        test_suites, suite_options, matrices = expand_matrices(
+                parse_config_file(self.config),
+                {'QIIME': {'matrix': 'python:2.6,2.7,3.3', 'workers': '2'}})
+        self.assertEqual(_get_test_suite_batches(test_suites, matrices),
+                         [[3, 2], [1, 1]])
+
+        # Variants that run on their own (e.g. the only one left when a run
+        # is resumed) don't need a batch of their own.
+        self.assertEqual(_get_test_suite_batches(test_suites[2:], matrices),
+                         [[1, 2], [1, 1]])
+        matrices[0]['workers'] = 1
+        self.assertEqual(_get_test_suite_batches(test_suites, matrices),
+                         [[1, 1], [1, 1], [1, 1], [1, 1]])
+        self.assertEqual(_get_test_suite_batches(test_suites, None),
+                         [[1, 1], [1, 1], [1, 1], [1, 1]])
+
+    def test_build_artifact_commands(self):
+        """Test building the commands that stream artifacts back."""
+        test_suites = parse_config_file(self.config)
+        obs = _build_artifact_commands(test_suites, LocalBackend('/foo'),
+                'nightly_tests', {'QIIME': {'artifacts': 'a.xml'},
+                                  'PyCogent': {'artifacts': 'b.xml',
+                                               'stage': '/src/cogent'}},
+                '/bar')
+        self.assertEqual(obs[0], 'mkdir -p /bar')
+        self.assertTrue(obs[1].startswith("cd /foo/nightly_tests && /bin/sh "
+                                          "-c 'top=\"$PWD\" && "))
+        self.assertTrue(obs[1].endswith("tar czhf - -C .clout_artifacts .; }' "
+                                        "> /bar/artifacts.tar.gz"))
+        self.assertTrue('(cd .clout_stage/src_cogent && for f in b.xml;' in
+                        obs[1])
+
+    def test_build_profile_commands(self):
+        """Test building the commands that prepare for and collect profiles.
+        """
+        test_suites = parse_config_file(self.config)
+        backend = LocalBackend('/foo')
+        profiles_dir = join(self.runs_dir, 'profiles')
+
+        obs = _build_profile_commands(test_suites, backend, 'nightly_tests',
+                                      {'PyCogent': {'profile': 'resources'}},
+                                      profiles_dir)
+        self.assertEqual(obs, (["cd /foo/nightly_tests && /bin/sh -c 'rm -rf "
+                                ".clout_profiles && mkdir -p "
+                                ".clout_profiles'"],
+                               ["mkdir -p %s" % profiles_dir,
+                                "cp -R /foo/nightly_tests/.clout_profiles %s" %
+                                profiles_dir]))
+        self.assertFalse(exists(profiles_dir))
+
+        # The Python profiler hook is copied to the cluster.
+        obs = _build_profile_commands(test_suites, backend, 'nightly_tests',
+                                      {'PyCogent': {'profile': 'python'}},
+                                      profiles_dir)
+        self.assertEqual(obs[0][1], "cp -R %s/python_hook /foo/nightly_tests/"
+                         ".clout_profiles" % profiles_dir)
+        self.assertTrue(exists(join(profiles_dir, 'python_hook',
+                                    'sitecustomize.py')))
+
+    def test_get_run_config_hash(self):
+        """Test that only identically-configured runs have equal hashes."""
+        def build_run_params(**params):
+            run_params = {'test_suites': parse_config_file(self.config),
+                          'suite_options': {'QIIME': {'timeout': 'auto'}},
+                          'setup_timeout': 20.0,
+                          'test_suites_timeout': 240.0,
+                          'teardown_timeout': 20.0,
+                          'recipients': ['foo@bar.baz']}
+            run_params.update(params)
+            return run_params
+
+        backend = StarClusterBackend('sc_config')
+        obs = _get_run_config_hash(build_run_params(), backend)
+        self.assertEqual(obs, _get_run_config_hash(build_run_params(),
+                                                   StarClusterBackend(
+                                                           'sc_config')))
+        self.assertNotEqual(obs, _get_run_config_hash(
+                build_run_params(test_suites=
+                                 parse_config_file(self.config)[:1]),
+                backend))
+        self.assertNotEqual(obs, _get_run_config_hash(build_run_params(),
+                StarClusterBackend('sc_config', user='ubuntu')))
+        for params in ({'recipients': ['foo2@bar2.baz2']},
+                       {'suite_options': None},
+                       {'suite_options': {'QIIME': {'timeout': '60'}}},
+                       {'setup_timeout': 10.0},
+                       {'test_suites_timeout': 120.0},
+                       {'teardown_timeout': 10.0}):
+            self.assertNotEqual(obs, _get_run_config_hash(
+                    build_run_params(**params), backend))
+
     def test_execute_commands_and_build_email(self):
         """Test functions correctly using standard, valid input."""
         obs = _execute_commands_and_build_email(
@@ -123,6 +505,531 @@ class RunTests(TestCase):
         self.assertEqual(log_f.read(),
             "Command:\n\necho bar\n\nStdout:\n\nbar\n\nStderr:\n\n\n")
 
+        run_summary = obs[2]
+        self.assertEqual(run_summary['setup']['succeeded'], True)
+        self.assertTrue(run_summary['setup']['duration'] >= 0)
+        self.assertEqual(run_summary['teardown']['succeeded'], True)
+        self.assertEqual([(t['label'], t['status'], t['ret_val'],
+                           t['log_name']) for t in run_summary['test_suites']],
+                         [('Test1', 'pass', 0, 'Test1_results.txt'),
+                          ('Test2', 'pass', 0, 'Test2_results.txt')])
+        self.assertTrue(run_summary['test_suites'][0]['duration'] >= 0)
+
+    def test_execute_commands_and_build_email_test_results(self):
+        """Test summarizing the individual test results of each suite."""
+        test1_cmd = ('echo "test_a (m.C) ... ok" && '
+                     'echo "test_b (m.C) ... FAIL"')
+        obs = _execute_commands_and_build_email(
+            [['Test1', test1_cmd], ['Test2', 'echo "test_c (m.C) ... ok"']],
+            ['echo setting up'],
+            [test1_cmd, 'echo "test_c (m.C) ... ok"'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag',
+            suite_options={'Test1': {}, 'Test2': {'results': 'none'}})
+        self.assertEqual(obs[0], 'Test1: Pass\nTest2: Pass\n\n'
+                         'Failing tests:\n\nTest1 (1 of 2 tests):\n'
+                         '    FAIL: m.C.test_b\n\n')
+
+        tests = obs[2]['test_suites'][0]['tests']
+        self.assertEqual(tests['parser'], 'unittest')
+        self.assertEqual(tests['counts']['pass'], 1)
+        self.assertEqual(obs[2]['test_suites'][1]['tests'], None)
+
+        # The logs can still be read from the beginning.
+        self.assertEqual(obs[1][1][1].read()[:8], 'Command:')
+
+    def test_validate_suite_options(self):
+        """Test validating per-suite options."""
+        _validate_suite_options({'Test1': {'results': 'junit'}, 'Test2': {}})
+        self.assertRaises(ValueError, _validate_suite_options,
+                          {'Test1': {'foo': 'bar'}})
+        self.assertRaises(ValueError, _validate_suite_options,
+                          {'Test1': {'results': 'foo'}})
+        _validate_suite_options({'Test1': {'profile': 'python'}})
+        self.assertRaises(ValueError, _validate_suite_options,
+                          {'Test1': {'profile': 'foo'}})
+        _validate_suite_options({'Test1': {'timeout': '2.5'},
+                                 'Test2': {'timeout': 'none'}})
+        for timeout in 'foo', '0', '-1':
+            self.assertRaises(ValueError, _validate_suite_options,
+                              {'Test1': {'timeout': timeout}})
+        _validate_suite_options({'Test1': {'stage': self.runs_dir,
+                                           'artifacts': 'htmlcov, *.xml'}})
+        self.assertRaises(ValueError, _validate_suite_options,
+                          {'Test1': {'artifacts': '/tmp/*.xml'}})
+        self.assertRaises(ValueError, _validate_suite_options,
+                          {'Test1': {'stage': join(self.runs_dir, 'foo')}})
+        _validate_suite_options({'Test1': {'steps': 'commands'}})
+        self.assertRaises(ValueError, _validate_suite_options,
+                          {'Test1': {'steps': 'foo'}})
+        _validate_suite_options({'Test1': {'filters': 'progress,cap:50'},
+                                 'Test2': {'filters': 'none'}})
+        self.assertRaises(ValueError, _validate_suite_options,
+                          {'Test1': {'filters': 'cap:0'}})
+
+    def test_get_test_suites_output_filters(self):
+        """Test determining the output filters of each test suite."""
+        test_suites = [['Test1', 'echo foo'], ['Test2', 'echo bar']]
+        self.assertEqual(_get_test_suites_output_filters(test_suites, None,
+                                                         'none'), None)
+        self.assertEqual(_get_test_suites_output_filters(test_suites,
+                {'Test2': {'filters': 'none'}}, 'repeats'),
+                [{'progress': False, 'repeats': True, 'cap': None}, None])
+        self.assertEqual(_get_test_suites_output_filters(test_suites,
+                {'Test1': {'filters': 'cap:10'}}, 'none'),
+                [{'progress': False, 'repeats': False, 'cap': 10}, None])
+
+    def test_get_test_suite_timeouts(self):
+        """Test determining each test suite's own timeout."""
+        test_suites = [['Test1', 'echo foo'], ['Test2', 'echo bar'],
+                       ['Test3', 'echo baz'], ['Test4', 'echo qux']]
+        suite_options = {'Test2': {'timeout': '2.5'},
+                         'Test3': {'timeout': 'none'}}
+
+        # Without any history, only explicit timeouts apply.
+        self.assertEqual(_get_test_suite_timeouts(test_suites, suite_options,
+                                                  None, 'nightly_tests', 240),
+                         [None, 2.5, None, None])
+
+        run_history = RunHistory(join(self.runs_dir, 'history.jsonl'))
+        for i in range(5):
+            run_history.add_run('run%d' % i, {'cluster_tag': 'nightly_tests',
+                    'test_suites': [{'label': label, 'status': 'pass',
+                                     'duration': 600.0 + i}
+                                    for label, cmd in test_suites[:3]]})
+        obs = _get_test_suite_timeouts(test_suites, suite_options, run_history,
+                                       'nightly_tests', 240)
+        self.assertEqual(obs, [20.1, 2.5, None, None])
+
+        # The timeout for all of the test suites is the ceiling, and only
+        # runs with the same cluster tag count.
+        self.assertEqual(_get_test_suite_timeouts(test_suites, {},
+                                                  run_history,
+                                                  'nightly_tests', 15)[0], 15)
+        self.assertEqual(_get_test_suite_timeouts(test_suites, {},
+                                                  run_history, 'other', 240),
+                         [None, None, None, None])
+
+    def test_execute_commands_and_build_email_test_suite_timeouts(self):
+        """Test stopping a test suite that exceeds its own timeout."""
+        run_state = RunState.create(self.runs_dir, {})
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'sleep 10'], ['Test2', 'echo bar']],
+            ['echo setting up'], ['sleep 10', 'echo bar'],
+            ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+            run_state=run_state, test_suites_timeouts=[0.002, None])
+        self.assertEqual(obs[0], 'Test1: Fail\nTest2: Pass\n\nThe following '
+                         'test suites took longer than their own timeouts '
+                         'and were stopped: Test1 (0.002 minute(s))\n\n')
+        self.assertEqual([(t['status'], t['timeout'], t['timeout_exceeded'])
+                          for t in obs[2]['test_suites']],
+                         [('timeout', 0.002, True), ('pass', None, False)])
+        self.assertEqual([e['timeout_exceeded'] for e in
+                          run_state.get_events('test_suite_finished')],
+                         [True, False])
+
+        # A resumed run remembers which test suites exceeded their timeouts.
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'sleep 10'], ['Test2', 'echo bar']],
+            ['echo setting up'], ['sleep 10', 'echo bar'],
+            ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+            run_state=run_state)
+        self.assertEqual(obs[2]['test_suites'][0]['status'], 'timeout')
+
+    def test_execute_commands_and_build_email_staged(self):
+        """Test staging local directories before the test suites run."""
+        run_state = RunState.create(self.runs_dir, {})
+        obs = _execute_commands_and_build_email([['Test1', 'echo foo']],
+                ['echo setting up'], ['echo foo'], ['echo tearing down'], 1,
+                1, 1, 'test-cluster-tag', run_state=run_state,
+                stage_cmds=['exit 1'])
+        self.assertEqual(obs[0], 'There were problems in staging local '
+                         'directories on the remote cluster, so the test '
+                         'suites that use them may fail. Please check the '
+                         'attached log for more details.\n\nTest1: Pass\n\n')
+        self.assertEqual([e['succeeded'] for e in
+                          run_state.get_events('stage_synced')], [False])
+
+        # Staging isn't repeated if the run is resumed.
+        _execute_commands_and_build_email([['Test1', 'echo foo']],
+                ['echo setting up'], ['echo foo'], ['echo tearing down'], 1,
+                1, 1, 'test-cluster-tag', run_state=run_state,
+                stage_cmds=['exit 1'])
+        self.assertEqual(len(run_state.get_events('stage_synced')), 1)
+
+    def test_execute_commands_and_build_email_matrix(self):
+        """Test running a matrix test suite's setup and variants."""
+        test_suites, suite_options, matrices = expand_matrices(
+                [['Test1', 'echo {python}; test {python} != 2.7']],
+                {'Test1': {'matrix': 'python:2.6,2.7',
+                           'setup': 'python:echo setup {python}',
+                           'workers': '2'}})
+        run_state = RunState.create(self.runs_dir, {})
+        obs = _execute_commands_and_build_email(test_suites,
+                ['echo setting up'], [cmd for label, cmd in test_suites],
+                ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+                run_state=run_state, suite_options=suite_options,
+                matrix_setup_cmds=['echo setup 2.6', 'echo setup 2.7'],
+                matrices=matrices)
+        self.assertEqual(obs[0], 'Test1 (python=2.6): Pass\n'
+                         'Test1 (python=2.7): Fail\n\n'
+                         'Test1:\n\npython=2.6  Pass\npython=2.7  Fail\n\n')
+        self.assertEqual([e['succeeded'] for e in
+                          run_state.get_events('matrix_setup_finished')],
+                         [True])
+        log = obs[1][0][1].read()
+        self.assertTrue(log.index('setting up') < log.index('setup 2.6') <
+                        log.index('setup 2.7') < log.index('echo 2.6'))
+
+        # The variants' results are reported in order, even though they ran
+        # at the same time.
+        self.assertEqual([attachment[0] for attachment in obs[1]],
+                         ['complete_log.txt',
+                          'Test1 (python=2.6)_results.txt',
+                          'Test1 (python=2.7)_results.txt'])
+
+    def test_execute_commands_and_build_email_autoscaled(self):
+        """Test running test suites on several nodes and removing idle ones.
+        """
+        test_suites = [['Test1', 'a'], ['Test2', 'b'], ['Test3', 'c']]
+        test_suites_cmds = [['sleep 1; echo %s on master' % cmd,
+                             'echo %s on node001' % cmd]
+                            for label, cmd in test_suites]
+        cluster_plan = {'num_nodes': 2, 'deadline': 1.0, 'max_nodes': 2,
+                        'predicted_duration': 60.0, 'predicted_cost': 0.02,
+                        'meets_deadline': True, 'unknown_suites': []}
+        run_state = RunState.create(self.runs_dir, {})
+        obs = _execute_commands_and_build_email(test_suites,
+                ['echo setting up'], test_suites_cmds,
+                ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+                run_state=run_state, cluster_plan=cluster_plan,
+                node_removal_cmds=[None, 'echo removing node001'])
+        self.assertTrue(obs[0].startswith('Test1: Pass\nTest2: Pass\n'
+                                          'Test3: Pass\n\nCluster size: 2 '
+                                          'node(s), to run the test suites '
+                                          'within 1.0 minute(s)\n'))
+        self.assertTrue('    Idle nodes removed early: node001\n' in obs[0])
+
+        # The first test suite ran on the master while the others ran on the
+        # second node, which was removed once it had nothing left to run.
+        self.assertEqual([attachment[1].read().split('Stdout:\n\n')[1]
+                          .split('\n')[0] for attachment in obs[1][1:]],
+                         ['a on master', 'b on node001', 'c on node001'])
+        log = obs[1][0][1].read()
+        self.assertTrue(log.index('c on node001') <
+                        log.index('removing node001') <
+                        log.index('tearing down'))
+        self.assertEqual([(e['node'], e['succeeded']) for e in
+                          run_state.get_events('node_removed')], [(1, True)])
+
+        summary = obs[2]['cluster_plan']
+        self.assertEqual(summary['num_nodes'], 2)
+        self.assertEqual(summary['removed_nodes'], ['node001'])
+        self.assertTrue(1 <= summary['actual_duration'] < 10)
+        self.assertTrue(summary['actual_duration'] / 3600 <
+                        summary['actual_cost'] <
+                        2 * summary['actual_duration'] / 3600)
+
+    def test_execute_commands_and_build_email_snapshot(self):
+        """Test restoring matrix setups from snapshots in later runs."""
+        setups_fp = join(self.runs_dir, 'setups.txt')
+        test_suites, suite_options, matrices = expand_matrices(
+                [['Test1', 'cat env{python}/built']],
+                {'Test1': {'matrix': 'python:2.6,2.7',
+                           'setup': 'python:mkdir env{python} && echo '
+                                    '{python} > env{python}/built && echo '
+                                    '{python} >> %s' % setups_fp,
+                           'snapshot': 'env{python}'}})
+        backend = LocalBackend(join(self.runs_dir, 'clusters'))
+        snapshots_dir = join(self.runs_dir, 'snapshots')
+
+        def execute_run():
+            # Each run starts a fresh cluster and terminates it.
+            setup_cmds, test_suites_cmds, teardown_cmds = \
+                    _build_backend_commands(test_suites, backend, 'snap',
+                                            suite_options)
+            matrix_setup_cmds = _build_matrix_setup_commands(matrices,
+                    backend, 'snap', suite_options)
+            run_state = RunState.create(join(self.runs_dir, 'runs'), {})
+            obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                    test_suites_cmds, teardown_cmds, 1, 1, 1, 'snap',
+                    run_state=run_state, suite_options=suite_options,
+                    matrix_setup_cmds=matrix_setup_cmds, matrices=matrices,
+                    snapshot_cmds=_build_snapshot_commands(matrices, backend,
+                            'snap', suite_options, snapshots_dir))
+            self.assertEqual(
+                    run_state.get_events('matrix_setup_finished')[0]
+                    ['snapshots'], obs[2]['snapshots'])
+            return obs
+
+        # The first run builds each environment and snapshots it.
+        obs = execute_run()
+        self.assertTrue(obs[0].startswith('Test1 (python=2.6): Pass\n'
+                                          'Test1 (python=2.7): Pass\n\n'))
+        self.assertEqual([(snapshot['status'], snapshot['captured'])
+                          for snapshot in obs[2]['snapshots']],
+                         [('miss', True), ('miss', True)])
+        self.assertTrue('Setup snapshots:\n    Test1 (python=2.6): rebuilt '
+                        '(no snapshot), captured snapshot ' in obs[0])
+
+        # The second run restores them instead of running the setups again.
+        obs = execute_run()
+        self.assertTrue(obs[0].startswith('Test1 (python=2.6): Pass\n'
+                                          'Test1 (python=2.7): Pass\n\n'))
+        self.assertEqual([snapshot['status']
+                          for snapshot in obs[2]['snapshots']],
+                         ['hit', 'hit'])
+        setups_f = open(setups_fp, 'U')
+        self.assertEqual(setups_f.read(), '2.6\n2.7\n')
+        setups_f.close()
+
+        # A snapshot that can't be restored is rebuilt.
+        snapshot_fp = join(snapshots_dir, '%s.tar.gz' %
+                           obs[2]['snapshots'][1]['key'])
+        snapshot_f = open(snapshot_fp, 'w')
+        snapshot_f.write('not a snapshot')
+        snapshot_f.close()
+        obs = execute_run()
+        self.assertTrue(obs[0].startswith('Test1 (python=2.6): Pass\n'
+                                          'Test1 (python=2.7): Pass\n\n'))
+        self.assertEqual([(snapshot['status'], snapshot['captured'])
+                          for snapshot in obs[2]['snapshots']],
+                         [('hit', False), ('miss', True)])
+        setups_f = open(setups_fp, 'U')
+        self.assertEqual(setups_f.read(), '2.6\n2.7\n2.7\n')
+        setups_f.close()
+
+    def test_execute_commands_and_build_email_spot(self):
+        """Test running test suites again when their spot node is lost."""
+        # The second test suite preempts its node the first time it runs
+        # there, and the third test suite fails on its own.
+        test_suites = [['Test1', 'sleep 1; echo a'],
+                       ['Test2', 'if [ -n "$CLOUT_NODE" ] && [ ! -e lost ]; '
+                                 'then touch lost .clout_preempted_$CLOUT_NODE'
+                                 '; exit 1; fi; echo b'],
+                       ['Test3', 'sleep 0.5; exit 1']]
+        backend = LocalBackend(self.runs_dir)
+        cluster_plan = {'num_nodes': 2, 'deadline': 1.0, 'max_nodes': 2,
+                        'predicted_duration': 60.0, 'predicted_cost': 0.02,
+                        'meets_deadline': True, 'unknown_suites': [],
+                        'spot_bid': 0.05, 'spot_fallback': 'on_demand'}
+
+        for spot_fallback, replacement in ('on_demand', 'spot'), \
+                                          ('none', None):
+            cluster_plan['spot_fallback'] = spot_fallback
+            setup_cmds, test_suites_cmds, teardown_cmds = \
+                    _build_backend_commands(test_suites, backend, 'spot',
+                                            cluster_plan=cluster_plan)
+            node_check_cmds, node_replacement_cmds = \
+                    _build_spot_node_commands(backend, 'spot', 2, 0.05,
+                                              spot_fallback)
+            run_state = RunState.create(self.runs_dir, {})
+            obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                    test_suites_cmds, teardown_cmds, 1, 1, 1, 'spot',
+                    run_state=run_state, cluster_plan=cluster_plan,
+                    node_removal_cmds=_build_node_removal_commands(backend,
+                                                                   'spot', 2),
+                    node_check_cmds=node_check_cmds,
+                    node_replacement_cmds=node_replacement_cmds)
+
+            # The interrupted attempt is reported separately from the test
+            # suites' results, and only the genuine failure failed.
+            self.assertTrue(obs[0].startswith('Test1: Pass\nTest2: Pass\n'
+                                              'Test3: Fail\n\n'))
+            self.assertTrue('The following test suites were interrupted '
+                            'because the node running them was lost, and '
+                            'were run again (their results above are from '
+                            'their last attempt):\n    Test2: node001 after '
+                            in obs[0])
+            test_suite_summaries = obs[2]['test_suites']
+            self.assertEqual([[attempt['node'] for attempt in
+                               test_suite['interrupted_attempts']]
+                              for test_suite in test_suite_summaries],
+                             [[], ['node001'], []])
+            self.assertEqual(obs[2]['cluster_plan']['lost_nodes'],
+                             [{'node': 'node001',
+                               'replacement': replacement}])
+            self.assertEqual([(event['label'], event['node']) for event in
+                              run_state.get_events('test_suite_interrupted')],
+                             [('Test2', 'node001')])
+            self.assertEqual([(event['node'], event['replacement'])
+                              for event in run_state.get_events('node_lost')],
+                             [(1, replacement)])
+            log = obs[1][0][1].read()
+            self.assertTrue('Interrupted: the worker running the command was '
+                            'lost, so the command will be run again.' in log)
+
+        # A lost node that wasn't replaced was removed.
+        self.assertTrue('lost node001 (not replaced)' in obs[0])
+        self.assertEqual(obs[2]['cluster_plan']['removed_nodes'],
+                         ['node001'])
+
+    def test_execute_commands_and_build_email_matrix_setup_failure(self):
+        """Test a matrix test suite's setup failing."""
+        obs = _execute_commands_and_build_email([['Test1', 'echo foo']],
+                ['echo setting up'], ['echo foo'], ['echo tearing down'], 1,
+                1, 1, 'test-cluster-tag', matrix_setup_cmds=['exit 1'])
+        self.assertEqual(obs[0], 'There were problems in running the shared '
+                         'setup commands of the matrix test suites, so the '
+                         'variants that depend on them may fail. Please '
+                         'check the attached log for more details.\n\n'
+                         'Test1: Pass\n\n')
+
+    def test_execute_commands_and_build_email_profiles(self):
+        """Test collecting and summarizing the profiles of test suites."""
+        # Stand-in commands that 'collect' a profile for Test2.
+        profiles_dir = join(self.runs_dir, 'profiles')
+        profile_dir = join(profiles_dir, '.clout_profiles', 'Test2')
+        collect_cmd = ("mkdir -p %s && printf '\\tMaximum resident set size "
+                       "(kbytes): 2048\\n' > %s/resources.txt" %
+                       (profile_dir, profile_dir))
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo'], ['Test2', 'echo bar']],
+            ['echo setting up'], ['echo foo', 'echo bar'],
+            ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+            suite_options={'Test2': {'profile': 'resources'}},
+            profile_cmds=(['echo preparing'], [collect_cmd]),
+            profiles_dir=profiles_dir)
+        self.assertEqual(obs[0], 'Test1: Pass\nTest2: Pass\n\nProfiles:\n\n'
+                         'Test2:\n    Peak memory: 2.0 MB, CPU time: - user, '
+                         '- system, file system inputs/outputs: -/-\n\n')
+        self.assertEqual(obs[2]['test_suites'][0]['profile'], None)
+        self.assertEqual(obs[2]['test_suites'][1]['profile']['resources']
+                         ['max_rss_kb'], 2048)
+
+        # The profiling commands are run before and after the test suites.
+        log = obs[1][0][1].read()
+        self.assertTrue(log.index('preparing') < log.index('foo') <
+                        log.index('resources.txt') < log.index('tearing'))
+
+    def test_execute_commands_and_build_email_artifacts(self):
+        """Test collecting the artifacts that test suites leave behind."""
+        test_suites = [['Test1', 'echo foo > foo.xml'], ['Test2', 'echo bar']]
+        suite_options = {'Test1': {'artifacts': 'foo.xml'},
+                         'Test2': {'artifacts': 'bar*.xml'}}
+        backend = LocalBackend(self.runs_dir)
+        setup_cmds, test_suites_cmds, teardown_cmds = _build_backend_commands(
+                test_suites, backend, 'test-cluster-tag', suite_options)
+        artifacts_dir = join(self.runs_dir, 'artifacts')
+        artifact_cmds = _build_artifact_commands(test_suites, backend,
+                'test-cluster-tag', suite_options, artifacts_dir)
+
+        obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                test_suites_cmds, teardown_cmds, 1, 1, 1, 'test-cluster-tag',
+                suite_options=suite_options, artifact_cmds=artifact_cmds,
+                artifacts_dir=artifacts_dir)
+        self.assertTrue(obs[0].startswith('Test1: Pass\nTest2: Pass\n\n'
+                                          'Artifacts ('))
+        self.assertTrue(obs[0].endswith('):\n\nTest1: foo.xml (4 B)\n'
+                                        'Test2: none found\n\n'))
+        self.assertEqual([t['artifacts'] for t in obs[2]['test_suites']],
+                         [[['foo.xml', 4]], []])
+        self.assertTrue(obs[2]['artifacts']['succeeded'])
+        self.assertTrue(obs[2]['artifacts']['size'] > 0)
+        self.assertEqual(open(join(artifacts_dir, 'files', 'Test1',
+                                   'foo.xml')).read(), 'foo\n')
+
+        # The artifacts are collected before the cluster is terminated.
+        obs = _execute_commands_and_build_email(test_suites, setup_cmds,
+                test_suites_cmds, ['echo tearing down'], 1, 1, 1,
+                'test-cluster-tag', suite_options=suite_options,
+                artifact_cmds=['exit 1'], artifacts_dir=artifacts_dir)
+        self.assertTrue("There were problems in collecting the test suites' "
+                        "artifacts" in obs[0])
+        self.assertFalse(obs[2]['artifacts']['succeeded'])
+
+    def test_execute_commands_and_build_email_progress(self):
+        """Test reporting progress while the commands run."""
+        status_fp = join(self.runs_dir, 'status.jsonl')
+        progress = ProgressReporter(status_fp, heartbeat_interval=3600)
+        _execute_commands_and_build_email(
+                [['Test1', 'echo foo; echo bar'], ['Test2', 'exit 1']],
+                ['echo setting up'], ['echo foo; echo bar', 'exit 1'],
+                ['echo tearing down'], 1, 1, 1, 'test-cluster-tag',
+                progress=progress)
+        progress.close()
+
+        events = read_progress(status_fp)[0]
+        self.assertEqual([(e['event'], e.get('phase', e.get('label')))
+                          for e in events],
+                         [('phase_changed', 'setup'),
+                          ('phase_changed', 'test_suites'),
+                          ('suite_started', 'Test1'),
+                          ('output', 'Test1'),
+                          ('suite_finished', 'Test1'),
+                          ('suite_started', 'Test2'),
+                          ('suite_finished', 'Test2'),
+                          ('phase_changed', 'teardown')])
+        self.assertEqual(events[3]['last_line'], 'foo')
+        self.assertEqual([(e['status'], e['ret_val']) for e in events
+                          if e['event'] == 'suite_finished'],
+                         [('pass', 0), ('fail', 1)])
+
+    def test_execute_commands_and_build_email_steps(self):
+        """Test timing the steps that test suites' output marks."""
+        run_state = RunState.create(self.runs_dir, {})
+        cmd = ('echo ::clout-step download && sleep 0.3 && '
+               'echo ::clout-step test && echo ok')
+        obs = _execute_commands_and_build_email(
+                [['Test1', cmd], ['Test2', 'echo bar']], ['echo setting up'],
+                [cmd, 'echo bar'], ['echo tearing down'], 1, 1, 1,
+                'test-cluster-tag', run_state=run_state)
+
+        steps = obs[2]['test_suites'][0]['steps']
+        self.assertEqual([step['name'] for step in steps],
+                         ['download', 'test'])
+        self.assertTrue(steps[0]['duration'] >= 0.3)
+        self.assertTrue(steps[1]['start'] >= 0.3)
+        self.assertEqual(obs[2]['test_suites'][1]['steps'], [])
+        self.assertTrue('Steps:\n\nTest1:\n' in obs[0])
+        self.assertEqual(run_state.get_events('test_suite_finished')[0]
+                         ['steps'], steps)
+
+        # Each line of output is timestamped in the test suite's timeline.
+        timeline = run_state.open_log('Test1_0_timeline.txt').read()
+        self.assertEqual([line.split(None, 1)[1] for line in
+                          timeline.splitlines()],
+                         ['stdout ::clout-step download',
+                          'stdout ::clout-step test', 'stdout ok'])
+
+    def test_execute_commands_and_build_email_output_filters(self):
+        """Test filtering test suites' output as it is captured."""
+        run_state = RunState.create(self.runs_dir, {})
+        cmd = ('for i in 1 2 3 4 5; do echo "test_$i (m.C) ... ok"; done && '
+               'echo "test_6 (m.C) ... FAIL"')
+        output_filters = _get_test_suites_output_filters(
+                [['Test1', cmd], ['Test2', 'echo bar']],
+                {'Test2': {'filters': 'none'}}, 'repeats')
+        obs = _execute_commands_and_build_email(
+                [['Test1', cmd], ['Test2', 'echo bar']], ['echo setting up'],
+                [cmd, 'echo bar'], ['echo tearing down'], 1, 1, 1,
+                'test-cluster-tag', run_state=run_state,
+                test_suites_output_filters=output_filters,
+                keep_unfiltered_logs=True)
+
+        # Only the filtered output is attached, but the individual test
+        # results are parsed from the unfiltered output.
+        self.assertEqual(obs[1][1][1].read(),
+                         'Command:\n\n%s\n\nStdout:\n\n'
+                         'test_1 (m.C) ... ok\n[3 similar line(s) omitted]\n'
+                         'test_5 (m.C) ... ok\ntest_6 (m.C) ... FAIL\n\n'
+                         'Stderr:\n\n\n' % cmd)
+        self.assertEqual(obs[2]['test_suites'][0]['tests']['counts']['pass'],
+                         5)
+        self.assertTrue('Test1 (1 of 6 tests):\n    FAIL: m.C.test_6' in
+                        obs[0])
+
+        # The unfiltered log is kept in the run's directory.
+        self.assertEqual([(e['label'], e['unfiltered_log_name']) for e in
+                          run_state.get_events('test_suite_finished')],
+                         [('Test1', 'Test1_0_results_unfiltered.txt'),
+                          ('Test2', None)])
+        self.assertEqual(run_state.open_log(
+                'Test1_0_results_unfiltered.txt').read().count(' ... ok\n'),
+                5)
+        self.assertFalse(exists(join(run_state.log_dir,
+                                     'Test2_1_results_unfiltered.txt')))
+
     def test_execute_commands_and_build_email_failures(self):
         """Test functions correctly when a test suite fails."""
         obs = _execute_commands_and_build_email(
@@ -229,6 +1136,9 @@ class RunTests(TestCase):
         self.assertEqual(log_f.read(),
             "Command:\n\necho foo && sleep 5\n\n"
             "Stdout:\n\nfoo\n\nStderr:\n\n\n")
+        self.assertEqual([(t['label'], t['status'])
+                          for t in obs[2]['test_suites']],
+                         [('Test1', 'timeout'), ('Test2', 'not_run')])
 
         # Test a timeout that occurs in the last test suite to run.
         obs = _execute_commands_and_build_email(
@@ -310,6 +1220,129 @@ class RunTests(TestCase):
         self.assertEqual(log_f.read(),
             "Command:\n\necho foo\n\nStdout:\n\nfoo\n\nStderr:\n\n\n")
 
+    def test_execute_commands_and_build_email_journaled(self):
+        """Test journaling a run's progress and keeping its logs."""
+        run_state = RunState.create(self.runs_dir, {})
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo'], ['Test2', 'foobarbaz']],
+            ['echo setting up'],
+            ['echo foo', 'foobarbaz'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', run_state=run_state)
+        self.assertEqual(obs[0], 'Test1: Pass\nTest2: Fail\n\n')
+        self.assertEqual([name for name, log_f in obs[1]],
+                         ['complete_log.txt', 'Test1_results.txt',
+                          'Test2_results.txt'])
+        self.assertEqual(obs[1][1][1].read(),
+            "Command:\n\necho foo\n\nStdout:\n\nfoo\n\nStderr:\n\n\n")
+
+        self.assertEqual([e['event'] for e in run_state.get_events()],
+                         ['run_started', 'setup_started', 'setup_finished',
+                          'test_suite_finished', 'test_suite_finished',
+                          'test_suites_finished', 'teardown_finished'])
+        self.assertEqual([(e['label'], e['ret_val']) for e in
+                          run_state.get_events('test_suite_finished')],
+                         [('Test1', 0), ('Test2', 127)])
+        self.assertEqual(run_state.open_log('Test1_0_results.txt').read(),
+            "Command:\n\necho foo\n\nStdout:\n\nfoo\n\nStderr:\n\n\n")
+
+        # Labels that only differ in characters that aren't safe in filenames
+        # don't share a log.
+        run_state = RunState.create(self.runs_dir, {})
+        obs = _execute_commands_and_build_email(
+            [['a b', 'echo foo'], ['a/b', 'echo bar']],
+            ['echo setting up'],
+            ['echo foo', 'echo bar'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', run_state=run_state)
+        self.assertEqual([e['log_name'] for e in
+                          run_state.get_events('test_suite_finished')],
+                         ['a_b_0_results.txt', 'a_b_1_results.txt'])
+        self.assertEqual([log_f.read() for name, log_f in obs[1][1:]],
+            ["Command:\n\necho foo\n\nStdout:\n\nfoo\n\nStderr:\n\n\n",
+             "Command:\n\necho bar\n\nStdout:\n\nbar\n\nStderr:\n\n\n"])
+
+    def test_execute_commands_and_build_email_resumed(self):
+        """Test resuming a run that was interrupted during a test suite."""
+        # The cluster was started and the first test suite finished before
+        # the run was interrupted. The setup command and first test suite
+        # would fail if they were run again.
+        run_state = RunState.create(self.runs_dir, {})
+        run_state.record('setup_started')
+        run_state.record('setup_finished', succeeded=True)
+        log_f = run_state.open_log('Test1_results.txt')
+        log_f.write('Test1 log\n')
+        log_f.close()
+        run_state.record('test_suite_finished', label='Test1',
+                         log_name='Test1_results.txt', ret_val=0,
+                         timeout_occurred=False)
+        run_state.record('run_resumed')
+
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'foobarbaz'], ['Test2', 'echo bar']],
+            ['foobarbaz'],
+            ['foobarbaz', 'echo bar'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', run_state=run_state)
+        self.assertEqual(obs[0], 'This run was interrupted and has been '
+                         'resumed. Test suites that had already finished were '
+                         'not run again.\n\nTest1: Pass\nTest2: Pass\n\n')
+        self.assertEqual(obs[1][1][0], 'Test1_results.txt')
+        self.assertEqual(obs[1][1][1].read(), 'Test1 log\n')
+        self.assertEqual(obs[1][2][0], 'Test2_results.txt')
+        self.assertEqual(run_state.get_last_event('test_suite_finished')
+                         ['log_name'], 'Test2_1_results.txt')
+        self.assertEqual(obs[1][0][1].read(),
+            "Command:\n\necho bar\n\nStdout:\n\nbar\n\nStderr:\n\n\n"
+            "Command:\n\necho tearing down\n\nStdout:\n\ntearing down\n\n"
+            "Stderr:\n\n\n")
+
+    def test_execute_commands_and_build_email_resumed_during_setup(self):
+        """Test resuming a run that was interrupted while starting up."""
+        run_state = RunState.create(self.runs_dir, {})
+        run_state.record('setup_started')
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo']],
+            ['echo setting up'],
+            ['echo foo'],
+            ['echo tearing down'],
+            1, 1, 1, 'test-cluster-tag', run_state=run_state)
+        self.assertEqual(obs[0], 'Test1: Pass\n\n')
+
+        # The partially-started cluster is terminated before starting over.
+        self.assertEqual(obs[1][0][1].read(),
+            "Command:\n\necho tearing down\n\nStdout:\n\ntearing down\n\n"
+            "Stderr:\n\n\n"
+            "Command:\n\necho setting up\n\nStdout:\n\nsetting up\n\n"
+            "Stderr:\n\n\n"
+            "Command:\n\necho foo\n\nStdout:\n\nfoo\n\nStderr:\n\n\n"
+            "Command:\n\necho tearing down\n\nStdout:\n\ntearing down\n\n"
+            "Stderr:\n\n\n")
+
+    def test_execute_commands_and_build_email_resumed_after_teardown(self):
+        """Test resuming a run that was interrupted before sending email."""
+        run_state = RunState.create(self.runs_dir, {})
+        obs = _execute_commands_and_build_email(
+            [['Test1', 'echo foo && sleep 5'], ['Test2', 'echo bar']],
+            ['echo setting up'],
+            ['echo foo && sleep 5', 'echo bar'],
+            ['echo tearing down'],
+            1, 0.01, 1, 'test-cluster-tag', run_state=run_state)
+        num_events = len(run_state.get_events())
+
+        # Nothing is executed again, and the email is the same.
+        obs2 = _execute_commands_and_build_email(
+            [['Test1', 'echo foo && sleep 5'], ['Test2', 'echo bar']],
+            ['foobarbaz'],
+            ['foobarbaz', 'foobarbaz'],
+            ['foobarbaz'],
+            1, 0.01, 1, 'test-cluster-tag', run_state=run_state)
+        self.assertEqual(obs2[0], obs[0])
+        self.assertEqual(len(run_state.get_events()), num_events)
+        self.assertEqual(obs2[1][1][1].read(),
+            "Command:\n\necho foo && sleep 5\n\n"
+            "Stdout:\n\nfoo\n\nStderr:\n\n\n")
+
 
 if __name__ == "__main__":
     main()
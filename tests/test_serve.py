@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the serve.py module."""
+
+from datetime import datetime
+from json import loads
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event
+from unittest import main, TestCase
+from urllib2 import HTTPError, urlopen
+
+from clout.serve import (build_run_request, get_run_request_key, RunQueue,
+                         RunServer, submit_run)
+
+class ServeTests(TestCase):
+    """Tests for the serve.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.state_dir = mkdtemp(prefix='clout_temp_dir_')
+
+        self.options1 = {'config_fp': '/foo/config.txt',
+                         'sc_config_fp': '/foo/sc_config',
+                         'recipients_fp': '/foo/recipients.txt',
+                         'email_settings_fp': '/foo/email_settings.txt',
+                         'cluster_tag': 'nightly_tests'}
+        self.options2 = dict(self.options1, cluster_tag='other_tests')
+        self.options3 = dict(self.options1,
+                             cluster_template='some_cluster_template')
+
+        # A stand-in runner that records each run and optionally blocks until
+        # it is released.
+        self.runs = []
+        self.release = Event()
+        self.release.set()
+        self.terminated = []
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.state_dir)
+
+    def runner(self, request, start_cluster, terminate_cluster, state_dir):
+        self.runs.append((request['cluster_tag'], start_cluster,
+                          terminate_cluster))
+        self.release.wait()
+        if request['user'] == 'fail':
+            raise ValueError("Something went wrong.")
+        return request['user'] != 'setup_fails'
+
+    def terminator(self, request):
+        self.terminated.append(request['cluster_tag'])
+
+    def build_server(self, **kwargs):
+        return RunServer(self.state_dir, runner=self.runner,
+                         terminator=self.terminator, **kwargs)
+
+    def poll_and_wait(self, server, now=None):
+        for worker in server.poll(now):
+            worker.join()
+
+    def test_build_run_request(self):
+        """Test filling in defaults and converting timeouts."""
+        obs = build_run_request(dict(self.options1, setup_timeout='5'))
+        self.assertEqual(obs['setup_timeout'], 5.0)
+        self.assertEqual(obs['test_suites_timeout'], 240.0)
+        self.assertEqual(obs['user'], 'root')
+        self.assertEqual(obs['cluster_template'], None)
+        self.assertEqual(obs['cluster_tag'], 'nightly_tests')
+
+    def test_build_run_request_invalid(self):
+        """Test passing invalid run options."""
+        options = dict(self.options1)
+        del options['cluster_tag']
+        self.assertRaises(ValueError, build_run_request, options)
+        self.assertRaises(ValueError, build_run_request,
+                          dict(self.options1, foo='bar'))
+        self.assertRaises(ValueError, build_run_request,
+                          dict(self.options1, setup_timeout='abc'))
+        self.assertRaises(ValueError, build_run_request,
+                          dict(self.options1, teardown_timeout=0))
+
+    def test_get_run_request_key(self):
+        """Test that identical run requests have identical keys."""
+        self.assertEqual(
+                get_run_request_key(build_run_request(self.options1)),
+                get_run_request_key(build_run_request(dict(self.options1))))
+        self.assertNotEqual(
+                get_run_request_key(build_run_request(self.options1)),
+                get_run_request_key(build_run_request(self.options2)))
+
+    def test_RunQueue(self):
+        """Test deduplicating queued runs and persisting the queue."""
+        queue_fp = join(self.state_dir, 'queue.json')
+        queue = RunQueue(queue_fp)
+        run_id1, added = queue.put(build_run_request(self.options1), 'cli')
+        self.assertTrue(added)
+        run_id2, added = queue.put(build_run_request(self.options1), 'http')
+        self.assertFalse(added)
+        self.assertEqual(run_id1, run_id2)
+        run_id3, added = queue.put(build_run_request(self.options2), 'http')
+        self.assertTrue(added)
+
+        queue = RunQueue(queue_fp)
+        self.assertEqual([entry['run_id'] for entry in queue.pending()],
+                         [run_id1, run_id3])
+        queue.remove(run_id1)
+        queue = RunQueue(queue_fp)
+        self.assertEqual([entry['run_id'] for entry in queue.pending()],
+                         [run_id3])
+
+        # A running entry isn't pending, and an identical request can be
+        # queued behind it. If the daemon stops while it is running, it is
+        # queued again.
+        queue.mark_running(run_id3)
+        self.assertEqual(queue.pending(), [])
+        run_id4, added = queue.put(build_run_request(self.options2), 'cli')
+        self.assertTrue(added)
+        queue = RunQueue(queue_fp)
+        self.assertEqual([entry['run_id'] for entry in queue.pending()],
+                         [run_id3, run_id4])
+
+    def test_RunServer_concurrency_limit(self):
+        """Test that no more than the maximum number of runs execute."""
+        self.release.clear()
+        server = self.build_server(max_concurrent_runs=1)
+        server.submit(self.options1)
+        server.submit(self.options2)
+
+        workers = server.poll()
+        self.assertEqual(len(workers), 1)
+        self.assertEqual(server.poll(), [])
+        status = server.status()
+        self.assertEqual(len(status['running']), 1)
+        self.assertEqual(len(status['queued']), 1)
+
+        # The running entry stays in the persisted queue until it finishes.
+        self.assertEqual(len(RunQueue(join(self.state_dir,
+                                           'queue.json')).pending()), 2)
+
+        self.release.set()
+        workers[0].join()
+        self.assertEqual(len(RunQueue(join(self.state_dir,
+                                           'queue.json')).pending()), 1)
+        self.poll_and_wait(server)
+        self.assertEqual([run[0] for run in self.runs],
+                         ['nightly_tests', 'other_tests'])
+        self.assertEqual(len(server.status()['finished']), 2)
+
+    def test_RunServer_same_cluster_tag(self):
+        """Test that runs with the same cluster tag never run concurrently."""
+        self.release.clear()
+        server = self.build_server(max_concurrent_runs=3)
+        server.submit(self.options1)
+        server.submit(dict(self.options1, user='ubuntu'))
+        server.submit(self.options2)
+
+        workers = server.poll()
+        self.assertEqual(len(workers), 2)
+        self.assertEqual(len(server.status()['queued']), 1)
+        self.release.set()
+        for worker in workers:
+            worker.join()
+
+    def test_RunServer_warm_cluster_reuse(self):
+        """Test keeping a cluster warm for an identical queued cluster."""
+        server = self.build_server(cluster_idle_timeout=0)
+        server.submit(self.options1)
+        server.submit(dict(self.options1, user='ubuntu'))
+        server.submit(self.options3)
+
+        # The second run can reuse the first run's cluster, but the third run
+        # uses a different cluster template.
+        self.poll_and_wait(server)
+        self.poll_and_wait(server)
+        self.assertEqual(server.status()['warm_clusters'], [])
+        self.poll_and_wait(server)
+        self.assertEqual(self.runs,
+                         [('nightly_tests', True, False),
+                          ('nightly_tests', False, True),
+                          ('nightly_tests', True, True)])
+        self.assertEqual(self.terminated, [])
+
+        finished = server.status()['finished']
+        self.assertEqual([run['reused_cluster'] for run in finished],
+                         [False, True, False])
+
+    def test_RunServer_warm_cluster_setup_failed(self):
+        """Test terminating a cluster whose setup failed."""
+        server = self.build_server()
+        server.submit(dict(self.options1, user='setup_fails'))
+        server.submit(self.options1)
+
+        # The second run must start its own cluster.
+        self.poll_and_wait(server)
+        self.assertEqual(server.status()['warm_clusters'], [])
+        self.assertEqual(self.terminated, ['nightly_tests'])
+        self.poll_and_wait(server)
+        self.assertEqual(self.runs, [('nightly_tests', True, False),
+                                     ('nightly_tests', True, True)])
+        self.assertEqual([run['kept_cluster_warm'] for run in
+                          server.status()['finished']], [False, False])
+
+    def test_RunServer_warm_cluster_idle_timeout(self):
+        """Test terminating a warm cluster that is no longer needed."""
+        server = self.build_server(cluster_idle_timeout=0)
+        server.submit(self.options1)
+        server.submit(dict(self.options1, user='fail'))
+
+        # Run the first, then fail the second after it reused the cluster.
+        # The failing run still terminates the cluster itself.
+        self.poll_and_wait(server)
+        self.assertEqual(len(server.status()['warm_clusters']), 1)
+        self.poll_and_wait(server)
+        finished = server.status()['finished']
+        self.assertEqual(finished[1]['status'], 'failed')
+        self.assertEqual(finished[1]['error'],
+                         'ValueError: Something went wrong.')
+
+        # Simulate a warm cluster whose queued run disappeared.
+        server.submit(self.options1)
+        server.submit(dict(self.options1, user='ubuntu'))
+        self.poll_and_wait(server)
+        server.queue.remove(server.queue.pending()[0]['run_id'])
+        self.poll_and_wait(server)
+        self.assertEqual(self.terminated, ['nightly_tests'])
+        self.assertEqual(server.status()['warm_clusters'], [])
+
+    def test_RunServer_schedule(self):
+        """Test queueing runs from a schedule."""
+        request = build_run_request(self.options1)
+        server = self.build_server(schedule=[(2, 30, request)])
+        server._last_schedule_check = datetime(2013, 1, 1, 1, 0)
+
+        server.poll(datetime(2013, 1, 1, 2, 0))
+        self.assertEqual(self.runs, [])
+        self.poll_and_wait(server, datetime(2013, 1, 1, 2, 30))
+        self.assertEqual(len(self.runs), 1)
+        self.poll_and_wait(server, datetime(2013, 1, 1, 23, 0))
+        self.assertEqual(len(self.runs), 1)
+
+        # The daemon was asleep over the scheduled time.
+        self.poll_and_wait(server, datetime(2013, 1, 2, 3, 0))
+        self.assertEqual(len(self.runs), 2)
+
+    def test_RunServer_http_api(self):
+        """Test queueing runs and getting status over HTTP."""
+        self.release.clear()
+        server = self.build_server()
+        port = server.start_http_server(0)
+        try:
+            obs = submit_run(self.options1, port)
+            self.assertTrue(obs['queued'])
+            obs2 = submit_run(self.options1, port)
+            self.assertFalse(obs2['queued'])
+            self.assertEqual(obs['run_id'], obs2['run_id'])
+
+            self.assertRaises(HTTPError, submit_run, {'foo': 'bar'}, port)
+
+            workers = server.poll()
+            status = loads(urlopen('http://127.0.0.1:%d/status' %
+                                   port).read())
+            self.assertEqual(status['running'][0]['run_id'], obs['run_id'])
+            self.assertEqual(status['running'][0]['source'], 'http')
+        finally:
+            self.release.set()
+            server.stop_http_server()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the snapshot.py module."""
+
+from os import listdir, mkdir, utime
+from os.path import exists, join
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.snapshot import (build_capture_snapshot_cmd,
+                            build_restore_snapshot_cmd, evict_snapshots,
+                            get_snapshot_fp, get_snapshot_key,
+                            mark_snapshot_used, parse_snapshot_dirs)
+
+class SnapshotTests(TestCase):
+    """Tests for the snapshot.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.store_dir = join(self.temp_dir, 'snapshots')
+        mkdir(self.store_dir)
+        self.inputs_dir = join(self.temp_dir, 'inputs')
+        mkdir(self.inputs_dir)
+        self.requirements_fp = join(self.inputs_dir, 'requirements.txt')
+        self.write_file(self.requirements_fp, 'numpy==1.7.1\n')
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def write_file(self, fp, contents):
+        out_f = open(fp, 'w')
+        out_f.write(contents)
+        out_f.close()
+
+    def add_snapshot(self, key, size, last_used):
+        snapshot_fp = get_snapshot_fp(self.store_dir, key)
+        self.write_file(snapshot_fp, 'x' * size)
+        utime(snapshot_fp, (last_used, last_used))
+
+    def test_parse_snapshot_dirs(self):
+        """Test parsing the directories that a setup snapshots."""
+        self.assertEqual(parse_snapshot_dirs('env2.7, deps/build/ ,'),
+                         ['env2.7', 'deps/build'])
+        self.assertRaises(ValueError, parse_snapshot_dirs, ' , ')
+        self.assertRaises(ValueError, parse_snapshot_dirs, '/usr/local')
+        self.assertRaises(ValueError, parse_snapshot_dirs, '../env')
+        self.assertRaises(ValueError, parse_snapshot_dirs, '.')
+        self.assertRaises(ValueError, parse_snapshot_dirs, 'env;rm -rf ~')
+        self.assertRaises(ValueError, parse_snapshot_dirs, 'env*')
+
+    def test_get_snapshot_key(self):
+        """Test that a setup's snapshot key changes with its inputs."""
+        cluster_key = ('local', '/foo', '/bin/sh')
+        key = get_snapshot_key('make', ['env'], cluster_key,
+                               [self.requirements_fp])
+        self.assertEqual(len(key), 40)
+        self.assertEqual(get_snapshot_key('make', ['env'], cluster_key,
+                                          [self.requirements_fp]), key)
+
+        self.assertNotEqual(get_snapshot_key('make', ['env'], cluster_key),
+                            key)
+        self.assertNotEqual(get_snapshot_key('make all', ['env'],
+                                             cluster_key,
+                                             [self.requirements_fp]), key)
+        self.assertNotEqual(get_snapshot_key('make', ['env', 'build'],
+                                             cluster_key,
+                                             [self.requirements_fp]), key)
+        self.assertNotEqual(get_snapshot_key('make', ['env'],
+                                             ('local', '/bar', '/bin/sh'),
+                                             [self.requirements_fp]), key)
+
+        # Directories are hashed by the paths and contents of their files.
+        dir_key = get_snapshot_key('make', ['env'], cluster_key,
+                                   [self.inputs_dir])
+        self.write_file(self.requirements_fp, 'numpy==1.8.0\n')
+        self.assertNotEqual(get_snapshot_key('make', ['env'], cluster_key,
+                                             [self.requirements_fp]), key)
+        new_dir_key = get_snapshot_key('make', ['env'], cluster_key,
+                                       [self.inputs_dir])
+        self.assertNotEqual(new_dir_key, dir_key)
+        self.write_file(join(self.inputs_dir, 'setup.cfg'), '')
+        self.assertNotEqual(get_snapshot_key('make', ['env'], cluster_key,
+                                             [self.inputs_dir]), new_dir_key)
+
+    def test_get_snapshot_fp(self):
+        """Test naming the file that a snapshot is stored in."""
+        self.assertEqual(get_snapshot_fp('/foo/snapshots', 'abc123'),
+                         '/foo/snapshots/abc123.tar.gz')
+
+    def test_capture_restore_snapshot(self):
+        """Test capturing and restoring the snapshotted directories."""
+        work_dir = join(self.temp_dir, 'work')
+        mkdir(work_dir)
+        mkdir(join(work_dir, 'env'))
+        self.write_file(join(work_dir, 'env', 'python'), 'built\n')
+        self.assertEqual(build_capture_snapshot_cmd(['env', 'deps/build']),
+                         'tar czf - env deps/build')
+        snapshot_fp = get_snapshot_fp(self.store_dir, 'abc123')
+        proc = Popen('%s > %s' % (build_capture_snapshot_cmd(['env']),
+                                  snapshot_fp), shell=True, cwd=work_dir)
+        self.assertEqual(proc.wait(), 0)
+
+        # Restoring replaces the existing copy of each directory.
+        rmtree(join(work_dir, 'env'))
+        mkdir(join(work_dir, 'env'))
+        self.write_file(join(work_dir, 'env', 'stale'), '')
+        self.assertEqual(build_restore_snapshot_cmd(['env']),
+                         'rm -rf env && tar xzf -')
+        proc = Popen('%s < %s' % (build_restore_snapshot_cmd(['env']),
+                                  snapshot_fp), shell=True, cwd=work_dir)
+        self.assertEqual(proc.wait(), 0)
+        self.assertEqual(listdir(join(work_dir, 'env')), ['python'])
+
+        # Capturing a directory that doesn't exist fails.
+        proc = Popen(build_capture_snapshot_cmd(['missing']), shell=True,
+                     cwd=work_dir, stdout=PIPE, stderr=PIPE)
+        proc.communicate()
+        self.assertNotEqual(proc.returncode, 0)
+
+    def test_evict_snapshots(self):
+        """Test removing old and least recently used snapshots."""
+        now = 100 * 86400
+        self.add_snapshot('old', 10, now - 40 * 86400)
+        self.add_snapshot('a', 30, now - 3 * 86400)
+        self.add_snapshot('b', 30, now - 2 * 86400)
+        self.add_snapshot('c', 30, now - 1 * 86400)
+        self.write_file(join(self.store_dir, 'd.tar.gz.123.tmp'), 'x' * 50)
+
+        self.assertEqual(evict_snapshots(self.store_dir, now=now), [])
+        self.assertEqual(evict_snapshots(self.store_dir, max_age=30,
+                                         now=now), ['old'])
+        self.assertEqual(evict_snapshots(self.store_dir, max_size=50,
+                                         max_age=30, now=now), ['a', 'b'])
+        self.assertEqual(sorted(listdir(self.store_dir)),
+                         ['c.tar.gz', 'd.tar.gz.123.tmp'])
+        self.assertEqual(evict_snapshots(join(self.temp_dir, 'missing')),
+                         [])
+
+    def test_mark_snapshot_used(self):
+        """Test that restoring a snapshot keeps it from being evicted."""
+        now = 100 * 86400
+        self.add_snapshot('a', 30, now - 3 * 86400)
+        self.add_snapshot('b', 30, now - 2 * 86400)
+        mark_snapshot_used(get_snapshot_fp(self.store_dir, 'a'))
+        self.assertEqual(evict_snapshots(self.store_dir, max_size=40), ['b'])
+        self.assertTrue(exists(get_snapshot_fp(self.store_dir, 'a')))
+
+        # Snapshots that were already evicted are ignored.
+        mark_snapshot_used(get_snapshot_fp(self.store_dir, 'b'))
+
+
+if __name__ == "__main__":
+    main()
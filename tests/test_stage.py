@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the stage.py module."""
+
+from os import listdir, mkdir, readlink
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.stage import build_staged_cmd, create_stage_links, get_stage_name
+
+class StageTests(TestCase):
+    """Tests for the stage.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.qiime_dir = join(self.temp_dir, 'qiime')
+        self.cogent_dir = join(self.temp_dir, 'py cogent')
+        mkdir(self.qiime_dir)
+        mkdir(self.cogent_dir)
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def test_get_stage_name(self):
+        """Test naming a local directory's staged copy."""
+        self.assertEqual(get_stage_name('/home/ubuntu/Qiime-1.7/'),
+                         'home_ubuntu_Qiime-1.7')
+        self.assertEqual(get_stage_name('/home/ubuntu/py cogent'),
+                         'home_ubuntu_py_cogent')
+
+    def test_build_staged_cmd(self):
+        """Test wrapping a test suite's command to run from its staged copy.
+        """
+        self.assertEqual(build_staged_cmd('./tests.py', None), './tests.py')
+        self.assertEqual(build_staged_cmd('./tests.py', '/home/ubuntu/qiime'),
+                         'cd .clout_stage/home_ubuntu_qiime && ./tests.py')
+
+    def test_create_stage_links(self):
+        """Test linking to the local directories to stage."""
+        links_dir = join(self.temp_dir, 'stage')
+        obs = create_stage_links([self.qiime_dir, self.cogent_dir,
+                                  self.qiime_dir + '/'], links_dir)
+        self.assertEqual(obs, [join(links_dir, get_stage_name(self.qiime_dir)),
+                               join(links_dir,
+                                    get_stage_name(self.cogent_dir))])
+        self.assertEqual(readlink(obs[0]), self.qiime_dir)
+        self.assertEqual(readlink(obs[1]), self.cogent_dir)
+
+        # Existing links are replaced.
+        self.assertEqual(create_stage_links([self.qiime_dir], links_dir),
+                         obs[:1])
+        self.assertEqual(len(listdir(links_dir)), 2)
+
+        self.assertRaises(ValueError, create_stage_links,
+                          [join(self.temp_dir, 'foo')], links_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the state.py module."""
+
+from os.path import isdir, join
+from re import match
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.state import (create_run_id, get_safe_filename, list_runs,
+                         prune_runs, RunState)
+
+class StateTests(TestCase):
+    """Tests for the state.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.runs_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.params = {'cluster_tag': 'nightly_tests',
+                       'test_suites': [['QIIME', '/bin/tests.py']]}
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.runs_dir)
+
+    def test_create_and_load(self):
+        """Test creating the state of a run and loading it again."""
+        run_state = RunState.create(self.runs_dir, self.params)
+        self.assertEqual(run_state.params, self.params)
+        self.assertEqual([e['event'] for e in run_state.get_events()],
+                         ['run_started'])
+
+        obs = RunState.load(self.runs_dir, run_state.run_id)
+        self.assertEqual(obs.run_id, run_state.run_id)
+        self.assertEqual(obs.params, self.params)
+        self.assertRaises(ValueError, RunState.load, self.runs_dir, 'foo')
+        self.assertRaises(ValueError, RunState, self.runs_dir)
+
+    def test_journal(self):
+        """Test recording and retrieving journal entries."""
+        run_state = RunState.create(self.runs_dir, self.params)
+        run_state.record('setup_finished', succeeded=True)
+        run_state.record('test_suite_finished', label='QIIME', ret_val=1)
+        run_state.record('test_suite_finished', label='PyNAST', ret_val=0)
+
+        self.assertEqual(len(run_state.get_events()), 4)
+        obs = run_state.get_events('test_suite_finished')
+        self.assertEqual([(e['label'], e['ret_val']) for e in obs],
+                         [('QIIME', 1), ('PyNAST', 0)])
+        self.assertEqual(run_state.get_last_event('test_suite_finished')
+                         ['label'], 'PyNAST')
+        self.assertEqual(run_state.get_last_event('run_finished'), None)
+        self.assertFalse(run_state.is_finished())
+
+        run_state.record('run_finished')
+        self.assertTrue(run_state.is_finished())
+
+    def test_journal_truncated_entry(self):
+        """Test ignoring a journal entry that was only partially written."""
+        run_state = RunState.create(self.runs_dir, self.params)
+        run_state.record('setup_finished', succeeded=True)
+        journal_f = open(run_state.journal_fp, 'a')
+        journal_f.write('{"event": "test_suite_fin')
+        journal_f.close()
+
+        self.assertEqual([e['event'] for e in run_state.get_events()],
+                         ['run_started', 'setup_finished'])
+
+    def test_open_log(self):
+        """Test writing to and reading from a persistent log."""
+        run_state = RunState.create(self.runs_dir, self.params)
+        log_f = run_state.open_log('QIIME 1.5/results.txt')
+        log_f.write('foo\n')
+        log_f.seek(0, 0)
+        log_f.write('bar\n')
+        log_f.close()
+
+        self.assertEqual(open(join(run_state.log_dir,
+                                   'QIIME_1.5_results.txt')).read(),
+                         'foo\nbar\n')
+
+    def test_list_runs(self):
+        """Test listing the runs in a directory."""
+        self.assertEqual(list_runs(join(self.runs_dir, 'foo')), [])
+        run_state1 = RunState.create(self.runs_dir, self.params)
+        run_state2 = RunState.create(self.runs_dir, self.params)
+        obs = [run_state.run_id for run_state in list_runs(self.runs_dir)]
+        self.assertEqual(obs, sorted([run_state1.run_id, run_state2.run_id]))
+
+    def test_prune_runs(self):
+        """Test removing all but the most recently finished runs."""
+        self.assertEqual(prune_runs(join(self.runs_dir, 'foo')), [])
+        run_states = [RunState.create(self.runs_dir, self.params)
+                      for i in range(4)]
+        for i in 2, 0, 3:
+            run_states[i].record('run_finished')
+
+        self.assertEqual(prune_runs(self.runs_dir, 2),
+                         [run_states[2].run_id])
+        self.assertEqual([isdir(run_state.run_dir)
+                          for run_state in run_states],
+                         [True, True, False, True])
+        self.assertEqual(prune_runs(self.runs_dir, 2), [])
+
+        # Runs that haven't finished are kept, since they can be resumed.
+        self.assertEqual(sorted(prune_runs(self.runs_dir, 0)),
+                         sorted([run_states[0].run_id,
+                                 run_states[3].run_id]))
+        self.assertEqual([run_state.run_id
+                          for run_state in list_runs(self.runs_dir)],
+                         [run_states[1].run_id])
+
+    def test_create_run_id(self):
+        """Test creating unique, chronologically-sortable run IDs."""
+        run_id1 = create_run_id()
+        run_id2 = create_run_id()
+        self.assertNotEqual(run_id1, run_id2)
+        self.assertTrue(match(r'^\d{8}-\d{6}-[0-9a-f]{8}$', run_id1))
+        self.assertTrue(run_id1[:15] <= run_id2[:15])
+
+    def test_get_safe_filename(self):
+        """Test replacing unsafe characters in filenames."""
+        self.assertEqual(get_safe_filename('QIIME_results.txt'),
+                         'QIIME_results.txt')
+        self.assertEqual(get_safe_filename('../foo bar/baz'),
+                         '.._foo_bar_baz')
+
+
+if __name__ == "__main__":
+    main()
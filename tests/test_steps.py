@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the steps.py module."""
+
+from StringIO import StringIO
+from subprocess import PIPE, Popen
+from unittest import main, TestCase
+
+from clout.steps import (build_stepped_cmd, format_timeline_line,
+                         parse_step_marker, split_cmd, StepTimeline)
+
+class StepsTests(TestCase):
+    """Tests for the steps.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.cmd = ('wget http://example.com/q.tgz && tar zxvf q.tgz && '
+                    'cd q && python app-deploy.py --env "a && b" && '
+                    '(cd tests && ./all_tests.py)')
+
+    def test_split_cmd(self):
+        """Test splitting a command into its '&&'-separated commands."""
+        self.assertEqual(split_cmd(self.cmd),
+                         ['wget http://example.com/q.tgz', 'tar zxvf q.tgz',
+                          'cd q', 'python app-deploy.py --env "a && b"',
+                          '(cd tests && ./all_tests.py)'])
+        self.assertEqual(split_cmd("echo 'a && b' && echo \\&\\& c"),
+                         ["echo 'a && b'", 'echo \\&\\& c'])
+        self.assertEqual(split_cmd('a; b || c'), ['a; b || c'])
+        self.assertEqual(split_cmd('a &&  && b'), ['a', 'b'])
+        self.assertEqual(split_cmd(''), [])
+
+    def test_build_stepped_cmd(self):
+        """Test wrapping a command so that it marks each step."""
+        self.assertEqual(build_stepped_cmd(self.cmd, 'markers'), self.cmd)
+        self.assertEqual(build_stepped_cmd('a && b "c  d"', 'commands'),
+                         'echo "::clout-step a" && a && '
+                         'echo "::clout-step b \\"c d\\"" && b "c  d"')
+        self.assertEqual(build_stepped_cmd('echo ' + 'x' * 100,
+                                           'commands').split(' && ')[0],
+                         'echo "::clout-step echo %s..."' % ('x' * 52))
+
+        # The wrapped command runs the same commands and prints the markers.
+        proc = Popen(build_stepped_cmd("echo 'a && b' && echo \"$HOME\" > "
+                                       "/dev/null && false && echo c",
+                                       'commands'), shell=True, stdout=PIPE)
+        self.assertEqual(proc.communicate()[0],
+                         "::clout-step echo 'a && b'\na && b\n"
+                         "::clout-step echo \"$HOME\" > /dev/null\n"
+                         "::clout-step false\n")
+        self.assertEqual(proc.returncode, 1)
+
+    def test_parse_step_marker(self):
+        """Test recognizing the lines that start steps."""
+        self.assertEqual(parse_step_marker('::clout-step Download QIIME\n'),
+                         'Download QIIME')
+        self.assertEqual(parse_step_marker('  ::clout-step\n'), '')
+        self.assertEqual(parse_step_marker('Downloading QIIME\n'), None)
+
+    def test_format_timeline_line(self):
+        """Test formatting a timestamped line of output."""
+        self.assertEqual(format_timeline_line(12.3456, 'stderr', 'foo\n'),
+                         '    12.346 stderr foo\n')
+        self.assertEqual(format_timeline_line(0, 'stdout', 'bar'),
+                         '     0.000 stdout bar\n')
+
+    def test_StepTimeline(self):
+        """Test timing the steps that a command's output marks."""
+        timeline_f = StringIO()
+        timeline = StepTimeline(100.0, timeline_f)
+        timeline.line_received('stdout', 'Starting up\n', 100.5)
+        timeline.line_received('stdout', '::clout-step download\n', 101.0)
+        timeline.line_received('stderr', 'warning\n', 103.0)
+        timeline.line_received('stdout', '::clout-step\n', 111.0)
+        self.assertEqual(timeline.get_steps(130.0),
+                         [{'name': 'download', 'start': 1.0,
+                           'duration': 10.0},
+                          {'name': 'step 2', 'start': 11.0,
+                           'duration': 19.0}])
+        self.assertEqual(timeline_f.getvalue().splitlines(),
+                         ['     0.500 stdout Starting up',
+                          '     1.000 stdout ::clout-step download',
+                          '     3.000 stderr warning',
+                          '    11.000 stdout ::clout-step'])
+
+        # Output without markers has no steps.
+        timeline = StepTimeline(100.0)
+        timeline.line_received('stdout', 'ok\n', 101.0)
+        self.assertEqual(timeline.get_steps(102.0), [])
+
+
+if __name__ == "__main__":
+    main()
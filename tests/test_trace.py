@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2012-2013, The Clout Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPLv2"
+__version__ = "0.9-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the trace.py module."""
+
+from json import loads
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import main, TestCase
+
+from clout.trace import load_trace_events, Tracer
+
+class TraceTests(TestCase):
+    """Tests for the trace.py module."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.temp_dir = mkdtemp(prefix='clout_temp_dir_')
+        self.trace_fp = join(self.temp_dir, 'trace.json')
+
+    def tearDown(self):
+        """Remove temporary files/dirs created by the tests."""
+        rmtree(self.temp_dir)
+
+    def get_spans(self, tracer):
+        return [event for event in tracer.get_trace()['traceEvents']
+                if event['ph'] == 'X']
+
+    def get_track_names(self, tracer):
+        return dict([(event['tid'], event['args']['name'])
+                     for event in tracer.get_trace()['traceEvents']
+                     if event['name'] == 'thread_name'])
+
+    def test_add_span(self):
+        """Test recording spans on separate tracks."""
+        tracer = Tracer('clout run foo')
+        tracer.add_span('QIIME', 100.0, 102.5, 'worker 0', 'command',
+                        ret_val=0)
+        tracer.add_span('PyCogent', 101.0, 101.5, 'worker 1', 'command')
+
+        spans = self.get_spans(tracer)
+        self.assertEqual([(span['name'], span['cat'], span['ts'],
+                           span['dur'], span['args']) for span in spans],
+                         [('QIIME', 'command', 100000000.0, 2500000.0,
+                           {'ret_val': 0}),
+                          ('PyCogent', 'command', 101000000.0, 500000.0,
+                           {})])
+        track_names = self.get_track_names(tracer)
+        self.assertEqual([track_names[span['tid']] for span in spans],
+                         ['worker 0', 'worker 1'])
+        self.assertEqual(tracer.get_trace()['traceEvents'][0],
+                         {'name': 'process_name', 'ph': 'M',
+                          'pid': tracer.pid, 'tid': 0,
+                          'args': {'name': 'clout run foo'}})
+
+    def test_span(self):
+        """Test recording the code run in a with statement as a span."""
+        tracer = Tracer()
+        with tracer.span('send email', recipients=2):
+            pass
+        try:
+            with tracer.span('spool email'):
+                raise IOError
+        except IOError:
+            pass
+
+        spans = self.get_spans(tracer)
+        self.assertEqual([(span['name'], span['args']) for span in spans],
+                         [('send email', {'recipients': 2}),
+                          ('spool email', {'error': 'IOError'})])
+        self.assertTrue(spans[0]['dur'] >= 0)
+
+    def test_update(self):
+        """Test recording the run and its phases from progress events."""
+        tracer = Tracer()
+        for event in [
+                {'event': 'run_started', 'time': 100.0, 'run_id': 'foo',
+                 'cluster_tag': 'nightly'},
+                {'event': 'phase_changed', 'time': 101.0, 'phase': 'setup'},
+                {'event': 'phase_changed', 'time': 160.0,
+                 'phase': 'test_suites'},
+                {'event': 'suite_started', 'time': 160.0, 'label': 'QIIME'},
+                {'event': 'phase_changed', 'time': 200.0,
+                 'phase': 'teardown'},
+                {'event': 'run_finished', 'time': 230.0, 'succeeded': True}]:
+            tracer.update(event)
+
+        self.assertEqual([(span['name'], span['cat'], span['ts'] / 1e6,
+                           span['dur'] / 1e6) for span in
+                          self.get_spans(tracer)],
+                         [('setup', 'phase', 101.0, 59.0),
+                          ('test_suites', 'phase', 160.0, 40.0),
+                          ('teardown', 'phase', 200.0, 30.0),
+                          ('run', 'run', 100.0, 130.0)])
+        self.assertEqual(self.get_spans(tracer)[-1]['args'],
+                         {'run_id': 'foo', 'cluster_tag': 'nightly',
+                          'succeeded': True})
+
+    def test_get_trace_unfinished(self):
+        """Test that spans that haven't ended are marked as unfinished."""
+        tracer = Tracer()
+        tracer.update({'event': 'run_started', 'time': 100.0})
+        tracer.update({'event': 'phase_changed', 'time': 101.0,
+                       'phase': 'setup'})
+        spans = self.get_spans(tracer)
+        self.assertEqual([(span['name'], span['args']['unfinished'])
+                          for span in spans],
+                         [('setup', True), ('run', True)])
+
+        # The spans are still ended when the run finishes.
+        tracer.update({'event': 'run_finished', 'time': 102.0,
+                       'succeeded': False})
+        self.assertEqual([span['dur'] / 1e6 for span in
+                          self.get_spans(tracer)], [1.0, 2.0])
+
+    def test_write_load(self):
+        """Test writing a trace and continuing it in a later attempt."""
+        tracer = Tracer('attempt 1')
+        tracer.add_span('setup', 100.0, 110.0)
+        tracer.write(self.trace_fp)
+
+        trace_f = open(self.trace_fp, 'U')
+        trace = loads(trace_f.read())
+        trace_f.close()
+        self.assertEqual(trace['displayTimeUnit'], 'ms')
+        self.assertEqual(len(trace['traceEvents']), 4)
+
+        tracer = Tracer('attempt 2', load_trace_events(self.trace_fp))
+        tracer.add_span('teardown', 200.0, 210.0)
+        self.assertEqual([span['name'] for span in self.get_spans(tracer)],
+                         ['setup', 'teardown'])
+        self.assertEqual(len(tracer.get_trace()['traceEvents']), 8)
+
+    def test_load_trace_events_missing(self):
+        """Test loading a trace that doesn't exist or can't be read."""
+        self.assertEqual(load_trace_events(self.trace_fp), [])
+        trace_f = open(self.trace_fp, 'w')
+        trace_f.write('{"traceEv')
+        trace_f.close()
+        self.assertEqual(load_trace_events(self.trace_fp), [])
+
+
+if __name__ == "__main__":
+    main()
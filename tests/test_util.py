@@ -11,10 +11,15 @@ __email__ = "jai.rideout@gmail.com"
 
 """Test suite for the util.py module."""
 
+from os.path import exists, join
 from re import sub
-from tempfile import TemporaryFile
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from threading import active_count
+from time import time
 from unittest import main, TestCase
 
+from clout.trace import Tracer
 from clout.util import CommandExecutor
 
 class UtilTests(TestCase):
@@ -161,6 +166,371 @@ class UtilTests(TestCase):
         log_obs = log_f.read()
         self.assertEqual(log_obs, exp)
 
+    def test_CommandExecutor_cmd_finished_callback(self):
+        """Test being notified as each command finishes."""
+        finished = []
+        def cmd_finished(cmd_index, log_f, ret_val, timeout_occurred,
+                         duration):
+            finished.append((cmd_index, log_f, ret_val, timeout_occurred,
+                             duration))
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 0.2', 'foobarbaz'], log_f,
+                                   cmd_finished_callback=cmd_finished)
+        self.assertEqual(cmd_exec(1), (False, []))
+        self.assertEqual([f[:4] for f in finished],
+                         [(0, None, 0, False), (1, None, 127, False)])
+        self.assertTrue(finished[0][4] >= 0.2)
+        self.assertTrue(finished[1][4] >= 0)
+
+    def test_CommandExecutor_cmd_timeouts(self):
+        """Test terminating a command that exceeds its own timeout."""
+        timed_out = []
+        def cmd_finished(cmd_index, log_f, ret_val, timeout_occurred,
+                         duration):
+            timed_out.append(cmd_index in cmd_exec.timed_out_cmds)
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 10', 'sleep 0.1', 'echo foo'],
+                                   log_f, log_individual_cmds=True,
+                                   cmd_finished_callback=cmd_finished,
+                                   cmd_timeouts=[0.002, 0.01, None])
+        start_time = time()
+        obs = cmd_exec(1)
+        self.assertTrue(time() - start_time < 5)
+
+        # The remaining commands still run after a command is terminated.
+        self.assertEqual(obs[0], False)
+        self.assertEqual([ret_val for cmd_log_f, ret_val in obs[1]],
+                         [-15, 0, 0])
+        self.assertEqual(cmd_exec.timed_out_cmds, set([0]))
+        self.assertEqual(timed_out, [True, False, False])
+
+        obs[1][0][0].seek(0, 0)
+        self.assertTrue(obs[1][0][0].read().endswith(
+                'Terminated: the command exceeded its timeout of 0.002 '
+                'minute(s).\n\n'))
+
+    def test_CommandExecutor_streamed_output(self):
+        """Test receiving each command's output as it arrives."""
+        events = []
+        def cmd_started(cmd_index):
+            events.append(('started', cmd_index))
+        def output_received(cmd_index, stream_name, line):
+            events.append((stream_name, cmd_index, line))
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['echo foo; echo bar', 'echo baz >&2'],
+                                   log_f, cmd_started_callback=cmd_started,
+                                   output_callback=output_received)
+        self.assertEqual(cmd_exec(1), (True, []))
+        self.assertEqual(events, [('started', 0), ('stdout', 0, 'foo\n'),
+                                  ('stdout', 0, 'bar\n'), ('started', 1),
+                                  ('stderr', 1, 'baz\n')])
+
+        # The output is logged the same way as when it isn't streamed.
+        log_f.seek(0, 0)
+        self.assertEqual(log_f.read(), 'Command:\n\necho foo; echo bar\n\n'
+                         'Stdout:\n\nfoo\nbar\n\nStderr:\n\n\n'
+                         'Command:\n\necho baz >&2\n\nStdout:\n\n\n'
+                         'Stderr:\n\nbaz\n\n')
+
+    def test_CommandExecutor_cmd_batches(self):
+        """Test running the commands in a batch at the same time."""
+        events = []
+        def cmd_started(cmd_index):
+            events.append(('started', cmd_index))
+        def cmd_finished(cmd_index, log_f, ret_val, timeout_occurred,
+                         duration):
+            events.append(('finished', cmd_index))
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 0.5; echo a', 'sleep 0.5; exit 1',
+                                    'sleep 0.5; echo c', 'echo d'], log_f,
+                                   log_individual_cmds=True,
+                                   cmd_started_callback=cmd_started,
+                                   cmd_finished_callback=cmd_finished,
+                                   cmd_batches=[[3, 2], [1, 1]])
+        start_time = time()
+        obs = cmd_exec(1)
+        self.assertTrue(time() - start_time < 1.4)
+
+        # The results are in the same order as the commands, no matter the
+        # order they finished in.
+        self.assertEqual(obs[0], False)
+        self.assertEqual([ret_val for cmd_log_f, ret_val in obs[1]],
+                         [0, 1, 0, 0])
+        obs[1][2][0].seek(0, 0)
+        self.assertEqual(obs[1][2][0].read(), 'Command:\n\nsleep 0.5; echo '
+                         'c\n\nStdout:\n\nc\n\nStderr:\n\n\n')
+
+        # At most two commands ran at once, and the next batch only started
+        # once the first one had finished.
+        self.assertEqual(sorted(events[:2]), [('started', 0), ('started', 1)])
+        self.assertEqual(events[-2:], [('started', 3), ('finished', 3)])
+        self.assertTrue(events.index(('started', 2)) >
+                        min(events.index(('finished', 0)),
+                            events.index(('finished', 1))))
+
+    def test_CommandExecutor_worker_cmds(self):
+        """Test running each worker's own command and idle workers."""
+        idle_workers = []
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor([['sleep 0.5; echo a0', 'echo a1'],
+                                    ['echo b0', 'echo b1']], log_f,
+                                   log_individual_cmds=True,
+                                   cmd_batches=[[2, 2]],
+                                   worker_idle_callback=idle_workers.append)
+        obs = cmd_exec(1)
+        self.assertEqual(obs[0], True)
+        obs[1][0][0].seek(0, 0)
+        self.assertEqual(obs[1][0][0].read(), 'Command:\n\nsleep 0.5; echo '
+                         'a0\n\nStdout:\n\na0\n\nStderr:\n\n\n')
+        obs[1][1][0].seek(0, 0)
+        self.assertEqual(obs[1][1][0].read(), 'Command:\n\necho b1\n\n'
+                         'Stdout:\n\nb1\n\nStderr:\n\n\n')
+
+        # The second worker ran out of commands first.
+        self.assertEqual(idle_workers, [1, 0])
+
+        # Workers aren't idle if no more commands were going to be run.
+        idle_workers = []
+        cmd_exec.stop_on_first_failure = True
+        cmd_exec.cmds = [['exit 1', 'exit 1']]
+        cmd_exec.cmd_batches = [[1, 2]]
+        self.assertEqual(cmd_exec(1)[0], False)
+        self.assertEqual(idle_workers, [])
+
+    def test_CommandExecutor_worker_lost(self):
+        """Test running commands again when the worker running them is lost.
+        """
+        finished = []
+        def cmd_finished(cmd_index, log_f, ret_val, timeout_occurred,
+                         duration):
+            finished.append(cmd_index)
+        lost = []
+        def worker_lost(cmd_index, worker_index, ret_val, duration):
+            lost.append((cmd_index, worker_index, ret_val))
+            return ret_val == 255
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor([['sleep 0.3; echo a', 'exit 255'],
+                                    ['echo b', 'exit 255'],
+                                    ['exit 1', 'exit 255']], log_f,
+                                   log_individual_cmds=True,
+                                   cmd_finished_callback=cmd_finished,
+                                   cmd_batches=[[3, 2]],
+                                   worker_lost_callback=worker_lost)
+        obs = cmd_exec(1)
+
+        # The lost worker's command was run again by the other worker, and
+        # only genuine failures count.
+        self.assertEqual(obs[0], False)
+        self.assertEqual([ret_val for cmd_log_f, ret_val in obs[1]],
+                         [0, 0, 1])
+        obs[1][1][0].seek(0, 0)
+        self.assertEqual(obs[1][1][0].read(), 'Command:\n\necho b\n\n'
+                         'Stdout:\n\nb\n\nStderr:\n\n\n')
+        self.assertEqual(lost, [(1, 1, 255), (2, 0, 1)])
+        self.assertEqual(cmd_exec.interrupted_cmds, [1])
+        self.assertEqual(sorted(finished), [0, 1, 2])
+        log_f.seek(0, 0)
+        self.assertTrue('Command:\n\nexit 255\n\nStdout:\n\n\nStderr:\n\n'
+                        '\nInterrupted: the worker running the command was '
+                        'lost, so the command will be run again.' in
+                        log_f.read())
+
+    def test_CommandExecutor_replace_worker(self):
+        """Test running commands on a worker that replaced a lost one."""
+        temp_dir = mkdtemp(prefix=self.prefix)
+        marker_fp = join(temp_dir, 'replaced')
+        replaced = []
+        def replace_worker(worker_index):
+            replaced.append(worker_index)
+            open(marker_fp, 'w').close()
+            return True
+
+        worker_cmd = 'test -e %s || exit 255; echo %%s' % marker_fp
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor([['sleep 1; echo a0', worker_cmd % 'a1'],
+                                    ['sleep 1; echo b0', worker_cmd % 'b1']],
+                                   log_f, log_individual_cmds=True,
+                                   cmd_batches=[[2, 2]],
+                                   worker_lost_callback=lambda *args: True,
+                                   replace_worker_callback=replace_worker)
+        try:
+            obs = cmd_exec(1)
+            self.assertTrue(exists(marker_fp))
+        finally:
+            rmtree(temp_dir)
+        self.assertEqual(obs[0], True)
+        self.assertEqual(replaced, [1])
+        self.assertEqual(cmd_exec.interrupted_cmds, [1])
+        obs[1][1][0].seek(0, 0)
+        self.assertTrue('Stdout:\n\nb1\n' in obs[1][1][0].read())
+
+        # Without a worker left to run it again, the interrupted attempt is
+        # the command's result, and the remaining commands aren't run.
+        cmd_exec = CommandExecutor(['exit 255', 'echo b'], log_f,
+                                   log_individual_cmds=True,
+                                   cmd_batches=[[2, 1]],
+                                   worker_lost_callback=lambda *args: True)
+        obs = cmd_exec(1)
+        self.assertEqual(obs[0], False)
+        self.assertEqual([ret_val for cmd_log_f, ret_val in obs[1]], [255])
+        obs[1][0][0].seek(0, 0)
+        self.assertTrue(obs[1][0][0].read().endswith(
+                'Interrupted: the worker running the command was lost, and '
+                'no worker was left to run it again.\n\n'))
+
+    def test_CommandExecutor_cmd_batches_timeout(self):
+        """Test that every command in a batch is stopped by a timeout."""
+        timeouts = []
+        def cmd_finished(cmd_index, log_f, ret_val, timeout_occurred,
+                         duration):
+            timeouts.append((cmd_index, timeout_occurred))
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 10', 'sleep 10', 'sleep 10',
+                                    'echo foo'], log_f,
+                                   log_individual_cmds=True,
+                                   cmd_finished_callback=cmd_finished,
+                                   cmd_batches=[[3, 3], [1, 1]])
+        start_time = time()
+        obs = cmd_exec(0.01)
+        self.assertTrue(time() - start_time < 5)
+        self.assertEqual(obs[0], None)
+        self.assertEqual([ret_val for cmd_log_f, ret_val in obs[1]],
+                         [-15, -15, -15])
+        self.assertEqual(sorted(timeouts), [(0, True), (1, True), (2, True)])
+
+    def test_CommandExecutor_many_cmds(self):
+        """Test supervising many commands at once from the calling thread."""
+        thread_counts = []
+        def cmd_started(cmd_index):
+            thread_counts.append(active_count())
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 0.5; echo %d' % i
+                                    for i in range(30)], log_f,
+                                   log_individual_cmds=True,
+                                   cmd_started_callback=cmd_started,
+                                   cmd_batches=[[30, 30]])
+        start_time = time()
+        obs = cmd_exec(1)
+        self.assertTrue(time() - start_time < 5)
+        self.assertEqual(obs[0], True)
+        self.assertEqual(len(obs[1]), 30)
+        obs[1][29][0].seek(0, 0)
+        self.assertEqual(obs[1][29][0].read(), 'Command:\n\nsleep 0.5; echo '
+                         '29\n\nStdout:\n\n29\n\nStderr:\n\n\n')
+        self.assertEqual(thread_counts, [active_count()] * 30)
+
+    def test_CommandExecutor_tracer(self):
+        """Test recording each command as a span on its worker's track."""
+        tracer = Tracer()
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(['sleep 0.2', 'exit 1', 'true'], log_f,
+                                   cmd_batches=[[3, 2]], tracer=tracer,
+                                   trace_names=['a', 'b', 'c'])
+        self.assertEqual(cmd_exec(1)[0], False)
+
+        events = tracer.get_trace()['traceEvents']
+        track_names = dict([(event['tid'], event['args']['name'])
+                            for event in events
+                            if event['name'] == 'thread_name'])
+        # The spans are recorded as the commands finish, so they are sorted
+        # by name rather than relying on the order the commands took.
+        spans = sorted([event for event in events if event['ph'] == 'X'],
+                       key=lambda span: span['name'])
+        self.assertEqual([(span['name'], track_names[span['tid']],
+                           span['args']['ret_val'], span['args']['cmd'])
+                          for span in spans],
+                         [('a', 'worker 0', 0, 'sleep 0.2'),
+                          ('b', 'worker 1', 1, 'exit 1'),
+                          ('c', 'worker 1', 0, 'true')])
+        self.assertTrue(spans[0]['dur'] >= 200000)
+
+        # Without names, each span is named after its command.
+        tracer = Tracer()
+        CommandExecutor(['true'], log_f, tracer=tracer)(1)
+        self.assertEqual(tracer.get_trace()['traceEvents'][-1]['name'],
+                         'true')
+
+    def test_CommandExecutor_translated_newlines(self):
+        """Test that carriage returns in output are translated to newlines."""
+        lines = []
+        def output_received(cmd_index, stream_name, line):
+            lines.append(line)
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(["printf 'a\\r\\nb\\rc'"], log_f,
+                                   output_callback=output_received)
+        self.assertEqual(cmd_exec(1)[0], True)
+        self.assertEqual(lines, ['a\n', 'b\n', 'c'])
+
+    def test_CommandExecutor_split_crlf(self):
+        """Test translating '\\r\\n' line endings split across reads."""
+        lines = []
+        def output_received(cmd_index, stream_name, line):
+            lines.append(line)
+
+        # The sleeps make sure that '\r' and '\n' arrive in separate reads.
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd_exec = CommandExecutor(["printf 'a\\r'; sleep 0.2; "
+                                    "printf '\\nb\\r'; sleep 0.2; "
+                                    "printf 'c\\r'"], log_f,
+                                   output_callback=output_received)
+        self.assertEqual(cmd_exec(1)[0], True)
+        self.assertEqual(lines, ['a\n', 'b\n', 'c\n'])
+        log_f.seek(0, 0)
+        self.assertTrue('Stdout:\n\na\nb\nc\n\nStderr:' in log_f.read())
+
+    def test_CommandExecutor_output_filters(self):
+        """Test filtering each command's output as it is captured."""
+        lines = []
+        def output_received(cmd_index, stream_name, line):
+            lines.append(line)
+        unfiltered_logs = {}
+        def unfiltered_log_f_factory(cmd_index):
+            unfiltered_logs[cmd_index] = TemporaryFile(prefix=self.prefix,
+                                                       suffix='.txt')
+            return unfiltered_logs[cmd_index]
+
+        log_f = TemporaryFile(prefix=self.prefix, suffix='.txt')
+        cmd = "printf '1%%\\r2%%\\r3%%\\n' && seq 1 5 >&2"
+        cmd_exec = CommandExecutor([cmd, 'echo foo'], log_f,
+                                   log_individual_cmds=True,
+                                   output_callback=output_received,
+                                   output_filters=[{'progress': True,
+                                                    'repeats': True,
+                                                    'cap': None}, None],
+                                   unfiltered_log_f_factory=
+                                           unfiltered_log_f_factory)
+        obs = cmd_exec(1)
+        self.assertEqual(obs[0], True)
+
+        # Only the filtered output is logged.
+        exp = ("Command:\n\n%s\n\nStdout:\n\n3%%\n\nStderr:\n\n1\n"
+               "[3 similar line(s) omitted]\n5\n\n" % cmd)
+        log_f.seek(0, 0)
+        self.assertEqual(log_f.read(), exp +
+                         "Command:\n\necho foo\n\nStdout:\n\nfoo\n\n"
+                         "Stderr:\n\n\n")
+        obs[1][0][0].seek(0, 0)
+        self.assertEqual(obs[1][0][0].read(), exp)
+
+        # The unfiltered output is still streamed and kept for the command
+        # whose output was filtered.
+        self.assertEqual(sorted(lines), ['1\n', '1%\n', '2\n', '2%\n',
+                                         '3\n', '3%\n', '4\n', '5\n',
+                                         'foo\n'])
+        self.assertEqual(list(unfiltered_logs), [0])
+        unfiltered_logs[0].seek(0, 0)
+        self.assertEqual(unfiltered_logs[0].read(),
+                         "Command:\n\n%s\n\nStdout:\n\n1%%\n2%%\n3%%\n\n"
+                         "Stderr:\n\n1\n2\n3\n4\n5\n\n" % cmd)
+
 
 if __name__ == "__main__":
     main()